@@ -1,179 +1,56 @@
 import typing
 import time
+import json
 import asyncio
 import threading
-import uuid
-import queue
-import traceback
-from concurrent.futures import ProcessPoolExecutor
+import concurrent.futures
 import ssl
 import websocket as ws
-import websockets.server
 import websockets
+import websockets.asyncio.server
 from jsonHelper import JsonCompatible,JsonLike,asJson,asJsonStr
 from machineIdentity import NetworkLocation
+from reliableDelivery import ReliableCaller,newRequestId
+from endpointDispatcher import EndpointDispatcher
 
 
-EndpointCallable=typing.Callable[...,JsonCompatible]
-
-
-class ApiHandler:
-    """
-    A handler that can manage and execute api endpoints.
-
-    This supports asynchronous calling with full
-    multithreading, multiprocessing, and asyncio
-
-    TODO: this needs to go away in favor of a FunctionCallManager
-    """
-    def __init__(self):
-        self._localEndpoints:typing.Dict[str,
-            typing.Tuple[EndpointCallable,bool]]={}
-        self._keepGoing=True
-        self._toBeProcessed=queue.Queue()
-        self._processPoolExecutor:typing.Optional[ProcessPoolExecutor]=None
-        self._processThread:typing.Optional[threading.Thread]=None
-
-    def start(self,restart:bool=False)->None:
-        """
-        Start the messaging system.
-        (Will automatically start.  No need to call this manually.)
-        """
-        if restart and self._processThread:
-            self.stop()
-        if self._processThread is not None:
-            self._processPoolExecutor=ProcessPoolExecutor()
-            self._keepGoing=True
-            self._processThread=threading.Thread(
-                target=self._processDataLoop,daemon=True)
-            self._processThread.start()
-
-    def __del__(self):
-        self.stop()
-
-    def stop(self):
-        """
-        Stop the message processing thread
-        """
-        while self._processThread is not None:
-            self._keepGoing=False
-            time.sleep(0.1)
-        if self._processPoolExecutor is not None:
-            self._processPoolExecutor.shutdown()
-            self._processPoolExecutor=None
-
-    def _processDataLoop(self):
-        """
-        Pulls requests out of the queue and processes them
-        """
-        while self._keepGoing:
-            try:
-                request=self._toBeProcessed.get(timeout=0.01)
-                endpoint=self._localEndpoints.get(
-                    request.get('endpoint',''))
-                if endpoint is None:
-                    if 'requestId' in request:
-                        endpoint.send({
-                            'responseId':request['requestId'],
-                            'status':404})
-                    continue
-                if endpoint[1]:
-                    # call callLocalEndpoint() as separate process
-                    def callback(future):
-                        response=future.result()
-                        asyncio.run_coroutine_threadsafe(
-                            self.socket.send(response),self.loop)
-                    future=self._processPoolExecutor.submit(
-                        self.callLocalEndpoint,endpoint[0],request)
-                    future.add_done_callback(callback)
-                    continue
-                # call callLocalEndpoint() as a separate thread
-                asyncio.run_coroutine_threadsafe(
-                    self.socket.send(
-                        self.callLocalEndpoint(endpoint[0],request)),
-                    self.loop)
-            except queue.Empty:
-                time.sleep(1.0)
-                continue
-            except Exception as e:
-                print("Processing error:",e)
-        self._processThread=None
-
-    def callLocalEndpoint(self,
-        endpointFn:EndpointCallable,
-        request:JsonLike
-        )->JsonLike:
-        """
-        This code will either be called in a separate thread
-        or a separate cpu process, depending on how the Endpoint
-        was registered.
-        """
-        try:
-            response=asJson(
-                endpointFn(
-                    *request.get('args',[]),
-                    **request.get('kwargs',{})))
-        except Exception as e:
-            response={
-                'status':500,
-                'exception':traceback.format_exception(e)}
-        if 'status' not in response:
-            response['status']=200
-        if 'responseId' not in response:
-            response['responseId']=request['requestId']
-        return response
-
-    def addLocalEndpoint(self,
-        endpoint:EndpointCallable,
-        name:typing.Optional[str]=None,
-        asProcess:bool=False)->None:
-        """
-        Add a new endpoint to the list.
-
-        :endpoint: the endpoint functionto call with requests
-        :name: if no name is specified, use the function name of the endpoint
-        :asProcess: this can be run as a separate process (as opposed to a
-            separate thread under the GIL lock)
-        """
-        if name is None:
-            name=endpoint.__name__
-        self._localEndpoints[name]=(endpoint,asProcess)
-
-    def removeLocalEndpoint(self,
-        endpoint:typing.Union[str,EndpointCallable]
-        )->None:
-        """
-        Remove an endpoint from the list
-        """
-        if isinstance(endpoint,str):
-            del self._localEndpoints[endpoint]
-            return
-        names=[]
-        if not isinstance(endpoint,str):
-            for name,bfn in self._localEndpoints:
-                if bfn[0]==endpoint:
-                    names.append(name)
-        for endpoint in names:
-            del self._localEndpoints[endpoint]
+# ApiHandler is the name ApiCommunication and existing callers know it by
+ApiHandler=EndpointDispatcher
 
 
 class ApiCommunication:
     """
     Bidirectional api connection to a remote device
 
-    This supports asynchronous communication with full
-    multithreading, multiprocessing, and asyncio
+    Remote calls are delivered at least once: each request keeps its
+    requestId across retries (with exponential backoff), and the
+    remote ApiHandler's ResponseCache makes sure a resent request is
+    not run twice.  A dropped connection fails everything waiting on
+    it, so those requests are resent on the new connection rather
+    than waiting forever.
+
+    Incoming requests go to the apiHandler (an EndpointDispatcher,
+    which can be shared by every connection), and are answered
+    on this connection.
 
     TODO: need this to work as a bidirectional peer
     (that is, client or server).
-    TODO: attach to a single common ApiHandler, or better
-    yet, FunctionCallManager, to handle all execution
     """
     def __init__(self,
         networkAddress:NetworkLocation,
-        apiHandler:ApiHandler,
-        useSecureConnection:bool=True):
-        """ """
+        apiHandler:typing.Optional[ApiHandler],
+        useSecureConnection:bool=True,
+        maxAttempts:int=5,
+        requestTimeout:float=30.0,
+        maxOutstanding:int=256):
+        """
+        :apiHandler: answers requests from the other end (None for a
+            connection that only makes calls, which answers 404)
+        :maxAttempts: how many times to send a request before giving up
+        :requestTimeout: how long to wait for each attempt, in seconds
+        :maxOutstanding: most requests to have in flight at once
+            (further callers wait, so a slow peer cannot use up memory)
+        """
         self.apiHandler=apiHandler
         self._useSecureConnection=useSecureConnection
         self._sslContext:typing.Optional[ssl.SSLContext]=None
@@ -188,7 +65,11 @@ class ApiCommunication:
             self._sslContext.verify_mode=ssl.CERT_REQUIRED
         self._networkAddress=networkAddress
         self._socket:typing.Optional[ws.WebSocket]=None
-        self._awaitingResponse={}
+        self._socketLock=threading.RLock()
+        self._awaitingResponse:typing.Dict[str,concurrent.futures.Future]={}
+        self._caller=ReliableCaller(self._sendRequest,
+            maxAttempts=maxAttempts,requestTimeout=requestTimeout,
+            maxOutstanding=maxOutstanding)
         self._keepGoing=True
         self.start()
 
@@ -197,69 +78,123 @@ class ApiCommunication:
         Start the messaging system.
         (Will automatically start.  No need to call this manually.)
         """
-        self.loop=asyncio.new_event_loop()
-        self._processPoolExecutor=ProcessPoolExecutor()
-        self.thread=threading.Thread(
-            target=self._startLoop,daemon=True)
-        self.thread.start()
+        self._keepGoing=True
         # Thread to receive and queue incoming messages
         self.recv_thread=threading.Thread(
-            target=self._startRecieveloop,daemon=True)
+            target=self._receiveLoop,daemon=True)
         self.recv_thread.start()
-        self.apiHandler.start()
 
     def stop(self):
         """
         Stop all communication and close the socket
         """
         self._keepGoing=False
-        socket=self._socket
-        if socket:
-            self._socket=None
-            asyncio.run_coroutine_threadsafe(socket.close(),self.loop)
+        self._connectionLost(ConnectionError('Connection closed'))
     close=stop
     disconnect=stop
     def __del__(self):
         self.stop()
 
-    def _startLoop(self):
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_until_complete(self.socket)
+    def _connectionLost(self,error:Exception)->None:
+        """
+        Drop the socket, and fail every request waiting on it
+        so that they can be resent
+        """
+        with self._socketLock:
+            socket=self._socket
+            self._socket=None
+            awaiting=list(self._awaitingResponse.values())
+        if socket is not None:
+            try:
+                socket.close()
+            except Exception: # pylint: disable=broad-except
+                pass
+        for future in awaiting:
+            if not future.done():
+                future.set_exception(ConnectionError(str(error)))
 
-    async def _socketReceiveLoop(self):
+    def _receiveLoop(self):
         """
         Queue up all incoming requests
         and notify original callers of all incoming responses.
         """
         while self._keepGoing:
-            message=await self.socket.recv()
-            data=asJson(message)
+            socket=self._socket
+            if socket is None:
+                time.sleep(0.05) # not connected yet
+                continue
+            try:
+                message=socket.recv()
+            except ws.WebSocketTimeoutException:
+                continue
+            except (ws.WebSocketException,OSError) as e:
+                self._connectionLost(e)
+                continue
+            if not message:
+                continue
+            try:
+                data=json.loads(message)
+            except ValueError:
+                continue # a garbled frame, so drop it
+            if not isinstance(data,dict):
+                continue
             if 'responseId' in data:
                 # This is a response to a previous request
-                future=self._awaitingResponse.pop(data['responseId'],None)
-                if future:
-                    future.set_result(data['payload'])
-            else:
+                future=self._awaitingResponse.get(data['responseId'])
+                if future is not None and not future.done():
+                    future.set_result(data)
+            elif self.apiHandler is not None:
                 # This is a new incoming request
-                self._toBeProcessed.put(data)
+                self.apiHandler.queueRequest(data,self)
+            elif 'requestId' in data:
+                try:
+                    self.sendMessage(
+                        {'responseId':data['requestId'],'status':404})
+                except ConnectionError:
+                    pass
 
-    def _startRecieveloop(self):
+    def sendMessage(self,message:JsonCompatible)->None:
+        """
+        Send a message without waiting for any response
+        """
+        data=asJsonStr(message)
+        with self._socketLock:
+            try:
+                self.socket.send(data)
+            except (ws.WebSocketException,OSError) as e:
+                self._connectionLost(e)
+                raise ConnectionError(str(e)) from e
+
+    def _sendRequest(self,
+        message:typing.Dict[str,JsonLike],
+        timeout:float
+        )->JsonLike:
         """
-        Start the asyncio loop that receives messages
+        Send a request once, and wait for its response
         """
-        asyncio.run(self._socketReceiveLoop())
+        requestId=message['requestId']
+        future:concurrent.futures.Future=concurrent.futures.Future()
+        self._awaitingResponse[requestId]=future
+        try:
+            self.sendMessage(message)
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError as e:
+            raise TimeoutError(
+                f'No response to {requestId} in {timeout}s') from e
+        finally:
+            self._awaitingResponse.pop(requestId,None)
 
     async def sendJsonMessage(self,message:JsonCompatible)->JsonLike:
         """
         Ask a Json question, get a Json answer.
         """
         message=asJson(message)
+        if not self._keepGoing:
+            raise ConnectionError(f'Connection to {self.url} is stopped')
         if 'requestId' not in message:
-            message['requestId']=str(uuid.uuid4())
-        future=self.loop.create_future()
-        self._awaitingResponse[message['requestId']]=future
-        await self.socket.send(asJsonStr(message))
-        return await future
+            message['requestId']=newRequestId()
+        return await asyncio.get_running_loop().run_in_executor(
+            None,self._caller.call,message)
 
     def callRemoteEndpoint(self,commandName:str,*args,**kwargs)->JsonLike:
         """
@@ -267,20 +202,49 @@ class ApiCommunication:
         {
             'endpoint':'',
             'args':[],
-            'kwargs':{}
+            'kwargs':{},
+            'requestId':''
         }
         Return a json response.
+
+        Retries until it gets an answer (see ApiCommunication).
+        Raises reliableDelivery.DeliveryFailed if it never does, or
+        ConnectionError right away if the connection has been stopped.
         """
+        if not self._keepGoing:
+            raise ConnectionError(f'Connection to {self.url} is stopped')
         msg={
             'endpoint':commandName,
             'args':asJson(args),
-            'kwargs':asJson(kwargs)
+            'kwargs':asJson(kwargs),
+            'requestId':newRequestId()
         }
-        self.socket.send(msg)
-        jsonStr=self.socket.recv()
-        return asJson(jsonStr)
+        return self._caller.call(msg)
     __call__=callRemoteEndpoint
 
+    def callRemoteEndpointOnce(self,
+        timeout:float,
+        commandName:str,
+        *args,**kwargs)->JsonLike:
+        """
+        Same as callRemoteEndpoint(), but only sends the request once
+        and waits at most timeout seconds for the answer.
+
+        For messages where a late answer is no use (eg, heartbeats,
+        or state that will soon be sent again anyway).
+
+        Raises ConnectionError or TimeoutError if there is no answer.
+        """
+        if not self._keepGoing:
+            raise ConnectionError(f'Connection to {self.url} is stopped')
+        msg={
+            'endpoint':commandName,
+            'args':asJson(args),
+            'kwargs':asJson(kwargs),
+            'requestId':newRequestId()
+        }
+        return self._sendRequest(msg,timeout)
+
     @property
     def url(self)->str:
         """
@@ -314,46 +278,178 @@ class ApiCommunication:
         Connect the socket.
 
         (Will be called automatically as needed)
+
+        Raises ConnectionError once stop() has been called, since
+        nothing would be receiving on a new socket.
+        """
+        with self._socketLock:
+            if not self._keepGoing:
+                raise ConnectionError(f'Connection to {self.url} is stopped')
+            if reconnect and self._socket is not None:
+                self._connectionLost(ConnectionError('Reconnecting'))
+            if self._socket is None:
+                try:
+                    if self._useSecureConnection:
+                        self._socket=ws.create_connection(self.url,1,
+                            sslopt={'context':self._sslContext})
+                    else:
+                        self._socket=ws.create_connection(self.url,1)
+                except (ws.WebSocketException,OSError) as e:
+                    raise ConnectionError(
+                        f'Unable to connect to {self.url}: {e}') from e
+
+
+class _ServerConnection:
+    """
+    The server end of a client's websocket, which requests
+    arrive on and responses go back out on
+    """
+    def __init__(self,
+        websocket:websockets.asyncio.server.ServerConnection,
+        loop:asyncio.AbstractEventLoop):
+        self.websocket=websocket
+        self.loop=loop
+
+    def sendMessage(self,message:JsonCompatible)->None:
         """
-        if reconnect or self._socket is None:
-            if self._useSecureConnection:
-                self._socket=ws.create_connection(self.url,1)
-            else:
-                self._socket=ws.create_connection(
-                    self.url,1,ssl=self._sslContext)
-            asyncio.ensure_future(self._socketReceiveLoop())
+        Send a message without waiting for any response
+
+        (Safe to call from any thread, including the server's own.)
+        """
+        data=asJsonStr(message)
+        sending=self.websocket.send(data)
+        try:
+            asyncio.run_coroutine_threadsafe(sending,self.loop)
+        except RuntimeError as e: # the server has stopped
+            sending.close()
+            raise ConnectionError(str(e)) from e
 
 
 class ApiServer:
     """
-    Set up a server to listen for connections
+    Listens for connections, and answers the requests from each
+    client with the apiHandler (on the client's own connection)
+
+    The server runs on a thread of its own.  Requests are handed to
+    the apiHandler from that thread, so an apiHandler with the 'block'
+    overload policy holds up every client while it waits for room.
 
     TODO: somehow need to spawn an ApiCommunication object
     for every authenticated client that connects.
     """
-    def __init__(self):
-        self._server:typing.Optional[websockets.server.ServerConnection]=None
+    def __init__(self,
+        apiHandler:ApiHandler,
+        host:str='localhost',
+        port:int=18765,
+        useSecureConnection:bool=True):
+        """
+        :port: the port to listen on (0 to pick any free port)
+        """
+        self.apiHandler=apiHandler
+        self.host=host
+        self._port=port
         self._sslContext:typing.Optional[ssl.SSLContext]=None
-        self._sslContext=ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        self._sslContext.load_cert_chain(
-            certfile="certs/server.crt",
-            keyfile="certs/server.key")
-        self._sslContext.load_verify_locations("certs/ca.crt")
-        # Require client certificate
-        self._sslContext.verify_mode=ssl.CERT_REQUIRED
+        if useSecureConnection:
+            self._sslContext=ssl.create_default_context(
+                ssl.Purpose.CLIENT_AUTH)
+            self._sslContext.load_cert_chain(
+                certfile="certs/server.crt",
+                keyfile="certs/server.key")
+            self._sslContext.load_verify_locations("certs/ca.crt")
+            # Require client certificate
+            self._sslContext.verify_mode=ssl.CERT_REQUIRED
+        self._server:typing.Optional[websockets.asyncio.server.Server]=None
+        self._loop:typing.Optional[asyncio.AbstractEventLoop]=None
+        self._thread:typing.Optional[threading.Thread]=None
+        self._ready=threading.Event()
 
-    def start(self):
+    @property
+    def port(self)->int:
+        """
+        The port being listened on
+        """
+        if self._server is not None:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    @property
+    def networkAddress(self)->NetworkLocation:
+        """
+        Where clients can connect to
+        """
+        return NetworkLocation(self.host,self.port)
+
+    def start(self)->None:
         """
-        Start the server
+        Start the server (returning once it is listening)
         """
-        async def handler(websocket,path):
-            # You can inspect the client's certificate here
-            peer_cert=websocket.transport.get_extra_info('peercert')
-            print(path,"Client cert:",peer_cert)
-        self._server=websockets.server.serve(
-            handler,"localhost",18765,ssl=self._sslContext)
-        asyncio.get_event_loop().run_until_complete(self._server)
-        asyncio.get_event_loop().run_forever()
+        if self._thread is not None:
+            return
+        self._ready.clear()
+        self._loop=asyncio.new_event_loop()
+        self._thread=threading.Thread(target=self._serve,daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._server is None:
+            self._thread.join()
+            self._thread=None
+            raise ConnectionError(
+                f'Unable to listen on {self.host}:{self._port}')
+
+    def stop(self)->None:
+        """
+        Stop the server, and disconnect every client
+        """
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread=None
 
-s=ApiServer()
-s.start()
\ No newline at end of file
+    def serveForever(self)->None:
+        """
+        Start the server, and keep serving until interrupted
+        """
+        self.start()
+        self._thread.join()
+
+    def _serve(self)->None:
+        """
+        Run the server on its own event loop
+        """
+        loop=self._loop
+        asyncio.set_event_loop(loop)
+        async def listen()->websockets.asyncio.server.Server:
+            return await websockets.asyncio.server.serve(self._handler,
+                self.host,self._port,ssl=self._sslContext)
+        try:
+            self._server=loop.run_until_complete(listen())
+        finally:
+            self._ready.set()
+        loop.run_forever()
+        self._server.close()
+        loop.run_until_complete(self._server.wait_closed())
+        self._server=None
+        loop.close()
+
+    async def _handler(self,
+        websocket:websockets.asyncio.server.ServerConnection
+        )->None:
+        """
+        Queue up every request that arrives from a client
+        """
+        connection=_ServerConnection(websocket,self._loop)
+        try:
+            async for message in websocket:
+                try:
+                    data=json.loads(message)
+                except ValueError:
+                    continue # a garbled frame, so drop it
+                if isinstance(data,dict) and 'responseId' not in data:
+                    self.apiHandler.queueRequest(data,connection)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+if __name__=='__main__':
+    ApiServer(ApiHandler()).serveForever()
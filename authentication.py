@@ -1,9 +1,17 @@
 """
 Authenticate that a machine is what it claims to be
 """
+import typing
+import time
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from machineIdentity import MachineIdentity
 
 
+Authenticator=typing.Callable[[MachineIdentity,str],bool]
+
+
 def authenticateMachine(
     machine:MachineIdentity,
     authenticationKey:str)->bool:
@@ -11,3 +19,137 @@ def authenticateMachine(
     Authenticate that a machine is what it claims to be
     """
     return True # TODO: later
+
+
+def authenticateMachines(
+    requests:typing.Iterable[typing.Tuple[MachineIdentity,str]],
+    authenticate:Authenticator=authenticateMachine,
+    maxWorkers:int=8
+    )->typing.List[bool]:
+    """
+    Authenticate many machines at once, eg when everything
+    reconnects after a network blip.
+
+    Duplicate requests are only verified once, and the rest
+    are verified in parallel.
+
+    :return: whether each machine authenticated, in the same order
+    """
+    requests=list(requests)
+    unique:typing.Dict[typing.Tuple[str,str],
+        typing.Tuple[MachineIdentity,str]]={}
+    for machine,authenticationKey in requests:
+        unique.setdefault((machine.fingerprint,authenticationKey),
+            (machine,authenticationKey))
+    if len(unique)<=1:
+        results={k:authenticate(*v) for k,v in unique.items()}
+    else:
+        with ThreadPoolExecutor(min(maxWorkers,len(unique))) as executor:
+            futures={k:executor.submit(authenticate,*v)
+                for k,v in unique.items()}
+            results={k:f.result() for k,f in futures.items()}
+    return [results[(machine.fingerprint,authenticationKey)]
+        for machine,authenticationKey in requests]
+
+
+class AuthenticatedSessions:
+    """
+    Remembers which machines have already authenticated on which
+    connections, so that authentication happens once when a connection
+    is set up rather than on every request.
+
+    Sessions expire after a while, and go away with their connection.
+    """
+    def __init__(self,
+        ttl:float=3600.0,
+        authenticate:Authenticator=authenticateMachine):
+        """
+        :ttl: how long before a machine must authenticate again, in seconds
+        :authenticate: how to authenticate a machine
+        """
+        self.ttl=ttl
+        self.authenticate=authenticate
+        self._sessions:weakref.WeakKeyDictionary=weakref.WeakKeyDictionary()
+        self._lock=threading.Lock()
+
+    def isAuthenticated(self,
+        connection:typing.Any,
+        machine:MachineIdentity
+        )->bool:
+        """
+        Determine if a machine has a current session on a connection
+        (does not try to authenticate)
+        """
+        with self._lock:
+            expires=self._sessions.get(connection,{}).get(machine.fingerprint)
+        return expires is not None and expires>time.monotonic()
+
+    def _addSession(self,connection:typing.Any,fingerprint:str)->None:
+        with self._lock:
+            sessions=self._sessions.get(connection)
+            if sessions is None:
+                sessions={}
+                self._sessions[connection]=sessions
+            sessions[fingerprint]=time.monotonic()+self.ttl
+
+    def authenticateSession(self,
+        connection:typing.Any,
+        machine:MachineIdentity,
+        authenticationKey:str
+        )->bool:
+        """
+        Authenticate a machine on a connection, unless it
+        already has a current session there
+        """
+        if self.isAuthenticated(connection,machine):
+            return True
+        if not self.authenticate(machine,authenticationKey):
+            return False
+        self._addSession(connection,machine.fingerprint)
+        return True
+
+    def authenticateSessions(self,
+        requests:typing.Iterable[
+            typing.Tuple[typing.Any,MachineIdentity,str]],
+        maxWorkers:int=8
+        )->typing.List[bool]:
+        """
+        Authenticate many (connection,machine,authenticationKey)
+        at once, verifying only the ones without a current session
+        """
+        requests=list(requests)
+        results=[self.isAuthenticated(connection,machine)
+            for connection,machine,_ in requests]
+        todo=[i for i,ok in enumerate(results) if not ok]
+        verified=authenticateMachines(
+            [(requests[i][1],requests[i][2]) for i in todo],
+            self.authenticate,maxWorkers)
+        for i,ok in zip(todo,verified):
+            if ok:
+                self._addSession(requests[i][0],requests[i][1].fingerprint)
+            results[i]=ok
+        return results
+
+    def invalidate(self,
+        connection:typing.Any=None,
+        machine:typing.Optional[MachineIdentity]=None
+        )->None:
+        """
+        Forget sessions, eg when a machine is unpaired
+
+        :connection: only sessions on this connection
+        :machine: only sessions for this machine
+        """
+        with self._lock:
+            if connection is not None:
+                connections=[connection]
+            else:
+                connections=list(self._sessions.keys())
+            for conn in connections:
+                sessions=self._sessions.get(conn)
+                if sessions is None:
+                    continue
+                if machine is None:
+                    del self._sessions[conn]
+                else:
+                    sessions.pop(machine.fingerprint,None)
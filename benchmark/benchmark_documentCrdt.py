@@ -0,0 +1,106 @@
+"""
+Benchmark of CRDT document merge throughput, merging thousands of
+concurrent operations from another machine at once versus one at a time.
+"""
+import typing
+import random
+import timeit
+from ConfederatedApp.documentReference import DocumentReference,Operation
+from ConfederatedApp.documentCrdt import CrdtDocument
+
+
+def report(name:str,seconds:float,numOps:int)->None:
+    """
+    Print a single benchmark result
+    """
+    print(f'  {name:<44}{seconds:.4f}s  {numOps/seconds:>10.0f} ops/s')
+
+
+def makeEdits(
+    replica:str,
+    numOps:int,
+    seed:int
+    )->typing.Tuple[CrdtDocument,typing.List[Operation]]:
+    """
+    Make a replica with a shared starting point, then do numOps
+    random edits (mostly typing) to it
+    """
+    doc=CrdtDocument(DocumentReference('doc',replica))
+    base=CrdtDocument(DocumentReference('doc','base'))
+    base.root.setText('body').insert(0,'x'*100)
+    base.root.setList('items').append(*range(100))
+    doc.document.merge(base.document.log.operations())
+    rand=random.Random(seed)
+    body=doc.root['body']
+    items=doc.root['items']
+    cursor=50
+    for _ in range(numOps):
+        action=rand.random()
+        if action<0.7:
+            body.insert(cursor,rand.choice('abcdefg '))
+            cursor+=1
+        elif action<0.8:
+            if cursor>0:
+                cursor-=1
+                body.delete(cursor)
+        elif action<0.9:
+            items.insert(rand.randint(0,len(items)),rand.randint(0,99))
+        else:
+            doc.root[f'key{rand.randint(0,20)}']=rand.randint(0,99)
+        if rand.random()<0.02:
+            cursor=rand.randint(0,len(body))
+    return doc,doc.document.log.operations()
+
+
+def benchmark(numOps:int=5000)->None:
+    """
+    Run the benchmark and print the results
+    """
+    print(f'{numOps} concurrent operations from each of two machines')
+    start=timeit.default_timer()
+    a,_=makeEdits('a',numOps,1)
+    report('make local edits',timeit.default_timer()-start,numOps)
+    _,opsB=makeEdits('b',numOps,2)
+    remote=[op for op in opsB if op.replica=='b']
+
+    def batched():
+        doc=CrdtDocument(DocumentReference('doc','c'))
+        doc.document.merge(a.document.log.operations())
+        doc.document.merge(remote)
+        return doc
+    def oneAtATime():
+        doc=CrdtDocument(DocumentReference('doc','c'))
+        doc.document.merge(a.document.log.operations())
+        for op in remote:
+            doc.document.merge([op])
+        return doc
+    def shuffled():
+        doc=CrdtDocument(DocumentReference('doc','c'))
+        doc.document.merge(a.document.log.operations())
+        ops=list(remote)
+        random.Random(3).shuffle(ops)
+        doc.document.merge(ops)
+        return doc
+    baseline=timeit.timeit(lambda:CrdtDocument(DocumentReference(
+        'doc','c')).document.merge(a.document.log.operations()),number=1)
+    report('merge, one batch',timeit.timeit(batched,number=1)-baseline,numOps)
+    report('merge, one operation at a time',
+        timeit.timeit(oneAtATime,number=1)-baseline,numOps)
+    report('merge, one batch arriving out of order',
+        timeit.timeit(shuffled,number=1)-baseline,numOps)
+
+    merged=batched()
+    objects=merged._objects.values() # pylint: disable=protected-access
+    before=sum(len(getattr(c,'_elements',())) for c in objects)
+    start=timeit.default_timer()
+    collected=merged.compact({
+        'a':merged.document.versionVector,
+        'b':merged.document.versionVector,
+        'base':merged.document.versionVector})
+    seconds=timeit.default_timer()-start
+    print(f'  compact: {collected} of {before} list elements were'
+        f' tombstones, collected in {seconds:.4f}s')
+
+
+if __name__=='__main__':
+    benchmark()
@@ -0,0 +1,78 @@
+"""
+Benchmark end-to-end api calls from an ApiCommunication to an
+ApiServer over a loopback websocket, for each way an endpoint can run.
+"""
+import time
+import threading
+from ConfederatedApp.functionCallManager import FunctionCallManager
+from ConfederatedApp.endpointDispatcher import EndpointDispatcher
+from ConfederatedApp.apiCommunication import ApiCommunication,ApiServer
+
+
+def add(a:int,b:int)->dict:
+    """
+    The endpoint being called
+    """
+    return {'sum':a+b}
+
+
+async def addAsync(a:int,b:int)->dict:
+    """
+    The endpoint being called, as a coroutine
+    """
+    return {'sum':a+b}
+
+
+def timeCalls(
+    client:ApiCommunication,
+    endpoint:str,
+    numCalls:int,
+    numCallers:int
+    )->float:
+    """
+    Time calls made by a number of callers at once
+
+    :return: calls per second
+    """
+    def caller(count:int)->None:
+        for i in range(count):
+            response=client.callRemoteEndpoint(endpoint,i,1)
+            assert response['sum']==i+1
+    threads=[threading.Thread(target=caller,args=(numCalls//numCallers,))
+        for _ in range(numCallers)]
+    start=time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (numCalls//numCallers)*numCallers/(time.perf_counter()-start)
+
+
+def benchmark(numCalls:int=5000)->None:
+    """
+    Run the benchmark and print the results
+    """
+    manager=FunctionCallManager()
+    dispatcher=EndpointDispatcher(manager)
+    dispatcher.addLocalEndpoint(add,'thread')
+    dispatcher.addLocalEndpoint(add,'process',asProcess=True)
+    dispatcher.addLocalEndpoint(addAsync,'async')
+    server=ApiServer(dispatcher,'127.0.0.1',0,useSecureConnection=False)
+    server.start()
+    client=ApiCommunication(server.networkAddress,dispatcher,
+        useSecureConnection=False)
+    try:
+        print(f'{numCalls} calls over a loopback websocket')
+        for endpoint in ('thread','process','async'):
+            for numCallers in (1,32):
+                rate=timeCalls(client,endpoint,numCalls,numCallers)
+                print(f'  {endpoint:<8}{numCallers:>3} at a time'
+                    f'{rate:>10.0f} calls/s')
+    finally:
+        client.stop()
+        server.stop()
+        manager.stop()
+
+
+if __name__=="__main__":
+    benchmark()
@@ -0,0 +1,54 @@
+"""
+Benchmark MachineDisoveryManager.refresh() against a fake
+zeroconf/upnp responder with a simulated network round trip.
+"""
+import sys
+import time
+from pathlib import Path
+from ConfederatedApp.machineIdentity import NetworkLocation
+from ConfederatedApp.machineDiscovery import MachineDisoveryManager
+sys.path.insert(0,str(Path(__file__).parent.parent/'test'))
+# pylint: disable=wrong-import-position
+from fakeDiscovery import FakeDiscoveryResponder # noqa: E402
+# pylint: enable=wrong-import-position
+
+
+def timeRefresh(
+    numMachines:int,
+    roundTripTime:float,
+    maxConcurrentQueries:int,
+    useAsyncio:bool
+    )->float:
+    """
+    Time a single refresh that discovers every machine
+    """
+    responder=FakeDiscoveryResponder(numMachines,roundTripTime)
+    query=responder.queryIdentityAsync if useAsyncio \
+        else responder.queryIdentity
+    manager=MachineDisoveryManager('benchmark',
+        NetworkLocation('localhost',18765),
+        discoverySources=[responder],identityQuery=query,
+        maxConcurrentQueries=maxConcurrentQueries)
+    start=time.time()
+    manager.refresh()
+    elapsed=time.time()-start
+    assert len(manager.machines)==numMachines
+    return elapsed
+
+
+def benchmark(numMachines:int=100,roundTripTime:float=0.05)->None:
+    """
+    Run the benchmark and print the results
+    """
+    print(f'{numMachines} machines, {roundTripTime*1000:.0f}ms round trip')
+    for maxConcurrentQueries in (1,16,64):
+        for useAsyncio in (False,True):
+            kind='asyncio' if useAsyncio else 'blocking'
+            elapsed=timeRefresh(numMachines,roundTripTime,
+                maxConcurrentQueries,useAsyncio)
+            print(f'  {maxConcurrentQueries:>3} at a time,'
+                f' {kind:<8} query {elapsed:.3f}s')
+
+
+if __name__=="__main__":
+    benchmark()
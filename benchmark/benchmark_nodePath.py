@@ -0,0 +1,109 @@
+"""
+Microbenchmark of repeated NodePath queries, comparing
+cached compilation against compiling every time.
+"""
+import typing
+import timeit
+from ConfederatedApp.nodePath import (
+    NodePath,NodePathIndex,NodePathSet,compileNodePath)
+
+
+class BenchNode:
+    """
+    A simple tree node to search upon
+    """
+    def __init__(self,name:str,parent:typing.Optional["BenchNode"]=None):
+        self.name=name
+        self.parent=parent
+        self.root=self if parent is None else parent.root
+        self.children:typing.Dict[str,BenchNode]={}
+        if parent is not None:
+            parent.children[name]=self
+
+
+def buildTree(depth:int=4,breadth:int=8)->BenchNode:
+    """
+    Build a uniform tree of breadth**depth leaves
+    """
+    root=BenchNode('root')
+    level=[root]
+    for d in range(depth):
+        nextLevel=[]
+        for node in level:
+            for i in range(breadth):
+                nextLevel.append(BenchNode(f'n{d}_{i}.dat',node))
+        level=nextLevel
+    return root
+
+
+def report(name:str,seconds:float)->None:
+    """
+    Print a single benchmark result
+    """
+    print(f'  {name:<44}{seconds:.4f}s')
+
+
+def benchmark(numQueries:int=20000)->None:
+    """
+    Run the benchmark and print the results
+    """
+    root=buildTree()
+    paths=[
+        'n0_1.dat/n1_2.dat/n2_3.dat/n3_4.dat',
+        '/n0_1.dat/n1_2.dat/*/n3_4.dat',
+        'n0_*/n1_2.dat/n2_3.dat/n3_[0-3].dat',
+        'n0_1.dat/n1_2.dat/n2_3.dat/../n2_4.dat/n3_0.dat']
+    def cached():
+        for i in range(numQueries):
+            list(NodePath(paths[i%len(paths)]).search(root))
+    def uncached():
+        for i in range(numQueries):
+            compileNodePath.cache_clear()
+            list(NodePath(paths[i%len(paths)]).search(root))
+    def constructOnly():
+        for i in range(numQueries):
+            NodePath(paths[i%len(paths)])
+    def constructUncached():
+        for i in range(numQueries):
+            compileNodePath.cache_clear()
+            NodePath(paths[i%len(paths)])
+    print(f'{numQueries} repeated path queries')
+    report('construct, compile every time',
+        timeit.timeit(constructUncached,number=1))
+    report('construct, cached compile',timeit.timeit(constructOnly,number=1))
+    report('query, compile every time',timeit.timeit(uncached,number=1))
+    report('query, cached compile',timeit.timeit(cached,number=1))
+    report('**/n3_7.dat over 4096 leaves (x10)',timeit.timeit(
+        lambda:list(NodePath('**/n3_7.dat').search(root)),number=10))
+
+    # each (node,step) is only visited once, so extra "**" steps
+    # should cost roughly linearly rather than exponentially
+    for numDoubleStars in range(1,5):
+        steps=['**',*(f'n{d}_*/**' for d in range(numDoubleStars-1))]
+        path='/'.join([*steps,'n3_7.dat'])
+        report(f'{path} (x10)',timeit.timeit(
+            lambda p=path:list(NodePath(p).search(root)),number=10))
+    index=NodePathIndex(root)
+    report('**/n3_7.dat with NodePathIndex (x10)',timeit.timeit(
+        lambda:list(NodePath('**/n3_7.dat').search(root)),number=10))
+    report('literal path with NodePathIndex',timeit.timeit(cached,number=1))
+    index.detach()
+    patterns=[f'**/n{d}_{i}.dat' for d in range(4) for i in range(8)]
+    patterns+=[f'n0_{i}.dat/*/n2_{i}.dat/*' for i in range(8)]
+    patterns+=[f'*/n1_{i}.dat/**/n3_[0-{i}].dat' for i in range(8)]
+    paths=[NodePath(p) for p in patterns]
+    pathSet=NodePathSet(patterns)
+    report(f'{len(patterns)} patterns one at a time',timeit.timeit(
+        lambda:[list(p.search(root)) for p in paths],number=1))
+    report(f'{len(patterns)} patterns as a NodePathSet',timeit.timeit(
+        lambda:list(pathSet.match(root)),number=1))
+    chain=BenchNode('chain')
+    node=chain
+    for i in range(50000):
+        node=BenchNode(f'link{i}',node)
+    report('**/link49999 on a 50000 deep chain',timeit.timeit(
+        lambda:list(NodePath('**/link49999').search(chain)),number=1))
+
+
+if __name__=="__main__":
+    benchmark()
@@ -0,0 +1,36 @@
+"""
+Benchmark parallel NodePath search against the serial search
+on a large tree.
+"""
+import timeit
+from ConfederatedApp import FunctionCallManager
+from ConfederatedApp.nodePath import NodePath
+from benchmark_nodePath import buildTree,report
+
+
+def benchmark(numThreads:int=4)->None:
+    """
+    Run the benchmark and print the results
+    """
+    root=buildTree(depth=4,breadth=22) # ~246k nodes
+    manager=FunctionCallManager(num_threads=numThreads,num_processes=0)
+    try:
+        for path in ('**/n3_7.dat','*/*/n2_[0-9].dat/*'):
+            np=NodePath(path)
+            print(f'{path} ({numThreads} threads)')
+            report('serial',timeit.timeit(
+                lambda n=np:list(n.search(root)),number=1))
+            report('parallel',timeit.timeit(
+                lambda n=np:list(n.getNodesParallel(root,manager)),number=1))
+            report('serial, first 10',timeit.timeit(
+                lambda n=np:[x for _,x in zip(range(10),n.search(root))],
+                number=1))
+            report('parallel, first 10',timeit.timeit(
+                lambda n=np:list(n.getNodesParallel(root,manager,limit=10)),
+                number=1))
+    finally:
+        manager.stop()
+
+
+if __name__=="__main__":
+    benchmark()
@@ -0,0 +1,66 @@
+"""
+Benchmark hit-testing and overlap queries of the WindowSpatialIndex
+against a linear scan of 10k windows.
+"""
+import random
+import timeit
+from ConfederatedApp.windowSpatialIndex import (
+    WindowSpatialIndex,rectContains,rectsIntersect)
+
+
+def report(name:str,seconds:float)->None:
+    """
+    Print a single benchmark result
+    """
+    print(f'  {name:<28}{seconds:.4f}s')
+
+
+def benchmark(numWindows:int=10000,numQueries:int=1000)->None:
+    """
+    Run the benchmark and print the results
+    """
+    rand=random.Random(1234)
+    rects={}
+    for i in range(numWindows):
+        rects[f'window{i}']=(
+            rand.randint(0,20000),rand.randint(0,20000),
+            rand.randint(50,800),rand.randint(50,600))
+    index=WindowSpatialIndex()
+    buildTime=timeit.timeit(
+        lambda:[index.insert(k,v) for k,v in rects.items()],number=1)
+    points=[(rand.randint(0,20000),rand.randint(0,20000))
+        for _ in range(numQueries)]
+    queryRects=[p+(300,300) for p in points]
+
+    def linearAt():
+        for x,y in points:
+            [k for k,r in rects.items() if rectContains(r,x,y)]
+    def indexAt():
+        for x,y in points:
+            index.windowsAt(x,y)
+    def linearIntersecting():
+        for q in queryRects:
+            [k for k,r in rects.items() if rectsIntersect(r,q)]
+    def indexIntersecting():
+        for q in queryRects:
+            index.windowsIntersecting(q)
+    def indexMove():
+        for i,(x,y) in enumerate(points):
+            r=rects[f'window{i}']
+            index.update(f'window{i}',(x,y,r[2],r[3]))
+
+    print(f'{numWindows} windows, {numQueries} queries each')
+    report('build index',buildTime)
+    report('windowsAt linear',timeit.timeit(linearAt,number=1))
+    report('windowsAt index',timeit.timeit(indexAt,number=1))
+    report('windowsIntersecting linear',
+        timeit.timeit(linearIntersecting,number=1))
+    report('windowsIntersecting index',
+        timeit.timeit(indexIntersecting,number=1))
+    report('move (incremental update)',timeit.timeit(indexMove,number=1))
+    report('findFreeSpace',timeit.timeit(
+        lambda:index.findFreeSpace((400,300),(0,0,21000,21000)),number=1))
+
+
+if __name__=="__main__":
+    benchmark()
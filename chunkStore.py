@@ -0,0 +1,360 @@
+"""
+Content-addressed storage of document data, split into chunks
+at content-defined boundaries, so that a copy of a document on
+another machine can be brought up to date by sending only the
+chunks it does not already have.
+
+Chunk boundaries are chosen with a rolling (gear) hash over the data
+itself rather than at fixed offsets, so an insert or delete only
+changes the chunks around it, and everything after it still lines
+up.  Chunks are named by their sha256, so identical chunks are only
+stored once, even across different documents.
+"""
+import typing
+import os
+import base64
+import hashlib
+import random
+import threading
+from pathlib import Path
+from machineIdentity import MachineIdentity
+from connectionTypes import ConnectionLookup
+from jsonHelper import JsonBase,JsonLike,asJson
+
+
+MANIFEST_ENDPOINT='getDocumentManifest'
+CHUNKS_ENDPOINT='getChunks'
+ChunkHash=str
+
+
+def _makeGearTable()->typing.List[int]:
+    # fixed seed, since every machine must cut in the same places
+    rand=random.Random(0x5eed)
+    return [rand.getrandbits(64) for _ in range(256)]
+_GEAR=_makeGearTable()
+_MASK64=(1<<64)-1
+
+
+def chunkBoundaries(
+    data:bytes,
+    minSize:int=2048,
+    avgSize:int=8192,
+    maxSize:int=65536
+    )->typing.List[int]:
+    """
+    Find content-defined chunk boundaries (FastCDC style)
+
+    :avgSize: target average chunk size (a power of 2)
+    :return: the end offset of each chunk
+    """
+    bits=max(avgSize.bit_length()-1,1)
+    # harder to cut before the average size, easier after,
+    # which keeps chunk sizes closer to the average
+    maskSmall=((1<<(bits+1))-1)<<(64-bits-1)
+    maskLarge=((1<<(bits-1))-1)<<(64-bits+1)
+    gear=_GEAR
+    mask64=_MASK64
+    ends=[]
+    start=0
+    length=len(data)
+    while start<length:
+        end=min(start+maxSize,length)
+        if end-start<=minSize:
+            ends.append(end)
+            break
+        normal=min(start+avgSize,end)
+        h=0
+        i=start+minSize # no need to hash what we will not cut in
+        cut=end
+        while i<normal:
+            h=((h<<1)+gear[data[i]])&mask64
+            i+=1
+            if not h&maskSmall:
+                cut=i
+                break
+        else:
+            while i<end:
+                h=((h<<1)+gear[data[i]])&mask64
+                i+=1
+                if not h&maskLarge:
+                    cut=i
+                    break
+        ends.append(cut)
+        start=cut
+    return ends
+
+
+def chunkHash(data:bytes)->ChunkHash:
+    """
+    The name of a chunk
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class Manifest(JsonBase):
+    """
+    The list of chunks that make up a piece of data
+    """
+    def __init__(self,
+        chunks:typing.Optional[typing.List[typing.Tuple[ChunkHash,int]]]=None,
+        jsonObj:typing.Optional[JsonLike]=None):
+        """
+        :chunks: (hash,size) of each chunk, in order
+        """
+        self.chunks:typing.List[typing.Tuple[ChunkHash,int]]=list(chunks or ())
+        if jsonObj is not None:
+            self.jsonObj=asJson(jsonObj)
+
+    @property
+    def size(self)->int:
+        """
+        Total size of the data
+        """
+        return sum(size for _,size in self.chunks)
+
+    @property
+    def hash(self)->ChunkHash:
+        """
+        A hash of the whole thing, for quickly checking if two are equal
+        """
+        return chunkHash(''.join(h for h,_ in self.chunks).encode('ascii'))
+
+    @property
+    def jsonObj(self)->JsonLike:
+        """
+        get/set this as a json object
+        """
+        return {'chunks':[[h,size] for h,size in self.chunks]}
+    @jsonObj.setter
+    def jsonObj(self,jsonObj:JsonLike):
+        """
+        get/set this as a json object
+        """
+        self.chunks=[(str(h),int(size)) for h,size in jsonObj.get('chunks',[])]
+
+
+class ChunkStore:
+    """
+    Content-addressed chunks on disk, each one stored only once
+    """
+    def __init__(self,
+        directory:typing.Union[str,Path],
+        minSize:int=2048,
+        avgSize:int=8192,
+        maxSize:int=65536):
+        """
+        :directory: where to keep chunks
+        (the sizes are passed to chunkBoundaries, and must be
+        the same on every machine for chunks to be shared)
+        """
+        self.directory=Path(directory)
+        self.minSize=minSize
+        self.avgSize=avgSize
+        self.maxSize=maxSize
+        self._known:typing.Set[ChunkHash]=set()
+        self._lock=threading.Lock()
+        self.directory.mkdir(parents=True,exist_ok=True)
+        for subdir in self.directory.iterdir():
+            if subdir.is_dir():
+                self._known.update(subdir.name+f.name
+                    for f in subdir.iterdir() if not f.name.endswith('.tmp'))
+
+    def __len__(self)->int:
+        return len(self._known)
+
+    def __contains__(self,chunk:ChunkHash)->bool:
+        return chunk in self._known
+
+    def _path(self,chunk:ChunkHash)->Path:
+        return self.directory/chunk[:2]/chunk[2:]
+
+    def put(self,data:bytes,chunk:typing.Optional[ChunkHash]=None)->ChunkHash:
+        """
+        Store a chunk (if it is not stored already)
+
+        :chunk: the expected hash, which is checked
+        :return: the hash of the chunk
+        """
+        actual=chunkHash(data)
+        if chunk is not None and chunk!=actual:
+            raise ValueError(f'Chunk does not match its hash {chunk}')
+        with self._lock:
+            if actual in self._known:
+                return actual
+        path=self._path(actual)
+        path.parent.mkdir(exist_ok=True)
+        tempPath=path.with_name(path.name+f'.{threading.get_ident()}.tmp')
+        tempPath.write_bytes(data)
+        os.replace(tempPath,path) # so a crash never leaves a partial chunk
+        with self._lock:
+            self._known.add(actual)
+        return actual
+
+    def get(self,chunk:ChunkHash)->bytes:
+        """
+        Get a chunk
+        """
+        if chunk not in self._known:
+            raise KeyError(chunk)
+        return self._path(chunk).read_bytes()
+
+    def missing(self,
+        chunks:typing.Iterable[ChunkHash]
+        )->typing.List[ChunkHash]:
+        """
+        Which of the given chunks are not stored here (without duplicates)
+        """
+        ret:typing.List[ChunkHash]=[]
+        seen:typing.Set[ChunkHash]=set()
+        for chunk in chunks:
+            if chunk not in self._known and chunk not in seen:
+                seen.add(chunk)
+                ret.append(chunk)
+        return ret
+
+    def putData(self,data:bytes)->Manifest:
+        """
+        Split data into chunks and store them
+        """
+        chunks=[]
+        start=0
+        for end in chunkBoundaries(data,
+            self.minSize,self.avgSize,self.maxSize):
+            piece=data[start:end]
+            chunks.append((self.put(piece),len(piece)))
+            start=end
+        return Manifest(chunks)
+
+    def getData(self,manifest:Manifest)->bytes:
+        """
+        Put the data back together from its chunks
+        """
+        return b''.join(self.get(chunk) for chunk,_ in manifest.chunks)
+
+    def collect(self,keep:typing.Iterable[Manifest])->int:
+        """
+        Delete every chunk not used by any of the given manifests
+
+        :return: how many chunks were deleted
+        """
+        used={chunk for manifest in keep for chunk,_ in manifest.chunks}
+        with self._lock:
+            unused=self._known-used
+            self._known&=used
+        for chunk in unused:
+            try:
+                self._path(chunk).unlink()
+            except FileNotFoundError:
+                pass
+        return len(unused)
+
+
+class DocumentChunkSync:
+    """
+    Keeps document contents in a ChunkStore, and fetches
+    only the chunks that are missing from other machines.
+
+    Register the functions from endpoints() with the local api
+    so that other machines can fetch from this one.
+    """
+    def __init__(self,
+        store:ChunkStore,
+        getConnection:ConnectionLookup,
+        maxBytesPerRequest:int=1<<20):
+        """
+        :getConnection: get the ApiCommunication for a machine
+        :maxBytesPerRequest: how much chunk data to ask for at once
+        """
+        self.store=store
+        self.getConnection=getConnection
+        self.maxBytesPerRequest=maxBytesPerRequest
+        self.manifests:typing.Dict[str,Manifest]={}
+        self.bytesFetched=0
+
+    def publish(self,documentId:str,data:bytes)->Manifest:
+        """
+        Store the current contents of a document
+        """
+        manifest=self.store.putData(data)
+        self.manifests[documentId]=manifest
+        return manifest
+
+    def read(self,documentId:str)->bytes:
+        """
+        Get the current contents of a document
+        """
+        return self.store.getData(self.manifests[documentId])
+
+    def endpoints(self)->typing.Dict[str,typing.Callable[...,JsonLike]]:
+        """
+        The api endpoints to register, by name
+        """
+        return {
+            MANIFEST_ENDPOINT:self.manifestEndpoint,
+            CHUNKS_ENDPOINT:self.chunksEndpoint}
+
+    def manifestEndpoint(self,documentId:str)->JsonLike:
+        """
+        Another machine asks what chunks make up a document
+        """
+        manifest=self.manifests.get(documentId)
+        if manifest is None:
+            return {'status':404}
+        return {'manifest':manifest.jsonObj}
+
+    def chunksEndpoint(self,chunks:typing.List[ChunkHash])->JsonLike:
+        """
+        Another machine asks for chunks
+        """
+        return {'chunks':{
+            chunk:base64.b64encode(self.store.get(chunk)).decode('ascii')
+            for chunk in chunks if chunk in self.store}}
+
+    def _call(self,machine:MachineIdentity,endpoint:str,*args)->JsonLike:
+        response=self.getConnection(machine).callRemoteEndpoint(endpoint,*args)
+        if not isinstance(response,dict) or response.get('status',200)!=200:
+            raise ConnectionError(
+                f'{endpoint} failed on {machine}: {response}')
+        return response
+
+    def fetch(self,
+        machine:MachineIdentity,
+        documentId:str
+        )->bytes:
+        """
+        Bring our copy of a document up to date with another machine's,
+        fetching only the chunks we do not already have
+
+        :return: the document contents
+        """
+        manifest=Manifest(jsonObj=self._call(
+            machine,MANIFEST_ENDPOINT,documentId)['manifest'])
+        current=self.manifests.get(documentId)
+        if current is None or current.hash!=manifest.hash:
+            sizes=dict(manifest.chunks)
+            batch:typing.List[ChunkHash]=[]
+            batchBytes=0
+            for chunk in self.store.missing(sizes):
+                batch.append(chunk)
+                batchBytes+=sizes[chunk]
+                if batchBytes>=self.maxBytesPerRequest:
+                    self._fetchChunks(machine,batch)
+                    batch=[]
+                    batchBytes=0
+            if batch:
+                self._fetchChunks(machine,batch)
+            self.manifests[documentId]=manifest
+        return self.store.getData(manifest)
+
+    def _fetchChunks(self,
+        machine:MachineIdentity,
+        chunks:typing.List[ChunkHash]
+        )->None:
+        response=self._call(machine,CHUNKS_ENDPOINT,chunks)
+        received=response.get('chunks',{})
+        for chunk in chunks:
+            if chunk not in received:
+                raise KeyError(f'{machine} does not have chunk {chunk}')
+            data=base64.b64decode(received[chunk])
+            self.store.put(data,chunk)
+            self.bytesFetched+=len(data)
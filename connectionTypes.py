@@ -0,0 +1,14 @@
+"""
+Types shared by everything that talks to other machines
+
+This only imports what the types need, so that using them does not
+pull in discovery, websockets, and the dispatcher.
+"""
+import typing
+from machineIdentity import MachineIdentity
+if typing.TYPE_CHECKING:
+    from apiCommunication import ApiCommunication
+
+
+# get the ApiCommunication for a machine
+ConnectionLookup=typing.Callable[[MachineIdentity],'ApiCommunication']
@@ -0,0 +1,744 @@
+"""
+A conflict-free replicated data type (CRDT) document model
+on top of a DocumentReference.
+
+A document is a tree of maps, lists and text.  Every machine applies
+its own edits immediately, without asking anyone, and since each edit
+is recorded as an Operation in the DocumentReference log, the
+DocumentReplicator gets it to the other machines, who all end up with
+the same document no matter what order things arrived in.
+
+    * maps are last-writer-wins per key, by Lamport clock
+    * lists and text are a Replicated Growable Array (RGA)
+        where each element is placed after the element it was
+        inserted behind, with concurrent inserts ordered by id
+
+Once every machine has seen an operation, compact() forgets deletes
+that can no longer matter and truncates the log, keeping a snapshot
+of the document's state in place of the operations it dropped.
+"""
+import typing
+from documentReference import (
+    DocumentReference,Operation,ReplicaId,VersionVector)
+from jsonHelper import JsonLike
+
+
+ROOT='root'
+ObjectId=str
+ElementId=typing.Tuple[int,ReplicaId,int,int] # lamport,replica,seq,offset
+Timestamp=typing.Tuple[int,ReplicaId] # lamport,replica
+OperationId=typing.Tuple[ReplicaId,int] # replica,seq
+ChangedCallback=typing.Callable[["CrdtDocument"],None]
+
+
+def _elementId(jsonValue:typing.Sequence[typing.Any])->ElementId:
+    return (int(jsonValue[0]),str(jsonValue[1]),
+        int(jsonValue[2]),int(jsonValue[3]))
+
+
+def _isStable(opId:typing.Optional[OperationId],stable:VersionVector)->bool:
+    return opId is not None and stable.get(opId[0],0)>=opId[1]
+
+
+def _opId(jsonValue:typing.Optional[typing.Sequence[typing.Any]]
+    )->typing.Optional[OperationId]:
+    if jsonValue is None:
+        return None
+    return (str(jsonValue[0]),int(jsonValue[1]))
+
+
+def _saveValue(value:typing.Any)->JsonLike:
+    if isinstance(value,_Ref):
+        return {'ref':value.objectId}
+    return {'value':value}
+
+
+def _loadValue(jsonObj:JsonLike)->typing.Any:
+    if 'ref' in jsonObj:
+        return _Ref(jsonObj['ref'])
+    return jsonObj.get('value')
+
+
+class _Ref:
+    """
+    A value that is another container in the document
+    """
+    __slots__=('objectId',)
+
+    def __init__(self,objectId:ObjectId):
+        self.objectId=objectId
+
+
+class _Element:
+    """
+    A single element of a list or text
+    """
+    __slots__=('id','value','deleted','next')
+
+    def __init__(self,elementId:typing.Optional[ElementId],value:typing.Any):
+        self.id=elementId
+        self.value=value
+        self.deleted:typing.Optional[OperationId]=None
+        self.next:typing.Optional[_Element]=None
+
+
+class CrdtMap:
+    """
+    Last-writer-wins map
+    """
+    kind='map'
+
+    def __init__(self,objectId:ObjectId):
+        self.objectId=objectId
+        # key:(timestamp,value,id of the delete if it is deleted)
+        self._entries:typing.Dict[str,typing.Tuple[
+            Timestamp,typing.Any,typing.Optional[OperationId]]]={}
+
+    def set(self,
+        key:str,
+        timestamp:Timestamp,
+        value:typing.Any,
+        deleted:typing.Optional[OperationId]=None
+        )->None:
+        """
+        Set (or delete) a key, if this is the latest write to it
+        """
+        current=self._entries.get(key)
+        if current is None or timestamp>current[0]:
+            self._entries[key]=(timestamp,value,deleted)
+
+    def items(self)->typing.Iterable[typing.Tuple[str,typing.Any]]:
+        """
+        All keys that are not deleted, and their values
+        """
+        for key,(_,value,deleted) in self._entries.items():
+            if deleted is None:
+                yield key,value
+
+    def get(self,key:str,default:typing.Any=None)->typing.Any:
+        """
+        Get the value of a key
+        """
+        entry=self._entries.get(key)
+        if entry is None or entry[2] is not None:
+            return default
+        return entry[1]
+
+    def compact(self,stable:VersionVector)->int:
+        """
+        Forget deletes that every machine has seen
+
+        :return: how many were forgotten
+        """
+        collected=[key for key,(_,_,deleted) in self._entries.items()
+            if _isStable(deleted,stable)]
+        for key in collected:
+            del self._entries[key]
+        return len(collected)
+
+    @property
+    def state(self)->JsonLike:
+        """
+        get/set everything needed to carry on merging, as json
+        """
+        return [[key,list(timestamp),_saveValue(value),
+                None if deleted is None else list(deleted)]
+            for key,(timestamp,value,deleted) in self._entries.items()]
+    @state.setter
+    def state(self,state:JsonLike):
+        self._entries={key:((int(timestamp[0]),str(timestamp[1])),
+                _loadValue(value),_opId(deleted))
+            for key,timestamp,value,deleted in state}
+
+
+class CrdtList:
+    """
+    Replicated Growable Array
+    """
+    kind='list'
+
+    def __init__(self,objectId:ObjectId):
+        self.objectId=objectId
+        self._head=_Element(None,None)
+        self._elements:typing.Dict[ElementId,_Element]={}
+        self._length=0
+
+    def __len__(self)->int:
+        return self._length
+
+    def __contains__(self,elementId:ElementId)->bool:
+        return elementId in self._elements
+
+    def insert(self,
+        after:typing.Optional[ElementId],
+        elementIds:typing.Sequence[ElementId],
+        values:typing.Sequence[typing.Any]
+        )->None:
+        """
+        Insert a run of elements after the given element
+        (or at the start, if None)
+        """
+        prev=self._head if after is None else self._elements[after]
+        # skip concurrent inserts at the same spot that have a
+        # greater id (along with everything inserted after them)
+        first=elementIds[0]
+        nxt=prev.next
+        while nxt is not None and nxt.id>first:
+            prev=nxt
+            nxt=nxt.next
+        for elementId,value in zip(elementIds,values):
+            element=_Element(elementId,value)
+            element.next=prev.next
+            prev.next=element
+            self._elements[elementId]=element
+            prev=element
+        self._length+=len(elementIds)
+
+    def remove(self,elementId:ElementId,deleted:OperationId)->None:
+        """
+        Mark an element as deleted (it stays as a tombstone
+        until compact() so that later inserts can find it)
+        """
+        element=self._elements.get(elementId)
+        if element is not None and element.deleted is None:
+            element.deleted=deleted
+            self._length-=1
+
+    def elements(self)->typing.Iterable[_Element]:
+        """
+        All elements that are not deleted, in order
+        """
+        element=self._head.next
+        while element is not None:
+            if element.deleted is None:
+                yield element
+            element=element.next
+
+    def elementAt(self,index:int)->_Element:
+        """
+        Get the element at a visible index
+        """
+        if index<0:
+            index+=self._length
+        if 0<=index<self._length:
+            for i,element in enumerate(self.elements()):
+                if i==index:
+                    return element
+        raise IndexError(index)
+
+    def compact(self,stable:VersionVector)->int:
+        """
+        Forget deleted elements that every machine has seen deleted
+
+        :return: how many were forgotten
+        """
+        collected=0
+        prev=self._head
+        element=prev.next
+        while element is not None:
+            if _isStable(element.deleted,stable):
+                prev.next=element.next
+                del self._elements[element.id]
+                collected+=1
+            else:
+                prev=element
+            element=element.next
+        return collected
+
+    @property
+    def state(self)->JsonLike:
+        """
+        get/set everything needed to carry on merging, as json
+        (including deleted elements that are not compacted yet)
+        """
+        ret=[]
+        element=self._head.next
+        while element is not None:
+            ret.append([list(element.id),_saveValue(element.value),
+                None if element.deleted is None else list(element.deleted)])
+            element=element.next
+        return ret
+    @state.setter
+    def state(self,state:JsonLike):
+        self._head=_Element(None,None)
+        self._elements={}
+        self._length=0
+        prev=self._head
+        for elementId,value,deleted in state:
+            element=_Element(_elementId(elementId),_loadValue(value))
+            element.deleted=_opId(deleted)
+            prev.next=element
+            prev=element
+            self._elements[element.id]=element
+            if element.deleted is None:
+                self._length+=1
+
+
+class CrdtText(CrdtList):
+    """
+    Replicated Growable Array of characters
+    """
+    kind='text'
+
+
+_CONTAINERS:typing.Dict[str,typing.Type[typing.Any]]={
+    c.kind:c for c in (CrdtMap,CrdtList,CrdtText)}
+Container=typing.Union[CrdtMap,CrdtList,CrdtText]
+
+
+class CrdtDocument:
+    """
+    A conflict-free replicated document of maps, lists and text,
+    kept in a DocumentReference.
+
+    Change it through the handles starting from root, eg:
+        doc.root['title']='Hello'
+        doc.root.setText('body').insert(0,'Once upon a time')
+    """
+    def __init__(self,
+        document:DocumentReference,
+        onChangedCallbacks:typing.Optional[
+            typing.Iterable[ChangedCallback]]=None):
+        """
+        :onChangedCallbacks: called once after each batch of
+            operations is applied, whether local or remote
+        """
+        self.document=document
+        self.onChangedCallbacks:typing.List[ChangedCallback]=\
+            list(onChangedCallbacks or ())
+        self._objects:typing.Dict[ObjectId,Container]={ROOT:CrdtMap(ROOT)}
+        # operations waiting on an object or element that has not arrived
+        self._pending:typing.Dict[typing.Any,typing.List[Operation]]={}
+        self._pendingIds:typing.Set[OperationId]=set()
+        # every operation applied (or waiting to be)
+        self._versionVector:VersionVector={}
+        document.onOperationsCallbacks.append(self._operationsArrived)
+        contents=document.log.contents()
+        if contents.state is not None:
+            self.state=contents.state
+        existing=[op for op in contents.operations
+            if not _isStable(op.id,self._versionVector)]
+        if existing:
+            self.applyOperations(existing)
+
+    @property
+    def root(self)->'MapHandle':
+        """
+        The top level map of the document
+        """
+        return MapHandle(self,ROOT)
+
+    @property
+    def value(self)->JsonLike:
+        """
+        The whole document as plain json
+        """
+        return self._valueOf(self._objects[ROOT])
+
+    @property
+    def pendingCount(self)->int:
+        """
+        How many operations are waiting on ones that have not arrived
+        """
+        return len(self._pendingIds)
+
+    @property
+    def versionVector(self)->VersionVector:
+        """
+        Which operations the document state includes
+        """
+        return dict(self._versionVector)
+
+    @property
+    def state(self)->JsonLike:
+        """
+        get/set the whole internal state of the document as json,
+        including everything needed to merge later operations
+        """
+        pending=[op for ops in self._pending.values() for op in ops]
+        pending.sort(key=lambda op:op.order)
+        return {
+            'versionVector':dict(self._versionVector),
+            'objects':{objectId:[container.kind,container.state]
+                for objectId,container in self._objects.items()},
+            'pending':[op.jsonObj for op in pending]
+        }
+    @state.setter
+    def state(self,state:JsonLike):
+        self._objects={}
+        for objectId,(kind,containerState) in state['objects'].items():
+            container=_CONTAINERS[kind](objectId)
+            container.state=containerState
+            self._objects[objectId]=container
+        self._pending={}
+        self._pendingIds=set()
+        self._versionVector=dict(state.get('versionVector',{}))
+        for jsonObj in state.get('pending',[]):
+            self._apply(Operation(jsonObj=jsonObj))
+
+    def _valueOf(self,value:typing.Any)->JsonLike:
+        if isinstance(value,_Ref):
+            value=self._objects[value.objectId]
+        if isinstance(value,CrdtMap):
+            return {k:self._valueOf(v) for k,v in value.items()}
+        if isinstance(value,CrdtText):
+            return ''.join(e.value for e in value.elements())
+        if isinstance(value,CrdtList):
+            return [self._valueOf(e.value) for e in value.elements()]
+        return value
+
+    def _wrap(self,value:typing.Any)->typing.Any:
+        """
+        Turn a container reference into a handle
+        """
+        if isinstance(value,_Ref):
+            container=self._objects[value.objectId]
+            return _HANDLES[container.kind](self,value.objectId)
+        return value
+
+    def _edit(self,payload:JsonLike)->Operation:
+        """
+        Make a local edit (it is applied by _operationsArrived)
+        """
+        return self.document.edit(payload)
+
+    def _operationsArrived(self,
+        document:DocumentReference,
+        operations:typing.List[Operation]
+        )->None:
+        del document
+        self.applyOperations(operations)
+
+    def applyOperations(self,operations:typing.Iterable[Operation])->None:
+        """
+        Apply a batch of operations, in causal order as far as possible,
+        then call the changed callbacks once
+        """
+        for op in sorted(operations,key=lambda op:op.order):
+            if op.seq<=self._versionVector.get(op.replica,0):
+                continue # already applied
+            self._versionVector[op.replica]=op.seq
+            self._apply(op)
+        for fn in self.onChangedCallbacks:
+            fn(self)
+
+    def _apply(self,op:Operation)->None:
+        """
+        Apply a single operation, along with any that were waiting on it
+        """
+        work=[op]
+        while work:
+            op=work.pop()
+            missing=self._missing(op)
+            if missing is not None:
+                self._pending.setdefault(missing,[]).append(op)
+                self._pendingIds.add(op.id)
+                continue
+            self._pendingIds.discard(op.id)
+            created=self._integrate(op)
+            if self._pending:
+                for createdId in created:
+                    waiting=self._pending.pop(createdId,None)
+                    if waiting:
+                        work.extend(waiting)
+
+    def _missing(self,op:Operation)->typing.Any:
+        """
+        Get what an operation is waiting on, if anything
+        """
+        payload=op.payload
+        container=self._objects.get(payload['obj'])
+        if container is None:
+            return payload['obj']
+        kind=payload['t']
+        if kind=='ins':
+            ref=payload.get('ref')
+            if ref is not None:
+                ref=_elementId(ref)
+                if ref not in container:
+                    return ref
+        elif kind=='rem':
+            for elementId in payload['elems']:
+                elementId=_elementId(elementId)
+                if elementId not in container \
+                    and not self._wasCollected(elementId):
+                    return elementId
+        return None
+
+    def _wasCollected(self,elementId:ElementId)->bool:
+        """
+        An element we do not have, but whose insert we have applied,
+        must have been deleted and compacted away
+        """
+        opId=(elementId[1],elementId[2])
+        return self.document.log.has(*opId) and opId not in self._pendingIds
+
+    def _newContainer(self,op:Operation,kind:str)->ObjectId:
+        objectId=f'{op.replica}:{op.seq}'
+        self._objects[objectId]=_CONTAINERS[kind](objectId)
+        return objectId
+
+    def _integrate(self,op:Operation)->typing.List[typing.Any]:
+        """
+        Apply an operation whose dependencies are all present
+
+        :return: ids of the objects and elements it created
+        """
+        payload=op.payload
+        container=self._objects[payload['obj']]
+        kind=payload['t']
+        created:typing.List[typing.Any]=[]
+        if kind=='set':
+            make=payload.get('make')
+            if make is not None:
+                value:typing.Any=_Ref(self._newContainer(op,make))
+                created.append(value.objectId)
+            else:
+                value=payload.get('value')
+            container.set(payload['key'],op.order,value)
+        elif kind=='del':
+            container.set(payload['key'],op.order,None,op.id)
+        elif kind=='ins':
+            ref=payload.get('ref')
+            make=payload.get('make')
+            if make is not None:
+                values=[_Ref(self._newContainer(op,make))]
+                created.append(values[0].objectId)
+            elif 'text' in payload:
+                values=payload['text']
+            else:
+                values=payload['values']
+            if values:
+                elementIds=[(op.lamport,op.replica,op.seq,i)
+                    for i in range(len(values))]
+                container.insert(
+                    None if ref is None else _elementId(ref),
+                    elementIds,values)
+                created.extend(elementIds)
+        elif kind=='rem':
+            for elementId in payload['elems']:
+                container.remove(_elementId(elementId),op.id)
+        return created
+
+    def compact(self,
+        peerVersionVectors:typing.Dict[ReplicaId,VersionVector]
+        )->int:
+        """
+        Forget deletes (tombstones) that can no longer matter, and
+        operations every machine has, to keep memory bounded.
+
+        A delete can be forgotten once every machine has seen it, and
+        we have every operation any machine made before seeing it.
+        The operations every machine has are dropped from the log,
+        which keeps a snapshot of the state instead.  (A machine that
+        is not in peerVersionVectors and is behind that snapshot can
+        no longer be caught up from the log.)
+
+        :peerVersionVectors: the latest version vector of this
+            document from every other machine that edits it
+            (see DocumentReplicator.peerVersionVectors)
+        :return: how many tombstones were forgotten
+        """
+        ours=self.document.versionVector
+        for peer in peerVersionVectors.values():
+            for replica,seq in peer.items():
+                if ours.get(replica,0)<seq:
+                    return 0 # a peer knows of operations we have not got
+        stable=dict(ours)
+        for peer in peerVersionVectors.values():
+            for replica in list(stable):
+                stable[replica]=min(stable[replica],peer.get(replica,0))
+        collected=sum(container.compact(stable)
+            for container in self._objects.values())
+        state=self.state
+        self.document.log.truncate(stable,state,state['versionVector'])
+        return collected
+
+
+# handles are part of the document, so they use its internals
+# pylint: disable=protected-access
+class MapHandle:
+    """
+    Read and edit a map within a CrdtDocument
+    """
+    def __init__(self,document:CrdtDocument,objectId:ObjectId):
+        self.document=document
+        self.objectId=objectId
+
+    @property
+    def _map(self)->CrdtMap:
+        return self.document._objects[self.objectId]
+
+    def __getitem__(self,key:str)->typing.Any:
+        value=self._map.get(key,KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return self.document._wrap(value)
+
+    def get(self,key:str,default:typing.Any=None)->typing.Any:
+        """
+        Get a value (or a handle to a container)
+        """
+        return self.document._wrap(self._map.get(key,default))
+
+    def __contains__(self,key:str)->bool:
+        return self._map.get(key,KeyError) is not KeyError
+
+    def keys(self)->typing.List[str]:
+        """
+        All keys in the map
+        """
+        return [k for k,_ in self._map.items()]
+
+    def __len__(self)->int:
+        return len(self.keys())
+
+    def __setitem__(self,key:str,value:JsonLike)->None:
+        self.document._edit({'t':'set','obj':self.objectId,
+            'key':key,'value':value})
+
+    def __delitem__(self,key:str)->None:
+        self.document._edit({'t':'del','obj':self.objectId,'key':key})
+
+    def _make(self,key:str,kind:str)->typing.Any:
+        op=self.document._edit({'t':'set','obj':self.objectId,
+            'key':key,'make':kind})
+        return _HANDLES[kind](self.document,f'{op.replica}:{op.seq}')
+
+    def setMap(self,key:str)->'MapHandle':
+        """
+        Set a key to a new, empty map
+        """
+        return self._make(key,'map')
+
+    def setList(self,key:str)->'ListHandle':
+        """
+        Set a key to a new, empty list
+        """
+        return self._make(key,'list')
+
+    def setText(self,key:str)->'TextHandle':
+        """
+        Set a key to a new, empty text
+        """
+        return self._make(key,'text')
+
+    @property
+    def value(self)->JsonLike:
+        """
+        This map as plain json
+        """
+        return self.document._valueOf(self._map)
+
+
+class ListHandle:
+    """
+    Read and edit a list within a CrdtDocument
+    """
+    def __init__(self,document:CrdtDocument,objectId:ObjectId):
+        self.document=document
+        self.objectId=objectId
+
+    @property
+    def _list(self)->CrdtList:
+        return self.document._objects[self.objectId]
+
+    def __len__(self)->int:
+        return len(self._list)
+
+    def __getitem__(self,index:int)->typing.Any:
+        return self.document._wrap(self._list.elementAt(index).value)
+
+    def _refFor(self,index:int)->typing.Optional[ElementId]:
+        """
+        Get the element to insert after, to insert at an index
+        """
+        if index<0:
+            index+=len(self._list)
+        if index==0:
+            return None
+        return self._list.elementAt(index-1).id
+
+    def insert(self,index:int,*values:JsonLike)->None:
+        """
+        Insert values at an index
+        """
+        self.document._edit({'t':'ins','obj':self.objectId,
+            'ref':self._refFor(index),'values':list(values)})
+
+    def append(self,*values:JsonLike)->None:
+        """
+        Add values to the end
+        """
+        self.insert(len(self._list),*values)
+
+    def _insertNew(self,index:int,kind:str)->typing.Any:
+        op=self.document._edit({'t':'ins','obj':self.objectId,
+            'ref':self._refFor(index),'make':kind})
+        return _HANDLES[kind](self.document,f'{op.replica}:{op.seq}')
+
+    def insertMap(self,index:int)->MapHandle:
+        """
+        Insert a new, empty map at an index
+        """
+        return self._insertNew(index,'map')
+
+    def insertList(self,index:int)->'ListHandle':
+        """
+        Insert a new, empty list at an index
+        """
+        return self._insertNew(index,'list')
+
+    def insertText(self,index:int)->'TextHandle':
+        """
+        Insert a new, empty text at an index
+        """
+        return self._insertNew(index,'text')
+
+    def delete(self,index:int,count:int=1)->None:
+        """
+        Delete count values starting at an index
+        """
+        if index<0:
+            index+=len(self._list)
+        elementIds=[]
+        for i,element in enumerate(self._list.elements()):
+            if i>=index+count:
+                break
+            if i>=index:
+                elementIds.append(list(element.id))
+        if len(elementIds)<count:
+            raise IndexError(index+count-1)
+        if elementIds:
+            self.document._edit({'t':'rem','obj':self.objectId,
+                'elems':elementIds})
+
+    @property
+    def value(self)->JsonLike:
+        """
+        This list as plain json
+        """
+        return self.document._valueOf(self._list)
+
+
+class TextHandle(ListHandle):
+    """
+    Read and edit text within a CrdtDocument
+    """
+
+    def insert(self,index:int,*values:str)->None:
+        """
+        Insert text at an index
+        """
+        text=''.join(values)
+        if text:
+            self.document._edit({'t':'ins','obj':self.objectId,
+                'ref':self._refFor(index),'text':text})
+
+    def __str__(self)->str:
+        return self.value
+
+
+# pylint: enable=protected-access
+_HANDLES:typing.Dict[str,typing.Type[typing.Any]]={
+    'map':MapHandle,'list':ListHandle,'text':TextHandle}
@@ -1,14 +1,370 @@
 """
 A single open document can be referenced across multiple
 windows on multiple screens on multiple computers.
+
+Each machine keeps an append-only log of the operations (edits)
+made to a document.  Every operation is stamped with the replica
+(machine) that made it, a per-replica sequence number, and a Lamport
+clock.  A version vector (replica:highest sequence number seen) then
+says exactly which operations a machine has, so two machines can
+swap only the operations the other is missing.
+
+Once every machine has an operation, the log no longer needs to keep
+it, so the document model can replace the operations everyone has
+with a snapshot of the document's state (see OperationLog.truncate).
 """
+import typing
+import threading
+from jsonHelper import JsonBase,JsonLike,asJson
+
+
+ReplicaId=str # generally the MachineIdentity.fingerprint
+VersionVector=typing.Dict[ReplicaId,int]
+OperationCallback=typing.Callable[["DocumentReference","Operation"],None]
+OperationsCallback=typing.Callable[
+    ["DocumentReference",typing.List["Operation"]],None]
+
+
+class Operation(JsonBase):
+    """
+    A single edit to a document
+    """
+    __slots__=('replica','seq','lamport','payload')
+
+    def __init__(self,
+        replica:ReplicaId='',
+        seq:int=0,
+        lamport:int=0,
+        payload:JsonLike=None,
+        jsonObj:typing.Optional[JsonLike]=None):
+        """
+        :replica: which replica made the edit
+        :seq: sequence number of the edit on that replica (from 1)
+        :lamport: Lamport clock when the edit was made
+        :payload: what the edit actually is
+        """
+        self.replica=replica
+        self.seq=seq
+        self.lamport=lamport
+        self.payload=payload
+        if jsonObj is not None:
+            self.jsonObj=asJson(jsonObj)
+
+    @property
+    def id(self)->typing.Tuple[ReplicaId,int]:
+        """
+        Unique id of this operation
+        """
+        return (self.replica,self.seq)
+
+    @property
+    def order(self)->typing.Tuple[int,ReplicaId]:
+        """
+        Sort key giving the same total order on every machine
+        """
+        return (self.lamport,self.replica)
+
+    @property
+    def jsonObj(self)->JsonLike:
+        """
+        get/set this as a json object
+        """
+        return {
+            'replica':self.replica,
+            'seq':self.seq,
+            'lamport':self.lamport,
+            'payload':self.payload
+        }
+    @jsonObj.setter
+    def jsonObj(self,jsonObj:JsonLike):
+        """
+        get/set this as a json object
+        """
+        self.replica=jsonObj.get('replica','')
+        self.seq=int(jsonObj.get('seq',0))
+        self.lamport=int(jsonObj.get('lamport',0))
+        self.payload=jsonObj.get('payload')
+
+    def __repr__(self):
+        return f'Operation({self.replica}:{self.seq}@{self.lamport})'
+
+
+class LogContents(typing.NamedTuple):
+    """
+    A consistent copy of everything in an OperationLog
+    """
+    state:JsonLike # the snapshot of the document (None if there is none)
+    stateVector:VersionVector # which operations the snapshot covers
+    operations:typing.List[Operation] # those still kept, in total order
+    lamport:int
+
+
+class OperationLog:
+    """
+    Append-only log of every operation made to a document,
+    from every replica.
+
+    Operations from each replica are kept in sequence order, so the
+    operations another machine is missing are just the tail of each
+    replica's list past its version vector.
+
+    Operations every machine has can be dropped from the front of
+    each list with truncate(), which keeps a snapshot of the state
+    of the document in their place.
+    """
+    def __init__(self,replica:ReplicaId):
+        """
+        :replica: the id of this machine
+        """
+        self.replica=replica
+        self.lamport=0
+        self._ops:typing.Dict[ReplicaId,typing.List[Operation]]={}
+        # how many operations have been dropped from the front of each list
+        self._base:typing.Dict[ReplicaId,int]={}
+        self._state:JsonLike=None
+        self._stateVector:VersionVector={}
+        # operations that arrived before the ones they follow
+        self._pending:typing.Dict[ReplicaId,typing.Dict[int,Operation]]={}
+        self._lock=threading.RLock()
+
+    def __len__(self)->int:
+        """
+        How many operations are kept (not counting truncated ones)
+        """
+        return sum(len(ops) for ops in self._ops.values())
+
+    def _length(self,replica:ReplicaId)->int:
+        """
+        How many operations from a replica are in the log,
+        including truncated ones
+        """
+        return self._base.get(replica,0)+len(self._ops.get(replica,()))
+
+    @property
+    def versionVector(self)->VersionVector:
+        """
+        The highest sequence number seen from each replica
+        (with no gaps before it)
+        """
+        with self._lock:
+            return {replica:self._length(replica) for replica in self._ops}
+
+    def has(self,replica:ReplicaId,seq:int)->bool:
+        """
+        Determine if an operation is in the log
+        (or was, before it was truncated)
+        """
+        return seq<=self._length(replica)
+
+    def append(self,payload:JsonLike)->Operation:
+        """
+        Record a new local edit
+        """
+        with self._lock:
+            seq=self._length(self.replica)+1
+            self.lamport+=1
+            op=Operation(self.replica,seq,self.lamport,payload)
+            self._ops.setdefault(self.replica,[]).append(op)
+            return op
+
+    def merge(self,
+        operations:typing.Iterable[Operation]
+        )->typing.List[Operation]:
+        """
+        Merge operations from another machine.
+
+        Duplicates are ignored, and operations that arrive ahead of
+        ones they follow are held until the gap is filled.
+
+        :return: the operations that were new, in the
+            order they were added to the log
+        """
+        added:typing.List[Operation]=[]
+        with self._lock:
+            for op in operations:
+                ops=self._ops.setdefault(op.replica,[])
+                have=self._length(op.replica)
+                if op.seq<=have:
+                    continue # already have it
+                if op.seq>have+1:
+                    self._pending.setdefault(op.replica,{})[op.seq]=op
+                    continue
+                self._add(ops,op,added)
+                pending=self._pending.get(op.replica)
+                while pending:
+                    nextOp=pending.pop(self._length(op.replica)+1,None)
+                    if nextOp is None:
+                        break
+                    self._add(ops,nextOp,added)
+                if pending is not None and not pending:
+                    del self._pending[op.replica]
+        return added
+
+    def _add(self,
+        ops:typing.List[Operation],
+        op:Operation,
+        added:typing.List[Operation]
+        )->None:
+        ops.append(op)
+        self.lamport=max(self.lamport,op.lamport)
+        added.append(op)
+
+    def missingFor(self,
+        versionVector:VersionVector
+        )->typing.List[Operation]:
+        """
+        Get all operations that a machine with the given
+        version vector does not have yet
+
+        (Truncated operations can not be sent, but every machine
+        that truncate() was told about already has them.)
+        """
+        ret:typing.List[Operation]=[]
+        with self._lock:
+            for replica,ops in self._ops.items():
+                have=versionVector.get(replica,0)-self._base.get(replica,0)
+                if have<len(ops):
+                    ret.extend(ops[max(have,0):])
+        return ret
+
+    def operations(self)->typing.List[Operation]:
+        """
+        All operations still kept, in the same total order on every machine
+        """
+        with self._lock:
+            ret=[op for ops in self._ops.values() for op in ops]
+        ret.sort(key=lambda op:op.order)
+        return ret
+
+    def truncate(self,
+        below:VersionVector,
+        state:JsonLike,
+        stateVector:VersionVector
+        )->int:
+        """
+        Drop the operations every machine has, keeping a snapshot
+        of the document in their place
+
+        :below: the operations every machine has
+        :state: the state of the document (with whatever
+            the document model needs to carry on from it)
+        :stateVector: which operations the state covers
+            (only operations in both this and below are dropped)
+        :return: how many operations were dropped
+        """
+        dropped=0
+        with self._lock:
+            for replica,ops in self._ops.items():
+                base=self._base.get(replica,0)
+                upTo=min(below.get(replica,0),stateVector.get(replica,0))
+                count=min(max(upTo-base,0),len(ops))
+                if count:
+                    del ops[:count]
+                    self._base[replica]=base+count
+                    dropped+=count
+            self._state=state
+            self._stateVector=dict(stateVector)
+        return dropped
+
+    def contents(self)->LogContents:
+        """
+        A consistent copy of everything in the log
+        (eg, to rebuild the document, or to save it)
+        """
+        with self._lock:
+            return LogContents(self._state,dict(self._stateVector),
+                self.operations(),self.lamport)
+
+    def restore(self,contents:LogContents)->typing.List[Operation]:
+        """
+        Load what contents() returned into an empty log
+        (eg, after a restart)
+
+        :return: the operations that were new
+        """
+        with self._lock:
+            if self._ops:
+                raise ValueError('Can only restore into an empty log')
+            self._state=contents.state
+            self._stateVector=dict(contents.stateVector)
+            self.lamport=max(self.lamport,contents.lamport)
+            first:typing.Dict[ReplicaId,int]={}
+            for op in contents.operations:
+                first[op.replica]=min(first.get(op.replica,op.seq),op.seq)
+            for replica,seq in contents.stateVector.items():
+                self._ops[replica]=[]
+                self._base[replica]=first.get(replica,seq+1)-1
+            return self.merge(contents.operations)
 
 
 class DocumentReference:
     """
     A single open document can be referenced across multiple
     windows on multiple screens on multiple computers.
+
+    Edits are recorded in an OperationLog, which a DocumentReplicator
+    keeps in step with the other machines.
     """
-    # TODO: synchromization will be a problem all its own, so
-    # for now the decision is to just leave it stubbed-out
-    # and focus on the application managment portion.
+    def __init__(self,
+        documentId:str,
+        replica:ReplicaId,
+        onOperationCallbacks:typing.Optional[
+            typing.Iterable[OperationCallback]]=None):
+        """
+        :documentId: the same on every machine
+        :replica: the id of this machine
+        :onOperationCallbacks: called with each new operation,
+            whether it was made here or arrived from elsewhere
+        """
+        self.documentId=documentId
+        self.log=OperationLog(replica)
+        self.onOperationCallbacks:typing.List[OperationCallback]=\
+            list(onOperationCallbacks or ())
+        self.onLocalOperationCallbacks:typing.List[OperationCallback]=[]
+        # like onOperationCallbacks, but once for each batch merged
+        self.onOperationsCallbacks:typing.List[OperationsCallback]=[]
+
+    @property
+    def versionVector(self)->VersionVector:
+        """
+        Which operations this machine has
+        """
+        return self.log.versionVector
+
+    def edit(self,payload:JsonLike)->Operation:
+        """
+        Make an edit on this machine
+        """
+        op=self.log.append(payload)
+        for fn in self.onOperationCallbacks:
+            fn(self,op)
+        for fn in self.onOperationsCallbacks:
+            fn(self,[op])
+        for fn in self.onLocalOperationCallbacks:
+            fn(self,op)
+        return op
+
+    def merge(self,
+        operations:typing.Iterable[Operation]
+        )->typing.List[Operation]:
+        """
+        Merge operations that arrived from another machine
+
+        :return: the operations that were new
+        """
+        added=self.log.merge(operations)
+        for op in added:
+            for fn in self.onOperationCallbacks:
+                fn(self,op)
+        if added:
+            for fn in self.onOperationsCallbacks:
+                fn(self,added)
+        return added
+
+    def missingFor(self,
+        versionVector:VersionVector
+        )->typing.List[Operation]:
+        """
+        Get all operations that another machine does not have yet
+        """
+        return self.log.missingFor(versionVector)
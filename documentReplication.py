@@ -0,0 +1,268 @@
+"""
+Keep the operation logs of open documents in step across machines.
+
+New local edits are batched and pushed to every peer.  Since a push
+can be lost (eg, a peer was offline), every so often each peer is also
+sent our version vectors in an anti-entropy round, and it answers with
+exactly the operations we are missing and its own version vectors, so
+we can send back whatever it is missing.  The cost of a sync is
+proportional to the number of edits, not the size of the document.
+"""
+import typing
+import time
+import threading
+from machineIdentity import MachineIdentity
+from documentReference import (
+    DocumentReference,Operation,ReplicaId,VersionVector)
+from connectionTypes import ConnectionLookup
+from jsonHelper import JsonLike
+
+
+SYNC_ENDPOINT='syncDocuments'
+PUSH_ENDPOINT='pushOperations'
+PeerLookup=typing.Callable[[],typing.Iterable[MachineIdentity]]
+
+
+class DocumentReplicator:
+    """
+    Keep the operation logs of open documents in step across machines.
+
+    Register the functions from endpoints() with the local api
+    so that other machines can sync with this one.
+    """
+    def __init__(self,
+        replica:ReplicaId,
+        getConnection:ConnectionLookup,
+        getPeers:PeerLookup,
+        pushInterval:float=0.05,
+        antiEntropyInterval:float=5.0):
+        """
+        :replica: the id of this machine
+        :getConnection: get the ApiCommunication for a machine
+        :getPeers: get the machines to replicate with, eg
+            lambda:discoveryManager.machines.values()
+        :pushInterval: how long to batch up local edits
+            before pushing them, in seconds
+        :antiEntropyInterval: how often to do a full
+            catch-up with every peer, in seconds
+        """
+        self.replica=replica
+        self.getConnection=getConnection
+        self.getPeers=getPeers
+        self.pushInterval=pushInterval
+        self.antiEntropyInterval=antiEntropyInterval
+        self.documents:typing.Dict[str,DocumentReference]={}
+        self._outbox:typing.Dict[str,typing.List[Operation]]={}
+        self._peerVersionVectors:typing.Dict[
+            str,typing.Dict[ReplicaId,VersionVector]]={}
+        self._lock=threading.Lock()
+        self._wakeup=threading.Event()
+        self._keepGoing=False
+        self._thread:typing.Optional[threading.Thread]=None
+
+    def open(self,documentId:str)->DocumentReference:
+        """
+        Get a document, starting to replicate it if it is not already
+        """
+        with self._lock:
+            document=self.documents.get(documentId)
+            if document is None:
+                document=DocumentReference(documentId,self.replica)
+                document.onLocalOperationCallbacks.append(self._localEdit)
+                self.documents[documentId]=document
+            return document
+
+    def close(self,documentId:str)->None:
+        """
+        Stop replicating a document
+        """
+        with self._lock:
+            self.documents.pop(documentId,None)
+            self._outbox.pop(documentId,None)
+            self._peerVersionVectors.pop(documentId,None)
+
+    def peerVersionVectors(self,
+        documentId:str
+        )->typing.Dict[ReplicaId,VersionVector]:
+        """
+        The latest version vector of a document seen from each
+        other machine (eg, for CrdtDocument.compact())
+        """
+        with self._lock:
+            return dict(self._peerVersionVectors.get(documentId,{}))
+
+    def _sawVersionVector(self,
+        documentId:str,
+        replica:typing.Optional[ReplicaId],
+        versionVector:VersionVector
+        )->None:
+        if replica is None or replica==self.replica:
+            return
+        with self._lock:
+            if documentId in self.documents:
+                self._peerVersionVectors.setdefault(
+                    documentId,{})[replica]=dict(versionVector)
+
+    def _localEdit(self,document:DocumentReference,op:Operation)->None:
+        with self._lock:
+            self._outbox.setdefault(document.documentId,[]).append(op)
+        self._wakeup.set()
+
+    def endpoints(self)->typing.Dict[str,typing.Callable[...,JsonLike]]:
+        """
+        The api endpoints to register, by name
+        """
+        return {
+            SYNC_ENDPOINT:self.syncEndpoint,
+            PUSH_ENDPOINT:self.pushEndpoint}
+
+    def syncEndpoint(self,
+        versionVectors:typing.Dict[str,VersionVector],
+        replica:typing.Optional[ReplicaId]=None
+        )->JsonLike:
+        """
+        Another machine tells us what it has.  We answer with what
+        it is missing, and what we have (so it can send what we lack).
+
+        :replica: the id of the machine asking
+        """
+        ret={}
+        for documentId,versionVector in versionVectors.items():
+            document=self.documents.get(documentId)
+            if document is None:
+                continue
+            self._sawVersionVector(documentId,replica,versionVector)
+            ret[documentId]={
+                'operations':[op.jsonObj
+                    for op in document.missingFor(versionVector)],
+                'versionVector':document.versionVector}
+        return {'documents':ret,'replica':self.replica}
+
+    def pushEndpoint(self,
+        operations:typing.Dict[str,typing.List[JsonLike]]
+        )->JsonLike:
+        """
+        Another machine sends us operations
+        """
+        added=0
+        for documentId,ops in operations.items():
+            document=self.documents.get(documentId)
+            if document is not None:
+                added+=len(document.merge(
+                    Operation(jsonObj=op) for op in ops))
+        return {'added':added}
+
+    def _call(self,
+        machine:MachineIdentity,
+        endpoint:str,
+        *args
+        )->typing.Optional[JsonLike]:
+        try:
+            response=self.getConnection(machine).callRemoteEndpoint(
+                endpoint,*args)
+        except (ConnectionError,TimeoutError,EOFError,OSError):
+            return None # anti-entropy will catch them up later
+        if not isinstance(response,dict) or response.get('status',200)!=200:
+            return None
+        return response
+
+    def push(self)->int:
+        """
+        Send batched local edits to all peers now
+
+        :return: how many operations were sent
+        """
+        with self._lock:
+            outbox=self._outbox
+            self._outbox={}
+        if not outbox:
+            return 0
+        message={documentId:[op.jsonObj for op in ops]
+            for documentId,ops in outbox.items()}
+        for machine in list(self.getPeers()):
+            self._call(machine,PUSH_ENDPOINT,message)
+        return sum(len(ops) for ops in outbox.values())
+
+    def syncWith(self,machine:MachineIdentity)->int:
+        """
+        Do an anti-entropy round with a peer, bringing both sides
+        up to date on all open documents
+
+        :return: how many operations were exchanged in total
+        """
+        with self._lock:
+            documents=dict(self.documents)
+        if not documents:
+            return 0
+        response=self._call(machine,SYNC_ENDPOINT,
+            {documentId:document.versionVector
+                for documentId,document in documents.items()},
+            self.replica)
+        if response is None:
+            return 0
+        exchanged=0
+        toPush:typing.Dict[str,typing.List[JsonLike]]={}
+        for documentId,theirs in response.get('documents',{}).items():
+            document=documents.get(documentId)
+            if document is None:
+                continue
+            ops=theirs.get('operations',[])
+            exchanged+=len(ops)
+            document.merge(Operation(jsonObj=op) for op in ops)
+            theirVersionVector=theirs.get('versionVector',{})
+            self._sawVersionVector(
+                documentId,response.get('replica'),theirVersionVector)
+            missing=document.missingFor(theirVersionVector)
+            if missing:
+                toPush[documentId]=[op.jsonObj for op in missing]
+                exchanged+=len(missing)
+        if toPush:
+            self._call(machine,PUSH_ENDPOINT,toPush)
+        return exchanged
+
+    def syncAll(self)->int:
+        """
+        Do an anti-entropy round with every peer
+
+        :return: how many operations were exchanged in total
+        """
+        return sum(self.syncWith(machine) for machine in list(self.getPeers()))
+
+    def start(self)->None:
+        """
+        Start pushing edits and doing anti-entropy in the background
+        """
+        if self._thread is not None:
+            return
+        self._keepGoing=True
+        self._thread=threading.Thread(target=self._replicationLoop,daemon=True)
+        self._thread.start()
+
+    def stop(self)->None:
+        """
+        Stop background replication
+        """
+        if self._thread is None:
+            return
+        self._keepGoing=False
+        self._wakeup.set()
+        self._thread.join()
+        self._thread=None
+
+    def __del__(self):
+        self.stop()
+
+    def _replicationLoop(self)->None:
+        nextAntiEntropy=time.monotonic()+self.antiEntropyInterval
+        while self._keepGoing:
+            timeout=max(nextAntiEntropy-time.monotonic(),0.0)
+            if self._wakeup.wait(timeout):
+                if not self._keepGoing:
+                    break
+                # give a burst of edits time to collect into one batch
+                time.sleep(self.pushInterval)
+                self._wakeup.clear()
+                self.push()
+            if time.monotonic()>=nextAntiEntropy:
+                self.syncAll()
+                nextAntiEntropy=time.monotonic()+self.antiEntropyInterval
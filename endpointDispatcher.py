@@ -0,0 +1,247 @@
+"""
+Routes incoming api requests to the endpoints that answer them
+
+Every endpoint is registered once, along with how it runs:
+    'thread': on a worker thread (the default)
+    'process': on a worker process, for cpu-bound work (the endpoint
+        must be a module-level function, so it can be sent there)
+    'async': on the event loop (for "async def" endpoints)
+All of them run on a FunctionCallManager, so they share its workers,
+its bound on queued work, and its overload policy.  Each answer is sent
+back on the connection its request arrived on.
+"""
+import typing
+import asyncio
+import traceback
+import concurrent.futures
+from jsonHelper import JsonCompatible,JsonLike,asJson
+from functionCallManager import FunctionCallManager
+from reliableDelivery import ResponseCache
+from overload import Overloaded,OVERLOAD_REJECT,OVERLOADED_STATUS
+
+
+ENDPOINT_THREAD='thread'
+ENDPOINT_PROCESS='process'
+ENDPOINT_ASYNC='async'
+ENDPOINT_MODES=(ENDPOINT_THREAD,ENDPOINT_PROCESS,ENDPOINT_ASYNC)
+EndpointCallable=typing.Callable[...,JsonCompatible]
+
+
+class ResponseConnection(typing.Protocol):
+    """
+    Anything a request can arrive on (eg, an ApiCommunication)
+    """
+    def sendMessage(self,message:JsonCompatible)->None:
+        """
+        Send a message without waiting for any response
+        """
+
+
+class EndpointRoute:
+    """
+    Where requests for one endpoint go
+    """
+    __slots__=('name','endpoint','mode','functionName')
+
+    def __init__(self,name:str,endpoint:EndpointCallable,mode:str):
+        self.name=name
+        self.endpoint=endpoint
+        self.mode=mode
+        # the name it is registered under in the FunctionCallManager
+        self.functionName=f'endpoint:{name}'
+
+
+class EndpointDispatcher:
+    """
+    Answers api requests by running endpoints on a FunctionCallManager
+
+    A request looks like:
+        {'endpoint':'','args':[],'kwargs':{},'requestId':''}
+    and is answered with the endpoint's response plus:
+        {'responseId':requestId,'status':200}
+    or a status of 404 (no such endpoint), 500 (the endpoint raised)
+    or 503 (too busy, try again later).  A request with no requestId
+    gets no answer.
+
+    A request that arrives again (because the caller did not hear
+    the answer) gets the answer it had before, rather than running
+    twice.
+    """
+    def __init__(self,
+        functionCallManager:typing.Optional[FunctionCallManager]=None,
+        responseCache:typing.Optional[ResponseCache]=None,
+        maxPending:int=1024,
+        overloadPolicy:str=OVERLOAD_REJECT,
+        blockTimeout:typing.Optional[float]=None):
+        """
+        :functionCallManager: where to run endpoints (default is to
+            start one of our own, using the overload settings below)
+        :responseCache: remembers responses by requestId so that
+            a request that arrives twice only runs once
+        :maxPending: most requests to have waiting or running
+            (0 for no limit)
+        :overloadPolicy: 'reject', 'shed' or 'block' (see overload.py).
+            Blocking stops the connection reading from its socket so
+            the backpressure reaches the sender, but also holds up
+            responses arriving on that connection.
+        :blockTimeout: longest to block the connection before
+            rejecting the request
+        """
+        self._ownsFunctionCallManager=functionCallManager is None
+        if functionCallManager is None:
+            functionCallManager=FunctionCallManager(
+                max_pending=maxPending,
+                overload_policy=overloadPolicy,
+                block_timeout=blockTimeout)
+        self.functionCallManager=functionCallManager
+        self.responseCache=responseCache or ResponseCache()
+        self._routes:typing.Dict[str,EndpointRoute]={}
+
+    def start(self)->None:
+        """
+        Start the workers (if they were stopped)
+        """
+        if self._ownsFunctionCallManager:
+            self.functionCallManager.start()
+
+    def stop(self)->None:
+        """
+        Stop the workers, if they are our own
+        """
+        if self._ownsFunctionCallManager:
+            self.functionCallManager.stop()
+
+    @property
+    def overloadMetrics(self)->typing.Dict[str,typing.Union[int,float]]:
+        """
+        How many requests are waiting, and how overload has been handled
+        """
+        return self.functionCallManager.overloadMetrics
+
+    def addLocalEndpoint(self,
+        endpoint:EndpointCallable,
+        name:typing.Optional[str]=None,
+        asProcess:bool=False,
+        mode:typing.Optional[str]=None,
+        priority:int=0)->None:
+        """
+        Add a new endpoint to the routing table.
+
+        :endpoint: the endpoint function to call with requests
+        :name: if no name is specified, use the function name of the endpoint
+        :asProcess: same as mode='process'
+        :mode: one of ENDPOINT_MODES (default is 'async' for coroutine
+            functions, otherwise 'thread')
+        :priority: when overloaded and shedding, waiting requests
+            for lower priority endpoints are dropped first
+        """
+        if name is None:
+            name=endpoint.__name__
+        if mode is None:
+            if asProcess:
+                mode=ENDPOINT_PROCESS
+            elif asyncio.iscoroutinefunction(endpoint):
+                mode=ENDPOINT_ASYNC
+            else:
+                mode=ENDPOINT_THREAD
+        if mode not in ENDPOINT_MODES:
+            raise ValueError(f'Unknown endpoint mode "{mode}"')
+        if (mode==ENDPOINT_ASYNC)!=asyncio.iscoroutinefunction(endpoint):
+            raise ValueError(
+                f'Endpoint "{name}" must be "async def" exactly when'
+                ' its mode is "async"')
+        route=EndpointRoute(name,endpoint,mode)
+        self.functionCallManager.addFunction(endpoint,route.functionName,
+            threadsafe=mode!=ENDPOINT_PROCESS,priority=priority)
+        self._routes[name]=route
+
+    def addLocalEndpoints(self,
+        endpoints:typing.Dict[str,EndpointCallable],
+        mode:typing.Optional[str]=None)->None:
+        """
+        Add everything a component offers from its endpoints()
+        """
+        for name,endpoint in endpoints.items():
+            self.addLocalEndpoint(endpoint,name,mode=mode)
+
+    def removeLocalEndpoint(self,
+        endpoint:typing.Union[str,EndpointCallable]
+        )->None:
+        """
+        Remove an endpoint (by name, or every name it is registered under)
+        """
+        if isinstance(endpoint,str):
+            names=[endpoint]
+        else:
+            names=[name for name,route in self._routes.items()
+                if route.endpoint==endpoint]
+        for name in names:
+            route=self._routes.pop(name)
+            self.functionCallManager.removeFunction(route.functionName)
+
+    def queueRequest(self,
+        request:JsonLike,
+        connection:ResponseConnection
+        )->None:
+        """
+        Start answering an incoming request.  The answer is sent
+        on the connection the request arrived on once it is ready.
+
+        (With the 'block' overload policy, this waits for room.)
+        """
+        requestId=request.get('requestId')
+        route=self._routes.get(request.get('endpoint',''))
+        if route is None:
+            self._respond(connection,requestId,{'status':404})
+            return
+        try:
+            future=self.responseCache.submit(requestId,
+                lambda:self.functionCallManager.submitLocal(
+                    route.functionName,
+                    *request.get('args',[]),
+                    **request.get('kwargs',{})))
+        except Overloaded:
+            self._respond(connection,requestId,{'status':OVERLOADED_STATUS})
+            return
+        future.add_done_callback(
+            lambda done:self._respond(connection,requestId,
+                self._response(done)))
+    dispatch=queueRequest
+
+    def _response(self,done:concurrent.futures.Future)->JsonLike:
+        """
+        Turn a finished endpoint call into a response
+        """
+        exception=done.exception() if not done.cancelled() \
+            else concurrent.futures.CancelledError()
+        if isinstance(exception,concurrent.futures.CancelledError):
+            # shed to make room for something more important
+            return {'status':OVERLOADED_STATUS}
+        if exception is not None:
+            return {
+                'status':500,
+                'exception':traceback.format_exception(exception)}
+        try:
+            response=asJson(done.result())
+        except ValueError as e: # a string that is not json
+            return {'status':500,'exception':traceback.format_exception(e)}
+        if not isinstance(response,dict):
+            response={'result':response}
+        response.setdefault('status',200)
+        return response
+
+    def _respond(self,
+        connection:ResponseConnection,
+        requestId:typing.Optional[str],
+        response:typing.Dict[str,JsonLike]
+        )->None:
+        """
+        Send a response back where its request came from
+        """
+        if requestId is None:
+            return
+        response['responseId']=requestId
+        try:
+            connection.sendMessage(response)
+        except ConnectionError:
+            pass # the caller will resend, and get the cached answer
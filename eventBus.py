@@ -0,0 +1,424 @@
+"""
+Publish/subscribe events across machines
+
+Topics are paths like "window/editor/geometry", and subscriptions
+are NodePath patterns like "window/*/geometry" or "document/**".
+Each machine tells its peers what it is subscribed to, so an event
+is only ever sent to the machines that want it.
+
+Events for a peer are queued and sent together in one message every
+so often.  Topics that change many times a second (such as a window
+being dragged) can be conflated, so that only the latest value
+waiting to be sent goes out.
+
+Each peer is sent to on its own, once and with a short timeout, so a
+slow or hung peer only holds up its own events.  While a batch to a
+peer is still on its way, further events for it wait and go together
+in the next batch.
+"""
+import typing
+import threading
+import time
+import concurrent.futures
+from machineIdentity import MachineIdentity
+from connectionTypes import ConnectionLookup
+from jsonHelper import JsonLike
+from nodePath import NodePath,NodePathSet,PathCompatible
+
+
+SUBSCRIBE_ENDPOINT='subscribeEvents'
+PUBLISH_ENDPOINT='publishEvents'
+PeerLookup=typing.Callable[[],typing.Iterable[MachineIdentity]]
+EventCallback=typing.Callable[[str,JsonLike],None]
+PeerId=str
+
+
+def peerIdOf(machine:typing.Union[MachineIdentity,str])->PeerId:
+    """
+    How a machine is identified on the bus
+    """
+    return getattr(machine,'fingerprint',None) or str(machine)
+
+
+class EventSubscription:
+    """
+    A local subscription to a topic pattern
+    """
+    def __init__(self,pattern:str,callback:EventCallback):
+        """ """
+        self.pattern=pattern
+        self.callback=callback
+
+    def __repr__(self):
+        return f'EventSubscription({self.pattern})'
+
+
+class _Outbox:
+    """
+    Events waiting to be sent to a single peer
+    """
+    __slots__=('events','conflated')
+    def __init__(self):
+        self.events:typing.List[typing.List[JsonLike]]=[]
+        # conflated topic:index of its event in events
+        self.conflated:typing.Dict[str,int]={}
+
+
+class EventBus:
+    """
+    Publish/subscribe events across machines
+
+    Register the functions from endpoints() with the local api
+    so that other machines can send events to this one.
+    """
+    def __init__(self,
+        localId:PeerId,
+        getConnection:ConnectionLookup,
+        getPeers:PeerLookup,
+        flushInterval:float=0.02,
+        announceInterval:float=5.0,
+        conflate:typing.Iterable[PathCompatible]=(),
+        requestTimeout:float=1.0):
+        """
+        :localId: the id of this machine (generally its fingerprint)
+        :getConnection: get the ApiCommunication for a machine
+        :getPeers: get the machines to talk to, eg
+            lambda:discoveryManager.machines.values()
+        :flushInterval: how long to collect events before sending
+            them, in seconds
+        :announceInterval: how often to check for new peers to tell
+            our subscriptions to (and to try again with peers that
+            could not be told), in seconds
+        :conflate: topic patterns where only the latest waiting value
+            needs to be sent, eg "window/*/geometry"
+        :requestTimeout: how long to wait for a peer to answer
+            (messages are sent once, never retried)
+        """
+        self.localId=localId
+        self.getConnection=getConnection
+        self.getPeers=getPeers
+        self.flushInterval=flushInterval
+        self.announceInterval=announceInterval
+        self.requestTimeout=requestTimeout
+        self.conflate=NodePathSet(conflate)
+        self.messagesSent=0
+        self.eventsConflated=0
+        self.eventsDropped=0
+        self._subscriptions=NodePathSet()
+        self._localSubscriptions:typing.List[EventSubscription]=[]
+        self._remotePatterns:typing.Dict[PeerId,typing.List[str]]={}
+        self._remoteSubscriptions=NodePathSet()
+        self._peers:typing.Dict[PeerId,MachineIdentity]={}
+        self._announced:typing.Set[PeerId]=set()
+        # peers that could not be told, and when to try them again
+        self._announceRetry:typing.Dict[PeerId,float]={}
+        self._outboxes:typing.Dict[PeerId,_Outbox]={}
+        # peers with a message on its way to them
+        self._busy:typing.Set[typing.Tuple[PeerId,str]]=set()
+        self._executor:typing.Optional[
+            concurrent.futures.ThreadPoolExecutor]=None
+        self._lock=threading.RLock()
+        self._wakeup=threading.Event()
+        self._keepGoing=False
+        self._thread:typing.Optional[threading.Thread]=None
+
+    @property
+    def patterns(self)->typing.List[str]:
+        """
+        The patterns that this machine is subscribed to
+        """
+        with self._lock:
+            return sorted({subscription.pattern
+                for subscription in self._localSubscriptions})
+
+    def subscribe(self,
+        pattern:str,
+        callback:EventCallback
+        )->EventSubscription:
+        """
+        Be called with (topic,data) for every event whose topic matches
+
+        (Peers are told about it on the next flush.)
+        """
+        subscription=EventSubscription(pattern,callback)
+        with self._lock:
+            self._subscriptions.add(NodePath(pattern),subscription)
+            self._localSubscriptions.append(subscription)
+            self._announced.clear()
+        self._wakeup.set()
+        return subscription
+
+    def unsubscribe(self,subscription:EventSubscription)->None:
+        """
+        Stop a subscription
+        """
+        with self._lock:
+            if subscription not in self._subscriptions:
+                return
+            self._subscriptions.remove(subscription)
+            self._localSubscriptions.remove(subscription)
+            self._announced.clear()
+        self._wakeup.set()
+
+    def publish(self,
+        topic:str,
+        data:JsonLike=None,
+        conflate:typing.Optional[bool]=None
+        )->None:
+        """
+        Send an event to every subscriber, here and on other machines
+
+        :conflate: replace any value for the same topic that has not
+            been sent yet (default is whether the topic matches
+            one of the conflate patterns)
+        """
+        self._deliver(topic,data)
+        with self._lock:
+            peers={key[0]
+                for key in self._remoteSubscriptions.matchNames(topic)}
+            if not peers:
+                return
+            if conflate is None:
+                conflate=bool(self.conflate.matchNames(topic))
+            for peer in peers:
+                outbox=self._outboxes.get(peer)
+                if outbox is None:
+                    outbox=_Outbox()
+                    self._outboxes[peer]=outbox
+                if conflate:
+                    index=outbox.conflated.get(topic)
+                    if index is not None:
+                        outbox.events[index][1]=data
+                        self.eventsConflated+=1
+                        continue
+                    outbox.conflated[topic]=len(outbox.events)
+                outbox.events.append([topic,data])
+        self._wakeup.set()
+
+    def _deliver(self,topic:str,data:JsonLike)->None:
+        """
+        Call the local subscribers for an event
+        """
+        with self._lock:
+            subscriptions=self._subscriptions.matchNames(topic)
+        for subscription in subscriptions:
+            subscription.callback(topic,data)
+
+    def endpoints(self)->typing.Dict[str,typing.Callable[...,JsonLike]]:
+        """
+        The api endpoints to register, by name
+        """
+        return {
+            SUBSCRIBE_ENDPOINT:self.subscribeEndpoint,
+            PUBLISH_ENDPOINT:self.publishEndpoint}
+
+    def subscribeEndpoint(self,
+        peer:PeerId,
+        patterns:typing.List[str]
+        )->JsonLike:
+        """
+        Another machine tells us what it is subscribed to
+
+        :return: what we are subscribed to, so it can do the same
+        """
+        self._setRemotePatterns(peer,patterns)
+        return {'patterns':self.patterns}
+
+    def publishEndpoint(self,
+        peer:PeerId, # pylint: disable=unused-argument
+        events:typing.List[typing.List[JsonLike]]
+        )->JsonLike:
+        """
+        Another machine sends us a batch of events
+        """
+        for topic,data in events:
+            self._deliver(topic,data)
+        return {'received':len(events)}
+
+    def _setRemotePatterns(self,peer:PeerId,patterns:typing.List[str])->None:
+        with self._lock:
+            if self._remotePatterns.get(peer,[])==list(patterns):
+                return
+            if patterns:
+                self._remotePatterns[peer]=list(patterns)
+            else:
+                self._remotePatterns.pop(peer,None)
+            # patterns change rarely, so simply rebuild
+            subscriptions=NodePathSet()
+            for peerId,peerPatterns in self._remotePatterns.items():
+                for pattern in peerPatterns:
+                    subscriptions.add(NodePath(pattern),(peerId,pattern))
+            self._remoteSubscriptions=subscriptions
+            outbox=self._outboxes.get(peer)
+            if outbox is not None and not patterns:
+                del self._outboxes[peer]
+
+    def _call(self,
+        peer:PeerId,
+        endpoint:str,
+        *args
+        )->typing.Optional[JsonLike]:
+        machine=self._peers.get(peer)
+        if machine is None:
+            return None
+        with self._lock:
+            self.messagesSent+=1
+        try:
+            response=self.getConnection(machine).callRemoteEndpointOnce(
+                self.requestTimeout,endpoint,*args)
+        except (ConnectionError,TimeoutError,EOFError,OSError,LookupError):
+            return None
+        if not isinstance(response,dict) or response.get('status',200)!=200:
+            return None
+        return response
+
+    def _sendToEach(self,
+        endpoint:str,
+        argsByPeer:typing.Dict[PeerId,typing.Tuple[typing.Any,...]],
+        done:typing.Callable[[PeerId,typing.Optional[JsonLike]],None]
+        )->None:
+        """
+        Call an endpoint on several peers, each on its own, and wait
+        (at most about requestTimeout) for them to answer
+
+        A peer that is taking longer carries on in the background.
+
+        :done: called with each peer's response (None if it failed)
+            once it has one, whether or not we are still waiting
+        """
+        def send(peer:PeerId,args:typing.Tuple[typing.Any,...])->None:
+            try:
+                response=self._call(peer,endpoint,*args)
+            except Exception: # pylint: disable=broad-except
+                response=None # eg, events that can not be sent as json
+            finally:
+                with self._lock:
+                    self._busy.discard((peer,endpoint))
+            done(peer,response)
+        with self._lock:
+            if self._executor is None:
+                self._executor=concurrent.futures.ThreadPoolExecutor(
+                    thread_name_prefix='eventBus')
+            executor=self._executor
+            self._busy.update((peer,endpoint) for peer in argsByPeer)
+        futures=[executor.submit(send,peer,args)
+            for peer,args in argsByPeer.items()]
+        concurrent.futures.wait(futures,timeout=self.requestTimeout+0.1)
+
+    def announce(self)->None:
+        """
+        Tell any peers that have not heard our subscriptions yet,
+        and forget peers that have gone away
+
+        A peer that could not be told is only tried again
+        every announceInterval.
+        """
+        peers={peerIdOf(machine):machine for machine in list(self.getPeers())}
+        now=time.monotonic()
+        with self._lock:
+            self._peers=peers
+            for peer in list(self._remotePatterns):
+                if peer not in peers:
+                    self._setRemotePatterns(peer,[])
+            self._announced&=peers.keys()
+            for peer in list(self._announceRetry):
+                if peer not in peers:
+                    del self._announceRetry[peer]
+            patterns=self.patterns
+            toAnnounce={}
+            for peer in peers:
+                if peer in self._announced or \
+                    (peer,SUBSCRIBE_ENDPOINT) in self._busy:
+                    continue
+                if self._announceRetry.get(peer,now)<=now:
+                    toAnnounce[peer]=(self.localId,patterns)
+        def announced(peer:PeerId,response:typing.Optional[JsonLike])->None:
+            with self._lock:
+                if response is None:
+                    self._announceRetry[peer]=\
+                        time.monotonic()+self.announceInterval
+                    return
+                self._announceRetry.pop(peer,None)
+                if self.patterns==patterns: # else it needs telling again
+                    self._announced.add(peer)
+                self._setRemotePatterns(peer,response.get('patterns',[]))
+        if toAnnounce:
+            self._sendToEach(SUBSCRIBE_ENDPOINT,toAnnounce,announced)
+
+    def flush(self)->int:
+        """
+        Send everything that is waiting now
+
+        A peer that still has a batch on its way keeps its events
+        waiting for the next flush.
+
+        :return: how many events were sent (by the time it returns)
+        """
+        self.announce()
+        with self._lock:
+            batches={}
+            for peer,outbox in list(self._outboxes.items()):
+                if outbox.events and \
+                    (peer,PUBLISH_ENDPOINT) not in self._busy:
+                    batches[peer]=outbox.events
+                    del self._outboxes[peer]
+        sent=[0]
+        def published(peer:PeerId,response:typing.Optional[JsonLike])->None:
+            events=batches[peer]
+            with self._lock:
+                if response is None:
+                    self.eventsDropped+=len(events)
+                else:
+                    sent[0]+=len(events)
+                if peer in self._outboxes:
+                    self._wakeup.set() # more came in while it was sending
+        if batches:
+            self._sendToEach(PUBLISH_ENDPOINT,
+                {peer:(self.localId,events)
+                    for peer,events in batches.items()},
+                published)
+        with self._lock:
+            return sent[0]
+
+    def start(self)->None:
+        """
+        Start sending events in the background
+        """
+        if self._thread is not None:
+            return
+        self._keepGoing=True
+        self._thread=threading.Thread(target=self._sendLoop,daemon=True)
+        self._thread.start()
+
+    def stop(self)->None:
+        """
+        Stop sending events in the background
+        """
+        with self._lock:
+            executor,self._executor=self._executor,None
+        if executor is not None:
+            executor.shutdown(wait=False,cancel_futures=True)
+        if self._thread is None:
+            return
+        self._keepGoing=False
+        self._wakeup.set()
+        self._thread.join()
+        self._thread=None
+
+    def __del__(self):
+        self.stop()
+
+    def _sendLoop(self)->None:
+        nextAnnounce=time.monotonic()
+        while self._keepGoing:
+            timeout=max(nextAnnounce-time.monotonic(),0.0)
+            if self._wakeup.wait(timeout):
+                if not self._keepGoing:
+                    break
+                # give a burst of events time to collect into one batch
+                time.sleep(self.flushInterval)
+                self._wakeup.clear()
+                self.flush()
+            if time.monotonic()>=nextAnnounce:
+                self.announce()
+                nextAnnounce=time.monotonic()+self.announceInterval
@@ -6,13 +6,17 @@ Makes function calls in either a threading or multiprocessing
 worker based on thread-safety annotations.
 """
 import typing
-import time
+import asyncio
 import threading
 import multiprocessing
-from multiprocessing.connection import PipeConnection
+from multiprocessing.connection import Connection
 import queue
 import uuid
 import traceback
+from concurrent.futures import Future,InvalidStateError
+from overload import AdmissionControl,OVERLOAD_BLOCK
+if typing.TYPE_CHECKING:
+    from remoteWorkers import RemoteWorkerPool
 
 
 class FunctionCallManager:
@@ -22,20 +26,46 @@ class FunctionCallManager:
 
     Makes function calls in either a threading or multiprocessing
     worker based on thread-safety annotations.
+
+    Functions registered as remote are sent to other machines
+    by remoteWorkers (when it is set), and run locally otherwise.
+
+    Coroutine functions (async def) run on an event loop that
+    the manager starts the first time one is called.
+
+    The number of calls waiting to run can be bounded with
+    max_pending, in which case overload_policy decides what to do
+    with calls beyond that (see overload.py).
     """
 
-    def __init__(self,num_threads:int=4,num_processes:int=2)->None:
+    def __init__(self,
+        num_threads:int=4,
+        num_processes:int=2,
+        remoteWorkers:typing.Optional['RemoteWorkerPool']=None,
+        max_pending:int=0,
+        overload_policy:str=OVERLOAD_BLOCK,
+        block_timeout:typing.Optional[float]=None)->None:
+        """
+        :param max_pending: most calls to have waiting or running
+            (0 for no limit.  With the 'block' policy, a function that
+            submits calls and waits on them can deadlock if the limit
+            is too small.)
+        :param overload_policy: 'block', 'reject' or 'shed'
+            (shedding cancels waiting calls of lower priority functions,
+            other than those sent to worker processes)
+        :param block_timeout: longest submit() will block for room
+        """
         self.functions:typing.Dict[
             str,
             typing.Tuple[typing.Callable[...,typing.Any],bool]]={}
+        self.remoteFunctions:typing.Set[str]=set()
+        self.priorities:typing.Dict[str,int]={}
+        self.remoteWorkers=remoteWorkers
+        self.admission=AdmissionControl(
+            max_pending,overload_policy,block_timeout)
         self.threadsafe_queue:queue.Queue=queue.Queue()
         self.multiproc_queue:multiprocessing.Queue=multiprocessing.Queue()
-        self.results:typing.Dict[
-            str,
-            typing.Tuple[typing.Any,typing.Optional[Exception]]]={}
-        self.result_events:typing.Dict[
-            str,
-            typing.Union[threading.Event,multiprocessing.Event]]={}
+        self.futures:typing.Dict[str,Future]={}
         self.lock=threading.Lock()
         self.num_threads=num_threads
         self.num_processes=num_processes
@@ -43,29 +73,63 @@ class FunctionCallManager:
         self._processes:typing.List[multiprocessing.Process]=[]
         self._threads:typing.List[threading.Thread]=[]
         self._collector_thread:typing.Optional[threading.Thread]=None
-        self.parent_conns:typing.List[PipeConnection]=[]
+        self._loop:typing.Optional[asyncio.AbstractEventLoop]=None
+        self._loop_thread:typing.Optional[threading.Thread]=None
+        self.parent_conns:typing.List[Connection]=[]
+        self._running=False
         self.start()
 
     def start(self)->None:
         """
         Start all threads and processes
+        (does nothing if they are already running)
         """
+        with self.lock:
+            if self._running:
+                return
+            self._running=True
+        self._shutdown_event.clear()
         self._start_thread_workers()
         self._start_process_workers()
 
     def stop(self)->None:
         """
         Stop all threads/processes
+        (start() will start them again)
+
+        Calls that have not finished are cancelled, or fail with
+        RuntimeError if they had already started.
+        """
+        with self.lock:
+            running,self._running=self._running,False
+        if running:
+            self._stop_workers()
+        with self.lock:
+            loop,self._loop=self._loop,None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            if self._loop_thread is not None:
+                self._loop_thread.join()
+                self._loop_thread=None
+            loop.close()
+        self._fail_unfinished()
+    def __del__(self):
+        self.stop()
+
+    def _stop_workers(self)->None:
+        """
+        Stop the thread and process workers
         """
         self._shutdown_event.set()
-        for _ in range(self.num_threads):
+        for _ in self._threads:
             self.threadsafe_queue.put(None)
-        for _ in range(self.num_processes):
+        for _ in self._processes:
             self.multiproc_queue.put(None)
         for t in self._threads:
             t.join()
         if self._collector_thread:
             self._collector_thread.join()
+            self._collector_thread=None
         for p in self._processes:
             p.join()
         for conn in self.parent_conns:
@@ -73,61 +137,226 @@ class FunctionCallManager:
         self._threads.clear()
         self._processes.clear()
         self.parent_conns.clear()
-    def __del__(self):
-        self.stop()
+        # calls still queued are failed by _fail_unfinished(), and
+        # threads that saw the shutdown first leave their stop
+        # markers behind, which would stop the next workers started
+        for work_queue in (self.threadsafe_queue,self.multiproc_queue):
+            while True:
+                try:
+                    work_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+    def _fail_unfinished(self)->None:
+        """
+        Resolve the futures of every call that did not finish,
+        so that nobody waits on them forever
+        """
+        with self.lock:
+            unfinished=list(self.futures.items())
+            self.futures.clear()
+        for call_id,future in unfinished:
+            self.admission.release(call_id)
+            if future.cancel():
+                continue
+            try:
+                future.set_exception(RuntimeError(
+                    'FunctionCallManager stopped before the call finished'))
+            except InvalidStateError:
+                pass # it finished after all
 
     def addFunction(self,
         func:typing.Callable[...,typing.Any],
         name:typing.Optional[str]=None,
-        threadsafe:bool=False)->None:
+        threadsafe:bool=False,
+        remote:bool=False,
+        priority:int=0)->None:
         """
         Registers a function with a name and whether it is threadsafe.
 
         :param name: Unique name for the function
         :param func: Callable function to register
         :param threadsafe: Boolean indicating if the function
-            is safe to call from threads
+            is safe to call from threads (ignored for coroutine
+            functions, which always run on the event loop)
+        :param remote: Boolean indicating if the function can be
+            sent to another machine (which must have the same
+            function registered under the same name)
+        :param priority: when overloaded and shedding, waiting calls
+            to lower priority functions are cancelled first
+            (calls to functions that are not threadsafe are never
+            cancelled, since a worker process would still run them)
         """
         if name is None:
             name=func.__name__
         self.functions[name]=(func,threadsafe)
+        self.priorities[name]=priority
+        if remote:
+            self.remoteFunctions.add(name)
+        else:
+            self.remoteFunctions.discard(name)
 
-    def call(self,
+    def removeFunction(self,name:str)->None:
+        """
+        Unregister a function (calls already submitted still run)
+        """
+        self.functions.pop(name,None)
+        self.priorities.pop(name,None)
+        self.remoteFunctions.discard(name)
+
+    def submit(self,
         name:str,
         *args:typing.List[typing.Any],
         **kwargs:typing.Dict[str,typing.Any]
-        )->typing.Any:
+        )->Future:
         """
         Calls a registered function asynchronously,
-        blocking until result or exception is returned.
+        without waiting for the result.
 
         :param name: Name of the function to call
         :param args: Positional arguments for the function
         :param kwargs: Keyword arguments for the function
-        :return: Return value from the function
-        :raises Exception: Any exception raised inside the target function
+        :return: a Future for the return value from the function.
+            Cancelling it before a worker picks it up will skip the call.
+        """
+        if name not in self.functions:
+            raise ValueError(f"Function '{name}' is not registered.")
+        if self.remoteWorkers is not None and name in self.remoteFunctions:
+            return self.remoteWorkers.submit(name,args,kwargs,
+                lambda:self.submitLocal(name,*args,**kwargs))
+        return self.submitLocal(name,*args,**kwargs)
+
+    def submitLocal(self,
+        name:str,
+        *args:typing.List[typing.Any],
+        **kwargs:typing.Dict[str,typing.Any]
+        )->Future:
+        """
+        Same as submit(), but always runs on this machine
+
+        :raises overload.Overloaded: if too many calls are
+            waiting already (depending on the overload policy)
         """
         if name not in self.functions:
             raise ValueError(f"Function '{name}' is not registered.")
         func,threadsafe=self.functions[name]
+        isCoroutine=asyncio.iscoroutinefunction(func)
         call_id=str(uuid.uuid4())
-        event=threading.Event() if threadsafe else multiprocessing.Event()
+        future:Future=Future()
+        # once a call is on the process queue, a worker process runs it
+        # whether or not its future is cancelled, so it can't be shed
+        cancel=future.cancel if threadsafe or isCoroutine else None
+        self.admission.admit(call_id,self.priorities.get(name,0),cancel)
         with self.lock:
-            self.result_events[call_id]=event
+            self.futures[call_id]=future
+        if isCoroutine:
+            asyncio.run_coroutine_threadsafe(
+                self._run_coroutine(call_id,func,args,kwargs),
+                self._event_loop())
+            return future
         call_data={'id':call_id,'func':func,'args':args,'kwargs':kwargs}
         if threadsafe:
             self.threadsafe_queue.put(call_data)
         else:
             self.multiproc_queue.put(call_data)
-        event.wait()
-        with self.lock:
-            result,exception=self.results.pop(call_id)
-            self.result_events.pop(call_id)
-        if exception:
-            raise exception
-        return result
+        return future
+
+    def call(self,
+        name:str,
+        *args:typing.List[typing.Any],
+        **kwargs:typing.Dict[str,typing.Any]
+        )->typing.Any:
+        """
+        Calls a registered function asynchronously,
+        blocking until result or exception is returned.
+
+        :param name: Name of the function to call
+        :param args: Positional arguments for the function
+        :param kwargs: Keyword arguments for the function
+        :return: Return value from the function
+        :raises Exception: Any exception raised inside the target function
+        """
+        return self.submit(name,*args,**kwargs).result()
     __call__=call
 
+    @property
+    def overloadMetrics(self)->typing.Dict[str,typing.Union[int,float]]:
+        """
+        How much work is waiting, and how overload has been handled
+        """
+        return self.admission.metrics
+
+    def _event_loop(self)->asyncio.AbstractEventLoop:
+        """
+        The event loop that coroutine functions run on
+        (started the first time it is needed)
+        """
+        with self.lock:
+            if self._loop is None:
+                self._loop=asyncio.new_event_loop()
+                self._loop_thread=threading.Thread(
+                    target=self._loop.run_forever,daemon=True)
+                self._loop_thread.start()
+            return self._loop
+
+    async def _run_coroutine(self,
+        call_id:str,
+        func:typing.Callable[...,typing.Awaitable[typing.Any]],
+        args:typing.Tuple[typing.Any,...],
+        kwargs:typing.Dict[str,typing.Any]
+        )->None:
+        """
+        Run a coroutine function call on the event loop
+        """
+        if not self._start_call(call_id):
+            return
+        try:
+            result=await func(*args,**kwargs)
+            exception=None
+        except Exception as e:
+            result=None
+            exception=e
+        self._finish_call(call_id,result,exception)
+
+    def _start_call(self,call_id:str)->bool:
+        """
+        Mark a call as running
+
+        :return: False if the call has been cancelled and should be skipped
+        """
+        with self.lock:
+            future=self.futures.get(call_id)
+        if future is None:
+            return False
+        if future.set_running_or_notify_cancel():
+            return True
+        with self.lock:
+            self.futures.pop(call_id,None)
+        self.admission.release(call_id)
+        return False
+
+    def _finish_call(self,
+        call_id:str,
+        result:typing.Any,
+        exception:typing.Optional[BaseException]
+        )->None:
+        """
+        Deliver the result of a call to whoever is waiting on it
+        """
+        with self.lock:
+            future=self.futures.pop(call_id,None)
+        self.admission.release(call_id)
+        if future is None or future.done():
+            return
+        if not future.running():
+            # process workers never get to mark the future as running
+            if not future.set_running_or_notify_cancel():
+                return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
     def _start_thread_workers(self)->None:
         """
         Starts the threading-based workers.
@@ -144,9 +373,15 @@ class FunctionCallManager:
                         call_data=self.multiproc_queue.get_nowait()
                     except queue.Empty:
                         continue
+                    if call_data is None:
+                        # a process worker's stop marker, not ours
+                        self.multiproc_queue.put(None)
+                        break
                 if call_data is None:
                     break
                 call_id=call_data['id']
+                if not self._start_call(call_id):
+                    continue
                 func=call_data['func']
                 args=call_data['args']
                 kwargs=call_data['kwargs']
@@ -156,10 +391,7 @@ class FunctionCallManager:
                 except Exception as e:
                     result=None
                     exception=e
-                with self.lock:
-                    self.results[call_id]=(result,exception)
-                    event=self.result_events[call_id]
-                    event.set()
+                self._finish_call(call_id,result,exception)
         for _ in range(self.num_threads):
             t=threading.Thread(target=thread_worker,daemon=True)
             t.start()
@@ -200,19 +432,20 @@ class FunctionCallManager:
             self.parent_conns.append(parent_conn)
             self._processes.append(proc)
         def collect_results()->None:
+            conns=list(self.parent_conns)
             while not self._shutdown_event.is_set():
-                for conn in self.parent_conns:
-                    if conn.poll():
+                # wake as soon as any worker has a result
+                for conn in multiprocessing.connection.wait(conns,timeout=0.1):
+                    try:
                         call_id,result,exc_info=conn.recv()
-                        exception:typing.Optional[RuntimeError]=None
-                        if exc_info:
-                            exception=RuntimeError(
-                                f"Exception in subprocess:\n{exc_info}")
-                        with self.lock:
-                            self.results[call_id]=(result,exception)
-                            event=self.result_events[call_id]
-                            event.set()
-                time.sleep(0.01)
+                    except (EOFError,OSError):
+                        conns.remove(conn) # the worker has exited
+                        continue
+                    exception:typing.Optional[RuntimeError]=None
+                    if exc_info:
+                        exception=RuntimeError(
+                            f"Exception in subprocess:\n{exc_info}")
+                    self._finish_call(call_id,result,exception)
         self._collector_thread=threading.Thread(
             target=collect_results,daemon=True)
         self._collector_thread.start()
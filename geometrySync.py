@@ -0,0 +1,510 @@
+"""
+Mirror window geometry to other machines while windows are
+being dragged or resized, without flooding the links.
+
+Changes are coalesced per window, so only the latest geometry is
+ever waiting to be sent, and frames go out no faster than maxRate.
+Each frame is a compact binary list of the fields that changed,
+delta-encoded against what that peer was last sent, so a one pixel
+move of a window costs about four bytes.
+
+Each peer is sent to on its own, once and with a short timeout, so a
+slow or hung peer only holds up its own frames.  While a frame to a
+peer is still on its way, changes for it wait and go together in the
+next frame.
+
+Frame layout:
+    version:uint8  seq:uint32
+    then for each window:
+        id:varint  flags:uint8  [name:varint length+utf-8]
+        [dx][dy][dw][dh]:zigzag varint, only for fields flagged as changed
+"""
+import typing
+import time
+import struct
+import base64
+import threading
+import concurrent.futures
+from machineIdentity import MachineIdentity
+from connectionTypes import ConnectionLookup
+from jsonHelper import JsonLike
+from windowSpatialIndex import Rect
+if typing.TYPE_CHECKING:
+    from windowLayout import WindowLayout
+
+
+GEOMETRY_ENDPOINT='syncGeometry'
+FRAME_VERSION=1
+PeerLookup=typing.Callable[[],typing.Iterable[MachineIdentity]]
+PeerId=str
+WindowKey=str
+RemoteGeometryCallback=typing.Callable[
+    [PeerId,WindowKey,typing.Optional[Rect]],None]
+
+_HEADER=struct.Struct('>BI')
+# flags
+_FIELD_FLAGS=(1,2,4,8) # x,y,w,h changed
+_DEFINE=16 # the window's name follows (first time it is sent)
+_REMOVED=32 # the window is gone
+
+
+def _writeVarint(out:bytearray,value:int)->None:
+    while value>=0x80:
+        out.append((value&0x7f)|0x80)
+        value>>=7
+    out.append(value)
+
+
+def _readVarint(data:bytes,pos:int)->typing.Tuple[int,int]:
+    value=0
+    shift=0
+    while True:
+        byte=data[pos]
+        pos+=1
+        value|=(byte&0x7f)<<shift
+        if byte<0x80:
+            return value,pos
+        shift+=7
+
+
+def _zigzag(value:int)->int:
+    return value*2 if value>=0 else -value*2-1
+
+
+def _unzigzag(value:int)->int:
+    return value>>1 if not value&1 else -((value+1)>>1)
+
+
+class GeometryEncoder:
+    """
+    Encodes geometry frames for one peer, remembering what
+    it was last sent so that only deltas need to go out
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self)->None:
+        """
+        Forget everything, so the next frame stands on its own
+        """
+        self.seq=0
+        self._nextId=0
+        self._ids:typing.Dict[WindowKey,int]={}
+        self._sent:typing.Dict[WindowKey,Rect]={}
+
+    @property
+    def sent(self)->typing.Dict[WindowKey,Rect]:
+        """
+        The geometry this peer was last sent for each window
+        """
+        return self._sent
+
+    def encode(self,
+        changes:typing.Dict[WindowKey,typing.Optional[Rect]],
+        full:bool=False
+        )->typing.Optional[bytes]:
+        """
+        Encode changed geometry (None means the window is gone)
+
+        :full: changes is every window there is, so send a frame
+            even if it is empty (so the peer learns there are none)
+        :return: the frame, or None if nothing actually changed
+        """
+        out=bytearray()
+        for key,rect in changes.items():
+            windowId=self._ids.get(key)
+            flags=0
+            if rect is None:
+                if windowId is None:
+                    continue
+                del self._ids[key]
+                del self._sent[key]
+                _writeVarint(out,windowId)
+                out.append(_REMOVED)
+                continue
+            if windowId is None:
+                windowId=self._nextId
+                self._nextId+=1
+                self._ids[key]=windowId
+                flags|=_DEFINE
+            old=self._sent.get(key,(0,0,0,0))
+            deltas=[new-prev for new,prev in zip(rect,old)]
+            for flag,delta in zip(_FIELD_FLAGS,deltas):
+                if delta:
+                    flags|=flag
+            if not flags:
+                continue
+            _writeVarint(out,windowId)
+            out.append(flags)
+            if flags&_DEFINE:
+                name=key.encode('utf-8')
+                _writeVarint(out,len(name))
+                out+=name
+            for flag,delta in zip(_FIELD_FLAGS,deltas):
+                if flags&flag:
+                    _writeVarint(out,_zigzag(delta))
+            self._sent[key]=tuple(rect)
+        if not out and not (full and self.seq==0):
+            return None
+        self.seq+=1
+        return _HEADER.pack(FRAME_VERSION,self.seq)+bytes(out)
+
+
+class GeometryDecoder:
+    """
+    Decodes geometry frames from one peer
+    """
+    def __init__(self):
+        self.seq=0
+        self._keys:typing.Dict[int,WindowKey]={}
+        self.geometry:typing.Dict[WindowKey,Rect]={}
+
+    def decode(self,
+        frame:bytes
+        )->typing.Optional[typing.Dict[WindowKey,typing.Optional[Rect]]]:
+        """
+        Decode a frame
+
+        :return: {window:new geometry (None if gone)}, or None if
+            a frame was missed and the sender needs to start over
+        """
+        version,seq=_HEADER.unpack_from(frame)
+        if version!=FRAME_VERSION:
+            raise ValueError(f'Unknown geometry frame version {version}')
+        changes:typing.Dict[WindowKey,typing.Optional[Rect]]={}
+        if seq==1:
+            # the sender started over, sending every window it has,
+            # so any window not in this frame is gone
+            changes.update((key,None) for key in self.geometry)
+            self._keys={}
+            self.geometry={}
+        elif seq!=self.seq+1:
+            return None
+        self.seq=seq
+        pos=_HEADER.size
+        while pos<len(frame):
+            windowId,pos=_readVarint(frame,pos)
+            flags=frame[pos]
+            pos+=1
+            if flags&_REMOVED:
+                key=self._keys.pop(windowId)
+                self.geometry.pop(key,None)
+                changes[key]=None
+                continue
+            if flags&_DEFINE:
+                length,pos=_readVarint(frame,pos)
+                key=frame[pos:pos+length].decode('utf-8')
+                pos+=length
+                self._keys[windowId]=key
+            key=self._keys[windowId]
+            rect=list(self.geometry.get(key,(0,0,0,0)))
+            for i,flag in enumerate(_FIELD_FLAGS):
+                if flags&flag:
+                    delta,pos=_readVarint(frame,pos)
+                    rect[i]+=_unzigzag(delta)
+            self.geometry[key]=tuple(rect)
+            changes[key]=self.geometry[key]
+        return changes
+
+
+class GeometrySync:
+    """
+    Mirror window geometry to other machines, coalescing
+    changes and sending no more than maxRate frames a second.
+
+    Register the functions from endpoints() with the local api
+    so that other machines can send geometry to this one.
+    """
+    def __init__(self,
+        localId:PeerId,
+        getConnection:ConnectionLookup,
+        getPeers:PeerLookup,
+        maxRate:float=30.0,
+        onRemoteGeometryCallbacks:typing.Optional[
+            typing.Iterable[RemoteGeometryCallback]]=None,
+        requestTimeout:float=1.0):
+        """
+        :localId: the id of this machine (generally its fingerprint)
+        :getConnection: get the ApiCommunication for a machine
+        :getPeers: get the machines to mirror to
+        :maxRate: most frames to send each second
+        :onRemoteGeometryCallbacks: called with (peer,window,rect)
+            when a window on another machine moves (rect is None
+            if the window is gone)
+        :requestTimeout: how long to wait for a peer to answer
+        """
+        self.localId=localId
+        self.getConnection=getConnection
+        self.getPeers=getPeers
+        self.maxRate=maxRate
+        self.onRemoteGeometryCallbacks:typing.List[RemoteGeometryCallback]=\
+            list(onRemoteGeometryCallbacks or ())
+        self.requestTimeout=requestTimeout
+        self.framesSent=0
+        self.bytesSent=0
+        self._geometry:typing.Dict[WindowKey,Rect]={}
+        self._dirty:typing.Set[WindowKey]=set()
+        self._removed:typing.Set[WindowKey]=set()
+        self._encoders:typing.Dict[PeerId,GeometryEncoder]={}
+        self._decoders:typing.Dict[PeerId,GeometryDecoder]={}
+        # changes waiting for peers that still have a frame on its way
+        self._pending:typing.Dict[PeerId,
+            typing.Dict[WindowKey,typing.Optional[Rect]]]={}
+        self._busy:typing.Set[PeerId]=set()
+        self._failing:typing.Set[PeerId]=set() # last frame did not go
+        self._executor:typing.Optional[
+            concurrent.futures.ThreadPoolExecutor]=None
+        self._windowCallbacks:typing.Dict[WindowKey,typing.Tuple[
+            "WindowLayout",typing.Callable[["WindowLayout"],None]]]={}
+        self._lock=threading.Lock()
+        self._wakeup=threading.Event()
+        self._keepGoing=False
+        self._thread:typing.Optional[threading.Thread]=None
+
+    @property
+    def remoteGeometry(self)->typing.Dict[PeerId,typing.Dict[WindowKey,Rect]]:
+        """
+        The latest geometry of the windows on each other machine
+        """
+        return {peer:dict(decoder.geometry)
+            for peer,decoder in self._decoders.items()}
+
+    def windowMoved(self,key:WindowKey,rect:Rect)->None:
+        """
+        Record a window's new geometry, to be sent on the next frame
+        """
+        rect=tuple(int(v) for v in rect)
+        with self._lock:
+            if self._geometry.get(key)==rect:
+                return
+            self._geometry[key]=rect
+            self._dirty.add(key)
+            self._removed.discard(key)
+        self._wakeup.set()
+
+    def windowRemoved(self,key:WindowKey)->None:
+        """
+        Record that a window is gone
+        """
+        with self._lock:
+            if self._geometry.pop(key,None) is None:
+                return
+            self._dirty.discard(key)
+            self._removed.add(key)
+        self._wakeup.set()
+
+    def trackWindow(self,key:WindowKey,window:"WindowLayout")->None:
+        """
+        Follow a window's moves and resizes
+        """
+        self.untrackWindow(key,removed=False)
+        def onGeometryChanged(w:"WindowLayout")->None:
+            self.windowMoved(key,w.rect)
+        window.onGeometryChangedCallbacks.append(onGeometryChanged)
+        self._windowCallbacks[key]=(window,onGeometryChanged)
+        self.windowMoved(key,window.rect)
+
+    def untrackWindow(self,key:WindowKey,removed:bool=True)->None:
+        """
+        Stop following a window
+
+        :removed: also tell the other machines the window is gone
+        """
+        window,callback=self._windowCallbacks.pop(key,(None,None))
+        if window is not None \
+            and callback in window.onGeometryChangedCallbacks:
+            window.onGeometryChangedCallbacks.remove(callback)
+        if removed:
+            self.windowRemoved(key)
+
+    def endpoints(self)->typing.Dict[str,typing.Callable[...,JsonLike]]:
+        """
+        The api endpoints to register, by name
+        """
+        return {GEOMETRY_ENDPOINT:self.geometryEndpoint}
+
+    def geometryEndpoint(self,peer:PeerId,frame:str)->JsonLike:
+        """
+        Another machine sends a geometry frame (base64 encoded)
+        """
+        with self._lock:
+            decoder=self._decoders.get(peer)
+            if decoder is None:
+                decoder=GeometryDecoder()
+                self._decoders[peer]=decoder
+            changes=decoder.decode(base64.b64decode(frame))
+        if changes is None:
+            return {'resync':True}
+        for key,rect in changes.items():
+            for fn in self.onRemoteGeometryCallbacks:
+                fn(peer,key,rect)
+        return {}
+
+    def flush(self)->int:
+        """
+        Send a frame with whatever has changed to every peer now
+
+        A peer that still has a frame on its way keeps its changes
+        waiting for the next flush.  Peers whose last frame did not
+        go are not waited for, so they do not slow everyone down.
+
+        :return: how many bytes were sent (by the time it returns)
+        """
+        peers={getattr(machine,'fingerprint',None) or str(machine):machine
+            for machine in list(self.getPeers())}
+        toSend:typing.Dict[PeerId,typing.Tuple[
+            MachineIdentity,typing.Dict[WindowKey,typing.Optional[Rect]],
+            typing.Optional[GeometryEncoder]]]={}
+        with self._lock:
+            changes:typing.Dict[WindowKey,typing.Optional[Rect]]={
+                key:self._geometry[key] for key in self._dirty}
+            changes.update((key,None) for key in self._removed)
+            self._dirty.clear()
+            self._removed.clear()
+            geometry=dict(self._geometry)
+            for peer in list(self._encoders):
+                if peer not in peers:
+                    del self._encoders[peer]
+            for peer in list(self._pending):
+                if peer not in peers:
+                    del self._pending[peer]
+                    self._failing.discard(peer)
+            for peer,machine in peers.items():
+                pending=self._pending.setdefault(peer,{})
+                pending.update(changes)
+                if peer in self._busy:
+                    continue
+                encoder=self._encoders.get(peer)
+                if encoder is not None and not pending:
+                    continue
+                del self._pending[peer]
+                self._busy.add(peer)
+                # a new peer (or one that has to start over) is sent
+                # everything, without an encoder to build on
+                toSend[peer]=(machine,
+                    pending if encoder is not None else geometry,encoder)
+            if not toSend:
+                return 0
+            if self._executor is None:
+                self._executor=concurrent.futures.ThreadPoolExecutor(
+                    thread_name_prefix='geometrySync')
+            executor=self._executor
+            failing=set(self._failing)
+        sent=[0]
+        def send(peer:PeerId)->None:
+            try:
+                size=self._sendTo(peer,*toSend[peer])
+            except Exception: # pylint: disable=broad-except
+                size=None
+            with self._lock:
+                self._busy.discard(peer)
+                if size is None:
+                    self._encoders.pop(peer,None) # start over next time
+                    self._failing.add(peer)
+                else:
+                    self._failing.discard(peer)
+                    sent[0]+=size
+            if size is not None and self._pending.get(peer):
+                self._wakeup.set() # more changed while it was on its way
+        futures=[executor.submit(send,peer) for peer in toSend]
+        concurrent.futures.wait(
+            [future for peer,future in zip(toSend,futures)
+                if peer not in failing],
+            timeout=self.requestTimeout+0.1)
+        return sent[0]
+
+    def _sendTo(self,
+        peer:PeerId,
+        machine:MachineIdentity,
+        changes:typing.Dict[WindowKey,typing.Optional[Rect]],
+        encoder:typing.Optional[GeometryEncoder]
+        )->typing.Optional[int]:
+        """
+        Send one peer what changed for it
+
+        :encoder: what this peer was last sent, or None to send
+            changes (which is all the geometry) from scratch
+        :return: the bytes sent, or None if the peer is to start
+            over next time
+        """
+        if encoder is None:
+            encoder=GeometryEncoder()
+            frame=encoder.encode(changes,full=True)
+            with self._lock:
+                self._encoders[peer]=encoder
+        else:
+            frame=encoder.encode(changes)
+        if frame is None:
+            return 0
+        response=self._send(machine,frame)
+        if response is not None and response.get('resync'):
+            # it missed a frame, so send everything from scratch
+            with self._lock:
+                geometry=dict(self._geometry)
+                self._pending.pop(peer,None)
+            encoder.reset()
+            frame=encoder.encode(geometry,full=True)
+            response=self._send(machine,frame)
+        if response is None:
+            return None
+        return len(frame)
+
+    def _send(self,
+        machine:MachineIdentity,
+        frame:bytes
+        )->typing.Optional[JsonLike]:
+        with self._lock:
+            self.framesSent+=1
+            self.bytesSent+=len(frame)
+        try:
+            response=self.getConnection(machine).callRemoteEndpointOnce(
+                self.requestTimeout,GEOMETRY_ENDPOINT,self.localId,
+                base64.b64encode(frame).decode('ascii'))
+        except (ConnectionError,TimeoutError,EOFError,OSError,LookupError):
+            return None
+        if not isinstance(response,dict) or response.get('status',200)!=200:
+            return None
+        return response
+
+    def start(self)->None:
+        """
+        Start sending geometry in the background
+        """
+        if self._thread is not None:
+            return
+        self._keepGoing=True
+        self._thread=threading.Thread(target=self._sendLoop,daemon=True)
+        self._thread.start()
+
+    def stop(self)->None:
+        """
+        Stop sending geometry in the background
+        """
+        with self._lock:
+            executor,self._executor=self._executor,None
+        if executor is not None:
+            executor.shutdown(wait=False,cancel_futures=True)
+        if self._thread is None:
+            return
+        self._keepGoing=False
+        self._wakeup.set()
+        self._thread.join()
+        self._thread=None
+
+    def __del__(self):
+        self.stop()
+
+    def _sendLoop(self)->None:
+        nextSend=time.monotonic()
+        while self._keepGoing:
+            self._wakeup.wait()
+            if not self._keepGoing:
+                break
+            # hold off until the rate limit allows the next frame,
+            # collecting every change made in the meantime
+            delay=nextSend-time.monotonic()
+            if delay>0:
+                time.sleep(delay)
+            self._wakeup.clear()
+            nextSend=time.monotonic()+1.0/self.maxRate
+            self.flush()
@@ -15,19 +15,26 @@ JsonCompatible=typing.Union[str,JsonLike,"JsonBase"]
 def asJsonObj(jsonCompatible:JsonCompatible)->JsonLike:
     """
     Attempt to get whatever is passed in as a Json-like "object"
+
+    A string is parsed as json.  Anything else is converted
+    to json-like values (strings within it are kept as strings).
     """
-    if hasattr(jsonCompatible,'json'):
-        return asJson(jsonCompatible.json)
     if isinstance(jsonCompatible,str):
-        return json.loads(str)
-    if isinstance(jsonCompatible,dict):
-        fixed={}
-        for k,v in jsonCompatible.items():
-            fixed[str(k)]=asJson(v)
-        return fixed
-    if hasattr(jsonCompatible,'__iter__'):
-        return [asJson(v) for v in jsonCompatible]
-    return json.loads(str(JsonLike))
+        return json.loads(jsonCompatible)
+    return _asJsonValue(jsonCompatible)
+def _asJsonValue(value:typing.Any)->JsonLike:
+    """
+    Convert a value within a Json-like "object"
+    """
+    if value is None or isinstance(value,(str,int,float,bool)):
+        return value
+    if hasattr(value,'jsonObj'):
+        return _asJsonValue(value.jsonObj)
+    if isinstance(value,dict):
+        return {str(k):_asJsonValue(v) for k,v in value.items()}
+    if hasattr(value,'__iter__'):
+        return [_asJsonValue(v) for v in value]
+    return str(value)
 asJson=asJsonObj
 def asJsonStr(jsonCompatible:JsonCompatible)->str:
     """
@@ -42,6 +49,7 @@ class JsonBase:
     Basically, you gain a whole lot of functionality
     just by defining a jsonObj getter/setter.
     """
+    __slots__=() # so that subclasses can use __slots__ too
 
     @property
     @abstractmethod
@@ -100,7 +108,11 @@ class JsonBase:
         """
         if not isinstance(path,Path):
             path=Path(os.path.expandvars(str(path)))
-        path.write_text(self.jsonStr,'utf-8',errors='ignore')
+        # write a new file and swap it in, so an interrupted
+        # save never leaves a half-written file behind
+        tempPath=path.with_name(path.name+'.tmp')
+        tempPath.write_text(self.jsonStr,'utf-8',errors='ignore')
+        os.replace(tempPath,path)
     save=saveJson
 
     def __repr__(self):
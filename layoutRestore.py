@@ -0,0 +1,207 @@
+"""
+Plan and carry out reopening all of the windows of a document
+wherever they last were, across all machines.
+
+Rather than walking the layout and making one remote call per window,
+the planner gathers every placement in a single pass, groups them by
+machine, and then sends each machine one batched restore message.
+Each machine registers endpoints() so that it can receive that
+message and put the windows back in its own layout.
+"""
+import typing
+import concurrent.futures
+from jsonHelper import JsonBase,JsonLike,asJson
+from windowLayout import (
+    ConfederatedAppLayout,MachineLayout,DesktopLayout,DisplayLayout,
+    WindowLayout)
+from machineIdentity import MachineIdentity,localMachineIdentity
+from connectionTypes import ConnectionLookup
+
+
+RESTORE_ENDPOINT='restoreWindows'
+
+
+class WindowPlacement(JsonBase):
+    """
+    Where a single window is to be restored
+    """
+    def __init__(self,
+        desktop:str='',
+        display:str='',
+        window:typing.Optional[WindowLayout]=None,
+        jsonObj:typing.Optional[JsonLike]=None,
+        name:typing.Optional[str]=None):
+        """
+        :name: what the display calls the window
+            (default is the window's own name)
+        """
+        self.desktop=desktop
+        self.display=display
+        self.window=window
+        self.name=name if name is not None else getattr(window,'name','')
+        if jsonObj is not None:
+            self.jsonObj=asJson(jsonObj)
+
+    @property
+    def jsonObj(self)->JsonLike:
+        """
+        get/set this as a json object
+        """
+        return {
+            'desktop':self.desktop,
+            'display':self.display,
+            'name':self.name,
+            'window':self.window.jsonObj
+        }
+    @jsonObj.setter
+    def jsonObj(self,jsonObj:JsonLike):
+        """
+        get/set this as a json object
+        """
+        self.desktop=jsonObj.get('desktop','')
+        self.display=jsonObj.get('display','')
+        self.window=WindowLayout(jsonObj.get('window',{}))
+        self.name=jsonObj.get('name',self.window.name)
+
+
+RestorePlan=typing.Dict[MachineIdentity,typing.List[WindowPlacement]]
+# the response from each machine, or why there was none
+RestoreResults=typing.Dict[MachineIdentity,typing.Union[JsonLike,Exception]]
+
+
+class LayoutRestorePlanner:
+    """
+    Plan and carry out reopening all of the windows of a document
+    wherever they last were, across all machines.
+    """
+    def __init__(self,
+        layout:ConfederatedAppLayout,
+        timeout:float=5.0,
+        maxWorkers:typing.Optional[int]=None,
+        localMachine:typing.Optional[MachineIdentity]=None):
+        """
+        :timeout: how long to wait on any single machine, in seconds
+        :maxWorkers: how many machines to contact at once
+            (default is all of them.  If it is fewer, the timeout
+            also includes time spent waiting for a free worker.)
+        :localMachine: the machine restores sent to us are put on
+            (default is this one)
+        """
+        self.layout=layout
+        self.timeout=timeout
+        self.maxWorkers=maxWorkers
+        self.localMachine=localMachine
+
+    def plan(self,document:str)->RestorePlan:
+        """
+        Find every window that was showing a document,
+        grouped by the machine it was on.
+
+        This is a single pass over the layout.
+        """
+        ret:RestorePlan={}
+        for machineKey,machine in self.layout.machines.items():
+            placements:typing.List[WindowPlacement]=[]
+            for desktopName,desktop in machine.desktops.items():
+                for displayName,display in desktop.displays.items():
+                    for name,window in display.windows.items():
+                        if window.document==document:
+                            placements.append(WindowPlacement(
+                                desktopName,displayName,window,name=name))
+            if placements:
+                ret[machineKey]=placements
+        return ret
+
+    def execute(self,
+        plan:RestorePlan,
+        getConnection:ConnectionLookup
+        )->RestoreResults:
+        """
+        Send each machine one batched restore message, all in parallel.
+
+        :getConnection: get the ApiCommunication for a machine
+        :return: the response from each machine, or the exception
+            (including TimeoutError) if it did not succeed
+        """
+        results:RestoreResults={}
+        if not plan:
+            return results
+        def restore(
+            machineKey:MachineIdentity,
+            placements:typing.List[WindowPlacement]
+            )->JsonLike:
+            connection=getConnection(machineKey)
+            return connection.callRemoteEndpoint(
+                RESTORE_ENDPOINT,[p.jsonObj for p in placements])
+        maxWorkers=self.maxWorkers or len(plan)
+        executor=concurrent.futures.ThreadPoolExecutor(maxWorkers)
+        try:
+            futures={
+                executor.submit(restore,machineKey,placements):machineKey
+                for machineKey,placements in plan.items()}
+            done,notDone=concurrent.futures.wait(
+                futures,timeout=self.timeout)
+            for future in done:
+                machineKey=futures[future]
+                try:
+                    results[machineKey]=future.result()
+                except Exception as e:
+                    results[machineKey]=e
+            for future in notDone:
+                future.cancel()
+                machineKey=futures[future]
+                results[machineKey]=TimeoutError(
+                    f'No restore response from {machineKey}'
+                    f' within {self.timeout}s')
+        finally:
+            # do not hold up the caller on machines that timed out
+            executor.shutdown(wait=False,cancel_futures=True)
+        return results
+
+    def endpoints(self)->typing.Dict[str,typing.Callable[...,JsonLike]]:
+        """
+        The api endpoints to register, by name
+        """
+        return {RESTORE_ENDPOINT:self.restoreEndpoint}
+
+    def restoreEndpoint(self,placements:typing.List[JsonLike])->JsonLike:
+        """
+        Another machine asks us to put windows back where they were
+        """
+        machine=self._localMachineLayout()
+        for jsonObj in placements:
+            placement=WindowPlacement(jsonObj=jsonObj)
+            desktop=machine.desktops.get(placement.desktop)
+            if desktop is None:
+                desktop=DesktopLayout({'name':placement.desktop})
+                machine.desktops[placement.desktop]=desktop
+            display=desktop.displays.get(placement.display)
+            if display is None:
+                display=DisplayLayout({'name':placement.display})
+                desktop.displays[placement.display]=display
+            display.addWindow(placement.window,placement.name)
+        return {'restored':len(placements)}
+
+    def _localMachineLayout(self)->MachineLayout:
+        """
+        Get the layout for this machine, adding it if need be
+        """
+        identity=self.localMachine
+        if identity is None:
+            identity=localMachineIdentity
+        machine=self.layout.machines.get(identity)
+        if machine is None:
+            machine=MachineLayout({})
+            machine.identity=identity
+            self.layout.machines[identity]=machine
+        return machine
+
+    def restore(self,
+        document:str,
+        getConnection:ConnectionLookup
+        )->RestoreResults:
+        """
+        Reopen all windows for a document wherever they last were
+        """
+        return self.execute(self.plan(document),getConnection)
+    __call__=restore
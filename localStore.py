@@ -0,0 +1,408 @@
+"""
+Crash-safe local storage of confederated state (layouts, documents)
+
+Everything lives in one sqlite database in WAL (write-ahead log)
+mode, so an interrupted write can never leave a half-written file.
+Writes are queued and committed by a background thread in groups,
+so a burst of small updates costs one transaction rather than one
+each.  Key/value state is read into memory on startup, so reads
+never touch the disk.
+
+Append-only logs (such as a document's operations) can be collapsed
+into a snapshot from time to time, so that recovering them on startup
+reads one row instead of replaying every record.
+"""
+import typing
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from jsonHelper import JsonLike
+from documentReference import DocumentReference,Operation,LogContents
+if typing.TYPE_CHECKING:
+    from windowLayout import ConfederatedAppLayout
+
+
+_SCHEMA="""
+CREATE TABLE IF NOT EXISTS kv(
+    collection TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY(collection,key)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS log(
+    stream TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY(stream,seq)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS snapshot(
+    stream TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    value TEXT NOT NULL) WITHOUT ROWID;
+"""
+# queued write statements
+_PUT="INSERT OR REPLACE INTO kv(collection,key,value) VALUES(?,?,?)"
+_DELETE="DELETE FROM kv WHERE collection=? AND key=?"
+_APPEND="INSERT OR REPLACE INTO log(stream,seq,value) VALUES(?,?,?)"
+_SNAPSHOT="INSERT OR REPLACE INTO snapshot(stream,seq,value) VALUES(?,?,?)"
+_TRUNCATE="DELETE FROM log WHERE stream=? AND seq<=?"
+
+
+def _dumps(value:JsonLike)->str:
+    return json.dumps(value,separators=(',',':'))
+
+
+class LocalStore:
+    """
+    Crash-safe local storage with group commit
+    """
+    def __init__(self,
+        applicationIdentity:str='ConfederatedApp',
+        filename:typing.Union[None,str,Path]=None,
+        commitDelay:float=0.002,
+        maxBatch:int=4096,
+        durable:bool=False):
+        """
+        :filename: the database file
+            (default is ~/.<applicationIdentity>/state.sqlite)
+        :commitDelay: how long to wait for more writes to arrive
+            before committing a group of them, in seconds
+        :maxBatch: commit right away once this many writes are waiting
+        :durable: fsync every commit (otherwise a power failure can lose
+            the last few commits, but never corrupts the database)
+        """
+        if filename is None:
+            filename=Path.home()/f'.{applicationIdentity}'/'state.sqlite'
+        self.filename=Path(filename)
+        self.filename.parent.mkdir(parents=True,exist_ok=True)
+        self.commitDelay=commitDelay
+        self.maxBatch=maxBatch
+        self.commits=0
+        self._db=sqlite3.connect(str(self.filename),check_same_thread=False,
+            isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        synchronous='FULL' if durable else 'NORMAL'
+        self._db.execute(f'PRAGMA synchronous={synchronous}')
+        self._db.executescript(_SCHEMA)
+        self._dbLock=threading.Lock()
+        # recover
+        self._kv:typing.Dict[str,typing.Dict[str,JsonLike]]={}
+        for collection,key,value in self._db.execute(
+            'SELECT collection,key,value FROM kv'):
+            self._kv.setdefault(collection,{})[key]=json.loads(value)
+        self._logLengths:typing.Dict[str,int]=dict(self._db.execute(
+            'SELECT stream,MAX(seq) FROM (SELECT stream,seq FROM log UNION ALL'
+            ' SELECT stream,seq FROM snapshot) GROUP BY stream'))
+        # group commit
+        self._queue:typing.List[typing.Tuple[str,tuple]]=[]
+        self._queued=0 # number of writes ever queued
+        self._committed=0 # number of writes ever committed
+        self._error:typing.Optional[BaseException]=None
+        self._condition=threading.Condition()
+        self._closed=False
+        self._writer=threading.Thread(target=self._writeLoop,
+            name='LocalStoreWriter',daemon=True)
+        self._writer.start()
+
+    def _enqueue(self,statement:str,args:tuple)->int:
+        with self._condition:
+            if self._closed:
+                raise ValueError(f'{self.filename} is closed')
+            self._queue.append((statement,args))
+            self._queued+=1
+            self._condition.notify_all()
+            return self._queued
+
+    def _writeLoop(self)->None:
+        """
+        Commit whatever has been queued, a group at a time
+        """
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                # give a burst of writes a moment to pile up
+                deadline=time.monotonic()+self.commitDelay
+                while not self._closed and len(self._queue)<self.maxBatch:
+                    remaining=deadline-time.monotonic()
+                    if remaining<=0:
+                        break
+                    self._condition.wait(remaining)
+                batch=self._queue
+                self._queue=[]
+            try:
+                with self._dbLock:
+                    self._db.execute('BEGIN')
+                    try:
+                        for statement,args in batch:
+                            self._db.execute(statement,args)
+                        self._db.execute('COMMIT')
+                    except BaseException:
+                        self._db.execute('ROLLBACK')
+                        raise
+                self.commits+=1
+            except Exception as e: # pylint: disable=broad-except
+                self._error=e
+            with self._condition:
+                self._committed+=len(batch)
+                self._condition.notify_all()
+
+    def flush(self,ticket:typing.Optional[int]=None,
+        timeout:typing.Optional[float]=None)->None:
+        """
+        Wait until writes are safely committed
+
+        :ticket: what a write returned (default is every write so far)
+        """
+        with self._condition:
+            if ticket is None:
+                ticket=self._queued
+            if not self._condition.wait_for(
+                lambda:self._committed>=ticket,timeout):
+                raise TimeoutError(f'{self.filename} commit timed out')
+        if self._error is not None:
+            error,self._error=self._error,None
+            raise error
+
+    def close(self)->None:
+        """
+        Commit anything waiting, and close the database
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed=True
+            self._condition.notify_all()
+        self._writer.join()
+        with self._dbLock:
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._db.close()
+
+    def __enter__(self)->"LocalStore":
+        return self
+
+    def __exit__(self,*_)->None:
+        self.close()
+
+    # key/value state
+
+    def get(self,
+        collection:str,
+        key:str,
+        default:JsonLike=None
+        )->JsonLike:
+        """
+        Get a value
+        """
+        return self._kv.get(collection,{}).get(key,default)
+
+    def items(self,collection:str)->typing.Dict[str,JsonLike]:
+        """
+        Get everything in a collection
+        """
+        return dict(self._kv.get(collection,{}))
+
+    def put(self,collection:str,key:str,value:JsonLike)->int:
+        """
+        Set a value
+
+        It can be read back right away, and is committed shortly after.
+
+        :return: a ticket to pass to flush() to wait for the commit
+        """
+        data=_dumps(value)
+        with self._condition: # so the queue is in the same order as the cache
+            self._kv.setdefault(collection,{})[key]=value
+            return self._enqueue(_PUT,(collection,key,data))
+
+    def delete(self,collection:str,key:str)->int:
+        """
+        Remove a value
+
+        :return: a ticket to pass to flush() to wait for the commit
+        """
+        with self._condition:
+            self._kv.get(collection,{}).pop(key,None)
+            return self._enqueue(_DELETE,(collection,key))
+
+    # append-only logs
+
+    def logLength(self,stream:str)->int:
+        """
+        How many records have ever been appended to a log
+        """
+        return self._logLengths.get(stream,0)
+
+    def append(self,stream:str,records:typing.Iterable[JsonLike])->int:
+        """
+        Append records to a log
+
+        :return: a ticket to pass to flush() to wait for the commit
+        """
+        ticket=self._queued
+        with self._condition:
+            seq=self._logLengths.get(stream,0)
+            for record in records:
+                seq+=1
+                ticket=self._enqueue(_APPEND,(stream,seq,_dumps(record)))
+            self._logLengths[stream]=seq
+        return ticket
+
+    def snapshot(self,stream:str,value:JsonLike,seq:int)->int:
+        """
+        Replace the first seq records of a log with a snapshot
+
+        :value: whatever the first seq records add up to
+        :return: a ticket to pass to flush() to wait for the commit
+        """
+        with self._condition:
+            self._enqueue(_SNAPSHOT,(stream,seq,_dumps(value)))
+            return self._enqueue(_TRUNCATE,(stream,seq))
+
+    def read(self,
+        stream:str
+        )->typing.Tuple[typing.Optional[JsonLike],typing.List[JsonLike]]:
+        """
+        Read a log back
+
+        :return: (the latest snapshot (if any),the records after it)
+        """
+        self.flush()
+        with self._dbLock:
+            row=self._db.execute(
+                'SELECT seq,value FROM snapshot WHERE stream=?',
+                (stream,)).fetchone()
+            seq,snapshot=(row[0],json.loads(row[1])) if row else (0,None)
+            records=[json.loads(value) for value, in self._db.execute(
+                'SELECT value FROM log WHERE stream=? AND seq>? ORDER BY seq',
+                (stream,seq))]
+        return snapshot,records
+
+
+class DocumentStore:
+    """
+    Keeps the operation logs of documents in a LocalStore,
+    so that they survive a restart.
+
+    A snapshot holds what the OperationLog itself holds: the state of
+    the document that was left when the log was last truncated (eg,
+    by CrdtDocument.compact()), the version vector it covers, and the
+    operations still kept after it.
+    """
+    def __init__(self,store:LocalStore,snapshotEvery:int=10000):
+        """
+        :snapshotEvery: collapse a document's log into a snapshot
+            once this many operations have been appended since the last one
+        """
+        self.store=store
+        self.snapshotEvery=snapshotEvery
+        self.documents:typing.Dict[str,DocumentReference]={}
+        self._snapshotAt:typing.Dict[str,int]={}
+
+    @staticmethod
+    def streamName(documentId:str)->str:
+        """
+        The name of a document's log in the store
+        """
+        return 'document/'+documentId
+
+    def open(self,document:DocumentReference)->DocumentReference:
+        """
+        Restore a document's operations, and record every new one
+
+        Open it before building a document model (eg, CrdtDocument)
+        on it, so the model starts from the restored snapshot.
+        """
+        stream=self.streamName(document.documentId)
+        snapshot,records=self.store.read(stream)
+        stored:typing.Set[typing.Tuple[str,int]]=set()
+        if isinstance(snapshot,dict):
+            contents=LogContents(snapshot.get('state'),
+                snapshot.get('versionVector',{}),
+                [Operation(jsonObj=op)
+                    for op in snapshot.get('operations',[])],
+                snapshot.get('lamport',0))
+            document.log.restore(contents)
+            stored.update(op.id for op in contents.operations)
+            snapshot=None
+        # (older snapshots are just a list of operations)
+        ops=[Operation(jsonObj=record) for record in (snapshot or [])+records]
+        document.merge(ops)
+        stored.update(op.id for op in ops)
+        unstored=[op.jsonObj for op in document.log.operations()
+            if op.id not in stored]
+        if unstored:
+            self.store.append(stream,unstored)
+        self._snapshotAt[document.documentId]=\
+            self.store.logLength(stream)-len(records)
+        self.documents[document.documentId]=document
+        document.onOperationsCallbacks.append(self._operationsAdded)
+        return document
+
+    def close(self,documentId:str)->None:
+        """
+        Stop recording a document
+        """
+        document=self.documents.pop(documentId,None)
+        if document is not None \
+            and self._operationsAdded in document.onOperationsCallbacks:
+            document.onOperationsCallbacks.remove(self._operationsAdded)
+
+    def _operationsAdded(self,
+        document:DocumentReference,
+        ops:typing.List[Operation]
+        )->None:
+        stream=self.streamName(document.documentId)
+        self.store.append(stream,[op.jsonObj for op in ops])
+        length=self.store.logLength(stream)
+        sinceSnapshot=length-self._snapshotAt.get(document.documentId,0)
+        if sinceSnapshot>=self.snapshotEvery:
+            self.snapshot(document.documentId)
+
+    def snapshot(self,documentId:str)->None:
+        """
+        Collapse a document's log into a single snapshot
+        """
+        document=self.documents[documentId]
+        stream=self.streamName(documentId)
+        # every record up to length is already in the log, so the copy
+        # holds them all.  It may also hold operations still waiting to
+        # be appended, which is harmless since merging ignores duplicates
+        length=self.store.logLength(stream)
+        contents=document.log.contents()
+        self.store.snapshot(stream,{
+            'state':contents.state,
+            'versionVector':contents.stateVector,
+            'operations':[op.jsonObj for op in contents.operations],
+            'lamport':contents.lamport
+            },length)
+        self._snapshotAt[documentId]=length
+
+
+LAYOUT_COLLECTION='layout'
+
+
+def saveLayout(store:LocalStore,layout:"ConfederatedAppLayout")->int:
+    """
+    Save the window layout, only writing the machines that changed
+
+    :return: a ticket to pass to flush() to wait for the commit
+    """
+    ticket=0
+    machines=layout.jsonObj['machines']
+    for key,machine in machines.items():
+        if store.get(LAYOUT_COLLECTION,key)!=machine:
+            ticket=store.put(LAYOUT_COLLECTION,key,machine)
+    for key in store.items(LAYOUT_COLLECTION):
+        if key not in machines:
+            ticket=store.delete(LAYOUT_COLLECTION,key)
+    return ticket
+
+
+def loadLayout(store:LocalStore,layout:"ConfederatedAppLayout")->None:
+    """
+    Load the saved window layout (if any) into a layout
+    """
+    layout.jsonObj={'machines':store.items(LAYOUT_COLLECTION)}
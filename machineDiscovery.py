@@ -3,13 +3,70 @@ Tools to locate other machines that are also
 running instances of this confederated application.
 """
 import typing
+import time
+import asyncio
+import inspect
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from jsonHelper import JsonBase,JsonLike
 from machineIdentity import localDeviceIdentity,NetworkLocation,MachineIdentity
-from remoteApi import queryMachineIdentity
 
 
 ApplicationIdentity=str
+MachineAddress=typing.Hashable
 MachineAddedCallback=typing.Callable[[MachineIdentity],None]
 MachineRemovedCallback=typing.Callable[[MachineIdentity],None]
+IdentityQuery=typing.Callable[
+    [MachineAddress],
+    typing.Union[typing.Optional[MachineIdentity],
+        typing.Awaitable[typing.Optional[MachineIdentity]]]]
+# A discovery source is anything with
+#   announce(networkLocation:str,serviceIdentity:str)
+#   find(serviceIdentity:str)->Iterable[anything with an .address]
+DiscoverySource=typing.Any
+logger=logging.getLogger(__name__)
+
+
+def defaultDiscoverySources()->typing.List[DiscoverySource]:
+    """
+    Discover machines with both zeroconf and upnp
+    """
+    import zeroconf
+    import upnp
+    return [zeroconf,upnp]
+
+
+def asNetworkLocation(address:MachineAddress)->NetworkLocation:
+    """
+    Get an address a discovery source found as a NetworkLocation
+    (which can be a NetworkLocation, "host:port" or (host,port))
+    """
+    if isinstance(address,NetworkLocation):
+        return address
+    if isinstance(address,str):
+        host,_,port=address.rpartition(':')
+        return NetworkLocation(host,int(port))
+    host,port=address
+    return NetworkLocation(host,int(port))
+
+
+def defaultIdentityQuery(
+    address:MachineAddress,
+    useSecureConnection:bool=True
+    )->typing.Optional[MachineIdentity]:
+    """
+    Ask a remote machine who it is, over a connection of its own
+    """
+    from apiCommunication import ApiCommunication
+    from remoteApi import queryMachineIdentity
+    connection=ApiCommunication(asNetworkLocation(address),None,
+        useSecureConnection=useSecureConnection,maxAttempts=1)
+    try:
+        return queryMachineIdentity(connection)
+    finally:
+        connection.stop()
 
 
 class MachineDisoveryManager:
@@ -27,15 +84,36 @@ class MachineDisoveryManager:
         onMachineAddedCallbacks:typing.Optional[
             typing.Iterable[MachineAddedCallback]]=None,
         onMachineRemovedCallbacks:typing.Optional[
-            typing.Iterable[MachineRemovedCallback]]=None):
-        """ """
-        self._machines:typing.Dict[str,MachineIdentity]={}
+            typing.Iterable[MachineRemovedCallback]]=None,
+        discoverySources:typing.Optional[
+            typing.Iterable[DiscoverySource]]=None,
+        identityQuery:typing.Optional[IdentityQuery]=None,
+        maxConcurrentQueries:int=16,
+        queryTimeout:float=2.0):
+        """
+        :discoverySources: where to announce and find machines
+            (default is zeroconf and upnp)
+        :identityQuery: how to ask a machine at an address who it is.
+            May be a regular function or a coroutine function.
+            (default is remoteApi.queryMachineIdentity)
+        :maxConcurrentQueries: how many machines to query at once
+        :queryTimeout: how long to wait on any one machine, in seconds
+        """
+        self._machines:typing.Dict[MachineAddress,MachineIdentity]={}
         self.applicationIdentity=applicationIdentity
-        self.announce(networkLocation)
+        if discoverySources is None:
+            discoverySources=defaultDiscoverySources()
+        self.discoverySources:typing.List[DiscoverySource]=\
+            list(discoverySources)
+        self.identityQuery:IdentityQuery=\
+            identityQuery or defaultIdentityQuery
+        self.maxConcurrentQueries=maxConcurrentQueries
+        self.queryTimeout=queryTimeout
         self.onMachineAddedCallbacks:typing.List[MachineAddedCallback]=\
-            list(onMachineAddedCallbacks)
+            list(onMachineAddedCallbacks or ())
         self.onMachineRemovedCallbacks:typing.List[MachineRemovedCallback]=\
-            list(onMachineRemovedCallbacks)
+            list(onMachineRemovedCallbacks or ())
+        self.announce(networkLocation)
 
     @property
     def serviceIdentity(self)->str:
@@ -44,6 +122,32 @@ class MachineDisoveryManager:
         """
         return 'confederatedApplication.'+self.applicationIdentity
 
+    @property
+    def machines(self)->typing.Dict[MachineAddress,MachineIdentity]:
+        """
+        All machines currently known, by address
+        """
+        return dict(self._machines)
+
+    def removeMachine(self,machine:MachineIdentity)->bool:
+        """
+        Forget a machine that is known to have gone away
+        (eg, it stopped answering heartbeats), calling
+        the removed callbacks.
+
+        If it is still being announced, it will be found
+        again on the next refresh.
+
+        :return: whether the machine was known
+        """
+        for address,known in list(self._machines.items()):
+            if known is machine:
+                del self._machines[address]
+                for fn in self.onMachineRemovedCallbacks:
+                    fn(machine)
+                return True
+        return False
+
     def announce(self,
         networkLocation:NetworkLocation):
         """
@@ -53,27 +157,470 @@ class MachineDisoveryManager:
         Only need to call this manually if the network location changes.)
         """
         localDeviceIdentity.networkLocation=networkLocation
-        upnp.announce(str(networkLocation),self.serviceIdentity)
-        zeroconf.annunce(str(networkLocation),self.serviceIdentity)
+        for source in self.discoverySources:
+            source.announce(str(networkLocation),self.serviceIdentity)
+
+    def findAddresses(self)->typing.Set[MachineAddress]:
+        """
+        Ask all discovery sources for the addresses of
+        machines running this application
+        """
+        ret:typing.Set[MachineAddress]=set()
+        for source in self.discoverySources:
+            found=source.find(self.serviceIdentity)
+            ret.update(machine.address for machine in found)
+        return ret
 
-    def refresh(self):
+    async def _queryIdentity(self,
+        address:MachineAddress,
+        semaphore:asyncio.Semaphore,
+        executor:ThreadPoolExecutor
+        )->typing.Tuple[MachineAddress,typing.Optional[MachineIdentity]]:
+        """
+        Query a single machine, giving up after queryTimeout
+        """
+        async with semaphore:
+            try:
+                if inspect.iscoroutinefunction(self.identityQuery):
+                    query=self.identityQuery(address)
+                else:
+                    query=asyncio.get_running_loop().run_in_executor(
+                        executor,self.identityQuery,address)
+                machine=await asyncio.wait_for(query,self.queryTimeout)
+            except asyncio.TimeoutError:
+                machine=None
+            except Exception as e: # pylint: disable=broad-except
+                logger.warning(
+                    'Unable to query machine identity at %s: %s',address,e)
+                machine=None
+        return address,machine
+
+    async def refreshAsync(self)->None:
         """
         find all machines running this application
+
+        All new machines are queried concurrently (up to
+        maxConcurrentQueries at a time) and the added callbacks
+        are called as each one answers.
         """
-        updatedMachineList=set([
-            machine.address for machine in zeroconf.find(self.serviceIdentity)])
-        updatedMachineList.union([
-            machine.address for machine in upnp.find(self.serviceIdentity)])
-        # check for new machines added
-        for address in updatedMachineList:
-            if address not in self._machines:
-                machine=queryMachineIdentity(address)
-                if machine:
-                    self._machines[address]=machine
-                    for fn in self.onMachineAddedCallbacks:
-                        fn(machine)
+        loop=asyncio.get_running_loop()
+        updatedMachineList=await loop.run_in_executor(
+            None,self.findAddresses)
         # check for old machines removed
-        for address,machine in self._machines:
+        for address,machine in list(self._machines.items()):
             if address not in updatedMachineList:
+                del self._machines[address]
                 for fn in self.onMachineRemovedCallbacks:
                     fn(machine)
+        # check for new machines added
+        newAddresses=[address for address in updatedMachineList
+            if address not in self._machines]
+        if not newAddresses:
+            return
+        semaphore=asyncio.Semaphore(self.maxConcurrentQueries)
+        executor=ThreadPoolExecutor(self.maxConcurrentQueries)
+        try:
+            queries=[self._queryIdentity(address,semaphore,executor)
+                for address in newAddresses]
+            for query in asyncio.as_completed(queries):
+                address,machine=await query
+                if machine and address not in self._machines:
+                    self._machines[address]=machine
+                    for fn in self.onMachineAddedCallbacks:
+                        fn(machine)
+        finally:
+            # do not wait on queries that timed out
+            executor.shutdown(wait=False,cancel_futures=True)
+
+    def refresh(self)->typing.Optional[asyncio.Task]:
+        """
+        find all machines running this application
+
+        If called from within a running asyncio loop, the refresh is
+        scheduled on that loop and the task is returned.  Otherwise
+        this blocks until the refresh is done.
+        """
+        try:
+            loop=asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self.refreshAsync())
+            return None
+        return loop.create_task(self.refreshAsync())
+
+
+class CachedMachineIdentity(JsonBase):
+    """
+    A machine identity as remembered by MachineIdentityCache
+    """
+    def __init__(self,
+        identity:typing.Optional[MachineIdentity]=None,
+        fingerprint:typing.Optional[str]=None,
+        expires:float=0.0,
+        jsonObj:typing.Optional[JsonLike]=None):
+        """ """
+        self.identity=identity
+        self.fingerprint=fingerprint
+        self.expires=expires
+        if jsonObj is not None:
+            self.jsonObj=jsonObj
+
+    @property
+    def expired(self)->bool:
+        """
+        Whether this is too old to be trusted
+        """
+        return time.time()>=self.expires
+
+    @property
+    def jsonObj(self)->JsonLike:
+        """
+        get/set this as a json object
+        """
+        return {
+            'identity':self.identity.jsonObj,
+            'fingerprint':self.fingerprint,
+            'expires':self.expires
+        }
+    @jsonObj.setter
+    def jsonObj(self,jsonObj:JsonLike):
+        """
+        get/set this as a json object
+        """
+        self.identity=MachineIdentity.fromJson(jsonObj.get('identity',{}))
+        self.fingerprint=jsonObj.get('fingerprint')
+        self.expires=float(jsonObj.get('expires',0.0))
+
+
+class MachineIdentityCache(JsonBase):
+    """
+    Remembers the identities of machines, by address, so that they
+    do not need to be queried again every time they are seen.
+
+    Entries expire after a time-to-live, or as soon as a machine
+    announces a different fingerprint.
+    """
+    def __init__(self,
+        filename:typing.Optional[Path]=None,
+        ttl:float=24*60*60):
+        """
+        :filename: where to persist the cache (None to not persist)
+        :ttl: how long an identity is trusted for, in seconds
+        """
+        self.filename=filename
+        self.ttl=ttl
+        self._entries:typing.Dict[str,CachedMachineIdentity]={}
+        if filename is not None and filename.exists():
+            self.load(filename)
+
+    @property
+    def jsonObj(self)->JsonLike:
+        """
+        get/set this as a json object
+        """
+        return {address:entry.jsonObj
+            for address,entry in self._entries.items()
+            if not entry.expired}
+    @jsonObj.setter
+    def jsonObj(self,jsonObj:JsonLike):
+        """
+        get/set this as a json object
+        """
+        self._entries={}
+        for address,entry in jsonObj.items():
+            cached=CachedMachineIdentity(jsonObj=entry)
+            if not cached.expired:
+                self._entries[address]=cached
+
+    def __len__(self)->int:
+        return len(self._entries)
+
+    def get(self,
+        address:MachineAddress,
+        fingerprint:typing.Optional[str]=None
+        )->typing.Optional[MachineIdentity]:
+        """
+        Get a cached identity, if it is still good
+
+        :fingerprint: what the machine is currently announcing.
+            If it differs from what was cached, the entry is stale.
+        """
+        entry=self._entries.get(str(address))
+        if entry is None:
+            return None
+        changed=fingerprint is not None and fingerprint!=entry.fingerprint
+        if entry.expired or changed:
+            del self._entries[str(address)]
+            return None
+        return entry.identity
+
+    def set(self,
+        address:MachineAddress,
+        identity:MachineIdentity,
+        fingerprint:typing.Optional[str]=None
+        )->None:
+        """
+        Remember an identity
+        """
+        self._entries[str(address)]=CachedMachineIdentity(
+            identity,fingerprint,time.time()+self.ttl)
+
+    def discard(self,address:MachineAddress)->None:
+        """
+        Forget an identity
+        """
+        self._entries.pop(str(address),None)
+
+    def save(self,path:typing.Union[None,str,Path]=None)->None:
+        """
+        Save to the cache file
+        """
+        path=path or self.filename
+        if path is None:
+            return
+        path=Path(path)
+        path.parent.mkdir(parents=True,exist_ok=True)
+        self.saveJson(path)
+
+
+class MachineDiscoveryService(MachineDisoveryManager):
+    """
+    A background discovery service that reacts to service
+    added/removed announcements rather than polling.
+
+    * identities are cached (and persisted to disk) so that
+        a machine is only queried when first seen, when its
+        cache entry expires, or when it announces a new
+        version/fingerprint
+    * a machine that disappears and comes back within
+        debounceTime does not trigger any callbacks
+
+    Discovery sources that have a
+        subscribe(serviceIdentity,onServiceAdded,onServiceRemoved)
+    method are listened to.  Others are polled every pollInterval.
+    Announcements may have a .fingerprint or .version to
+    tell when a machine's identity has changed.
+    """
+    def __init__(self,
+        applicationIdentity:ApplicationIdentity,
+        networkLocation:NetworkLocation,
+        onMachineAddedCallbacks:typing.Optional[
+            typing.Iterable[MachineAddedCallback]]=None,
+        onMachineRemovedCallbacks:typing.Optional[
+            typing.Iterable[MachineRemovedCallback]]=None,
+        discoverySources:typing.Optional[
+            typing.Iterable[DiscoverySource]]=None,
+        identityQuery:typing.Optional[IdentityQuery]=None,
+        maxConcurrentQueries:int=16,
+        queryTimeout:float=2.0,
+        identityCache:typing.Optional[MachineIdentityCache]=None,
+        debounceTime:float=5.0,
+        pollInterval:float=30.0):
+        """
+        :identityCache: where to remember identities (default
+            is ~/.applicationIdentity/identityCache.json)
+        :debounceTime: how long a machine must be gone before
+            it is considered removed, in seconds
+        :pollInterval: how often to poll discovery sources
+            that cannot be subscribed to, in seconds
+        """
+        if identityCache is None:
+            identityCache=MachineIdentityCache(
+                Path.home()/f'.{applicationIdentity}'/'identityCache.json')
+        self.identityCache=identityCache
+        self.debounceTime=debounceTime
+        self.pollInterval=pollInterval
+        self._loop:typing.Optional[asyncio.AbstractEventLoop]=None
+        self._thread:typing.Optional[threading.Thread]=None
+        self._semaphore:typing.Optional[asyncio.Semaphore]=None
+        self._executor:typing.Optional[ThreadPoolExecutor]=None
+        self._pendingRemovals:typing.Dict[
+            MachineAddress,asyncio.TimerHandle]={}
+        self._fingerprints:typing.Dict[MachineAddress,typing.Optional[str]]={}
+        self._querying:typing.Set[MachineAddress]=set()
+        self._polledAddresses:typing.Set[MachineAddress]=set()
+        MachineDisoveryManager.__init__(self,
+            applicationIdentity,networkLocation,
+            onMachineAddedCallbacks,onMachineRemovedCallbacks,
+            discoverySources,identityQuery,
+            maxConcurrentQueries,queryTimeout)
+
+    def start(self)->None:
+        """
+        Start listening in the background
+        """
+        if self._thread is not None:
+            return
+        self._loop=asyncio.new_event_loop()
+        self._executor=ThreadPoolExecutor(self.maxConcurrentQueries)
+        started=threading.Event()
+        def runLoop()->None:
+            asyncio.set_event_loop(self._loop)
+            self._semaphore=asyncio.Semaphore(self.maxConcurrentQueries)
+            started.set()
+            self._loop.run_forever()
+        self._thread=threading.Thread(target=runLoop,daemon=True)
+        self._thread.start()
+        started.wait()
+        polled=False
+        for source in self.discoverySources:
+            if hasattr(source,'subscribe'):
+                source.subscribe(self.serviceIdentity,
+                    self.onServiceAdded,self.onServiceRemoved)
+            else:
+                polled=True
+        if polled:
+            asyncio.run_coroutine_threadsafe(self._pollLoop(),self._loop)
+
+    def stop(self)->None:
+        """
+        Stop listening and save the identity cache
+        """
+        if self._thread is None:
+            return
+        for source in self.discoverySources:
+            if hasattr(source,'unsubscribe'):
+                source.unsubscribe(self.serviceIdentity,
+                    self.onServiceAdded,self.onServiceRemoved)
+        loop=self._loop
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+        self._executor.shutdown(wait=False,cancel_futures=True)
+        self._loop=None
+        self._thread=None
+        self._pendingRemovals.clear()
+        self.identityCache.save()
+
+    def __del__(self):
+        if self._thread is not None:
+            self.stop()
+
+    @staticmethod
+    def _fingerprintOf(announcement:typing.Any)->typing.Optional[str]:
+        """
+        Get whatever an announcement says identifies this
+        particular version of the machine
+        """
+        fingerprint=getattr(announcement,'fingerprint',None)
+        if fingerprint is None:
+            fingerprint=getattr(announcement,'version',None)
+        return None if fingerprint is None else str(fingerprint)
+
+    def onServiceAdded(self,announcement:typing.Any)->None:
+        """
+        Called by a discovery source (from any thread)
+        when a machine announces itself
+        """
+        self._loop.call_soon_threadsafe(self._serviceAdded,
+            announcement.address,self._fingerprintOf(announcement))
+
+    def onServiceRemoved(self,announcement:typing.Any)->None:
+        """
+        Called by a discovery source (from any thread)
+        when a machine goes away
+        """
+        self._loop.call_soon_threadsafe(
+            self._serviceRemoved,announcement.address)
+
+    def _serviceAdded(self,
+        address:MachineAddress,
+        fingerprint:typing.Optional[str]
+        )->None:
+        """
+        A machine has appeared (runs in the service loop)
+        """
+        pending=self._pendingRemovals.pop(address,None)
+        if pending is not None:
+            pending.cancel() # it was only flapping
+        if address in self._machines \
+            and self._fingerprints.get(address)==fingerprint:
+            return
+        self._fingerprints[address]=fingerprint
+        identity=self.identityCache.get(address,fingerprint)
+        if identity is not None:
+            self._setMachine(address,identity)
+            return
+        if address not in self._querying:
+            self._querying.add(address)
+            self._loop.create_task(self._query(address,fingerprint))
+
+    async def _query(self,
+        address:MachineAddress,
+        fingerprint:typing.Optional[str]
+        )->None:
+        """
+        Query a machine we do not already know
+        """
+        try:
+            _,identity=await self._queryIdentity(
+                address,self._semaphore,self._executor)
+        finally:
+            self._querying.discard(address)
+        if identity is None:
+            return
+        if self._fingerprints.get(address,fingerprint)!=fingerprint:
+            return # it changed again while we were asking
+        self.identityCache.set(address,identity,fingerprint)
+        self.identityCache.save()
+        if address in self._fingerprints:
+            self._setMachine(address,identity)
+
+    def _setMachine(self,
+        address:MachineAddress,
+        identity:MachineIdentity
+        )->None:
+        """
+        Record a machine as present, calling back as necessary
+        """
+        previous=self._machines.get(address)
+        if previous is identity:
+            return
+        self._machines[address]=identity
+        if previous is not None:
+            for fn in self.onMachineRemovedCallbacks:
+                fn(previous)
+        for fn in self.onMachineAddedCallbacks:
+            fn(identity)
+
+    def _serviceRemoved(self,address:MachineAddress)->None:
+        """
+        A machine has gone away (runs in the service loop)
+        """
+        if address in self._pendingRemovals:
+            return
+        self._pendingRemovals[address]=self._loop.call_later(
+            self.debounceTime,self._removeNow,address)
+
+    def _removeNow(self,address:MachineAddress)->None:
+        """
+        A machine has been gone long enough to count as removed
+        """
+        self._pendingRemovals.pop(address,None)
+        self._fingerprints.pop(address,None)
+        machine=self._machines.pop(address,None)
+        if machine is not None:
+            for fn in self.onMachineRemovedCallbacks:
+                fn(machine)
+
+    async def _pollLoop(self)->None:
+        """
+        Turn polling of sources that cannot be subscribed
+        to into added/removed announcements
+        """
+        loop=asyncio.get_running_loop()
+        while True:
+            addresses:typing.Dict[MachineAddress,typing.Optional[str]]={}
+            for source in self.discoverySources:
+                if hasattr(source,'subscribe'):
+                    continue
+                found=await loop.run_in_executor(
+                    None,source.find,self.serviceIdentity)
+                for announcement in found:
+                    addresses[announcement.address]=\
+                        self._fingerprintOf(announcement)
+            for address,fingerprint in addresses.items():
+                self._serviceAdded(address,fingerprint)
+            for address in self._polledAddresses-set(addresses):
+                self._serviceRemoved(address)
+            self._polledAddresses=set(addresses)
+            await asyncio.sleep(self.pollInterval)
@@ -2,6 +2,8 @@
 Determine what device we are talking about
 """
 import typing
+import hashlib
+import weakref
 from jsonHelper import JsonBase,asJson,JsonCompatible
 
 
@@ -9,6 +11,8 @@ class NetworkLocation(JsonBase):
     """
     Network host and port
     """
+    __slots__=('host','port')
+
     def __init__(self,
         host:str,
         port:int,
@@ -37,10 +41,30 @@ class NetworkLocation(JsonBase):
         return f'{self.host}:{self.port}'
 
 
+_IDENTITY_FIELDS=frozenset(
+    ('userName','machineName','operatingSystem','machineType'))
+
+
 class MachineIdentity(JsonBase):
     """
     Determine what device we are talking about
+
+    Two identities are equal (and hash the same) if they have the
+    same fingerprint, regardless of network location.
+
+    The fields that make up the fingerprint are read-only once it is
+    constructed (so identities stay put in dicts and sets); only the
+    network location can change.
+
+    Use MachineIdentity.intern() or MachineIdentity.fromJson() to get
+    the one shared instance for a machine, so that equal identities
+    are usually also the same object.
     """
+    __slots__=('userName','machineName','operatingSystem','machineType',
+        'networkLocation','_fingerprint','__weakref__')
+    _registry:'weakref.WeakValueDictionary[str,MachineIdentity]'=\
+        weakref.WeakValueDictionary()
+
     def __init__(self,
         userName:str,
         machineName:str,
@@ -49,6 +73,7 @@ class MachineIdentity(JsonBase):
         networkLocation:typing.Optional[NetworkLocation]=None,
         jsonObj:typing.Optional[JsonCompatible]=None):
         """ """
+        self._fingerprint:typing.Optional[str]=None
         self.userName=userName
         self.machineName=machineName
         self.operatingSystem=operatingSystem
@@ -56,6 +81,10 @@ class MachineIdentity(JsonBase):
         self.networkLocation=networkLocation
         if jsonObj is not None:
             self.jsonObj=asJson(jsonObj)
+        fields='\x1f'.join((self.userName,self.machineName,
+            self.operatingSystem,self.machineType))
+        self._fingerprint=hashlib.sha256(
+            fields.encode('utf-8')).hexdigest()[:32]
 
     @property
     def jsonObj(self)->typing.Dict[str,typing.Any]:
@@ -68,7 +97,7 @@ class MachineIdentity(JsonBase):
             'operatingSystem':self.operatingSystem,
             'machineType':self.machineType}
         if self.networkLocation is not None:
-            ret['networkLocation']=self.networkLocation
+            ret['networkLocation']=self.networkLocation.jsonObj
         return ret
     @jsonObj.setter
     def jsonObj(self,jsonObj:typing.Dict[str,typing.Any]):
@@ -82,6 +111,65 @@ class MachineIdentity(JsonBase):
         else:
             self.networkLocation=NetworkLocation('',0,jsonObj=networkLocation)
 
+    def __setattr__(self,name:str,value:typing.Any)->None:
+        if name in _IDENTITY_FIELDS and self._fingerprint is not None:
+            raise AttributeError(
+                f'{name} identifies the machine, so it cannot change'
+                ' (create a new MachineIdentity instead)')
+        object.__setattr__(self,name,value)
+
+    @property
+    def fingerprint(self)->str:
+        """
+        A short, stable key for this machine, for use in dicts,
+        on the wire, and on disk.
+
+        Does not include the network location, since that can change
+        while it is still the same machine.
+        """
+        return typing.cast(str,self._fingerprint)
+
+    def __eq__(self,other:typing.Any)->bool:
+        if self is other:
+            return True
+        if not isinstance(other,MachineIdentity):
+            return NotImplemented
+        return self.fingerprint==other.fingerprint
+
+    def __hash__(self)->int:
+        return hash(self.fingerprint)
+
+    @classmethod
+    def intern(cls,identity:'MachineIdentity')->'MachineIdentity':
+        """
+        Get the shared instance for a machine, registering
+        this one if there is none yet.
+
+        If the identity knows a network location, the shared
+        instance is updated to it.
+        """
+        existing=cls._registry.get(identity.fingerprint)
+        if existing is None:
+            cls._registry[identity.fingerprint]=identity
+            return identity
+        if identity.networkLocation is not None:
+            existing.networkLocation=identity.networkLocation
+        return existing
+
+    @classmethod
+    def fromJson(cls,jsonObj:JsonCompatible)->'MachineIdentity':
+        """
+        Get the shared instance for a machine from its json
+        """
+        return cls.intern(cls('','','','',jsonObj=jsonObj))
+
+    @classmethod
+    def byFingerprint(cls,fingerprint:str)->typing.Optional['MachineIdentity']:
+        """
+        Look up a shared instance by fingerprint
+        """
+        return cls._registry.get(fingerprint)
+
     def __repr__(self):
         if self.networkLocation:
             return f'{self.userName} on {self.machineType} {self.machineName}({self.operatingSystem}) listening on {self.networkLocation}' # noqa: E501 # pylint: disable=line-too-long
@@ -115,6 +203,7 @@ def getLocalDeviceIdentity()->MachineIdentity:
         uname=platform.uname()
         osName=f'{uname[0]} {uname[1]}'
         machineType=getLocalMachineType()
-        localMachineIdentity=MachineIdentity(user,uname[1],osName,machineType)
+        localMachineIdentity=MachineIdentity.intern(
+            MachineIdentity(user,uname[1],osName,machineType))
     return localMachineIdentity
 localDeviceIdentity=getLocalDeviceIdentity()
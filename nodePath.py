@@ -4,6 +4,10 @@ TODO: include with paths
 """
 import typing
 import re
+import fnmatch
+import functools
+import threading
+import concurrent.futures
 
 
 class InvalidNodePath(IndexError):
@@ -14,6 +18,348 @@ class InvalidNodePath(IndexError):
 NodeLike=typing.Any
 PathStepType=typing.Union[str,typing.Pattern]
 PathCompatible=typing.Union[str,typing.Iterable[PathStepType]]
+
+# opcodes for a compiled path step
+OP_LITERAL=0 # arg is the exact child name
+OP_WILDCARD=1 # any single child
+OP_REGEX=2 # arg is a compiled regex that the child name must match
+OP_DOUBLESTAR=3 # any sequence of zero or more children
+OP_PARENT=4 # parent of the current node
+PathStep=typing.Tuple[int,typing.Any]
+class CompiledNodePath(typing.NamedTuple):
+    """
+    A path that has been compiled down to a simple program of steps
+    """
+    absolute:bool
+    steps:typing.Tuple[PathStep,...]
+    ignoreCase:bool
+    parts:typing.Tuple[PathStepType,...] # the uncompiled path parts
+
+# a shared, immutable path stack of (node,previousLink)
+PathLink=typing.Optional[typing.Tuple[NodeLike,typing.Any]]
+
+# a single step of a search in progress
+PathState=typing.Tuple[NodeLike,int,PathLink]
+BRANCHING_OPS=(OP_WILDCARD,OP_REGEX,OP_DOUBLESTAR)
+STOP_CHECK_INTERVAL=256
+PARALLEL_TASK_NAME='runNodePathTask'
+TASKS_PER_WORKER=4
+
+GLOB_SPECIAL_CHARS=re.compile(r'[*?\[]')
+COMPILE_CACHE_SIZE=1024
+
+
+def _splitRegexPath(path:str,separator:str)->typing.List[str]:
+    """
+    Splits a regex path into path segments
+    while preserving grouping and escapes.
+    """
+    segments=[]
+    current=''
+    depth=0
+    escape=False
+    for char in path:
+        if escape:
+            current+=char
+            escape=False
+        elif char=='\\':
+            current+=char
+            escape=True
+        elif char=='(':
+            current+=char
+            depth+=1
+        elif char==')':
+            current+=char
+            depth-=1
+        elif char==separator and depth==0:
+            segments.append(current)
+            current=''
+        else:
+            current+=char
+    if depth!=0:
+        raise InvalidNodePath("Unbalanced parentheses in path regex")
+    segments.append(current)
+    return segments
+
+
+def _compileStep(
+    part:PathStepType,
+    ignoreCase:bool,
+    matchStyle:str,
+    allowDoubleStar:bool
+    )->typing.Optional[PathStep]:
+    """
+    Compile a single path step
+
+    :return: the step, or None if the step is a no-op
+    """
+    flags=re.IGNORECASE if ignoreCase else 0
+    if isinstance(part,re.Pattern):
+        if ignoreCase and not part.flags&re.IGNORECASE:
+            part=re.compile(part.pattern,part.flags|re.IGNORECASE)
+        return (OP_REGEX,part)
+    if matchStyle=='strict':
+        return (OP_LITERAL,part.lower() if ignoreCase else part)
+    if part=='':
+        return None
+    if part=='**' and allowDoubleStar:
+        return (OP_DOUBLESTAR,None)
+    if matchStyle=='regex':
+        # "." and ".." are regexes here, not the current and parent node
+        return (OP_REGEX,re.compile(rf'^(?:{part})$',flags))
+    if part=='.':
+        return None
+    if part=='..':
+        return (OP_PARENT,None)
+    if part=='*':
+        return (OP_WILDCARD,None)
+    if GLOB_SPECIAL_CHARS.search(part) is not None:
+        return (OP_REGEX,re.compile(fnmatch.translate(part),flags))
+    return (OP_LITERAL,part.lower() if ignoreCase else part)
+
+
+def _compileParts(
+    parts:typing.Sequence[PathStepType],
+    absolute:bool,
+    ignoreCase:bool,
+    matchStyle:str,
+    allowDoubleStar:bool
+    )->CompiledNodePath:
+    """
+    Compile already-split path parts into a program
+    """
+    steps=[]
+    for part in parts:
+        step=_compileStep(part,ignoreCase,matchStyle,allowDoubleStar)
+        if step is None:
+            continue
+        if step[0]==OP_DOUBLESTAR and steps and steps[-1][0]==OP_DOUBLESTAR:
+            continue # "**/**" is the same as "**"
+        steps.append(step)
+    return CompiledNodePath(absolute,tuple(steps),ignoreCase,tuple(parts))
+
+
+def _splitPath(
+    path:str,
+    matchStyle:str,
+    separator:str
+    )->typing.Tuple[bool,typing.List[str]]:
+    """
+    Split a path string into its parts
+
+    :return: (absolute,parts)
+    """
+    absolute=path.startswith(separator)
+    if absolute:
+        path=path[len(separator):]
+    if matchStyle=='regex':
+        parts=_splitRegexPath(path,separator)
+    else:
+        parts=path.split(separator)
+    if matchStyle=='strict':
+        # strict still ignores empty segments like "a//b" or "a/"
+        parts=[p for p in parts if p]
+    return absolute,parts
+
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compileNodePath(
+    path:str,
+    matchStyle:str='glob',
+    ignoreCase:bool=False,
+    separator:str='/',
+    allowDoubleStar:bool=True
+    )->CompiledNodePath:
+    """
+    Compile a path string into a program of steps
+
+    Results are cached, so building the same NodePath
+    over and over is nearly free.
+    """
+    if matchStyle not in ('glob','regex','strict'):
+        raise InvalidNodePath(f'Unknown matchStyle "{matchStyle}"')
+    absolute,parts=_splitPath(path,matchStyle,separator)
+    return _compileParts(
+        parts,absolute,ignoreCase,matchStyle,allowDoubleStar)
+
+
+def iterChildren(node:NodeLike)->typing.Iterable[typing.Tuple[str,NodeLike]]:
+    """
+    Get (name,child) pairs for a node, whether its children
+    are a name->child mapping or simply a list of named nodes
+    """
+    children=node.children
+    if hasattr(children,'items'):
+        return children.items()
+    return ((child.name,child) for child in children)
+
+
+def reversedChildren(node:NodeLike)->typing.Iterable[NodeLike]:
+    """
+    Get the child nodes of a node, last first
+    """
+    children=node.children
+    if hasattr(children,'values'):
+        return reversed(children.values())
+    return reversed(list(children))
+
+
+def getChild(node:NodeLike,name:str)->typing.Optional[NodeLike]:
+    """
+    Get a direct child by name
+    (the first one, if the children are a list that repeats names)
+    """
+    children=node.children
+    if hasattr(children,'get'):
+        return children.get(name)
+    for child in children:
+        if child.name==name:
+            return child
+    return None
+
+
+def getChildren(node:NodeLike,name:str)->typing.List[NodeLike]:
+    """
+    Get every direct child with a given name
+
+    (There can be more than one if the children are a list.)
+    """
+    children=node.children
+    if hasattr(children,'get'):
+        child=children.get(name)
+        return [] if child is None else [child]
+    return [child for child in children if child.name==name]
+
+
+def runCompiledPath(
+    compiled:CompiledNodePath,
+    todo:typing.List[PathState],
+    ignore:typing.Container[NodeLike]=(),
+    stop:typing.Optional[threading.Event]=None,
+    branchStates:typing.Optional[typing.List[PathState]]=None
+    )->typing.Generator[NodeLike,None,None]:
+    """
+    Run a compiled path program starting from the given states.
+
+    This is an explicit-stack matcher that runs each
+    (node,step) state at most once, so it scales linearly with
+    tree size no matter how many "**" steps there are, and
+    never hits the recursion limit on deep trees.  That also
+    prevents getting caught in loops.
+
+    :stop: give up early once this is set
+    :branchStates: if specified, states that would fan out
+        (wildcard,regex,**) are put in here rather than run
+    """
+    steps=compiled.steps
+    numSteps=len(steps)
+    ignoreCase=compiled.ignoreCase
+    # only "**" and ".." can reach the same state twice
+    trackVisited=any(op in (OP_DOUBLESTAR,OP_PARENT) for op,_ in steps)
+    visited:typing.Set[typing.Tuple[int,int]]=set()
+    found:typing.Set[int]=set()
+    todo=list(reversed(todo))
+    pop=todo.pop
+    push=todo.append
+    countdown=STOP_CHECK_INTERVAL
+    while todo:
+        if stop is not None:
+            countdown-=1
+            if not countdown:
+                if stop.is_set():
+                    return
+                countdown=STOP_CHECK_INTERVAL
+        currentNode,pc,link=pop()
+        if currentNode in ignore:
+            continue
+        if trackVisited:
+            state=(id(currentNode),pc)
+            if state in visited:
+                continue
+            visited.add(state)
+        if pc==numSteps:
+            if id(currentNode) not in found:
+                found.add(id(currentNode))
+                yield currentNode
+            continue
+        op,arg=steps[pc]
+        if branchStates is not None and op in BRANCHING_OPS:
+            branchStates.append((currentNode,pc,link))
+            continue
+        pc+=1
+        # children are pushed in reverse so results come out
+        # in the same order as the tree
+        if op==OP_LITERAL:
+            if ignoreCase:
+                matches=[child
+                    for childName,child in iterChildren(currentNode)
+                    if childName.lower()==arg]
+                for child in reversed(matches):
+                    push((child,pc,(child,link)))
+            else:
+                for child in reversed(getChildren(currentNode,arg)):
+                    push((child,pc,(child,link)))
+        elif op==OP_WILDCARD:
+            for child in reversedChildren(currentNode):
+                push((child,pc,(child,link)))
+        elif op==OP_REGEX:
+            match=arg.match
+            matches=[child
+                for childName,child in iterChildren(currentNode)
+                if match(childName) is not None]
+            for child in reversed(matches):
+                push((child,pc,(child,link)))
+        elif op==OP_DOUBLESTAR:
+            # deeper levels stay on this same step
+            for child in reversedChildren(currentNode):
+                push((child,pc-1,(child,link)))
+            # match the current level first
+            push((currentNode,pc,link))
+        elif op==OP_PARENT:
+            # go up one, but avoid traversing above root
+            if link[1] is not None:
+                push((link[1][0],pc,link[1]))
+            else:
+                parent=getattr(currentNode,'parent',None)
+                if parent is not None:
+                    push((parent,pc,(parent,None)))
+
+
+def runNodePathTask(
+    compiled:CompiledNodePath,
+    states:typing.List[PathState],
+    ignore:typing.Container[NodeLike],
+    stop:typing.Optional[threading.Event]
+    )->typing.List[NodeLike]:
+    """
+    A single subtree search, as run by a FunctionCallManager
+    worker in NodePath.getNodesParallel()
+    """
+    return list(runCompiledPath(compiled,states,ignore,stop))
+
+
+def _expandBranch(
+    compiled:CompiledNodePath,
+    state:PathState
+    )->typing.List[PathState]:
+    """
+    Take a single fan-out step of a branching state
+    """
+    currentNode,pc,link=state
+    op,arg=compiled.steps[pc]
+    if op==OP_DOUBLESTAR:
+        ret=[(currentNode,pc+1,link)]
+        ret.extend((child,pc,(child,link))
+            for _,child in iterChildren(currentNode))
+        return ret
+    if op==OP_REGEX:
+        return [(child,pc+1,(child,link))
+            for childName,child in iterChildren(currentNode)
+            if arg.match(childName) is not None]
+    return [(child,pc+1,(child,link))
+        for _,child in iterChildren(currentNode)]
+
+
 class NodePath:
     """
     A node path that can be searched upon a node map/tree
@@ -37,11 +383,14 @@ class NodePath:
             like /a/b(c/[a-z]*)+/e
             "**": match any sequence of nodes if allowDoubleStar
                 (like recursive wildcard in glob).
+            ("." and ".." are regexes too, not the current and
+            parent node as they are in glob style.)
 
         Glob style supports:
             "a": literal match.
             "..": parent of the current node.
             "*": match any single node at this level.
+            "*.exe": fnmatch-style matching within a level.
             "**": match any sequence of nodes if allowDoubleStar
                 (like recursive wildcard in glob).
             ".": current node.
@@ -52,6 +401,7 @@ class NodePath:
         self._matchStyle=matchStyle
         self._allowDoubleStar=allowDoubleStar
         self._parts:typing.List[PathStepType]=[]
+        self._compiled:CompiledNodePath
         self.assign(path,ignoreCase,
             matchStyle,separator,allowDoubleStar)
 
@@ -80,134 +430,853 @@ class NodePath:
         self._ignoreCase=ignoreCase
         self._matchStyle=matchStyle
         self._allowDoubleStar=allowDoubleStar
-        if not isinstance(path,str):
-            # simplest way is to just copy whatever as our path
-            self._parts=list(path)
-        elif matchStyle=='strict':
-            self._parts=path.split(self._separator)
-        elif matchStyle=='glob':
-            self._parts=path.split(self._separator)
-            if path[0]==self._separator:
+        if isinstance(path,str):
+            self._compiled=compileNodePath(
+                path,matchStyle,ignoreCase,separator,allowDoubleStar)
+            self._parts=list(self._compiled.parts)
+            if self._compiled.absolute:
                 self._parts.insert(0,'')
         else:
-            segments=[]
-            current=''
-            depth=0
-            escape=False
-            i=0
-            if path.startswith(self._separator):
-                self._parts.insert(0,'')
-                i=1  # skip initial '/'
-            while i<len(path):
-                char=path[i]
-                if escape:
-                    current+=char
-                    escape=False
-                elif char==self._separator:
-                    current+=char
-                    escape=True
-                elif char=='(':
-                    current+=char
-                    depth+=1
-                elif char==')':
-                    current+=char
-                    depth -=1
-                elif char==self._separator and depth==0:
-                    if allowDoubleStar and current=='**':
-                        segments.append('**')  # special token
-                    else:
-                        current=re.compile(rf'^{current}$')
-                        segments.append(current)
-                    current=''
-                else:
-                    current+=char
-                i+=1
-            if current:
-                if allowDoubleStar and current=='**':
-                    segments.append('**')
-                else:
-                    current=re.compile(rf'^{current}$')
-                    segments.append(current)
-            if depth !=0:
-                raise ValueError("Unbalanced parentheses in path regex")
-        return segments
+            # simplest way is to just copy whatever as our path
+            self._parts=list(path)
+            absolute=bool(self._parts) and self._parts[0]==''
+            self._compiled=_compileParts(
+                self._parts[1:] if absolute else self._parts,absolute,
+                ignoreCase,matchStyle,allowDoubleStar)
+
+    @property
+    def compiled(self)->CompiledNodePath:
+        """
+        The compiled program for this path
+        """
+        return self._compiled
 
     def getNodes(self,
         startingNode:NodeLike,
         ignore:typing.Optional[typing.Set[NodeLike]]=None,
-        pathStack:typing.Optional[typing.Set[NodeLike]]=None,
+        pathStack:typing.Optional[typing.List[NodeLike]]=None,
         allowRecurseAboveStart:bool=False
         )->typing.Generator[NodeLike,None,None]:
         """
-        Recursively search for all paths in the tree
-        that match the wildcard path.
+        Search for all nodes in the tree that match the path.
 
-        This has built-in logic to prevent getting caught in loops.
+        (See runCompiledPath() for how the search is done.)
+
+        :startingNode: the node to start from (or a list of them)
+        :ignore: nodes to never visit
+        :pathStack: the nodes leading down to startingNode, which
+            ".." will back up through before following parent links
+        :allowRecurseAboveStart: no longer needed since ".." follows
+            each node's parent link (stopping at the root)
         """
-        if pathStack is None:
-            pathStack=set()
-        if ignore is None: # ignore is also used to prevent loops
+        if not hasattr(startingNode,'children'):
+            for node in startingNode:
+                yield from self.getNodes(
+                    node,ignore,pathStack,allowRecurseAboveStart)
+            return
+        if ignore is None:
             ignore=set()
-        strict=self._matchStyle=='strict'
-        def _getNodeByPath(root:NodeLike,path:PathStepType)->NodeLike:
-            """
-            Helper to navigate a tree node path to a node object.
-            """
-            node=root
-            for part in path[1:]:  # skip root
-                node=node.children.get(part)
-                if node is None:
-                    return None
-            return node
-        def _search(
-            currentNode:NodeLike,
-            parts:typing.Iterable[PathStepType],
-            stack:typing.Set[NodeLike]
-            )->typing.Generator[typing.Iterable[NodeLike],None,None]:
-            """
-            Search at a given location
-            """
-            if currentNode in ignore:
-                return
-            ignore.add(currentNode)
-            if not parts:
-                yield stack.copy()
-                return
-            part=parts[0]
-            if isinstance(part,re.Pattern):
-                for childName,child in currentNode.children.items():
-                    if part.match(childName):
-                        yield from _search(child,parts[1:],stack+[childName])
-            elif part==".." and not strict:
-                # go up one, but avoid traversing above root
-                if len(stack)>1 or allowRecurseAboveStart:
-                    parent_stack=stack[:-1]
-                    parent_node=_getNodeByPath(startingNode,parent_stack)
-                    yield from _search(parent_node,parts[1:],parent_stack)
-            elif part=="**" and self._allowDoubleStar and not strict:
-                # Match current level and all deeper levels
-                yield from _search(currentNode,parts[1:],stack) # Match 0-level
-                for childName,child in currentNode.children.items():
-                    yield from _search(child,parts,stack+[childName])
-            elif part=="*" and not strict:
-                # take all children
-                for childName,child in currentNode.children.items():
-                    yield from _search(child,parts[1:],stack+[childName])
-            elif part=="." and not strict:
-                # just the current path, so do nothing
-                yield from _search(currentNode,parts[1:],stack)
-            else:
-                # a normal path name
-                if part in currentNode.children:
-                    yield from _search(
-                        currentNode.children[part],parts[1:],stack+[part])
-        parts=self._parts
-        if not parts[0]:
-            # if it started with '/'
-            parts=parts[1:]
+        compiled=self._compiled
+        if compiled.absolute:
             startingNode=startingNode.root
-        yield from _search(startingNode,parts,pathStack or [startingNode.name])
+            pathStack=None
+        if not pathStack:
+            index=getattr(getattr(startingNode,'root',None),
+                'nodePathIndex',None)
+            if index is not None:
+                results=index.lookup(compiled,startingNode)
+                if results is not None:
+                    for node in results:
+                        if node not in ignore:
+                            yield node
+                    return
+        # The path to each state is a shared linked list of
+        # (node,previousLink) so that nothing needs to be copied
+        link:PathLink=None
+        for node in pathStack or ():
+            link=(node,link)
+        if link is None or link[0] is not startingNode:
+            link=(startingNode,link)
+        yield from runCompiledPath(
+            compiled,[(startingNode,0,link)],ignore)
     search=getNodes
 
+    def getNodesParallel(self,
+        startingNode:NodeLike,
+        functionCallManager:typing.Any,
+        limit:typing.Optional[int]=None,
+        ignore:typing.Optional[typing.Set[NodeLike]]=None
+        )->typing.Generator[NodeLike,None,None]:
+        """
+        Search for all nodes in the tree that match the path,
+        splitting the work across the threads of a FunctionCallManager.
+
+        The search runs serially up to the first wildcard level, then
+        each subtree below that becomes a separate task.  Results are
+        streamed back as each task finishes (so they are not
+        necessarily in tree order).
+
+        :functionCallManager: the FunctionCallManager to run tasks on.
+            Only its threads are used, because process workers would
+            receive copies of the tree rather than the nodes themselves.
+        :limit: stop after this many results and cancel remaining work
+        :ignore: nodes to never visit
+        """
+        if limit is not None and limit<=0:
+            return
+        if ignore is None:
+            ignore=set()
+        compiled=self._compiled
+        if compiled.absolute:
+            startingNode=startingNode.root
+        index=getattr(getattr(startingNode,'root',None),'nodePathIndex',None)
+        if index is not None:
+            results=index.lookup(compiled,startingNode)
+            if results is not None:
+                results=[node for node in results if node not in ignore]
+                yield from results[:limit]
+                return
+        count=0
+        found:typing.Set[int]=set()
+        branchStates:typing.List[PathState]=[]
+        nodes=runCompiledPath(compiled,
+            [(startingNode,0,(startingNode,None))],ignore,
+            branchStates=branchStates)
+        for node in nodes:
+            found.add(id(node))
+            yield node
+            count+=1
+            if count==limit:
+                return
+        states:typing.List[PathState]=[]
+        for state in branchStates:
+            states.extend(_expandBranch(compiled,state))
+        if not states:
+            return
+        if PARALLEL_TASK_NAME not in functionCallManager.functions:
+            functionCallManager.addFunction(
+                runNodePathTask,PARALLEL_TASK_NAME,threadsafe=True)
+        numTasks=min(len(states),
+            max(1,functionCallManager.num_threads)*TASKS_PER_WORKER)
+        stop=threading.Event()
+        futures=[
+            functionCallManager.submit(PARALLEL_TASK_NAME,
+                compiled,states[i::numTasks],ignore,stop)
+            for i in range(numTasks)]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                for node in future.result():
+                    if id(node) in found:
+                        continue # tasks for "**" can overlap
+                    found.add(id(node))
+                    yield node
+                    count+=1
+                    if count==limit:
+                        return
+        finally:
+            stop.set()
+            for future in futures:
+                future.cancel()
+
     def __repr__(self):
         return self._separator.join([str(p) for p in self._parts])
+
+
+NodeNamePath=typing.Tuple[str,...]
+class NodePathIndex:
+    """
+    An optional index that can be attached to a tree root
+    so that NodePath searches like "/a/b/c" and "**/name"
+    become lookups rather than tree traversals.
+
+    The tree itself has no way to tell us when it changes, so
+    whoever mutates the tree must call nodeAdded(), nodeRemoved(),
+    or nodeRenamed() (or simply invalidate() to rebuild).
+
+    Usage:
+        index=NodePathIndex(root)
+        NodePath('**/foo').search(root) # uses the index
+    """
+    def __init__(self,root:NodeLike,attach:bool=True):
+        """
+        :attach: attach to root.nodePathIndex so that
+            NodePath.getNodes() will use it automatically
+        """
+        self.root=root
+        self._byName:typing.Dict[str,typing.Dict[NodeLike,None]]={}
+        # a list of children can repeat a name, so several
+        # nodes can share the same path
+        self._byPath:typing.Dict[NodeNamePath,typing.Dict[NodeLike,None]]={}
+        self._pathOf:typing.Dict[NodeLike,NodeNamePath]={}
+        self.version=0
+        self.rebuild()
+        if attach:
+            self.attach()
+
+    def attach(self)->None:
+        """
+        Attach to the tree root so that searches use this index
+        """
+        self.root.nodePathIndex=self
+
+    def detach(self)->None:
+        """
+        Detach from the tree root so that searches walk the tree
+        """
+        if getattr(self.root,'nodePathIndex',None) is self:
+            self.root.nodePathIndex=None
+
+    def __len__(self)->int:
+        return len(self._pathOf)
+
+    def __contains__(self,node:NodeLike)->bool:
+        return node in self._pathOf
+
+    def rebuild(self)->None:
+        """
+        Re-index the entire tree
+        """
+        self._byName.clear()
+        self._byPath.clear()
+        self._pathOf.clear()
+        self._indexSubtree(self.root,())
+    invalidate=rebuild
+
+    def _indexSubtree(self,node:NodeLike,path:NodeNamePath)->None:
+        """
+        Add a node and everything below it
+        """
+        todo=[(node,path)]
+        while todo:
+            node,path=todo.pop()
+            if node in self._pathOf:
+                continue # loop in the tree
+            self._pathOf[node]=path
+            self._byPath.setdefault(path,{})[node]=None
+            if path:
+                self._byName.setdefault(path[-1],{})[node]=None
+            # pushed in reverse so nodes are indexed in tree order
+            todo.extend(reversed([(child,path+(childName,))
+                for childName,child in iterChildren(node)]))
+        self.version+=1
+
+    def _unindexSubtree(self,node:NodeLike)->None:
+        """
+        Remove a node and everything below it
+        """
+        todo=[node]
+        while todo:
+            node=todo.pop()
+            path=self._pathOf.pop(node,None)
+            if path is None:
+                continue
+            self._discard(self._byPath,path,node)
+            if path:
+                self._discard(self._byName,path[-1],node)
+            todo.extend(child for _,child in iterChildren(node))
+        self.version+=1
+
+    @staticmethod
+    def _discard(
+        table:typing.Dict[typing.Hashable,typing.Dict[NodeLike,None]],
+        key:typing.Hashable,
+        node:NodeLike
+        )->None:
+        """
+        Remove a node from one entry of a table of nodes
+        """
+        nodes=table.get(key)
+        if nodes is not None:
+            nodes.pop(node,None)
+            if not nodes:
+                del table[key]
+
+    def pathOf(self,node:NodeLike)->typing.Optional[NodeNamePath]:
+        """
+        Get the names leading from the root to a node
+        """
+        return self._pathOf.get(node)
+
+    def nodeAdded(self,
+        node:NodeLike,
+        parent:typing.Optional[NodeLike]=None
+        )->None:
+        """
+        Call after a node (and its subtree) has been added to the tree
+
+        :parent: the node it was added to (default is node.parent)
+        """
+        if parent is None:
+            parent=getattr(node,'parent',None)
+        parentPath=self._pathOf.get(parent)
+        if parentPath is None:
+            return # not part of this tree
+        self._unindexSubtree(node)
+        self._indexSubtree(node,parentPath+(node.name,))
+
+    def nodeRemoved(self,node:NodeLike)->None:
+        """
+        Call after a node (and its subtree) has been removed from the tree
+        """
+        self._unindexSubtree(node)
+
+    def nodeRenamed(self,node:NodeLike)->None:
+        """
+        Call after a node has been renamed
+        (or moved within the tree)
+        """
+        path=self._pathOf.get(node)
+        if path is None:
+            return
+        parent=getattr(node,'parent',None)
+        if parent is None:
+            parents=self._byPath.get(path[:-1],{})
+            if len(parents)>1:
+                # can't tell which one it is under
+                self.rebuild()
+                return
+            parent=next(iter(parents),None)
+        self._unindexSubtree(node)
+        if parent is not None:
+            self.nodeAdded(node,parent)
+    nodeMoved=nodeRenamed
+
+    def nodesNamed(self,name:str)->typing.List[NodeLike]:
+        """
+        Get all nodes in the tree with a given name
+        """
+        return list(self._byName.get(name,()))
+
+    def nodeAt(self,path:typing.Iterable[str])->typing.Optional[NodeLike]:
+        """
+        Get the node at a given path of names from the root
+        (the first one, if names repeat)
+        """
+        return next(iter(self._byPath.get(tuple(path),())),None)
+
+    def nodesAt(self,path:typing.Iterable[str])->typing.List[NodeLike]:
+        """
+        Get every node at a given path of names from the root
+        """
+        return list(self._byPath.get(tuple(path),()))
+
+    def lookup(self,
+        compiled:CompiledNodePath,
+        startingNode:NodeLike
+        )->typing.Optional[typing.List[NodeLike]]:
+        """
+        Answer a compiled NodePath from the index
+
+        :return: the matching nodes, or None if the path
+            can't be answered by the index (eg, it has wildcards)
+        """
+        if compiled.ignoreCase:
+            return None
+        steps=compiled.steps
+        doubleStar=bool(steps) and steps[0][0]==OP_DOUBLESTAR
+        if doubleStar:
+            steps=steps[1:]
+            if not steps:
+                return None
+        if any(op!=OP_LITERAL for op,_ in steps):
+            return None
+        startPath=self._pathOf.get(startingNode)
+        if startPath is None:
+            return None
+        if len(self._byPath[startPath])>1:
+            # other nodes share its path, so paths can't tell
+            # what is below it from what is below them
+            return None
+        names=tuple(arg for _,arg in steps)
+        if not doubleStar:
+            return self.nodesAt(startPath+names)
+        ret:typing.Dict[NodeLike,None]={}
+        n=len(startPath)
+        for node in self._byName.get(names[0],()):
+            path=self._pathOf[node]
+            if len(path)>n and path[:n]==startPath:
+                if len(names)==1:
+                    ret[node]=None
+                else:
+                    ret.update(self._byPath.get(path+names[1:],{}))
+        return list(ret)
+
+
+PatternKey=typing.Hashable
+class _PatternTrieNode:
+    """
+    A state in a NodePathSet automaton.  Patterns that share
+    leading steps share the same states.
+    """
+    __slots__=('literals','literalsNoCase','wildcard','regexes',
+        'doubleStar','afterDoubleStar','accepting')
+    def __init__(self,afterDoubleStar:bool=False):
+        self.literals:typing.Dict[str,_PatternTrieNode]={}
+        self.literalsNoCase:typing.Dict[str,_PatternTrieNode]={}
+        self.wildcard:typing.Optional[_PatternTrieNode]=None
+        self.regexes:typing.Dict[typing.Pattern,_PatternTrieNode]={}
+        self.doubleStar:typing.Optional[_PatternTrieNode]=None
+        self.afterDoubleStar=afterDoubleStar # stays active in all descendants
+        self.accepting:typing.List[PatternKey]=[]
+
+
+ActiveStates=typing.FrozenSet[_PatternTrieNode]
+class NodePathSet:
+    """
+    Many NodePaths merged into a single automaton, so that they
+    can all be evaluated in one traversal of a tree.
+
+    Usage:
+        paths=NodePathSet()
+        paths.add('**/*.doc','documents')
+        paths.add('/windows/*','windows')
+        for node,keys in paths.match(root):
+            ...
+
+    ".." is not supported since it would need to back up the traversal.
+    """
+    def __init__(self,
+        paths:typing.Optional[typing.Iterable[PathCompatible]]=None,
+        maxCachedTransitions:int=65536):
+        """
+        :paths: initial paths to add (each is its own key)
+        :maxCachedTransitions: limit on how many computed
+            state transitions are remembered
+        """
+        self._relative=_PatternTrieNode()
+        self._absolute=_PatternTrieNode()
+        self._numAbsolute=0
+        self._keys:typing.Dict[PatternKey,NodePath]={}
+        self._transitions:typing.Dict[
+            typing.Tuple[ActiveStates,str],ActiveStates]={}
+        self.maxCachedTransitions=maxCachedTransitions
+        for path in paths or ():
+            self.add(path)
+
+    def __len__(self)->int:
+        return len(self._keys)
+
+    def __contains__(self,key:PatternKey)->bool:
+        return key in self._keys
+
+    def add(self,
+        path:typing.Union[PathCompatible,NodePath],
+        key:typing.Optional[PatternKey]=None
+        )->PatternKey:
+        """
+        Add a path to the set
+
+        :key: what to report when this path matches
+            (default is the path itself)
+        :return: the key
+        """
+        if not isinstance(path,NodePath):
+            path=NodePath(path)
+        if key is None:
+            key=repr(path)
+        if key in self._keys:
+            raise KeyError(f'"{key}" is already in this NodePathSet')
+        compiled=path.compiled
+        for op,_ in compiled.steps:
+            if op==OP_PARENT:
+                raise InvalidNodePath(
+                    f'"{path}" uses ".." which NodePathSet does not support')
+        trie=self._relative
+        if compiled.absolute:
+            trie=self._absolute
+            self._numAbsolute+=1
+        for op,arg in compiled.steps:
+            if op==OP_LITERAL:
+                table=trie.literalsNoCase if compiled.ignoreCase \
+                    else trie.literals
+                nextTrie=table.get(arg)
+                if nextTrie is None:
+                    nextTrie=_PatternTrieNode()
+                    table[arg]=nextTrie
+            elif op==OP_WILDCARD:
+                if trie.wildcard is None:
+                    trie.wildcard=_PatternTrieNode()
+                nextTrie=trie.wildcard
+            elif op==OP_REGEX:
+                nextTrie=trie.regexes.get(arg)
+                if nextTrie is None:
+                    nextTrie=_PatternTrieNode()
+                    trie.regexes[arg]=nextTrie
+            else: # OP_DOUBLESTAR
+                if trie.doubleStar is None:
+                    trie.doubleStar=_PatternTrieNode(afterDoubleStar=True)
+                nextTrie=trie.doubleStar
+            trie=nextTrie
+        trie.accepting.append(key)
+        self._keys[key]=path
+        self._transitions.clear()
+        return key
+
+    def remove(self,key:PatternKey)->None:
+        """
+        Remove a path from the set
+        """
+        del self._keys[key]
+        # rebuild, since states may be shared with other paths
+        remaining=self._keys
+        self._relative=_PatternTrieNode()
+        self._absolute=_PatternTrieNode()
+        self._numAbsolute=0
+        self._keys={}
+        self._transitions.clear()
+        for k,path in remaining.items():
+            self.add(path,k)
+
+    @staticmethod
+    def _closure(states:typing.Iterable[_PatternTrieNode])->ActiveStates:
+        """
+        Add the states reachable by letting a "**" match nothing
+        """
+        ret=set()
+        todo=list(states)
+        while todo:
+            state=todo.pop()
+            if state in ret:
+                continue
+            ret.add(state)
+            if state.doubleStar is not None:
+                todo.append(state.doubleStar)
+        return frozenset(ret)
+
+    def _step(self,active:ActiveStates,name:str)->ActiveStates:
+        """
+        Get the states that are active at a child with the given name
+        """
+        key=(active,name)
+        ret=self._transitions.get(key)
+        if ret is not None:
+            return ret
+        nextStates=[]
+        lowerName=None
+        for state in active:
+            if state.afterDoubleStar:
+                nextStates.append(state)
+            found=state.literals.get(name)
+            if found is not None:
+                nextStates.append(found)
+            if state.literalsNoCase:
+                if lowerName is None:
+                    lowerName=name.lower()
+                found=state.literalsNoCase.get(lowerName)
+                if found is not None:
+                    nextStates.append(found)
+            if state.wildcard is not None:
+                nextStates.append(state.wildcard)
+            for regex,found in state.regexes.items():
+                if regex.match(name) is not None:
+                    nextStates.append(found)
+        ret=self._closure(nextStates)
+        if len(self._transitions)>=self.maxCachedTransitions:
+            self._transitions.clear()
+        self._transitions[key]=ret
+        return ret
+
+    def match(self,
+        startingNode:NodeLike,
+        ignore:typing.Container[NodeLike]=()
+        )->typing.Generator[
+            typing.Tuple[NodeLike,typing.List[PatternKey]],None,None]:
+        """
+        Walk the tree once, reporting every node that
+        matches any of the paths.
+
+        Relative paths are matched from startingNode, absolute ones
+        from its root.  (If there are any absolute paths, the walk
+        starts at the root.)
+
+        :return: generator of (node,[keys of all matching paths])
+        """
+        relative=self._closure([self._relative])
+        start=startingNode
+        active:ActiveStates=relative
+        # nodes that must be walked through to get to startingNode
+        mustVisit:typing.Optional[typing.Set[int]]=set()
+        if self._numAbsolute:
+            start=startingNode.root
+            active=self._closure([self._absolute])
+            if start is startingNode:
+                active=active|relative
+            else:
+                node=startingNode
+                while node is not None and node is not start:
+                    mustVisit.add(id(node))
+                    node=getattr(node,'parent',None)
+                if node is None:
+                    mustVisit=None # no parent links, so walk everything
+        empty:ActiveStates=frozenset()
+        visited:typing.Set[int]=set()
+        todo:typing.List[typing.Tuple[NodeLike,ActiveStates]]=[(start,active)]
+        while todo:
+            node,active=todo.pop()
+            if id(node) in visited or node in ignore:
+                continue
+            visited.add(id(node))
+            if node is startingNode and node is not start:
+                active=active|relative
+            keys=[key for state in active for key in state.accepting]
+            if keys:
+                yield (node,keys)
+            for childName,child in reversed(list(iterChildren(node))):
+                nextActive=self._step(active,childName) if active else empty
+                if nextActive or mustVisit is None or id(child) in mustVisit:
+                    todo.append((child,nextActive))
+
+    def matchNames(self,
+        path:typing.Union[str,typing.Iterable[str]],
+        separator:str='/'
+        )->typing.List[PatternKey]:
+        """
+        Get the keys of every path that matches a path of node
+        names from the root, such as "a/b/c", without needing an
+        actual tree.  (Used for things like matching event topics.)
+        """
+        if isinstance(path,str):
+            path=[p for p in path.split(separator) if p]
+        active=self._closure([self._relative,self._absolute])
+        for name in path:
+            if not active:
+                return []
+            active=self._step(active,name)
+        return [key for state in active for key in state.accepting]
+
+    def statesAt(self,
+        node:NodeLike,
+        root:NodeLike
+        )->typing.Optional[ActiveStates]:
+        """
+        Get the automaton states that are active at a node,
+        for a walk that started at root.
+
+        This follows the node's parent links up to root.
+
+        :return: the states, or None if node is not under root
+        """
+        names=[]
+        while node is not root:
+            if node is None:
+                return None
+            names.append(node.name)
+            node=getattr(node,'parent',None)
+        active=self._closure([self._relative,self._absolute])
+        for name in reversed(names):
+            if not active:
+                break
+            active=self._step(active,name)
+        return active
+
+    def matchSubtree(self,
+        node:NodeLike,
+        active:ActiveStates,
+        ignore:typing.Container[NodeLike]=()
+        )->typing.Generator[
+            typing.Tuple[NodeLike,typing.List[PatternKey]],None,None]:
+        """
+        Continue a walk from a node given the states active there
+        (see statesAt()), reporting every node that matches.
+
+        :return: generator of (node,[keys of all matching paths])
+        """
+        visited:typing.Set[int]=set()
+        todo:typing.List[typing.Tuple[NodeLike,ActiveStates]]=[(node,active)]
+        while todo:
+            node,active=todo.pop()
+            if id(node) in visited or node in ignore:
+                continue
+            visited.add(id(node))
+            keys=[key for state in active for key in state.accepting]
+            if keys:
+                yield (node,keys)
+            for childName,child in reversed(list(iterChildren(node))):
+                nextActive=self._step(active,childName)
+                if nextActive:
+                    todo.append((child,nextActive))
+
+    def matchingKeys(self,startingNode:NodeLike
+        )->typing.Dict[PatternKey,typing.List[NodeLike]]:
+        """
+        Get all the nodes matching each path
+        """
+        ret:typing.Dict[PatternKey,typing.List[NodeLike]]={
+            key:[] for key in self._keys}
+        for node,keys in self.match(startingNode):
+            for key in keys:
+                ret[key].append(node)
+        return ret
+
+
+NodeEventCallback=typing.Callable[[NodeLike],None]
+class NodePathSubscription:
+    """
+    A NodePath being watched for nodes that appear or disappear
+    (see NodePathSubscriptions)
+    """
+    def __init__(self,
+        path:NodePath,
+        onAddedCallbacks:typing.Optional[
+            typing.Iterable[NodeEventCallback]]=None,
+        onRemovedCallbacks:typing.Optional[
+            typing.Iterable[NodeEventCallback]]=None):
+        """ """
+        self.path=path
+        self.matches:typing.Dict[NodeLike,None]={} # ordered set
+        self.onAddedCallbacks:typing.List[NodeEventCallback]=\
+            list(onAddedCallbacks or ())
+        self.onRemovedCallbacks:typing.List[NodeEventCallback]=\
+            list(onRemovedCallbacks or ())
+
+    def addMatch(self,node:NodeLike)->None:
+        """
+        Record a newly-matching node and call back
+        """
+        self.matches[node]=None
+        for fn in self.onAddedCallbacks:
+            fn(node)
+
+    def removeMatch(self,node:NodeLike)->None:
+        """
+        Forget a node that no longer matches and call back
+        """
+        del self.matches[node]
+        for fn in self.onRemovedCallbacks:
+            fn(node)
+
+    def __repr__(self):
+        return f'NodePathSubscription({self.path})'
+
+
+class NodePathSubscriptions:
+    """
+    Keeps track of which nodes match a set of NodePaths
+    as a tree changes, and calls back when they appear or disappear.
+
+    All of the paths are evaluated together (see NodePathSet),
+    and when the tree changes only the affected subtree is
+    re-evaluated rather than the whole tree.
+
+    The tree itself has no way to tell us when it changes, so
+    whoever mutates the tree must call nodeAdded(), nodeRemoved(),
+    or nodeRenamed().  Nodes need parent links.
+
+    Usage:
+        subscriptions=NodePathSubscriptions(root)
+        subscriptions.subscribe('**/*.doc',onAdded,onRemoved)
+        ...
+        parent.add_child(node)
+        subscriptions.nodeAdded(node)
+    """
+    def __init__(self,root:NodeLike):
+        """ """
+        self.root=root
+        self._pathSet=NodePathSet()
+        self._subscriptions:typing.Dict[int,NodePathSubscription]={}
+
+    def __len__(self)->int:
+        return len(self._subscriptions)
+
+    def __iter__(self)->typing.Iterator[NodePathSubscription]:
+        return iter(self._subscriptions.values())
+
+    def subscribe(self,
+        path:typing.Union[PathCompatible,NodePath],
+        onAdded:typing.Optional[NodeEventCallback]=None,
+        onRemoved:typing.Optional[NodeEventCallback]=None,
+        notifyExisting:bool=True
+        )->NodePathSubscription:
+        """
+        Start watching for nodes that match a path
+
+        :notifyExisting: call onAdded for every node
+            that already matches
+        """
+        if not isinstance(path,NodePath):
+            path=NodePath(path)
+        subscription=NodePathSubscription(path,
+            [onAdded] if onAdded else None,
+            [onRemoved] if onRemoved else None)
+        key=id(subscription)
+        self._pathSet.add(path,key)
+        self._subscriptions[key]=subscription
+        for node in path.search(self.root):
+            if notifyExisting:
+                subscription.addMatch(node)
+            else:
+                subscription.matches[node]=None
+        return subscription
+
+    def unsubscribe(self,subscription:NodePathSubscription)->None:
+        """
+        Stop watching a path
+        """
+        key=id(subscription)
+        if self._subscriptions.pop(key,None) is not None:
+            self._pathSet.remove(key)
+
+    def _subtreeNodes(self,node:NodeLike)->typing.List[NodeLike]:
+        """
+        Get a node and everything below it
+        """
+        ret=[]
+        visited:typing.Set[int]=set()
+        todo=[node]
+        while todo:
+            node=todo.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            ret.append(node)
+            todo.extend(child for _,child in iterChildren(node))
+        return ret
+
+    def _reevaluate(self,node:NodeLike,attached:bool=True)->None:
+        """
+        Re-evaluate all subscriptions within a subtree,
+        calling back for anything that changed.
+        """
+        before:typing.Dict[int,typing.List[NodeLike]]={}
+        if any(s.matches for s in self._subscriptions.values()):
+            for n in self._subtreeNodes(node):
+                for key,subscription in self._subscriptions.items():
+                    if n in subscription.matches:
+                        before.setdefault(key,[]).append(n)
+        after:typing.Dict[int,typing.Dict[NodeLike,None]]={}
+        if attached:
+            active=self._pathSet.statesAt(node,self.root)
+            if active:
+                for n,keys in self._pathSet.matchSubtree(node,active):
+                    for key in keys:
+                        after.setdefault(key,{})[n]=None
+        for key,nodes in before.items():
+            subscription=self._subscriptions[key]
+            stillMatching=after.get(key,{})
+            for n in nodes:
+                if n not in stillMatching:
+                    subscription.removeMatch(n)
+        for key,nodes in after.items():
+            subscription=self._subscriptions[key]
+            for n in nodes:
+                if n not in subscription.matches:
+                    subscription.addMatch(n)
+
+    def nodeAdded(self,node:NodeLike)->None:
+        """
+        Call after a node (and its subtree) has been added to the tree
+        """
+        self._reevaluate(node)
+
+    def nodeRemoved(self,node:NodeLike)->None:
+        """
+        Call after a node (and its subtree) has been removed from the tree
+        """
+        self._reevaluate(node,attached=False)
+
+    def nodeRenamed(self,node:NodeLike)->None:
+        """
+        Call after a node has been renamed (or moved within the tree)
+        """
+        self._reevaluate(node)
+    nodeMoved=nodeRenamed
@@ -0,0 +1,160 @@
+"""
+Bounding how much work can pile up waiting to be done
+
+Every piece of work is admitted before it is queued, and released
+when it is done (or skipped).  Once the limit is reached, the overload
+policy decides what happens to new work:
+    'block': wait for room, which slows down whoever is adding work
+        (eg, a websocket reader stops reading from its socket)
+    'reject': refuse it right away with Overloaded (an api answers 503)
+    'shed': cancel the newest piece of waiting work that has a lower
+        priority to make room, refusing the new work if there is none
+"""
+import typing
+import time
+import threading
+from collections import OrderedDict
+
+
+OVERLOAD_BLOCK='block'
+OVERLOAD_REJECT='reject'
+OVERLOAD_SHED='shed'
+OVERLOAD_POLICIES=(OVERLOAD_BLOCK,OVERLOAD_REJECT,OVERLOAD_SHED)
+OVERLOADED_STATUS=503
+CancelCallable=typing.Callable[[],bool]
+
+
+class Overloaded(RuntimeError):
+    """
+    Raised when there is no room for more work
+    """
+
+
+class AdmissionControl:
+    """
+    Keeps count of the work waiting to be done, and applies
+    an overload policy once there is too much.
+    """
+    def __init__(self,
+        maxPending:int=0,
+        policy:str=OVERLOAD_BLOCK,
+        blockTimeout:typing.Optional[float]=None):
+        """
+        :maxPending: most pieces of work to have waiting (0 for no limit)
+        :policy: one of OVERLOAD_POLICIES
+        :blockTimeout: longest to block waiting for room before
+            raising Overloaded (default is to wait as long as it takes)
+        """
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(f'Unknown overload policy "{policy}"')
+        self.maxPending=maxPending
+        self.policy=policy
+        self.blockTimeout=blockTimeout
+        self.admitted=0
+        self.rejected=0
+        self.shed=0
+        self.highWater=0
+        self.blockedSeconds=0.0
+        # priority:{key:cancel function}, oldest first
+        self._pending:typing.Dict[
+            int,typing.OrderedDict[typing.Hashable,CancelCallable]]={}
+        self._priorityOf:typing.Dict[typing.Hashable,int]={}
+        self._condition=threading.Condition()
+
+    @property
+    def pending(self)->int:
+        """
+        How much work is waiting right now
+        """
+        return len(self._priorityOf)
+
+    @property
+    def metrics(self)->typing.Dict[str,typing.Union[int,float]]:
+        """
+        Overload metrics
+        """
+        return {
+            'pending':self.pending,
+            'maxPending':self.maxPending,
+            'highWater':self.highWater,
+            'admitted':self.admitted,
+            'rejected':self.rejected,
+            'shed':self.shed,
+            'blockedSeconds':self.blockedSeconds}
+
+    def admit(self,
+        key:typing.Hashable,
+        priority:int=0,
+        cancel:typing.Optional[CancelCallable]=None
+        )->None:
+        """
+        Make room for a new piece of work, or raise Overloaded
+
+        :key: identifies the work, for release()
+        :priority: higher is more important (only used when shedding)
+        :cancel: cancels the work if it is shed to make room for
+            something more important, returning False if it is too late
+        """
+        with self._condition:
+            if self.maxPending>0 and self.pending>=self.maxPending:
+                if self.policy==OVERLOAD_BLOCK:
+                    self._waitForRoom()
+                elif self.policy==OVERLOAD_SHED:
+                    if not self._shedFor(priority):
+                        self.rejected+=1
+                        raise Overloaded('Too much work is waiting')
+                else:
+                    self.rejected+=1
+                    raise Overloaded('Too much work is waiting')
+            self._pending.setdefault(priority,OrderedDict())[key]=\
+                cancel or (lambda:False)
+            self._priorityOf[key]=priority
+            self.admitted+=1
+            self.highWater=max(self.highWater,self.pending)
+
+    def _waitForRoom(self)->None:
+        start=time.monotonic()
+        try:
+            if not self._condition.wait_for(
+                lambda:self.pending<self.maxPending,self.blockTimeout):
+                self.rejected+=1
+                raise Overloaded('Timed out waiting for room')
+        finally:
+            self.blockedSeconds+=time.monotonic()-start
+
+    def _shedFor(self,priority:int)->bool:
+        """
+        Cancel the newest waiting work with the lowest priority below
+        the given one
+
+        :return: whether room was made
+        """
+        for lowest in sorted(self._pending):
+            if lowest>=priority:
+                break
+            entries=self._pending[lowest]
+            for key in reversed(list(entries)):
+                if entries[key]():
+                    self._remove(key)
+                    self.shed+=1
+                    return True
+        return False
+
+    def _remove(self,key:typing.Hashable)->bool:
+        priority=self._priorityOf.pop(key,None)
+        if priority is None:
+            return False
+        entries=self._pending[priority]
+        del entries[key]
+        if not entries:
+            del self._pending[priority]
+        return True
+
+    def release(self,key:typing.Hashable)->None:
+        """
+        A piece of work is done (or was skipped), so it no longer
+        counts (releasing the same key twice is harmless)
+        """
+        with self._condition:
+            if self._remove(key):
+                self._condition.notify()
@@ -1,50 +1,215 @@
 """
-This wraps the .appplicationIdenty/pairedMachines.json file
+This wraps the .appplicationIdenty/pairedMachines.jsonl file
 in the user's home directory
+
+The file is an append-only journal, one json record per line,
+so pairing a machine only appends a line rather than rewriting
+everything.  Writers take an exclusive fcntl lock, and changes made
+by other processes are picked up by reading only the new lines.
 """
 import typing
+import os
+import json
+import time
 from pathlib import Path
-from authentication import authenticateMachine
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl=None # no cross-process locking on this platform
+from authentication import AuthenticatedSessions
 from machineIdentity import MachineIdentity
 
 
+MachineOrFingerprint=typing.Union[MachineIdentity,str]
+
+
+def _fingerprintOf(machine:MachineOrFingerprint)->str:
+    if isinstance(machine,str):
+        return machine
+    return machine.fingerprint
+
+
 class PairedMachines:
     """
-    This wraps the .appplicationIdenty/pairedMachines.json file
+    This wraps the .appplicationIdenty/pairedMachines.jsonl file
     in the user's home directory
+
+    Machines are indexed by MachineIdentity.fingerprint
     """
-    def __init__(self,applicationIdentity:str):
-        """ """
+    def __init__(self,
+        applicationIdentity:str,
+        filename:typing.Union[None,str,Path]=None,
+        checkInterval:float=1.0,
+        sessions:typing.Optional[AuthenticatedSessions]=None):
+        """
+        :filename: where to keep the journal
+            (default is ~/.<applicationIdentity>/pairedMachines.jsonl)
+        :checkInterval: how often to check whether another process
+            has changed the file, in seconds
+        :sessions: where to remember machines that have already
+            authenticated on a connection
+        """
         self.applicationIdentity=applicationIdentity
-        self._pairedAuthKeys:typing.Dict[MachineIdentity,str]={}
+        if filename is None:
+            filename=Path.home()/f'.{applicationIdentity}'
+            filename=filename/'pairedMachines.jsonl'
+        self._filename=Path(filename)
+        self.checkInterval=checkInterval
+        self.sessions=sessions or AuthenticatedSessions()
+        self._pairedAuthKeys:typing.Dict[
+            str,typing.Tuple[MachineIdentity,str]]={}
+        self._numRecords=0
+        self._readOffset=0
+        self._fileId:typing.Optional[typing.Tuple[int,int,int]]=None
+        self._lastCheck=0.0
         self.reload()
 
     @property
     def filename(self)->Path:
         """
-        the .appplicationIdenty/pairedMachines.json file
+        the .appplicationIdenty/pairedMachines.jsonl file
         in the user's home directory
         """
-        return Path.home()/f'.{self.applicationIdentity}'/'pairedMachines.json'
+        return self._filename
 
-    def reload(self):
+    @property
+    def lockFilename(self)->Path:
         """
-        reload the .appplicationIdenty/pairedMachines.json file
-        in the user's home directory
+        The file that is locked while the journal is being changed
+        (kept separate because compacting replaces the journal)
+        """
+        return self._filename.with_name(self._filename.name+'.lock')
+
+    @contextmanager
+    def _locked(self,exclusive:bool)->typing.Iterator[None]:
+        """
+        Hold the cross-process lock
+        """
+        self._filename.parent.mkdir(parents=True,exist_ok=True)
+        with open(self.lockFilename,'a',encoding='utf-8') as f:
+            if fcntl is not None:
+                fcntl.flock(f,fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f,fcntl.LOCK_UN)
+
+    def _apply(self,record:typing.Dict[str,typing.Any])->None:
+        """
+        Apply a single journal record to the index
+        """
+        fingerprint=record['fingerprint']
+        if record.get('removed'):
+            self._pairedAuthKeys.pop(fingerprint,None)
+        else:
+            self._pairedAuthKeys[fingerprint]=(
+                MachineIdentity.fromJson(record['machine']),
+                record['authenticationKey'])
+        self._numRecords+=1
+
+    def _readChanges(self)->None:
+        """
+        Bring the index up to date with the file
+        (the caller must hold the lock)
         """
         try:
-            self.jsonStr=self.filename.read_text('utf-8',errors='ignore')
+            stat=os.stat(self._filename)
         except FileNotFoundError:
             self._pairedAuthKeys={}
-            self.save()
+            self._numRecords=0
+            self._readOffset=0
+            self._fileId=None
+            return
+        fileId=(stat.st_dev,stat.st_ino,stat.st_mtime_ns)
+        if fileId==self._fileId and stat.st_size==self._readOffset:
+            return # nothing changed
+        if self._fileId is None or fileId[:2]!=self._fileId[:2] \
+            or stat.st_size<self._readOffset:
+            # replaced or truncated, so start over
+            self._pairedAuthKeys={}
+            self._numRecords=0
+            self._readOffset=0
+        with open(self._filename,'rb') as f:
+            f.seek(self._readOffset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break # incomplete write, eg from a crash
+                self._readOffset+=len(line)
+                line=line.strip()
+                if line:
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError,KeyError):
+                        pass # skip a damaged record
+        self._fileId=fileId
+
+    def _refresh(self,force:bool=False)->None:
+        """
+        Pick up changes made by other processes,
+        no more often than checkInterval
+        """
+        now=time.monotonic()
+        if not force and now-self._lastCheck<self.checkInterval:
+            return
+        self._lastCheck=now
+        with self._locked(False):
+            self._readChanges()
+
+    def reload(self):
+        """
+        reload the .appplicationIdenty/pairedMachines.jsonl file
+        in the user's home directory
+        """
+        self._refresh(True)
     load=reload
 
+    def _append(self,record:typing.Dict[str,typing.Any])->None:
+        """
+        Append a record to the journal and apply it
+        """
+        with self._locked(True):
+            self._readChanges()
+            line=json.dumps(record,separators=(',',':'))+'\n'
+            with open(self._filename,'ab') as f:
+                f.write(line.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            # reading back our own line also updates the offset
+            self._readChanges()
+            if self._numRecords>2*len(self._pairedAuthKeys)+16:
+                self._compact()
+
+    def _compact(self)->None:
+        """
+        Rewrite the journal with only the current records
+        (the caller must hold the exclusive lock)
+        """
+        tempFilename=self._filename.with_name(self._filename.name+'.tmp')
+        with open(tempFilename,'w',encoding='utf-8') as f:
+            for fingerprint,(machine,key) in self._pairedAuthKeys.items():
+                f.write(json.dumps({
+                    'fingerprint':fingerprint,
+                    'machine':machine.jsonObj,
+                    'authenticationKey':key},separators=(',',':'))+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempFilename,self._filename)
+        self._fileId=None
+        self._readChanges()
+
     def save(self):
         """
-        save to the .appplicationIdenty/pairedMachines.json file
+        save to the .appplicationIdenty/pairedMachines.jsonl file
         in the user's home directory
+
+        (Changes are saved as they are made, so this only
+        compacts the journal)
         """
-        self.filename.write_text(self.jsonStr,'utf-8',errors='ignore')
+        with self._locked(True):
+            self._readChanges()
+            self._compact()
 
     def addPairedMachine(self,
         machine:MachineIdentity,
@@ -59,17 +224,88 @@ class PairedMachines:
         This will also re-pair an existing device, in case the machine
         pairing has become invalid (eg, if they had to wipe a device)
         """
-        # TODO: this file is not locked, so it could change on us
-        self.reload()
-        self._pairedAuthKeys[machine]=authenticationKey
-        self.save()
+        self._append({
+            'fingerprint':machine.fingerprint,
+            'machine':machine.jsonObj,
+            'authenticationKey':authenticationKey})
+        self.sessions.invalidate(machine=machine)
     pair=addPairedMachine
 
+    def removePairedMachine(self,machine:MachineOrFingerprint)->None:
+        """
+        Remove a machine from the paired list
+        """
+        fingerprint=_fingerprintOf(machine)
+        self._refresh(True)
+        entry=self._pairedAuthKeys.get(fingerprint)
+        if entry is not None:
+            self._append({'fingerprint':fingerprint,'removed':True})
+            self.sessions.invalidate(machine=entry[0])
+    unpair=removePairedMachine
+
+    def __contains__(self,machine:MachineOrFingerprint)->bool:
+        self._refresh()
+        return _fingerprintOf(machine) in self._pairedAuthKeys
+
+    def __len__(self)->int:
+        self._refresh()
+        return len(self._pairedAuthKeys)
+
+    @property
+    def machines(self)->typing.List[MachineIdentity]:
+        """
+        All paired machines
+        """
+        self._refresh()
+        return [machine for machine,_ in self._pairedAuthKeys.values()]
+
+    def authenticationKey(self,
+        machine:MachineOrFingerprint
+        )->typing.Optional[str]:
+        """
+        Get the key a machine was paired with
+        """
+        self._refresh()
+        entry=self._pairedAuthKeys.get(_fingerprintOf(machine))
+        if entry is None:
+            return None
+        return entry[1]
+
     def isPairedAndAuthenticated(self,
-        machine:MachineIdentity)->bool:
+        machine:MachineIdentity,
+        connection:typing.Any=None)->bool:
         """
         Determine if the machine is paired and authenticated
+
+        :connection: the connection the machine is talking on.
+            If given, the machine only has to authenticate once
+            per session on that connection.
+        """
+        authenticationKey=self.authenticationKey(machine)
+        if authenticationKey is None:
+            return False
+        if connection is None:
+            return self.sessions.authenticate(machine,authenticationKey)
+        return self.sessions.authenticateSession(
+            connection,machine,authenticationKey)
+
+    def authenticateConnections(self,
+        requests:typing.Iterable[typing.Tuple[typing.Any,MachineIdentity]]
+        )->typing.List[bool]:
+        """
+        Authenticate many (connection,machine) at once, eg
+        when everything reconnects after a network blip
+
+        :return: whether each is paired and authenticated, in order
         """
-        if machine in self._pairedAuthKeys:
-            return authenticateMachine(machine,self._pairedAuthKeys[machine])
-        return False
+        requests=list(requests)
+        results=[False]*len(requests)
+        todo=[]
+        for i,(connection,machine) in enumerate(requests):
+            authenticationKey=self.authenticationKey(machine)
+            if authenticationKey is not None:
+                todo.append((i,(connection,machine,authenticationKey)))
+        verified=self.sessions.authenticateSessions(r for _,r in todo)
+        for (i,_),ok in zip(todo,verified):
+            results[i]=ok
+        return results
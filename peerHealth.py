@@ -0,0 +1,366 @@
+"""
+Health checking and latency-aware ranking of peer machines.
+
+Each peer is sent a periodic heartbeat over its ApiCommunication
+link.  The responses tell us round trip time, load, and how many
+workers the peer has free, which lets us rank peers for work.
+Missed heartbeats are detected with a phi-accrual failure detector,
+so a dead peer is noticed in a fraction of the time a fixed
+timeout would need.
+"""
+import typing
+import os
+import math
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from machineIdentity import MachineIdentity
+from machineDiscovery import MachineDisoveryManager
+from jsonHelper import JsonLike
+from connectionTypes import ConnectionLookup
+
+
+HEARTBEAT_ENDPOINT='heartbeat'
+
+
+def localHealthReport(
+    availableWorkers:int,
+    capabilities:typing.Iterable[str]=()
+    )->JsonLike:
+    """
+    What this machine answers to a heartbeat.
+
+    Register it as the HEARTBEAT_ENDPOINT, for example:
+        apiHandler.addLocalEndpoint(
+            lambda:localHealthReport(4,['gpu']),HEARTBEAT_ENDPOINT)
+    """
+    try:
+        load=os.getloadavg()[0]/(os.cpu_count() or 1)
+    except (AttributeError,OSError):
+        load=0.0 # not available on this platform
+    return {
+        'load':load,
+        'availableWorkers':availableWorkers,
+        'capabilities':list(capabilities)
+    }
+
+
+class PhiAccrualFailureDetector:
+    """
+    Phi-accrual failure detector (Hayashibara et al.)
+
+    Rather than a yes/no timeout, this gives a suspicion level, phi,
+    based on how late the next heartbeat is compared to the
+    history of heartbeat arrival intervals.  phi=1 means about a
+    10% chance of a false positive, phi=2 about 1%, and so on.
+
+    As in the Akka and Cassandra detectors, a heartbeat is allowed
+    to be acceptableHeartbeatPause late before suspicion starts
+    to build, so a garbage collection or a busy event loop does
+    not look like a failure.
+    """
+    def __init__(self,
+        windowSize:int=100,
+        minStdDeviation:float=0.25,
+        firstHeartbeatEstimate:float=1.0,
+        acceptableHeartbeatPause:float=0.0):
+        """
+        :windowSize: how many intervals to remember
+        :minStdDeviation: floor on the deviation, in seconds,
+            so very regular heartbeats do not make phi hair-trigger
+        :firstHeartbeatEstimate: assumed interval before
+            there is any history, in seconds
+        :acceptableHeartbeatPause: how late a heartbeat can be
+            without adding to suspicion, in seconds
+        """
+        self.windowSize=windowSize
+        self.minStdDeviation=minStdDeviation
+        self.acceptableHeartbeatPause=acceptableHeartbeatPause
+        self._intervals:typing.List[float]=[firstHeartbeatEstimate]
+        self._sum=firstHeartbeatEstimate
+        self._sumSquares=firstHeartbeatEstimate**2
+        self._lastHeartbeat:typing.Optional[float]=None
+
+    def heartbeat(self,now:typing.Optional[float]=None)->None:
+        """
+        Record that a heartbeat has arrived
+        """
+        if now is None:
+            now=time.monotonic()
+        if self._lastHeartbeat is not None:
+            interval=now-self._lastHeartbeat
+            self._intervals.append(interval)
+            self._sum+=interval
+            self._sumSquares+=interval**2
+            if len(self._intervals)>self.windowSize:
+                old=self._intervals.pop(0)
+                self._sum-=old
+                self._sumSquares-=old**2
+        self._lastHeartbeat=now
+
+    def timeSinceHeartbeat(self,now:typing.Optional[float]=None)->float:
+        """
+        Seconds since the last heartbeat arrived
+        """
+        if self._lastHeartbeat is None:
+            return 0.0
+        if now is None:
+            now=time.monotonic()
+        return now-self._lastHeartbeat
+
+    def phi(self,now:typing.Optional[float]=None)->float:
+        """
+        How suspicious we are that the peer has failed
+        """
+        if self._lastHeartbeat is None:
+            return 0.0
+        if now is None:
+            now=time.monotonic()
+        n=len(self._intervals)
+        mean=self._sum/n
+        variance=max(self._sumSquares/n-mean**2,0.0)
+        stdDeviation=max(math.sqrt(variance),self.minStdDeviation)
+        late=now-self._lastHeartbeat-mean-self.acceptableHeartbeatPause
+        y=late/stdDeviation
+        # logistic approximation of the normal cdf, where
+        # phi=-log10(1-cdf)=log10(1+exp(z)), done in log space
+        # so it cannot overflow no matter how late we are
+        z=y*(1.5976+0.070566*y*y)
+        if z>0:
+            return (z+math.log1p(math.exp(-z)))/math.log(10)
+        return math.log1p(math.exp(z))/math.log(10)
+
+
+class PeerStats:
+    """
+    What we know about the health of a single peer
+    """
+    def __init__(self,
+        machine:MachineIdentity,
+        rttSmoothing:float=0.2,
+        failureDetector:typing.Optional[PhiAccrualFailureDetector]=None):
+        """
+        :rttSmoothing: weight of the newest sample in the
+            exponentially weighted round trip time
+        """
+        self.machine=machine
+        self.rttSmoothing=rttSmoothing
+        self.rtt:typing.Optional[float]=None
+        self.load:float=0.0
+        self.availableWorkers:int=0
+        self.capabilities:typing.Set[str]=set()
+        self.failureDetector=failureDetector or PhiAccrualFailureDetector()
+
+    def update(self,rtt:float,report:JsonLike)->None:
+        """
+        Record a heartbeat response
+        """
+        if self.rtt is None:
+            self.rtt=rtt
+        else:
+            self.rtt+=self.rttSmoothing*(rtt-self.rtt)
+        self.load=float(report.get('load',0.0))
+        self.availableWorkers=int(report.get('availableWorkers',0))
+        self.capabilities=set(report.get('capabilities',()))
+        self.failureDetector.heartbeat()
+
+    @property
+    def score(self)->float:
+        """
+        How expensive it is to send work to this peer (lower is better)
+        """
+        rtt=self.rtt if self.rtt is not None else 1.0
+        return rtt*(1.0+self.load)/max(self.availableWorkers,0.5)
+
+    def __repr__(self):
+        rtt='?' if self.rtt is None else f'{self.rtt*1000:.1f}ms'
+        return (f'{self.machine} rtt={rtt} load={self.load:.2f}'
+            f' workers={self.availableWorkers}')
+
+
+class PeerHealthMonitor:
+    """
+    Keeps a ranked table of peer machines by sending
+    each of them a periodic heartbeat.
+
+    Peers are added and removed along with a MachineDisoveryManager,
+    and a peer that stops answering is removed from the
+    MachineDisoveryManager (calling its removed callbacks).
+    """
+    def __init__(self,
+        discoveryManager:MachineDisoveryManager,
+        getConnection:ConnectionLookup,
+        heartbeatInterval:float=1.0,
+        phiThreshold:float=8.0,
+        heartbeatTimeout:typing.Optional[float]=None,
+        acceptableHeartbeatPause:typing.Optional[float]=None,
+        requestTimeout:float=1.0):
+        """
+        :getConnection: get the ApiCommunication for a machine
+        :heartbeatInterval: how often to send heartbeats, in seconds
+        :phiThreshold: suspicion level at which a peer is
+            considered failed (see PhiAccrualFailureDetector)
+        :heartbeatTimeout: a peer that has not answered for this long
+            is considered failed regardless of phi
+            (default is 10 heartbeat intervals)
+        :acceptableHeartbeatPause: how late an answer can be before
+            it counts against a peer at all
+            (default is 2 heartbeat intervals)
+        :requestTimeout: how long to wait for the answer to each
+            heartbeat (which is sent once, never retried)
+        """
+        self.discoveryManager=discoveryManager
+        self.getConnection=getConnection
+        self.heartbeatInterval=heartbeatInterval
+        self.phiThreshold=phiThreshold
+        self.heartbeatTimeout=heartbeatTimeout or heartbeatInterval*10
+        if acceptableHeartbeatPause is None:
+            acceptableHeartbeatPause=heartbeatInterval*2
+        self.acceptableHeartbeatPause=acceptableHeartbeatPause
+        self.requestTimeout=requestTimeout
+        self._peers:typing.Dict[MachineIdentity,PeerStats]={}
+        self._lock=threading.Lock()
+        self._keepGoing=False
+        self._thread:typing.Optional[threading.Thread]=None
+        self._executor:typing.Optional[ThreadPoolExecutor]=None
+        self._inFlight:typing.Set[MachineIdentity]=set()
+        discoveryManager.onMachineAddedCallbacks.append(self.addPeer)
+        discoveryManager.onMachineRemovedCallbacks.append(self.removePeer)
+        for machine in discoveryManager.machines.values():
+            self.addPeer(machine)
+
+    def addPeer(self,machine:MachineIdentity)->None:
+        """
+        Start monitoring a machine
+        """
+        with self._lock:
+            if machine not in self._peers:
+                failureDetector=PhiAccrualFailureDetector(
+                    firstHeartbeatEstimate=self.heartbeatInterval,
+                    acceptableHeartbeatPause=self.acceptableHeartbeatPause)
+                stats=PeerStats(machine,failureDetector=failureDetector)
+                # count from when it was found, not from first answer
+                stats.failureDetector.heartbeat()
+                self._peers[machine]=stats
+
+    def removePeer(self,machine:MachineIdentity)->None:
+        """
+        Stop monitoring a machine
+        """
+        with self._lock:
+            self._peers.pop(machine,None)
+
+    @property
+    def peers(self)->typing.List[PeerStats]:
+        """
+        All monitored peers, best first
+        """
+        with self._lock:
+            ret=list(self._peers.values())
+        ret.sort(key=lambda p:p.score)
+        return ret
+
+    def bestPeers(self,
+        n:int=1,
+        capability:typing.Optional[str]=None
+        )->typing.List[MachineIdentity]:
+        """
+        Get the best n peers to send work to
+
+        :capability: only peers that have this capability
+        """
+        ret=[]
+        for stats in self.peers:
+            if stats.rtt is None:
+                continue # never answered
+            if capability is not None and capability not in stats.capabilities:
+                continue
+            ret.append(stats.machine)
+            if len(ret)>=n:
+                break
+        return ret
+
+    def start(self)->None:
+        """
+        Start sending heartbeats in the background
+        """
+        if self._thread is not None:
+            return
+        self._keepGoing=True
+        self._executor=ThreadPoolExecutor(thread_name_prefix='heartbeat')
+        self._thread=threading.Thread(target=self._heartbeatLoop,daemon=True)
+        self._thread.start()
+
+    def stop(self)->None:
+        """
+        Stop sending heartbeats
+        """
+        self._keepGoing=False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread=None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False,cancel_futures=True)
+            self._executor=None
+
+    def __del__(self):
+        self.stop()
+
+    def _sendHeartbeat(self,stats:PeerStats)->None:
+        """
+        Send a single heartbeat and record the response
+        """
+        try:
+            connection=self.getConnection(stats.machine)
+            start=time.monotonic()
+            # a retried heartbeat would measure the retries, not the peer
+            report=connection.callRemoteEndpointOnce(
+                self.requestTimeout,HEARTBEAT_ENDPOINT)
+            rtt=time.monotonic()-start
+            if isinstance(report,dict) and report.get('status',200)==200:
+                with self._lock:
+                    stats.update(rtt,report)
+        except Exception:
+            pass # a missed heartbeat is what the failure detector is for
+        finally:
+            with self._lock:
+                self._inFlight.discard(stats.machine)
+
+    def checkFailures(self)->typing.List[MachineIdentity]:
+        """
+        Find peers that have stopped answering, and remove them
+        from the discovery manager (which calls its removed callbacks)
+
+        :return: the machines that were removed
+        """
+        now=time.monotonic()
+        failed=[]
+        with self._lock:
+            for machine,stats in self._peers.items():
+                detector=stats.failureDetector
+                if detector.phi(now)>=self.phiThreshold \
+                    or detector.timeSinceHeartbeat(now)>=self.heartbeatTimeout:
+                    failed.append(machine)
+        for machine in failed:
+            self.discoveryManager.removeMachine(machine)
+            self.removePeer(machine) # in case it was not there
+        return failed
+
+    def _heartbeatLoop(self)->None:
+        """
+        Send heartbeats to all peers at once every heartbeatInterval,
+        checking for failures several times in between
+        """
+        checksPerInterval=4
+        tick=0
+        while self._keepGoing:
+            if tick%checksPerInterval==0:
+                with self._lock:
+                    due=[stats for machine,stats in self._peers.items()
+                        if machine not in self._inFlight]
+                    self._inFlight.update(stats.machine for stats in due)
+                for stats in due:
+                    self._executor.submit(self._sendHeartbeat,stats)
+            self.checkFailures()
+            tick+=1
+            time.sleep(self.heartbeatInterval/checksPerInterval)
@@ -0,0 +1,298 @@
+"""
+At-least-once delivery of remote calls
+
+The caller gives every request a requestId, and resends the request
+with the same requestId (backing off exponentially) until it gets an
+answer.  The receiver remembers recent answers by requestId, so a
+resent request gets the same answer again rather than running twice.
+Together that makes a remote call happen exactly once, even across
+dropped connections.
+
+The number of requests in flight is bounded, so that a slow peer
+makes callers wait rather than piling up requests without limit.
+A peer that is overloaded answers 503, which is also retried with
+backoff, giving it time to catch up.
+"""
+import typing
+import time
+import uuid
+import random
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from jsonHelper import JsonLike
+
+
+RETRYABLE_ERRORS=(ConnectionError,TimeoutError,EOFError,OSError)
+RETRYABLE_STATUSES=(503,)
+SendRequest=typing.Callable[[typing.Dict[str,JsonLike],float],JsonLike]
+
+
+class DeliveryFailed(ConnectionError):
+    """
+    Raised when a request could not be delivered after every retry
+    """
+
+
+class OutboxFull(ConnectionError):
+    """
+    Raised when too many requests are already waiting on a peer
+    """
+
+
+def backoffDelays(
+    baseDelay:float,
+    maxDelay:float,
+    count:int,
+    jitter:float=0.5
+    )->typing.Iterator[float]:
+    """
+    Exponentially growing delays, each randomly shortened by up to
+    jitter, so that many callers do not all retry at the same moment
+    """
+    delay=baseDelay
+    for _ in range(count):
+        yield delay*(1.0-jitter*random.random())
+        delay=min(delay*2,maxDelay)
+
+
+def newRequestId()->str:
+    """
+    A new, unique request id
+    """
+    return uuid.uuid4().hex
+
+
+class ReliableCaller:
+    """
+    Sends requests with retries and backoff, keeping the same
+    requestId across retries so the receiver can ignore duplicates
+    """
+    def __init__(self,
+        sendRequest:SendRequest,
+        maxAttempts:int=5,
+        baseDelay:float=0.05,
+        maxDelay:float=5.0,
+        requestTimeout:float=30.0,
+        maxOutstanding:int=256,
+        outboxTimeout:typing.Optional[float]=None,
+        retryStatuses:typing.Iterable[int]=RETRYABLE_STATUSES):
+        """
+        :sendRequest: send a single request and wait (up to a timeout)
+            for its response, raising ConnectionError, TimeoutError etc
+            if it could not
+        :maxAttempts: how many times to try before giving up
+        :baseDelay: the delay before the first retry, in seconds
+        :maxDelay: the longest delay between retries, in seconds
+        :requestTimeout: how long to wait for each attempt, in seconds
+        :maxOutstanding: most requests to have in flight at once
+            (more callers wait for room)
+        :outboxTimeout: how long to wait for room before giving up
+            with OutboxFull (default is to wait as long as it takes)
+        :retryStatuses: response statuses that mean "try again later"
+            (the last such response is returned if every attempt gets one)
+        """
+        self.sendRequest=sendRequest
+        self.maxAttempts=maxAttempts
+        self.baseDelay=baseDelay
+        self.maxDelay=maxDelay
+        self.requestTimeout=requestTimeout
+        self.maxOutstanding=maxOutstanding
+        self.outboxTimeout=outboxTimeout
+        self.retryStatuses=frozenset(retryStatuses)
+        self.retries=0
+        self.failures=0
+        self._outbox=threading.BoundedSemaphore(maxOutstanding)
+        self._outstanding=0
+        # guards the counters, which every calling thread updates
+        self._lock=threading.Lock()
+
+    @property
+    def outstanding(self)->int:
+        """
+        How many requests are in flight right now
+        """
+        return self._outstanding
+
+    def call(self,message:typing.Dict[str,JsonLike])->JsonLike:
+        """
+        Send a request and get its response, retrying as needed
+
+        :message: the request (a requestId is added if it has none)
+        """
+        if 'requestId' not in message:
+            message['requestId']=newRequestId()
+        if not self._outbox.acquire(timeout=self.outboxTimeout):
+            raise OutboxFull(
+                f'{self.maxOutstanding} requests are already waiting')
+        with self._lock:
+            self._outstanding+=1
+        try:
+            delays=backoffDelays(
+                self.baseDelay,self.maxDelay,self.maxAttempts-1)
+            while True:
+                try:
+                    response=self.sendRequest(message,self.requestTimeout)
+                except RETRYABLE_ERRORS as e:
+                    delay=next(delays,None)
+                    if delay is None:
+                        with self._lock:
+                            self.failures+=1
+                        raise DeliveryFailed(
+                            f'Gave up on request {message["requestId"]}'
+                            f' after {self.maxAttempts} attempts') from e
+                else:
+                    if not isinstance(response,dict) \
+                        or response.get('status') not in self.retryStatuses:
+                        return response
+                    delay=next(delays,None)
+                    if delay is None:
+                        with self._lock:
+                            self.failures+=1
+                        return response
+                with self._lock:
+                    self.retries+=1
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self._outstanding-=1
+            self._outbox.release()
+
+
+class ResponseCache:
+    """
+    Remembers recent responses by requestId, so that a request
+    that is delivered more than once only runs once.
+
+    Bounded both by number of entries and by age.
+    """
+    def __init__(self,maxEntries:int=4096,ttl:float=300.0):
+        """
+        :maxEntries: most responses to remember
+        :ttl: how long to remember a response, in seconds
+            (should be longer than a caller would keep retrying)
+        """
+        self.maxEntries=maxEntries
+        self.ttl=ttl
+        self.hits=0
+        # requestId:(expiry,response), or a Future while it is running
+        self._entries:typing.OrderedDict[str,typing.Union[
+            typing.Tuple[float,JsonLike],
+            concurrent.futures.Future]]=OrderedDict()
+        self._lock=threading.Lock()
+
+    def __len__(self)->int:
+        return len(self._entries)
+
+    def __contains__(self,requestId:str)->bool:
+        return requestId in self._entries
+
+    def execute(self,
+        requestId:typing.Optional[str],
+        fn:typing.Callable[[],JsonLike]
+        )->JsonLike:
+        """
+        Run fn() to answer a request, unless the request has been
+        answered already (or is being answered right now), in which
+        case give the same answer
+        """
+        if requestId is None:
+            return fn()
+        now=time.monotonic()
+        with self._lock:
+            entry=self._entries.get(requestId)
+            if entry is not None and not isinstance(
+                entry,concurrent.futures.Future) and entry[0]<now:
+                entry=None # expired
+            if entry is None:
+                future:concurrent.futures.Future=concurrent.futures.Future()
+                self._entries[requestId]=future
+                self._entries.move_to_end(requestId)
+            else:
+                self.hits+=1
+        if entry is not None:
+            if isinstance(entry,concurrent.futures.Future):
+                return entry.result() # a duplicate of one still running
+            return entry[1]
+        try:
+            response=fn()
+        except BaseException as e:
+            with self._lock:
+                self._entries.pop(requestId,None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._entries[requestId]=(time.monotonic()+self.ttl,response)
+            self._evict()
+        future.set_result(response)
+        return response
+
+    def submit(self,
+        requestId:typing.Optional[str],
+        start:typing.Callable[[],concurrent.futures.Future]
+        )->concurrent.futures.Future:
+        """
+        Same as execute(), but for answers that arrive later.  start()
+        begins answering the request, and the returned Future gets
+        the answer (which may be one given before).
+        """
+        if requestId is None:
+            return start()
+        now=time.monotonic()
+        with self._lock:
+            entry=self._entries.get(requestId)
+            if entry is not None and not isinstance(
+                entry,concurrent.futures.Future) and entry[0]<now:
+                entry=None # expired
+            if entry is None:
+                future:concurrent.futures.Future=concurrent.futures.Future()
+                self._entries[requestId]=future
+                self._entries.move_to_end(requestId)
+            else:
+                self.hits+=1
+        if entry is not None:
+            if isinstance(entry,concurrent.futures.Future):
+                return entry # a duplicate of one still running
+            done:concurrent.futures.Future=concurrent.futures.Future()
+            done.set_result(entry[1])
+            return done
+        def finished(answer:concurrent.futures.Future)->None:
+            exception=answer.exception() if not answer.cancelled() \
+                else concurrent.futures.CancelledError()
+            with self._lock:
+                if exception is not None:
+                    self._entries.pop(requestId,None)
+                else:
+                    self._entries[requestId]=(
+                        time.monotonic()+self.ttl,answer.result())
+                    self._evict()
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(answer.result())
+        try:
+            start().add_done_callback(finished)
+        except BaseException as e:
+            with self._lock:
+                self._entries.pop(requestId,None)
+            future.set_exception(e)
+            raise
+        return future
+
+    def _evict(self)->None:
+        """
+        Forget the oldest responses, and any that have expired
+        """
+        entries=self._entries
+        now=time.monotonic()
+        excess=len(entries)-self.maxEntries
+        expired=[]
+        for requestId,entry in entries.items():
+            if isinstance(entry,concurrent.futures.Future):
+                continue # still running
+            if excess<=0 and entry[0]>=now:
+                break
+            expired.append(requestId)
+            excess-=1
+        for requestId in expired:
+            del entries[requestId]
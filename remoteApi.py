@@ -1,13 +1,34 @@
 """
 Common commands to be run on a remote api
 """
+import typing
 from apiCommunication import ApiCommunication
 from machineIdentity import MachineIdentity
+from jsonHelper import JsonLike
+
+
+MACHINE_IDENTITY_ENDPOINT='queryMachineIdentity'
+
+
+def machineIdentityEndpoint(
+    identity:MachineIdentity
+    )->typing.Callable[[],JsonLike]:
+    """
+    Create the api endpoint that tells other machines who this one is.
+
+    Register it as the MACHINE_IDENTITY_ENDPOINT, for example:
+        apiHandler.addLocalEndpoint(
+            machineIdentityEndpoint(identity),MACHINE_IDENTITY_ENDPOINT)
+    """
+    return lambda:identity.jsonObj
 
 
 def queryMachineIdentity(connection:ApiCommunication)->MachineIdentity:
     """
     Query the machine identity
     """
-    json=connection.sendJsonMessage({'command':'queryMachineIdentity'})
-    return MachineIdentity('','','','',None,json)
+    json=connection.callRemoteEndpoint(MACHINE_IDENTITY_ENDPOINT)
+    if json.get('status',200)!=200:
+        raise ConnectionError(
+            f'Machine identity query failed with status {json["status"]}')
+    return MachineIdentity.fromJson(json)
@@ -0,0 +1,212 @@
+"""
+Run FunctionCallManager calls on other machines in the confederation.
+
+Functions registered with remote=True are sent to whichever peer
+(as ranked by a PeerHealthMonitor) has the most spare capacity.
+If that peer is lost mid-call, the call is retried on the next best
+peer, and if there are no peers with room, it simply runs locally.
+This means a call whose peer is lost may run more than once, so
+only functions that are safe to repeat should be registered remote.
+
+The receiving machine needs the same functions registered on its own
+FunctionCallManager, and remoteCallEndpoint() registered as an api
+endpoint.
+"""
+import typing
+import threading
+from concurrent.futures import Future,ThreadPoolExecutor,CancelledError
+from machineIdentity import MachineIdentity
+from peerHealth import PeerHealthMonitor,PeerStats
+from connectionTypes import ConnectionLookup
+from reliableDelivery import RETRYABLE_ERRORS,RETRYABLE_STATUSES
+from functionCallManager import FunctionCallManager
+from jsonHelper import JsonLike
+
+
+REMOTE_CALL_ENDPOINT='callFunction'
+# a peer that has gone away may no longer have a connection at all
+PEER_LOST_ERRORS=RETRYABLE_ERRORS+(LookupError,)
+
+
+class RemoteCallError(Exception):
+    """
+    A function raised an exception while running on another machine
+    """
+
+
+def remoteCallEndpoint(
+    functionCallManager:FunctionCallManager
+    )->typing.Callable[...,JsonLike]:
+    """
+    Create the api endpoint that runs calls sent by other machines.
+
+    Register it as the REMOTE_CALL_ENDPOINT, for example:
+        apiHandler.addLocalEndpoint(
+            remoteCallEndpoint(manager),REMOTE_CALL_ENDPOINT)
+    """
+    def callFunction(
+        name:str,
+        args:typing.Optional[typing.List[typing.Any]]=None,
+        kwargs:typing.Optional[typing.Dict[str,typing.Any]]=None
+        )->JsonLike:
+        # always local, so a call cannot bounce between machines
+        future=functionCallManager.submitLocal(
+            name,*(args or ()),**(kwargs or {}))
+        return {'result':future.result()}
+    return callFunction
+
+
+class RemoteWorkerPool:
+    """
+    Sends function calls to the peers with the most spare capacity
+    """
+    def __init__(self,
+        peerHealth:PeerHealthMonitor,
+        getConnection:ConnectionLookup,
+        maxAttempts:int=3,
+        maxConcurrentCalls:int=32):
+        """
+        :peerHealth: where to find ranked peers and their capacity
+        :getConnection: get the ApiCommunication for a machine
+        :maxAttempts: how many different peers to try before
+            falling back to running locally
+        :maxConcurrentCalls: how many remote calls can be waiting
+            on responses at once
+        """
+        self.peerHealth=peerHealth
+        self.getConnection=getConnection
+        self.maxAttempts=maxAttempts
+        self._inFlight:typing.Dict[MachineIdentity,int]={}
+        self._lock=threading.Lock()
+        self._executor=ThreadPoolExecutor(
+            maxConcurrentCalls,thread_name_prefix='remoteCall')
+
+    def stop(self)->None:
+        """
+        Stop sending calls (calls already sent are not waited for)
+        """
+        self._executor.shutdown(wait=False,cancel_futures=True)
+
+    def inFlight(self,machine:MachineIdentity)->int:
+        """
+        How many calls are currently running on a machine
+        """
+        with self._lock:
+            return self._inFlight.get(machine,0)
+
+    def _reservePeer(self,
+        exclude:typing.Set[MachineIdentity]
+        )->typing.Optional[MachineIdentity]:
+        """
+        Pick the peer with the best score that has a free worker,
+        and count a call against it
+        """
+        best:typing.Optional[PeerStats]=None
+        bestScore=0.0
+        with self._lock:
+            for stats in self.peerHealth.peers:
+                if stats.rtt is None or stats.machine in exclude:
+                    continue
+                inFlight=self._inFlight.get(stats.machine,0)
+                if inFlight>=stats.availableWorkers:
+                    continue
+                # each call already sent there makes it less attractive
+                score=stats.score*(1+inFlight)
+                if best is None or score<bestScore:
+                    best=stats
+                    bestScore=score
+            if best is None:
+                return None
+            self._inFlight[best.machine]=self._inFlight.get(best.machine,0)+1
+            return best.machine
+
+    def _releasePeer(self,machine:MachineIdentity)->None:
+        with self._lock:
+            count=self._inFlight.get(machine,0)-1
+            if count>0:
+                self._inFlight[machine]=count
+            else:
+                self._inFlight.pop(machine,None)
+
+    def _hasFreePeer(self)->bool:
+        """
+        Quick check whether any peer could take a call right now
+        """
+        with self._lock:
+            for stats in self.peerHealth.peers:
+                if stats.rtt is not None and \
+                    self._inFlight.get(stats.machine,0)<stats.availableWorkers:
+                    return True
+        return False
+
+    def submit(self,
+        name:str,
+        args:typing.Iterable[typing.Any],
+        kwargs:typing.Dict[str,typing.Any],
+        runLocally:typing.Callable[[],Future]
+        )->Future:
+        """
+        Send a call to the best peer
+
+        :runLocally: called to run the call here if no peer can
+        :return: a Future for the return value from the function
+        """
+        future:Future=Future()
+        args=list(args)
+
+        def fallBack()->None:
+            localFuture=runLocally()
+            def chain(done:Future)->None:
+                if done.cancelled():
+                    future.set_exception(CancelledError())
+                elif done.exception() is not None:
+                    future.set_exception(done.exception())
+                else:
+                    future.set_result(done.result())
+            localFuture.add_done_callback(chain)
+
+        def run()->None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                tryPeers()
+            except Exception as e: # pylint: disable=broad-except
+                # eg, arguments that can't be sent, or runLocally failing
+                if not future.done():
+                    future.set_exception(e)
+
+        def tryPeers()->None:
+            tried:typing.Set[MachineIdentity]=set()
+            for _ in range(self.maxAttempts):
+                machine=self._reservePeer(tried)
+                if machine is None:
+                    break
+                tried.add(machine)
+                try:
+                    response=self.getConnection(machine).callRemoteEndpoint(
+                        REMOTE_CALL_ENDPOINT,name,args,kwargs)
+                except PEER_LOST_ERRORS:
+                    continue # peer lost, try the next one
+                finally:
+                    self._releasePeer(machine)
+                if not isinstance(response,dict):
+                    continue
+                status=response.get('status',200)
+                if status in RETRYABLE_STATUSES:
+                    continue # peer too busy, try the next one
+                if status!=200:
+                    future.set_exception(RemoteCallError(
+                        f'Exception on {machine}:\n'+''.join(
+                            response.get('exception',()))))
+                    return
+                future.set_result(response.get('result'))
+                return
+            fallBack()
+
+        # the future is only marked running once run() starts
+        if self._hasFreePeer():
+            self._executor.submit(run)
+        else:
+            future.set_running_or_notify_cancel()
+            fallBack()
+        return future
@@ -0,0 +1,321 @@
+"""
+Find out which documents or windows are not in synch with
+another machine without shipping the whole state around.
+
+Every piece of state (a document, a window) is a leaf in a Merkle
+tree, keyed by a hash of its name so the tree stays balanced.  Two
+machines compare root hashes, and only descend into the subtrees
+whose hashes differ, so finding a handful of differences among
+thousands of items takes a few small messages instead of one huge one.
+"""
+import typing
+import json
+import hashlib
+import threading
+from machineIdentity import MachineIdentity
+from connectionTypes import ConnectionLookup
+from jsonHelper import JsonLike
+from documentReference import DocumentReference,Operation
+if typing.TYPE_CHECKING:
+    from windowLayout import ConfederatedAppLayout,WindowLayout
+
+
+MERKLE_ENDPOINT='getMerkleNodes'
+HEX_DIGITS='0123456789abcdef'
+StateKey=str
+NodeHash=str
+
+
+def stateHash(value:JsonLike)->NodeHash:
+    """
+    Hash any json-compatible value (the same way on every machine)
+    """
+    return hashlib.sha256(json.dumps(value,sort_keys=True,
+        separators=(',',':')).encode('utf-8')).hexdigest()[:32]
+
+
+class MerkleTree:
+    """
+    A Merkle tree over a set of keys, each with the hash of its value
+
+    Keys are placed by the hex digits of their own hash, 16 ways
+    at each level, down to leaf buckets of keys.
+    """
+    def __init__(self,depth:int=3):
+        """
+        :depth: levels below the root (16**depth leaf buckets)
+        """
+        self.depth=depth
+        self._buckets:typing.Dict[str,typing.Dict[StateKey,NodeHash]]={}
+        # only nodes with something under them are kept
+        self._nodes:typing.Dict[str,NodeHash]={}
+        self._lock=threading.RLock()
+
+    def _bucketOf(self,key:StateKey)->str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:self.depth]
+
+    def __len__(self)->int:
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+    def __contains__(self,key:StateKey)->bool:
+        return key in self._buckets.get(self._bucketOf(key),{})
+
+    @property
+    def rootHash(self)->NodeHash:
+        """
+        Hash of everything (empty if there is nothing)
+        """
+        return self._nodes.get('','')
+
+    def get(self,key:StateKey)->typing.Optional[NodeHash]:
+        """
+        Get the hash of a key's value
+        """
+        return self._buckets.get(self._bucketOf(key),{}).get(key)
+
+    def set(self,key:StateKey,valueHash:NodeHash)->None:
+        """
+        Set the hash of a key's value
+        """
+        prefix=self._bucketOf(key)
+        with self._lock:
+            bucket=self._buckets.setdefault(prefix,{})
+            if bucket.get(key)==valueHash:
+                return
+            bucket[key]=valueHash
+            self._rehash(prefix)
+
+    def remove(self,key:StateKey)->None:
+        """
+        Remove a key (if it is there)
+        """
+        prefix=self._bucketOf(key)
+        with self._lock:
+            bucket=self._buckets.get(prefix)
+            if bucket is None or key not in bucket:
+                return
+            del bucket[key]
+            if not bucket:
+                del self._buckets[prefix]
+            self._rehash(prefix)
+
+    def _rehash(self,prefix:str)->None:
+        """
+        Recalculate the hashes from a leaf bucket up to the root
+        """
+        bucket=self._buckets.get(prefix)
+        if bucket:
+            self._nodes[prefix]=stateHash(sorted(bucket.items()))
+        else:
+            self._nodes.pop(prefix,None)
+        while prefix:
+            prefix=prefix[:-1]
+            nodes=self._nodes
+            children=[nodes.get(prefix+digit,'') for digit in HEX_DIGITS]
+            if any(children):
+                nodes[prefix]=stateHash(children)
+            else:
+                nodes.pop(prefix,None)
+
+    def children(self,
+        prefix:str
+        )->typing.Dict[str,NodeHash]:
+        """
+        Get what is directly under a node
+
+        :return: {childPrefix:hash} for inner nodes,
+            or {key:valueHash} for leaf buckets
+        """
+        with self._lock:
+            if len(prefix)>=self.depth:
+                return dict(self._buckets.get(prefix,{}))
+            nodes=self._nodes
+            ret={}
+            for digit in HEX_DIGITS:
+                h=nodes.get(prefix+digit)
+                if h is not None:
+                    ret[prefix+digit]=h
+            return ret
+
+    def diff(self,
+        remoteRoot:NodeHash,
+        fetchChildren:typing.Callable[
+            [typing.List[str]],typing.Dict[str,typing.Dict[str,NodeHash]]]
+        )->typing.List[StateKey]:
+        """
+        Find every key that differs from another tree, descending
+        only into subtrees whose hashes differ
+
+        :remoteRoot: the other tree's root hash
+        :fetchChildren: get children() of several nodes in the other tree
+            (called once per level)
+        :return: keys that are different, or only in one of the trees
+        """
+        if remoteRoot==self.rootHash:
+            return []
+        different:typing.List[StateKey]=[]
+        prefixes=['']
+        while prefixes:
+            remote=fetchChildren(prefixes)
+            nextPrefixes=[]
+            for prefix in prefixes:
+                local=self.children(prefix)
+                theirs=remote.get(prefix,{})
+                for name in local.keys()|theirs.keys():
+                    if local.get(name)==theirs.get(name):
+                        continue
+                    if len(prefix)>=self.depth:
+                        different.append(name)
+                    else:
+                        nextPrefixes.append(name)
+            prefixes=nextPrefixes
+        different.sort()
+        return different
+
+
+class StateTree:
+    """
+    Keeps a MerkleTree over the open documents and the window layout,
+    and compares it with other machines.
+
+    Register the functions from endpoints() with the local api
+    so that other machines can compare with this one.
+    """
+    def __init__(self,
+        getConnection:ConnectionLookup,
+        depth:int=3):
+        """
+        :getConnection: get the ApiCommunication for a machine
+        """
+        self.getConnection=getConnection
+        self.tree=MerkleTree(depth)
+        self.documents:typing.Dict[str,DocumentReference]={}
+        self.layout:typing.Optional["ConfederatedAppLayout"]=None
+        self._windowCallbacks:typing.Dict[StateKey,typing.Tuple[
+            "WindowLayout",typing.Callable[["WindowLayout"],None]]]={}
+        self.messagesSent=0
+
+    @staticmethod
+    def documentKey(documentId:str)->StateKey:
+        """
+        The key of a document in the tree
+        """
+        return 'document/'+documentId
+
+    @staticmethod
+    def windowKey(
+        machine:typing.Union[MachineIdentity,str],
+        desktop:str,
+        display:str,
+        window:str
+        )->StateKey:
+        """
+        The key of a window in the tree
+        """
+        machine=getattr(machine,'fingerprint',machine)
+        return f'window/{machine}/{desktop}/{display}/{window}'
+
+    def trackDocument(self,document:DocumentReference)->None:
+        """
+        Follow the state of a document
+        """
+        if self.documents.get(document.documentId) is document:
+            return
+        self.untrackDocument(document.documentId)
+        self.documents[document.documentId]=document
+        document.onOperationsCallbacks.append(self._documentChanged)
+        self._documentChanged(document,[])
+
+    def untrackDocument(self,documentId:str)->None:
+        """
+        Stop following a document
+        """
+        document=self.documents.pop(documentId,None)
+        if document is None:
+            return
+        if self._documentChanged in document.onOperationsCallbacks:
+            document.onOperationsCallbacks.remove(self._documentChanged)
+        self.tree.remove(self.documentKey(documentId))
+
+    def _documentChanged(self,
+        document:DocumentReference,
+        _:typing.List[Operation]
+        )->None:
+        # equal version vectors mean equal operations, and so equal contents
+        self.tree.set(self.documentKey(document.documentId),
+            stateHash(document.versionVector))
+
+    def trackLayout(self,layout:"ConfederatedAppLayout")->None:
+        """
+        Follow the window layout
+
+        Window moves and resizes are followed automatically,
+        call refreshLayout() after adding or removing windows.
+        """
+        self.layout=layout
+        self.refreshLayout()
+
+    def refreshLayout(self)->None:
+        """
+        Bring the tree up to date with the windows in the layout
+        """
+        windows:typing.Dict[StateKey,"WindowLayout"]={}
+        if self.layout is not None:
+            for identity,machine in self.layout.machines.items():
+                for desktopName,desktop in getattr(
+                    machine,'desktops',{}).items():
+                    for displayName,display in desktop.displays.items():
+                        for windowName,window in display.windows.items():
+                            windows[self.windowKey(identity,desktopName,
+                                displayName,windowName)]=window
+        for key,(window,callback) in list(self._windowCallbacks.items()):
+            if windows.get(key) is not window:
+                if callback in window.onGeometryChangedCallbacks:
+                    window.onGeometryChangedCallbacks.remove(callback)
+                del self._windowCallbacks[key]
+                if key not in windows:
+                    self.tree.remove(key)
+        for key,window in windows.items():
+            if key not in self._windowCallbacks:
+                def onGeometryChanged(w:"WindowLayout",key=key)->None:
+                    self.tree.set(key,stateHash(w.jsonObj))
+                window.onGeometryChangedCallbacks.append(onGeometryChanged)
+                self._windowCallbacks[key]=(window,onGeometryChanged)
+            self.tree.set(key,stateHash(window.jsonObj))
+
+    def endpoints(self)->typing.Dict[str,typing.Callable[...,JsonLike]]:
+        """
+        The api endpoints to register, by name
+        """
+        return {MERKLE_ENDPOINT:self.nodesEndpoint}
+
+    def nodesEndpoint(self,prefixes:typing.List[str])->JsonLike:
+        """
+        Another machine asks for our root hash and
+        what is under the given nodes
+        """
+        return {
+            'root':self.tree.rootHash,
+            'nodes':{prefix:self.tree.children(prefix) for prefix in prefixes}}
+
+    def _call(self,
+        machine:MachineIdentity,
+        prefixes:typing.List[str]
+        )->JsonLike:
+        self.messagesSent+=1
+        response=self.getConnection(machine).callRemoteEndpoint(
+            MERKLE_ENDPOINT,prefixes)
+        if not isinstance(response,dict) or response.get('status',200)!=200:
+            raise ConnectionError(
+                f'{MERKLE_ENDPOINT} failed on {machine}: {response}')
+        return response
+
+    def diverged(self,machine:MachineIdentity)->typing.List[StateKey]:
+        """
+        Find which documents and windows are different on another machine
+
+        :return: the keys that differ (see documentKey() and windowKey())
+        """
+        root=self._call(machine,[])['root']
+        return self.tree.diff(root,
+            lambda prefixes:self._call(machine,prefixes)['nodes'])
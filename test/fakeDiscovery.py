@@ -0,0 +1,148 @@
+"""
+A local stand-in for zeroconf/upnp and for remote machines
+answering identity queries, for tests and benchmarks.
+"""
+import typing
+import time
+import asyncio
+import threading
+from ConfederatedApp.machineIdentity import MachineIdentity
+
+
+class FakeAnnouncement:
+    """
+    What a discovery source returns for each machine found
+    """
+    def __init__(self,address:str,fingerprint:typing.Optional[str]=None):
+        self.address=address
+        self.fingerprint=fingerprint
+
+
+ServiceCallback=typing.Callable[[FakeAnnouncement],None]
+
+
+class FakeDiscoveryResponder:
+    """
+    A local stand-in for zeroconf/upnp and for remote machines
+    answering identity queries.
+
+    Each simulated machine answers its identity query after
+    a simulated network round trip.
+    """
+    def __init__(self,
+        numMachines:int=0,
+        roundTripTime:float=0.05,
+        unresponsive:typing.Iterable[str]=(),
+        unresponsiveDelay:float=5.0):
+        """
+        :roundTripTime: simulated network delay for each identity query
+        :unresponsive: addresses that take unresponsiveDelay to answer
+        """
+        self.roundTripTime=roundTripTime
+        self.unresponsiveDelay=unresponsiveDelay
+        self.unresponsive=set(unresponsive)
+        self.announced:typing.Dict[str,typing.Set[str]]={}
+        self.machines:typing.Dict[str,MachineIdentity]={}
+        self.fingerprints:typing.Dict[str,str]={}
+        self.subscribers:typing.List[
+            typing.Tuple[ServiceCallback,ServiceCallback]]=[]
+        self.queryCount=0
+        self._lock=threading.Lock()
+        for i in range(numMachines):
+            self.addMachine(f'10.0.{i//250}.{i%250+1}:18765')
+
+    def addMachine(self,
+        address:str,
+        fingerprint:str='1'
+        )->MachineIdentity:
+        """
+        Simulate a machine appearing on the network
+        (or re-announcing itself with a new fingerprint)
+        """
+        machine=MachineIdentity(
+            'user',f'machine-{address}',f'Fake OS {fingerprint}','computer')
+        self.machines[address]=machine
+        self.fingerprints[address]=fingerprint
+        for onAdded,_ in list(self.subscribers):
+            onAdded(FakeAnnouncement(address,fingerprint))
+        return machine
+
+    def removeMachine(self,address:str)->None:
+        """
+        Simulate a machine leaving the network
+        """
+        if self.machines.pop(address,None) is None:
+            return
+        fingerprint=self.fingerprints.pop(address,None)
+        for _,onRemoved in list(self.subscribers):
+            onRemoved(FakeAnnouncement(address,fingerprint))
+
+    # discovery source interface
+    def announce(self,networkLocation:str,serviceIdentity:str)->None:
+        """
+        Record an announcement
+        """
+        self.announced.setdefault(serviceIdentity,set()).add(networkLocation)
+
+    def find(self,serviceIdentity:str)->typing.List[FakeAnnouncement]:
+        """
+        Find all machines (the service identity is ignored)
+        """
+        del serviceIdentity
+        return [FakeAnnouncement(address,self.fingerprints.get(address))
+            for address in self.machines]
+
+    # identity query interface
+    def queryIdentity(self,address:str)->typing.Optional[MachineIdentity]:
+        """
+        A blocking identity query
+        """
+        with self._lock:
+            self.queryCount+=1
+        if address in self.unresponsive:
+            time.sleep(self.unresponsiveDelay)
+        time.sleep(self.roundTripTime)
+        return self.machines.get(address)
+
+    async def queryIdentityAsync(self,
+        address:str
+        )->typing.Optional[MachineIdentity]:
+        """
+        An asyncio identity query
+        """
+        self.queryCount+=1
+        if address in self.unresponsive:
+            await asyncio.sleep(self.unresponsiveDelay)
+        await asyncio.sleep(self.roundTripTime)
+        return self.machines.get(address)
+
+
+class FakeSubscribableDiscoveryResponder(FakeDiscoveryResponder):
+    """
+    A FakeDiscoveryResponder that also sends added/removed
+    announcements to subscribers, like an event-driven zeroconf browser
+    """
+
+    def subscribe(self,
+        serviceIdentity:str,
+        onServiceAdded:ServiceCallback,
+        onServiceRemoved:ServiceCallback
+        )->None:
+        """
+        Start sending announcements (including all current machines)
+        """
+        del serviceIdentity
+        self.subscribers.append((onServiceAdded,onServiceRemoved))
+        for announcement in self.find(''):
+            onServiceAdded(announcement)
+
+    def unsubscribe(self,
+        serviceIdentity:str,
+        onServiceAdded:ServiceCallback,
+        onServiceRemoved:ServiceCallback
+        )->None:
+        """
+        Stop sending announcements
+        """
+        del serviceIdentity
+        self.subscribers.remove((onServiceAdded,onServiceRemoved))
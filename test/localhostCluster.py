@@ -0,0 +1,177 @@
+"""
+Several worker processes on localhost that stand in for several
+machines in the confederation, for tests and benchmarks.
+
+Each worker process runs its own FunctionCallManager and answers
+heartbeat and remote call requests over a local socket, the same
+way an ApiCommunication peer would.
+"""
+import typing
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener,Client,Connection
+from ConfederatedApp.machineIdentity import MachineIdentity
+from ConfederatedApp.functionCallManager import FunctionCallManager
+from ConfederatedApp.peerHealth import HEARTBEAT_ENDPOINT,localHealthReport
+from ConfederatedApp.remoteWorkers import (
+    REMOTE_CALL_ENDPOINT,remoteCallEndpoint)
+from fakeDiscovery import FakeDiscoveryResponder
+
+
+FunctionTable=typing.Dict[str,typing.Tuple[typing.Callable,bool]]
+
+
+def _serveRequest(
+    conn:Connection,
+    endpoints:typing.Dict[str,typing.Callable[...,typing.Any]]
+    )->None:
+    """
+    Answer a single request the way an EndpointDispatcher does
+    """
+    try:
+        request=conn.recv()
+        endpoint=endpoints.get(request.get('endpoint',''))
+        if endpoint is None:
+            response={'status':404}
+        else:
+            try:
+                response=endpoint(
+                    *request.get('args',[]),**request.get('kwargs',{}))
+                response.setdefault('status',200)
+            except Exception as e:
+                response={'status':500,'exception':[repr(e)]}
+        conn.send(response)
+    except (EOFError,OSError):
+        pass
+    finally:
+        conn.close()
+
+
+def _workerMain(
+    functions:FunctionTable,
+    numWorkers:int,
+    capabilities:typing.List[str],
+    portPipe:Connection
+    )->None:
+    """
+    The body of a worker process
+    """
+    manager=FunctionCallManager(num_threads=numWorkers,num_processes=0)
+    for name,(func,threadsafe) in functions.items():
+        manager.addFunction(func,name,threadsafe)
+    endpoints={
+        HEARTBEAT_ENDPOINT:lambda:localHealthReport(numWorkers,capabilities),
+        REMOTE_CALL_ENDPOINT:remoteCallEndpoint(manager)}
+    with Listener(('127.0.0.1',0)) as listener:
+        portPipe.send(listener.address[1])
+        portPipe.close()
+        while True:
+            conn=listener.accept()
+            threading.Thread(target=_serveRequest,
+                args=(conn,endpoints),daemon=True).start()
+
+
+class LocalhostConnection:
+    """
+    Stands in for an ApiCommunication link to a worker process
+    """
+    def __init__(self,port:int):
+        self.port=port
+
+    def callRemoteEndpoint(self,commandName:str,*args,**kwargs):
+        """
+        Call an endpoint on the worker, raising ConnectionError
+        if the worker is gone
+        """
+        try:
+            with Client(('127.0.0.1',self.port)) as conn:
+                conn.send({'endpoint':commandName,
+                    'args':list(args),'kwargs':kwargs})
+                return conn.recv()
+        except (EOFError,OSError) as e:
+            raise ConnectionError(f'Lost worker on port {self.port}') from e
+    __call__=callRemoteEndpoint
+
+    def callRemoteEndpointOnce(self,
+        timeout:float,
+        commandName:str,
+        *args,**kwargs):
+        """
+        Same as callRemoteEndpoint() (which never retries here anyway)
+        """
+        del timeout
+        return self.callRemoteEndpoint(commandName,*args,**kwargs)
+
+
+class LocalhostCluster(FakeDiscoveryResponder):
+    """
+    Several worker processes on localhost that stand in for
+    several machines, and a discovery source that finds them.
+    """
+    def __init__(self,
+        numMachines:int,
+        functions:FunctionTable,
+        workersPerMachine:int=2,
+        capabilities:typing.Optional[typing.Dict[int,typing.List[str]]]=None):
+        """
+        :functions: name:(function,threadsafe) to register on every worker
+            (functions must be importable by the worker processes)
+        :capabilities: extra capabilities for the machine at a given index
+        """
+        FakeDiscoveryResponder.__init__(self,roundTripTime=0.0)
+        self.functions=functions
+        self.workersPerMachine=workersPerMachine
+        self.processes:typing.Dict[str,multiprocessing.Process]={}
+        self.connections:typing.Dict[str,LocalhostConnection]={}
+        capabilities=capabilities or {}
+        for i in range(numMachines):
+            self.startWorker(capabilities.get(i,[]))
+
+    def startWorker(self,
+        capabilities:typing.Iterable[str]=()
+        )->MachineIdentity:
+        """
+        Start another worker process and make it discoverable
+        """
+        parentPipe,childPipe=multiprocessing.Pipe(False)
+        process=multiprocessing.Process(target=_workerMain,args=(
+            self.functions,self.workersPerMachine,
+            list(capabilities),childPipe),daemon=True)
+        process.start()
+        port=parentPipe.recv()
+        address=f'127.0.0.1:{port}'
+        self.processes[address]=process
+        self.connections[address]=LocalhostConnection(port)
+        return self.addMachine(address)
+
+    def killWorker(self,machine:MachineIdentity)->None:
+        """
+        Simulate a machine crashing (without telling discovery)
+        """
+        process=self.processes[self.addressOf(machine)]
+        process.kill()
+        process.join()
+
+    def addressOf(self,machine:MachineIdentity)->str:
+        """
+        Get the address a machine is at
+        """
+        for address,known in self.machines.items():
+            if known is machine:
+                return address
+        raise KeyError(machine)
+
+    def getConnection(self,machine:MachineIdentity)->LocalhostConnection:
+        """
+        Get the connection to a machine
+        """
+        return self.connections[self.addressOf(machine)]
+
+    def stop(self)->None:
+        """
+        Stop all worker processes
+        """
+        for process in self.processes.values():
+            process.kill()
+            process.join()
+        self.processes.clear()
@@ -0,0 +1,118 @@
+"""
+Unit tests for api calls over a loopback websocket
+"""
+import unittest
+import json
+import time
+import threading
+import websockets.sync.server
+from ConfederatedApp.machineIdentity import NetworkLocation
+from ConfederatedApp.functionCallManager import FunctionCallManager
+from ConfederatedApp.endpointDispatcher import EndpointDispatcher
+from ConfederatedApp.apiCommunication import ApiCommunication,ApiServer
+
+
+def add(a:int,b:int)->dict:
+    """
+    An endpoint to call
+    """
+    return {'sum':a+b}
+
+
+class TestApiCommunication(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for api calls over a loopback websocket
+    """
+
+    def setUp(self)->None:
+        """
+        Start a server, and connect to it
+        """
+        self.manager=FunctionCallManager(num_threads=4,num_processes=0)
+        self.dispatcher=EndpointDispatcher(self.manager)
+        self.dispatcher.addLocalEndpoint(add)
+        self.server=ApiServer(self.dispatcher,'127.0.0.1',0,
+            useSecureConnection=False)
+        self.server.start()
+        self.client=ApiCommunication(self.server.networkAddress,
+            self.dispatcher,useSecureConnection=False,requestTimeout=5)
+
+    def tearDown(self)->None:
+        """
+        Disconnect and stop the server
+        """
+        self.client.stop()
+        self.server.stop()
+        self.manager.stop()
+
+    def test_calls(self):
+        """
+        Test calls, including unknown endpoints and many at once
+        """
+        response=self.client.callRemoteEndpoint('add',2,3)
+        self.assertEqual(response['sum'],5)
+        self.assertEqual(response['status'],200)
+        self.assertEqual(self.client.callRemoteEndpoint('nope')['status'],404)
+        results={}
+        def call(i):
+            results[i]=self.client.callRemoteEndpoint('add',i,1)['sum']
+        threads=[threading.Thread(target=call,args=(i,)) for i in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results,{i:i+1 for i in range(50)})
+
+    def test_call_once(self):
+        """
+        Test that a single-attempt call gives up after its timeout
+        rather than retrying
+        """
+        self.dispatcher.addLocalEndpoint(lambda:time.sleep(1) or {},'slow')
+        self.assertEqual(
+            self.client.callRemoteEndpointOnce(5,'add',2,3)['sum'],5)
+        start=time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self.client.callRemoteEndpointOnce(0.2,'slow')
+        self.assertLess(time.monotonic()-start,0.9)
+
+    def test_stopped(self):
+        """
+        Test that calling on a stopped connection fails right away
+        """
+        self.client.callRemoteEndpoint('add',1,1)
+        self.client.stop()
+        start=time.monotonic()
+        with self.assertRaises(ConnectionError):
+            self.client.callRemoteEndpoint('add',1,1)
+        self.assertLess(time.monotonic()-start,1.0)
+
+    def test_garbled_frame(self):
+        """
+        Test that a garbled frame from the peer is dropped,
+        rather than stopping the connection
+        """
+        def handler(websocket):
+            for message in websocket:
+                request=json.loads(message)
+                websocket.send('{not json')
+                websocket.send(json.dumps(
+                    {'responseId':request['requestId'],'status':200}))
+        with websockets.sync.server.serve(handler,'127.0.0.1',0) as server:
+            thread=threading.Thread(target=server.serve_forever,daemon=True)
+            thread.start()
+            client=ApiCommunication(
+                NetworkLocation('127.0.0.1',server.socket.getsockname()[1]),
+                self.dispatcher,useSecureConnection=False,requestTimeout=2)
+            try:
+                for _ in range(2):
+                    self.assertEqual(
+                        client.callRemoteEndpoint('add',1,1)['status'],200)
+            finally:
+                client.stop()
+                server.shutdown()
+            thread.join()
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
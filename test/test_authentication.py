@@ -0,0 +1,102 @@
+"""
+Unit tests for authenticated session caching
+"""
+import unittest
+import time
+import threading
+from ConfederatedApp.machineIdentity import MachineIdentity
+from ConfederatedApp.authentication import AuthenticatedSessions
+
+
+class FakeConnection:
+    """
+    Stands in for an ApiCommunication
+    """
+
+
+class CountingAuthenticator:
+    """
+    Accepts any key starting with "good", counting how often it is asked
+    """
+    def __init__(self,delay:float=0.0):
+        self.delay=delay
+        self.count=0
+        self._lock=threading.Lock()
+
+    def __call__(self,machine:MachineIdentity,authenticationKey:str)->bool:
+        with self._lock:
+            self.count+=1
+        time.sleep(self.delay)
+        return authenticationKey.startswith('good')
+
+
+class TestAuthentication(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for authenticated session caching
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.authenticator=CountingAuthenticator()
+        self.sessions=AuthenticatedSessions(
+            ttl=0.2,authenticate=self.authenticator)
+        self.machine=MachineIdentity('user','machine1','Test OS','computer')
+
+    def test_session_reused(self):
+        """
+        Test that a machine only authenticates once per connection
+        """
+        connection=FakeConnection()
+        for _ in range(10):
+            self.assertTrue(self.sessions.authenticateSession(
+                connection,self.machine,'good'))
+        self.assertEqual(self.authenticator.count,1)
+        self.assertTrue(self.sessions.authenticateSession(
+            FakeConnection(),self.machine,'good'))
+        self.assertEqual(self.authenticator.count,2)
+
+    def test_failure_not_cached(self):
+        """
+        Test that a failed authentication does not create a session
+        """
+        connection=FakeConnection()
+        self.assertFalse(self.sessions.authenticateSession(
+            connection,self.machine,'bad'))
+        self.assertFalse(self.sessions.isAuthenticated(
+            connection,self.machine))
+
+    def test_expiry_and_invalidate(self):
+        """
+        Test that sessions expire and can be invalidated
+        """
+        connection=FakeConnection()
+        self.sessions.authenticateSession(connection,self.machine,'good')
+        self.sessions.invalidate(machine=self.machine)
+        self.assertFalse(self.sessions.isAuthenticated(
+            connection,self.machine))
+        self.sessions.authenticateSession(connection,self.machine,'good')
+        time.sleep(0.3)
+        self.assertFalse(self.sessions.isAuthenticated(
+            connection,self.machine))
+
+    def test_batch(self):
+        """
+        Test that a batch of reconnects is verified in parallel
+        """
+        self.authenticator.delay=0.1
+        machines=[MachineIdentity('user',f'machine{i}','Test OS','computer')
+            for i in range(8)]
+        requests=[(FakeConnection(),m,'good' if i%4 else 'bad')
+            for i,m in enumerate(machines)]
+        start=time.time()
+        results=self.sessions.authenticateSessions(requests)
+        self.assertLess(time.time()-start,0.5)
+        self.assertEqual(results,[bool(i%4) for i in range(8)])
+        self.assertEqual(self.sessions.authenticateSessions(requests),results)
+        self.assertEqual(self.authenticator.count,10)
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
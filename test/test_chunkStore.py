@@ -0,0 +1,112 @@
+"""
+Unit tests for the chunk store and chunk-level document sync
+"""
+import unittest
+import json
+import random
+import tempfile
+from pathlib import Path
+from ConfederatedApp.chunkStore import (
+    ChunkStore,DocumentChunkSync,chunkBoundaries)
+
+
+class InProcessConnection:
+    """
+    Stands in for an ApiCommunication link to another machine
+    """
+    def __init__(self,target:DocumentChunkSync):
+        self.target=target
+
+    def callRemoteEndpoint(self,commandName:str,*args):
+        """
+        Call an endpoint on the other machine
+        """
+        response=self.target.endpoints()[commandName](
+            *json.loads(json.dumps(args)))
+        return json.loads(json.dumps(response))
+
+
+def randomBytes(size:int,seed:int)->bytes:
+    """
+    Reproducible test data
+    """
+    return random.Random(seed).randbytes(size)
+
+
+class TestChunkStore(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for the chunk store and chunk-level document sync
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.tempDir=tempfile.TemporaryDirectory()
+        self.directory=Path(self.tempDir.name)
+
+    def tearDown(self)->None:
+        self.tempDir.cleanup()
+
+    def test_boundaries_survive_insert(self):
+        """
+        Test that inserting data only changes the chunks around it
+        """
+        data=randomBytes(500000,1)
+        edited=data[:250000]+b'inserted'+data[250000:]
+        before=chunkBoundaries(data)
+        after=chunkBoundaries(edited)
+        self.assertEqual(before[-1],len(data))
+        self.assertTrue(all(2048<=b-a<=65536
+            for a,b in zip([0]+before[:-2],before[:-1])))
+        unchanged=len(set(before)&set(after))
+        shifted=len({b+8 for b in before}&set(after))
+        self.assertGreaterEqual(unchanged+shifted,len(before)-2)
+
+    def test_dedupe(self):
+        """
+        Test that identical chunks are only stored once
+        """
+        store=ChunkStore(self.directory)
+        data=randomBytes(200000,2)
+        first=store.putData(data)
+        count=len(store)
+        second=store.putData(data[:100000]+b'x'+data[100000:])
+        self.assertLessEqual(len(store),count+2)
+        self.assertEqual(store.getData(first),data)
+        self.assertEqual(len(ChunkStore(self.directory)),len(store))
+        self.assertEqual(store.collect([second]),
+            len(store.missing(h for h,_ in second.chunks))+len(
+            {h for h,_ in first.chunks}-{h for h,_ in second.chunks}))
+
+    def test_sync(self):
+        """
+        Test that bringing a stale copy up to date
+        only transfers the changed chunks
+        """
+        local=DocumentChunkSync(ChunkStore(self.directory/'a'),None)
+        remote=DocumentChunkSync(ChunkStore(self.directory/'b'),None)
+        local.getConnection=lambda machine:InProcessConnection(remote)
+        data=randomBytes(1000000,3)
+        remote.publish('doc',data)
+        self.assertEqual(local.fetch('machine','doc'),data)
+        self.assertEqual(local.bytesFetched,len(data))
+        edited=data[:400000]+b'a small edit'+data[400010:]
+        remote.publish('doc',edited)
+        self.assertEqual(local.fetch('machine','doc'),edited)
+        self.assertLess(local.bytesFetched-len(data),200000)
+        fetched=local.bytesFetched
+        local.fetch('machine','doc')
+        self.assertEqual(local.bytesFetched,fetched)
+
+    def test_bad_chunk(self):
+        """
+        Test that a chunk that does not match its hash is rejected
+        """
+        store=ChunkStore(self.directory)
+        with self.assertRaises(ValueError):
+            store.put(b'some data','0'*64)
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
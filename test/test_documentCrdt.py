@@ -0,0 +1,195 @@
+"""
+Unit tests for the CRDT document model
+"""
+import unittest
+import json
+import random
+from ConfederatedApp.documentReference import DocumentReference
+from ConfederatedApp.documentCrdt import CrdtDocument
+
+
+def makeReplicas(n:int):
+    """
+    Create n replicas of the same document
+    """
+    return [CrdtDocument(DocumentReference('doc',f'replica{i}'))
+        for i in range(n)]
+
+
+def syncPair(a:CrdtDocument,b:CrdtDocument)->None:
+    """
+    Bring two replicas up to date with each other
+    """
+    b.document.merge(a.document.missingFor(b.document.versionVector))
+    a.document.merge(b.document.missingFor(a.document.versionVector))
+
+
+def syncAll(replicas)->None:
+    """
+    Bring all replicas up to date
+    """
+    for a in replicas:
+        for b in replicas:
+            if a is not b:
+                syncPair(a,b)
+
+
+class TestDocumentCrdt(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for the CRDT document model
+    """
+
+    def test_map_last_writer_wins(self):
+        """
+        Test that concurrent writes to a key agree on one winner
+        """
+        a,b=makeReplicas(2)
+        a.root['title']='from a'
+        b.root['title']='from b'
+        b.root['title']='from b again'
+        syncAll([a,b])
+        self.assertEqual(a.value,b.value)
+        self.assertEqual(a.value['title'],'from b again')
+        del a.root['title']
+        syncAll([a,b])
+        self.assertEqual(b.value,{})
+
+    def test_concurrent_text(self):
+        """
+        Test that concurrent typing at the same spot does not interleave
+        """
+        a,b=makeReplicas(2)
+        a.root.setText('body').insert(0,'Hello world')
+        syncAll([a,b])
+        a.root['body'].insert(5,' there')
+        b.root['body'].insert(5,' you')
+        b.root['body'].delete(0,1)
+        syncAll([a,b])
+        self.assertEqual(a.value,b.value)
+        self.assertIn(a.value['body'],
+            ('ello there you world','ello you there world'))
+
+    def test_nested(self):
+        """
+        Test lists of maps
+        """
+        a,b=makeReplicas(2)
+        items=a.root.setList('items')
+        first=items.insertMap(0)
+        first['name']='first'
+        items.append(1,2,3)
+        syncAll([a,b])
+        b.root['items'][0]['name']='renamed'
+        b.root['items'].delete(1)
+        syncAll([a,b])
+        self.assertEqual(a.value,{'items':[{'name':'renamed'},2,3]})
+
+    def test_causal_buffering(self):
+        """
+        Test that an edit arriving before the edit it depends on waits
+        """
+        a,b,c=makeReplicas(3)
+        a.root.setText('body').insert(0,'abc')
+        syncPair(a,b)
+        b.root['body'].insert(3,'def')
+        # c hears from b before it hears from a
+        c.document.merge(b.document.log.missingFor({'replica0':1}))
+        self.assertEqual(c.pendingCount,1)
+        self.assertEqual(c.value,{})
+        syncPair(a,c)
+        self.assertEqual(c.pendingCount,0)
+        self.assertEqual(c.value,{'body':'abcdef'})
+
+    def test_random_convergence(self):
+        """
+        Test that random concurrent edits, synced in random
+        order, always converge
+        """
+        rand=random.Random(1234)
+        replicas=makeReplicas(3)
+        replicas[0].root.setText('text')
+        replicas[0].root.setList('list')
+        syncAll(replicas)
+        for _ in range(20):
+            for r in replicas:
+                for _ in range(rand.randint(0,5)):
+                    target=r.root['text' if rand.random()<0.5 else 'list']
+                    action=rand.random()
+                    if action<0.3 and len(target)>0:
+                        target.delete(rand.randrange(len(target)))
+                    elif action<0.4:
+                        r.root[f'key{rand.randint(0,3)}']=rand.randint(0,9)
+                    elif isinstance(target.value,str):
+                        target.insert(rand.randint(0,len(target)),
+                            rand.choice('abc')*rand.randint(1,3))
+                    else:
+                        target.insert(rand.randint(0,len(target)),
+                            rand.randint(0,9))
+            a,b=rand.sample(replicas,2)
+            ops=a.document.missingFor(b.document.versionVector)
+            rand.shuffle(ops)
+            b.document.merge(ops)
+        syncAll(replicas)
+        self.assertEqual(replicas[0].value,replicas[1].value)
+        self.assertEqual(replicas[1].value,replicas[2].value)
+
+    def test_compact(self):
+        """
+        Test that tombstones are collected once everyone has seen
+        the delete, and edits still converge afterwards
+        """
+        a,b=makeReplicas(2)
+        a.root.setText('body').insert(0,'x'*100)
+        syncAll([a,b])
+        a.root['body'].delete(10,80)
+        b.root['body'].insert(50,'concurrent')
+        self.assertEqual(a.compact({'replica1':b.document.versionVector}),0)
+        syncAll([a,b])
+        collected=a.compact({'replica1':b.document.versionVector})
+        self.assertEqual(collected,80)
+        b.compact({'replica0':a.document.versionVector})
+        b.root['body'].insert(5,'after')
+        a.root['body'].delete(0,2)
+        syncAll([a,b])
+        self.assertEqual(a.value,b.value)
+        self.assertEqual(len(a.value['body']),20+len('concurrent')+5-2)
+
+    def test_compact_log(self):
+        """
+        Test that compacting drops the operations everyone has from the
+        log, and the document can be rebuilt from what is left
+        """
+        a,b=makeReplicas(2)
+        a.root['title']='Hello'
+        items=a.root.setList('items')
+        for i in range(50):
+            items.append(i)
+        a.root.setText('body').insert(0,'x'*100)
+        syncAll([a,b])
+        b.root['items'].delete(0,10)
+        b.root['body'].delete(10,80)
+        syncAll([a,b])
+        a.root['title']='Not everyone has this yet'
+        a.compact({'replica1':b.document.versionVector})
+        self.assertEqual(len(a.document.log),1)
+        self.assertEqual(a.document.versionVector,
+            {'replica0':55,'replica1':2})
+        # rebuilt from the snapshot (through json) and what is left
+        contents=a.document.log.contents()
+        document=DocumentReference('doc','replica0')
+        document.log.restore(contents._replace(
+            state=json.loads(json.dumps(contents.state))))
+        rebuilt=CrdtDocument(document)
+        self.assertEqual(rebuilt.value,a.value)
+        rebuilt.root['items'].insert(5,'new')
+        rebuilt.root['title']='Newest'
+        b.root['body'].insert(5,'from b')
+        syncPair(rebuilt,b)
+        self.assertEqual(rebuilt.value,b.value)
+        self.assertEqual(rebuilt.value['title'],'Newest')
+        self.assertEqual(rebuilt.value['items'][5],'new')
+        self.assertEqual(len(rebuilt.value['body']),20+len('from b'))
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
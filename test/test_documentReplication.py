@@ -0,0 +1,136 @@
+"""
+Unit tests for document operation logs and replication
+"""
+import unittest
+import json
+import time
+from ConfederatedApp.documentReference import OperationLog,Operation
+from ConfederatedApp.documentReplication import DocumentReplicator
+
+
+class InProcessConnection:
+    """
+    Stands in for an ApiCommunication link to another replicator,
+    sending everything through json like the real thing would
+    """
+    def __init__(self,target:DocumentReplicator):
+        self.target=target
+        self.online=True
+        self.operationsSent=0
+
+    def callRemoteEndpoint(self,commandName:str,*args):
+        """
+        Call an endpoint on the other replicator
+        """
+        if not self.online:
+            raise ConnectionError('offline')
+        args=json.loads(json.dumps(args))
+        if commandName=='pushOperations':
+            self.operationsSent+=sum(len(ops) for ops in args[0].values())
+        response=self.target.endpoints()[commandName](*args)
+        return json.loads(json.dumps(response))
+
+
+class TestDocumentReplication(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for document operation logs and replication
+    """
+
+    def makeCluster(self,n:int,**kwargs):
+        """
+        Create n replicators that all talk to each other
+        """
+        replicators={}
+        connections={}
+        for i in range(n):
+            name=f'replica{i}'
+            replicators[name]=DocumentReplicator(name,
+                lambda machine,me=name:connections[(me,machine)],
+                lambda me=name:[p for p in replicators if p!=me],
+                **kwargs)
+        for a in replicators:
+            for b in replicators:
+                if a!=b:
+                    connections[(a,b)]=InProcessConnection(replicators[b])
+        return replicators,connections
+
+    def test_out_of_order_merge(self):
+        """
+        Test that operations arriving early wait for the gap to fill
+        """
+        source=OperationLog('a')
+        ops=[source.append(i) for i in range(5)]
+        dest=OperationLog('b')
+        self.assertEqual(dest.merge([ops[2],ops[4]]),[])
+        self.assertEqual(dest.versionVector,{'a':0})
+        added=dest.merge([ops[0],ops[1],ops[3],ops[0]])
+        self.assertEqual([op.seq for op in added],[1,2,3,4,5])
+        self.assertEqual(dest.lamport,5)
+        self.assertEqual(dest.append('x').lamport,6)
+
+    def test_total_order(self):
+        """
+        Test that every machine sees the same order
+        """
+        a=OperationLog('a')
+        b=OperationLog('b')
+        opsA=[a.append(i) for i in range(3)]
+        opsB=[b.append(i) for i in range(3)]
+        a.merge(opsB)
+        b.merge(reversed(opsA))
+        self.assertEqual([op.id for op in a.operations()],
+            [op.id for op in b.operations()])
+
+    def test_anti_entropy(self):
+        """
+        Test that a peer that was offline catches up, and that
+        only the missing operations are sent
+        """
+        replicators,connections=self.makeCluster(2)
+        a=replicators['replica0'].open('doc')
+        b=replicators['replica1'].open('doc')
+        for i in range(100):
+            a.edit(i)
+        replicators['replica0'].push()
+        self.assertEqual(len(b.log),100)
+        connections[('replica0','replica1')].online=False
+        for i in range(10):
+            a.edit(i)
+        b.edit('concurrent')
+        replicators['replica0'].push() # lost
+        connections[('replica0','replica1')].online=True
+        self.assertEqual(replicators['replica1'].syncAll(),11)
+        self.assertEqual(a.versionVector,b.versionVector)
+        self.assertEqual(connections[('replica1','replica0')].operationsSent,1)
+        self.assertEqual(replicators['replica1'].syncAll(),0)
+
+    def test_background(self):
+        """
+        Test that edits are pushed in batches in the background
+        """
+        replicators,connections=self.makeCluster(3,
+            pushInterval=0.05,antiEntropyInterval=0.2)
+        docs=[r.open('doc') for r in replicators.values()]
+        for r in replicators.values():
+            r.start()
+        try:
+            connections[('replica0','replica2')].online=False
+            for i in range(30):
+                docs[i%3].edit(i)
+            time.sleep(0.2)
+            connections[('replica0','replica2')].online=True
+            end=time.time()+2.0
+            while time.time()<end and \
+                any(len(d.log)<30 for d in docs):
+                time.sleep(0.01)
+        finally:
+            for r in replicators.values():
+                r.stop()
+        for d in docs:
+            self.assertEqual(len(d.log),30)
+        self.assertEqual(docs[0].log.operations()[0].jsonObj,
+            Operation(jsonObj=docs[2].log.operations()[0].jsonObj).jsonObj)
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
@@ -0,0 +1,128 @@
+"""
+Unit tests for routing api requests to endpoints
+"""
+import unittest
+import asyncio
+import threading
+import queue
+from ConfederatedApp.endpointDispatcher import EndpointDispatcher
+
+
+def square(x:int)->dict:
+    """
+    An endpoint that runs in a worker process
+    """
+    return {'square':x*x}
+
+
+class RecordingConnection:
+    """
+    Stands in for the connection a request arrived on
+    """
+    def __init__(self):
+        self.sent:queue.Queue=queue.Queue()
+
+    def sendMessage(self,message:dict)->None:
+        """
+        Send a message back to the caller
+        """
+        self.sent.put(message)
+
+    def response(self)->dict:
+        """
+        Wait for the next response
+        """
+        return self.sent.get(timeout=5)
+
+
+class TestEndpointDispatcher(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for routing api requests to endpoints
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.dispatcher=EndpointDispatcher(maxPending=8)
+        self.connection=RecordingConnection()
+
+    def tearDown(self)->None:
+        """
+        Clean up after the tests
+        """
+        self.dispatcher.stop()
+
+    def request(self,endpoint:str,*args,requestId:str='r1')->dict:
+        """
+        Send a request, and wait for its response
+        """
+        self.dispatcher.queueRequest({'endpoint':endpoint,
+            'args':list(args),'requestId':requestId},self.connection)
+        return self.connection.response()
+
+    def test_modes(self):
+        """
+        Test endpoints that run on threads, processes and the event loop
+        """
+        async def echo(text):
+            await asyncio.sleep(0)
+            return {'text':text}
+        self.dispatcher.addLocalEndpoint(lambda a,b:{'sum':a+b},'add')
+        self.dispatcher.addLocalEndpoint(square,asProcess=True)
+        self.dispatcher.addLocalEndpoint(echo)
+        self.assertEqual(self.request('add',2,3,requestId='a'),
+            {'sum':5,'status':200,'responseId':'a'})
+        self.assertEqual(self.request('square',7,requestId='b'),
+            {'square':49,'status':200,'responseId':'b'})
+        self.assertEqual(self.request('echo','hi',requestId='c'),
+            {'text':'hi','status':200,'responseId':'c'})
+        with self.assertRaises(ValueError):
+            self.dispatcher.addLocalEndpoint(echo,mode='thread')
+
+    def test_errors(self):
+        """
+        Test unknown endpoints, endpoints that raise, and removal
+        """
+        def fail():
+            raise KeyError('oops')
+        self.dispatcher.addLocalEndpoint(fail)
+        self.assertEqual(self.request('missing'),
+            {'status':404,'responseId':'r1'})
+        response=self.request('fail',requestId='r2')
+        self.assertEqual(response['status'],500)
+        self.assertIn('oops',''.join(response['exception']))
+        self.dispatcher.removeLocalEndpoint(fail)
+        self.assertEqual(self.request('fail',requestId='r3')['status'],404)
+
+    def test_duplicates(self):
+        """
+        Test that a request that arrives twice only runs once
+        """
+        calls=[]
+        self.dispatcher.addLocalEndpoint(
+            lambda:calls.append(1) or {'count':len(calls)},'count')
+        self.assertEqual(self.request('count')['count'],1)
+        self.assertEqual(self.request('count')['count'],1)
+        self.assertEqual(self.request('count',requestId='r2')['count'],2)
+
+    def test_overload(self):
+        """
+        Test that requests beyond the limit are answered with 503
+        """
+        release=threading.Event()
+        self.dispatcher.addLocalEndpoint(
+            lambda:release.wait() and {},'wait')
+        for i in range(10):
+            self.dispatcher.queueRequest(
+                {'endpoint':'wait','requestId':str(i)},self.connection)
+        rejected=[self.connection.response() for _ in range(2)]
+        self.assertEqual([r['status'] for r in rejected],[503,503])
+        release.set()
+        answered=[self.connection.response() for _ in range(8)]
+        self.assertEqual({r['status'] for r in answered},{200})
+        self.assertEqual(self.dispatcher.overloadMetrics['rejected'],2)
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
@@ -0,0 +1,170 @@
+"""
+Unit tests for publish/subscribe across machines
+"""
+import unittest
+import json
+import time
+import typing
+import threading
+from ConfederatedApp.eventBus import EventBus
+
+
+class InProcessConnection:
+    """
+    Stands in for an ApiCommunication link to another machine
+    """
+    def __init__(self,target:EventBus,calls:typing.List[str]):
+        self.target=target
+        self.calls=calls
+
+    def callRemoteEndpoint(self,commandName:str,*args):
+        """
+        Call an endpoint on the other machine
+        """
+        self.calls.append(self.target.localId)
+        response=self.target.endpoints()[commandName](
+            *json.loads(json.dumps(args)))
+        return json.loads(json.dumps(response))
+
+    def callRemoteEndpointOnce(self,timeout:float,commandName:str,*args):
+        """
+        Call an endpoint on the other machine, only once
+        """
+        del timeout
+        return self.callRemoteEndpoint(commandName,*args)
+
+
+class HungConnection:
+    """
+    A link to a machine that never answers (until released)
+    """
+    def __init__(self):
+        self.release=threading.Event()
+        self.attempts=0
+
+    def callRemoteEndpointOnce(self,timeout:float,commandName:str,*args):
+        """
+        Wait the whole timeout, then give up
+        """
+        del commandName,args
+        self.attempts+=1
+        if not self.release.wait(timeout):
+            raise TimeoutError()
+        return {'status':200,'patterns':['**']}
+
+
+def makeBuses(names:typing.List[str],**kwargs)->typing.Dict[str,EventBus]:
+    """
+    Make a bus for each machine, all connected to each other
+    """
+    buses:typing.Dict[str,EventBus]={}
+    calls:typing.List[str]=[]
+    for name in names:
+        buses[name]=EventBus(name,
+            lambda machine:InProcessConnection(buses[machine],calls),
+            lambda name=name:[n for n in buses if n!=name],**kwargs)
+    for bus in buses.values():
+        bus.calls=calls
+    return buses
+
+
+class TestEventBus(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for publish/subscribe across machines
+    """
+
+    def test_routing(self):
+        """
+        Test that events only go to machines that subscribed to them
+        """
+        buses=makeBuses(['a','b','c'])
+        received=[]
+        buses['a'].subscribe('window/*/geometry',
+            lambda topic,data:received.append((topic,data)))
+        buses['a'].subscribe('document/**',
+            lambda topic,data:received.append((topic,data)))
+        for bus in buses.values():
+            bus.announce()
+        buses['b'].calls.clear()
+        buses['b'].publish('window/editor/geometry',[0,0,640,480])
+        buses['b'].publish('document/doc1/edit',{'x':1})
+        buses['b'].publish('machine/joined','d')
+        self.assertEqual(buses['b'].flush(),2)
+        self.assertEqual(buses['b'].calls,['a'])
+        self.assertEqual(received,[
+            ('window/editor/geometry',[0,0,640,480]),
+            ('document/doc1/edit',{'x':1})])
+
+    def test_conflation(self):
+        """
+        Test that a fast-changing topic only sends its latest value
+        """
+        buses=makeBuses(['a','b'],conflate=['window/*/geometry'])
+        received=[]
+        buses['a'].subscribe('**',
+            lambda topic,data:received.append((topic,data)))
+        buses['b'].announce()
+        for x in range(100):
+            buses['b'].publish('window/editor/geometry',[x,0,640,480])
+            buses['b'].publish('window/preview/geometry',[x,0,320,480])
+        buses['b'].publish('document/doc1/edit',1)
+        buses['b'].publish('document/doc1/edit',2)
+        buses['b'].calls.clear()
+        buses['b'].flush()
+        self.assertEqual(buses['b'].calls,['a'])
+        self.assertEqual(received,[
+            ('window/editor/geometry',[99,0,640,480]),
+            ('window/preview/geometry',[99,0,320,480]),
+            ('document/doc1/edit',1),
+            ('document/doc1/edit',2)])
+        self.assertEqual(buses['b'].eventsConflated,198)
+
+    def test_unsubscribe(self):
+        """
+        Test that unsubscribing stops events from being sent at all
+        """
+        buses=makeBuses(['a','b'])
+        received=[]
+        subscription=buses['a'].subscribe('**',
+            lambda topic,data:received.append(topic))
+        buses['a'].announce()
+        buses['b'].publish('one')
+        buses['b'].flush()
+        buses['a'].unsubscribe(subscription)
+        buses['a'].announce()
+        buses['b'].publish('two')
+        buses['b'].calls.clear()
+        buses['b'].flush()
+        self.assertEqual(received,['one'])
+        self.assertEqual(buses['b'].calls,[])
+
+    def test_hung_peer(self):
+        """
+        Test that a peer that does not answer does not hold up
+        events to the others, and is only retried every
+        announceInterval
+        """
+        buses=makeBuses(['a','b'],requestTimeout=0.2,announceInterval=60)
+        hung=HungConnection()
+        getConnection=buses['b'].getConnection
+        buses['b'].getConnection=lambda machine:\
+            hung if machine=='c' else getConnection(machine)
+        buses['b'].getPeers=lambda:['a','c']
+        received=[]
+        buses['a'].subscribe('**',lambda topic,data:received.append(topic))
+        buses['a'].announce()
+        start=time.monotonic()
+        buses['b'].publish('one')
+        self.assertEqual(buses['b'].flush(),1)
+        self.assertLess(time.monotonic()-start,1.0)
+        self.assertEqual(received,['one'])
+        self.assertEqual(hung.attempts,1)
+        for _ in range(3):
+            buses['b'].publish('again')
+            buses['b'].flush()
+        self.assertEqual(hung.attempts,1)
+        self.assertEqual(received,['one','again','again','again'])
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
@@ -3,6 +3,7 @@ Unit tests for the FunctionCallManager
 """
 import unittest
 import time
+import asyncio
 from ConfederatedApp import FunctionCallManager
 
 
@@ -99,6 +100,67 @@ class TestFunctionCallManager(unittest.TestCase): # pylint: disable=no-member
         expected=[1,3,5,15,9,35,13,63,17,99]
         self.assertEqual(results,expected)
 
+    def test_restart(self)->None:
+        """
+        Test that starting twice does nothing, and that a stopped
+        manager can be started again
+        """
+        self.manager.start()
+        # pylint: disable=protected-access
+        self.assertEqual(len(self.manager._threads),2)
+        self.assertEqual(len(self.manager._processes),2)
+        # pylint: enable=protected-access
+        self.manager.stop()
+        self.manager.stop()
+        self.manager.start()
+        self.assertEqual(self.manager.submit('add',2,3).result(timeout=5),5)
+        self.assertEqual(
+            self.manager.submit('multiply',4,5).result(timeout=5),20)
+        self.manager.stop()
+
+    def test_stop_unfinished(self)->None:
+        """
+        Test that calls still waiting when the manager stops are
+        cancelled rather than left waiting forever
+        """
+        self.manager.stop()
+        # no workers, so nothing queued ever gets to run
+        manager=FunctionCallManager(num_threads=0,num_processes=0)
+        async def sleepForever()->None:
+            await asyncio.sleep(60)
+        manager.addFunction(thread_safe_add,'add',threadsafe=True)
+        manager.addFunction(sleepForever,'sleep')
+        running=manager.submit('sleep')
+        waiting=[manager.submit('add',i,i) for i in range(3)]
+        while not running.running():
+            time.sleep(0.01)
+        manager.stop()
+        for future in waiting:
+            self.assertTrue(future.cancelled())
+        with self.assertRaises(RuntimeError):
+            running.result(timeout=5)
+        self.assertEqual(manager.overloadMetrics['pending'],0)
+
+    def test_shed_process_calls(self)->None:
+        """
+        Test that a call already sent to the worker processes is not
+        shed, since it would still run
+        """
+        self.manager.stop()
+        manager=FunctionCallManager(num_threads=1,num_processes=1,
+            max_pending=1,overload_policy='shed')
+        try:
+            manager.addFunction(process_safe_multiply,'multiply')
+            manager.addFunction(thread_safe_add,'add',threadsafe=True,
+                priority=1)
+            future=manager.submit('multiply',4,5)
+            with self.assertRaises(RuntimeError): # overload.Overloaded
+                manager.submit('add',2,3)
+            self.assertEqual(future.result(timeout=5),20)
+            self.assertEqual(manager.overloadMetrics['shed'],0)
+        finally:
+            manager.stop()
+
 
 if __name__=="__main__":
     unittest.main() # pylint: disable=no-member
@@ -0,0 +1,211 @@
+"""
+Unit tests for mirroring window geometry to other machines
+"""
+import unittest
+import json
+import time
+import typing
+import threading
+from ConfederatedApp.geometrySync import (
+    GeometrySync,GeometryEncoder,GeometryDecoder)
+
+
+class InProcessConnection:
+    """
+    Stands in for an ApiCommunication link to another machine
+    """
+    def __init__(self,target:GeometrySync,dropFrames:int=0):
+        self.target=target
+        self.dropFrames=dropFrames
+
+    def callRemoteEndpoint(self,commandName:str,*args):
+        """
+        Call an endpoint on the other machine
+        """
+        if self.dropFrames:
+            self.dropFrames-=1
+            return {} # pretend it arrived, but it was lost
+        response=self.target.endpoints()[commandName](
+            *json.loads(json.dumps(args)))
+        return json.loads(json.dumps(response))
+
+    def callRemoteEndpointOnce(self,timeout:float,commandName:str,*args):
+        """
+        Call an endpoint on the other machine, only once
+        """
+        del timeout
+        return self.callRemoteEndpoint(commandName,*args)
+
+
+class HungConnection:
+    """
+    A link to a machine that never answers (until released)
+    """
+    def __init__(self):
+        self.release=threading.Event()
+        self.attempts=0
+
+    def callRemoteEndpointOnce(self,timeout:float,commandName:str,*args):
+        """
+        Wait the whole timeout, then give up
+        """
+        del commandName,args
+        self.attempts+=1
+        if not self.release.wait(timeout):
+            raise TimeoutError()
+        return {}
+
+
+def makePair(**kwargs)->typing.Tuple[GeometrySync,GeometrySync,list]:
+    """
+    A machine sending geometry, and one mirroring it
+    """
+    received=[]
+    mirror=GeometrySync('b',None,lambda:[],
+        onRemoteGeometryCallbacks=[lambda *args:received.append(args)])
+    connection=InProcessConnection(mirror)
+    sender=GeometrySync('a',lambda machine:connection,lambda:['b'],**kwargs)
+    sender.connection=connection
+    return sender,mirror,received
+
+
+class TestGeometrySync(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for mirroring window geometry to other machines
+    """
+
+    def test_frames(self):
+        """
+        Test that frames are small and decode correctly
+        """
+        encoder=GeometryEncoder()
+        decoder=GeometryDecoder()
+        first=encoder.encode({'editor':(100,200,800,600),'preview':(0,0,1,1)})
+        self.assertEqual(decoder.decode(first),
+            {'editor':(100,200,800,600),'preview':(0,0,1,1)})
+        moved=encoder.encode({'editor':(99,205,800,600),'preview':(0,0,1,1)})
+        self.assertLessEqual(len(moved),5+4)
+        self.assertEqual(decoder.decode(moved),{'editor':(99,205,800,600)})
+        gone=encoder.encode({'preview':None})
+        self.assertEqual(decoder.decode(gone),{'preview':None})
+        self.assertEqual(decoder.geometry,{'editor':(99,205,800,600)})
+        # a missed frame needs a resync
+        encoder.encode({'editor':(0,0,1,1)})
+        self.assertIsNone(decoder.decode(encoder.encode({'editor':(1,0,1,1)})))
+
+    def test_start_over(self):
+        """
+        Test that windows left out when the sender starts over
+        are reported as gone
+        """
+        decoder=GeometryDecoder()
+        encoder=GeometryEncoder()
+        decoder.decode(
+            encoder.encode({'editor':(1,2,3,4),'preview':(0,0,1,1)}))
+        encoder.reset()
+        self.assertEqual(decoder.decode(
+            encoder.encode({'editor':(1,2,3,4)},full=True)),
+            {'editor':(1,2,3,4),'preview':None})
+        encoder.reset()
+        self.assertEqual(decoder.decode(encoder.encode({},full=True)),
+            {'editor':None})
+        self.assertEqual(decoder.geometry,{})
+
+    def test_sender_restarted(self):
+        """
+        Test that when a sender starts over from scratch, windows it
+        no longer has are reported to the callbacks as gone
+        """
+        sender,mirror,received=makePair()
+        sender.windowMoved('editor',(0,0,640,480))
+        sender.windowMoved('preview',(10,0,640,480))
+        sender.flush()
+        restarted=GeometrySync('a',lambda machine:sender.connection,
+            lambda:['b'])
+        restarted.windowMoved('editor',(0,0,640,480))
+        received.clear()
+        restarted.flush()
+        self.assertIn(('a','preview',None),received)
+        self.assertEqual(mirror.remoteGeometry['a'],
+            {'editor':(0,0,640,480)})
+
+    def test_coalescing(self):
+        """
+        Test that a burst of moves sends just the latest geometry
+        """
+        sender,mirror,received=makePair()
+        for x in range(100):
+            sender.windowMoved('editor',(x,0,640,480))
+        sender.flush()
+        self.assertEqual(sender.framesSent,1)
+        self.assertEqual(received,[('a','editor',(99,0,640,480))])
+        sender.windowMoved('editor',(99,0,640,480))
+        sender.flush()
+        self.assertEqual(sender.framesSent,1)
+        sender.windowRemoved('editor')
+        sender.flush()
+        self.assertEqual(mirror.remoteGeometry,{'a':{}})
+
+    def test_resync(self):
+        """
+        Test that a peer that missed a frame is brought back in step
+        """
+        sender,mirror,_=makePair()
+        sender.windowMoved('editor',(0,0,640,480))
+        sender.flush()
+        sender.connection.dropFrames=1
+        sender.windowMoved('editor',(10,0,640,480))
+        sender.windowMoved('preview',(10,0,640,480))
+        sender.flush()
+        sender.windowMoved('editor',(20,0,640,480))
+        sender.flush()
+        self.assertEqual(mirror.remoteGeometry['a'],
+            {'editor':(20,0,640,480),'preview':(10,0,640,480)})
+
+    def test_hung_peer(self):
+        """
+        Test that a peer that does not answer does not hold up
+        frames to the others
+        """
+        sender,mirror,_=makePair(requestTimeout=0.2)
+        hung=HungConnection()
+        sender.getConnection=lambda machine:\
+            hung if machine=='c' else sender.connection
+        sender.getPeers=lambda:['b','c']
+        try:
+            sender.windowMoved('editor',(0,0,640,480))
+            sender.flush()
+            start=time.monotonic()
+            for x in range(5):
+                sender.windowMoved('editor',(x,0,640,480))
+                sender.flush()
+            self.assertLess(time.monotonic()-start,0.2)
+        finally:
+            hung.release.set()
+            sender.stop()
+        self.assertEqual(mirror.remoteGeometry['a'],
+            {'editor':(4,0,640,480)})
+        self.assertLessEqual(hung.attempts,2)
+
+    def test_rate_limit(self):
+        """
+        Test that a drag sends no more than maxRate frames a second
+        """
+        sender,mirror,_=makePair(maxRate=20.0)
+        sender.start()
+        try:
+            start=time.monotonic()
+            x=0
+            while time.monotonic()-start<0.5:
+                x+=1
+                sender.windowMoved('editor',(x,0,640,480))
+                time.sleep(0.001)
+            time.sleep(0.2)
+        finally:
+            sender.stop()
+        self.assertLessEqual(sender.framesSent,0.7*20+2)
+        self.assertEqual(mirror.remoteGeometry['a']['editor'],(x,0,640,480))
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
@@ -0,0 +1,168 @@
+"""
+Unit tests for the LayoutRestorePlanner
+"""
+import typing
+import json
+import threading
+import unittest
+from ConfederatedApp.layoutRestore import LayoutRestorePlanner,RESTORE_ENDPOINT
+from ConfederatedApp.windowLayout import ConfederatedAppLayout
+
+
+def windowJson(document:str)->typing.Dict[str,typing.Any]:
+    """
+    A window showing a document
+    """
+    return {'document':document,'minimized':'f','maximized':'f'}
+
+
+class FakeConnection:
+    """
+    Answers restore calls the way a remote machine would
+    """
+    def __init__(self,release:typing.Optional[threading.Event]=None):
+        """
+        :release: if given, do not answer until it is set
+        """
+        self.release=release
+        self.calls:typing.List[typing.Tuple[str,typing.Any]]=[]
+
+    def callRemoteEndpoint(self,commandName:str,*args,**kwargs):
+        """
+        Pretend to call the remote endpoint
+        """
+        del kwargs
+        self.calls.append((commandName,args[0]))
+        if self.release is not None:
+            self.release.wait(5)
+        return {'status':200,'restored':len(args[0])}
+
+
+class InProcessConnection:
+    """
+    Stands in for an ApiCommunication link to another machine
+    """
+    def __init__(self,target:LayoutRestorePlanner):
+        self.target=target
+
+    def callRemoteEndpoint(self,commandName:str,*args):
+        """
+        Call an endpoint on the other machine
+        """
+        response=self.target.endpoints()[commandName](
+            *json.loads(json.dumps(args)))
+        return json.loads(json.dumps(response))
+
+
+class TestLayoutRestorePlanner(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for the LayoutRestorePlanner
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.layout=ConfederatedAppLayout({'machines':{
+            'alpha':{'name':'alpha','desktops':{
+                'main':{'name':'main','displays':{
+                    'left':{'name':'left','windows':{
+                        'a1':windowJson('report'),
+                        'a2':windowJson('notes')}},
+                    'right':{'name':'right','windows':{
+                        'a3':windowJson('report')}}}}}},
+            'beta':{'name':'beta','desktops':{
+                'main':{'name':'main','displays':{
+                    'only':{'name':'only','windows':{
+                        'b1':windowJson('report')}}}}}},
+            'gamma':{'name':'gamma','desktops':{
+                'main':{'name':'main','displays':{
+                    'only':{'name':'only','windows':{
+                        'c1':windowJson('notes')}}}}}}}})
+        self.planner=LayoutRestorePlanner(self.layout,timeout=0.5)
+
+    def test_plan(self):
+        """
+        Test that windows are grouped by the machine they were on,
+        and machines with nothing to restore are left out
+        """
+        plan=self.planner.plan('report')
+        self.assertEqual(set(plan),{'alpha','beta'})
+        self.assertEqual(
+            sorted((p.desktop,p.display) for p in plan['alpha']),
+            [('main','left'),('main','right')])
+        self.assertEqual(
+            [(p.desktop,p.display) for p in plan['beta']],
+            [('main','only')])
+        self.assertEqual(set(self.planner.plan('notes')),{'alpha','gamma'})
+        self.assertEqual(self.planner.plan('missing'),{})
+
+    def test_execute(self):
+        """
+        Test that each machine gets a single batched call
+        """
+        connections={'alpha':FakeConnection(),'beta':FakeConnection()}
+        results=self.planner.restore('report',connections.__getitem__)
+        self.assertEqual(results['alpha']['restored'],2)
+        self.assertEqual(results['beta']['restored'],1)
+        self.assertEqual(len(connections['alpha'].calls),1)
+        self.assertEqual(connections['alpha'].calls[0][0],RESTORE_ENDPOINT)
+
+    def test_execute_timeout(self):
+        """
+        Test that a machine that does not answer in time gets a
+        TimeoutError, without holding up the others
+        """
+        release=threading.Event()
+        connections={
+            'alpha':FakeConnection(release),
+            'beta':FakeConnection()}
+        self.planner.timeout=0.1
+        try:
+            results=self.planner.restore('report',connections.__getitem__)
+        finally:
+            release.set()
+        self.assertIsInstance(results['alpha'],TimeoutError)
+        self.assertEqual(results['beta']['restored'],1)
+
+    def test_round_trip(self):
+        """
+        Test that the machines put the windows back in their own layouts
+        """
+        self.layout.machines['alpha'].desktops['main'].displays['left']\
+            .windows['a1'].location=(20,30)
+        remote={}
+        for machineKey in ('alpha','beta'):
+            remote[machineKey]=LayoutRestorePlanner(
+                ConfederatedAppLayout({'machines':{
+                    machineKey:{'name':machineKey,'desktops':{}}}}),
+                localMachine=machineKey)
+        results=self.planner.restore('report',
+            lambda machineKey:InProcessConnection(remote[machineKey]))
+        self.assertEqual(results['alpha']['restored'],2)
+        alpha=remote['alpha'].layout.machines['alpha'].desktops['main']
+        self.assertEqual(set(alpha.displays),{'left','right'})
+        self.assertEqual(list(alpha.displays['left'].windows),['a1'])
+        window=alpha.displays['left'].windows['a1']
+        self.assertEqual(window.document,'report')
+        self.assertEqual(window.location,(20,30))
+        self.assertEqual(alpha.displays['left'].windowsAt(25,35),[window])
+        beta=remote['beta'].layout.machines['beta']
+        self.assertEqual(
+            list(beta.desktops['main'].displays['only'].windows),['b1'])
+
+    def test_execute_exception(self):
+        """
+        Test that a machine that fails gets its exception as its result
+        """
+        def getConnection(machineKey:str)->FakeConnection:
+            if machineKey=='alpha':
+                raise ConnectionError('alpha is unreachable')
+            return FakeConnection()
+        results=self.planner.restore('report',getConnection)
+        self.assertIsInstance(results['alpha'],ConnectionError)
+        self.assertEqual(results['beta']['restored'],1)
+
+
+if __name__=='__main__':
+    unittest.main() # pylint: disable=no-member
@@ -0,0 +1,116 @@
+"""
+Unit tests for crash-safe local storage
+"""
+import unittest
+import tempfile
+import threading
+from pathlib import Path
+from ConfederatedApp.documentReference import DocumentReference
+from ConfederatedApp.documentCrdt import CrdtDocument
+from ConfederatedApp.localStore import LocalStore,DocumentStore
+
+
+class TestLocalStore(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for crash-safe local storage
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.tempDir=tempfile.TemporaryDirectory()
+        self.filename=Path(self.tempDir.name)/'state.sqlite'
+
+    def tearDown(self)->None:
+        self.tempDir.cleanup()
+
+    def test_recovery(self):
+        """
+        Test that values and logs come back after a restart
+        """
+        with LocalStore(filename=self.filename) as store:
+            store.put('layout','m1',{'desktops':{}})
+            store.put('layout','m2',[1,2,3])
+            store.delete('layout','m1')
+            self.assertEqual(store.get('layout','m2'),[1,2,3])
+            store.append('log',['a','b','c'])
+            store.snapshot('log','ab',2)
+            store.append('log',['d'])
+        with LocalStore(filename=self.filename) as store:
+            self.assertEqual(store.items('layout'),{'m2':[1,2,3]})
+            self.assertEqual(store.read('log'),('ab',['c','d']))
+            self.assertEqual(store.logLength('log'),4)
+
+    def test_group_commit(self):
+        """
+        Test that a burst of writes from many threads
+        is committed in a few transactions
+        """
+        store=LocalStore(filename=self.filename,commitDelay=0.05)
+        def writer(n:int)->None:
+            for i in range(250):
+                store.put('values',f'{n}.{i}',i)
+        threads=[threading.Thread(target=writer,args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        store.flush()
+        self.assertLess(store.commits,20)
+        store.close()
+        with LocalStore(filename=self.filename) as store:
+            self.assertEqual(len(store.items('values')),1000)
+
+    def test_documents(self):
+        """
+        Test that document operations survive a restart,
+        including after snapshots
+        """
+        with LocalStore(filename=self.filename) as store:
+            documents=DocumentStore(store,snapshotEvery=10)
+            document=documents.open(DocumentReference('doc','a'))
+            for i in range(25):
+                document.edit({'i':i})
+            other=DocumentReference('doc','b')
+            other.edit({'from':'b'})
+            document.merge(other.log.operations())
+            self.assertEqual(len(store.read('document/doc')[1]),6)
+        with LocalStore(filename=self.filename) as store:
+            restored=DocumentStore(store).open(DocumentReference('doc','a'))
+            self.assertEqual(restored.versionVector,{'a':25,'b':1})
+            self.assertEqual(restored.edit({}).seq,26)
+
+    def test_document_state(self):
+        """
+        Test that a snapshot holds the compacted document state rather
+        than every operation, and the document comes back from it
+        """
+        with LocalStore(filename=self.filename) as store:
+            documents=DocumentStore(store,snapshotEvery=1000000)
+            crdt=CrdtDocument(documents.open(DocumentReference('doc','a')))
+            other=CrdtDocument(DocumentReference('doc','b'))
+            body=crdt.root.setText('body')
+            for i in range(200):
+                body.insert(i,'x')
+            body.delete(0,150)
+            other.document.merge(crdt.document.log.operations())
+            crdt.compact({'b':other.document.versionVector})
+            crdt.root['title']='after the compact'
+            documents.snapshot('doc')
+            snapshot,records=store.read('document/doc')
+            self.assertEqual(len(snapshot['operations']),1)
+            self.assertEqual(records,[])
+            crdt.root['title']='after the snapshot'
+            value=crdt.value
+        with LocalStore(filename=self.filename) as store:
+            restored=CrdtDocument(
+                DocumentStore(store).open(DocumentReference('doc','a')))
+            self.assertEqual(restored.value,value)
+            self.assertEqual(restored.document.versionVector,{'a':204})
+            restored.root['title']='after the restart'
+            self.assertEqual(restored.value['title'],'after the restart')
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
@@ -0,0 +1,215 @@
+"""
+Unit tests for the MachineDisoveryManager
+"""
+import unittest
+import time
+import tempfile
+import functools
+from pathlib import Path
+from ConfederatedApp.machineIdentity import NetworkLocation,MachineIdentity
+from ConfederatedApp.machineDiscovery import (
+    MachineDisoveryManager,MachineDiscoveryService,MachineIdentityCache,
+    defaultIdentityQuery)
+from ConfederatedApp.functionCallManager import FunctionCallManager
+from ConfederatedApp.endpointDispatcher import EndpointDispatcher
+from ConfederatedApp.apiCommunication import ApiServer
+from ConfederatedApp.remoteApi import (
+    MACHINE_IDENTITY_ENDPOINT,machineIdentityEndpoint)
+from fakeDiscovery import (
+    FakeDiscoveryResponder,FakeSubscribableDiscoveryResponder)
+
+
+def waitFor(condition,timeout:float=2.0)->bool:
+    """
+    Wait for something to happen in the background
+    """
+    end=time.time()+timeout
+    while not condition():
+        if time.time()>end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestMachineDiscovery(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for the MachineDisoveryManager
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.added=[]
+        self.removed=[]
+        self.responder=FakeDiscoveryResponder(20,roundTripTime=0.1)
+
+    def makeManager(self,**kwargs)->MachineDisoveryManager:
+        """
+        Create a manager that discovers from the fake responder
+        """
+        kwargs.setdefault('identityQuery',self.responder.queryIdentity)
+        return MachineDisoveryManager('test',
+            NetworkLocation('localhost',18765),
+            [self.added.append],[self.removed.append],
+            discoverySources=[self.responder],**kwargs)
+
+    def test_announce(self):
+        """
+        Test that we announce ourselves
+        """
+        self.makeManager()
+        self.assertEqual(self.responder.announced,
+            {'confederatedApplication.test':{'localhost:18765'}})
+
+    def test_concurrent_refresh(self):
+        """
+        Test that machines are queried concurrently
+        """
+        manager=self.makeManager(maxConcurrentQueries=20)
+        start=time.time()
+        manager.refresh()
+        elapsed=time.time()-start
+        self.assertEqual(len(self.added),20)
+        self.assertLess(elapsed,1.0) # serially, would be 2 seconds
+        # already known machines are not queried again
+        manager.refresh()
+        self.assertEqual(self.responder.queryCount,20)
+
+    def test_timeout(self):
+        """
+        Test that an unresponsive machine does not hold up the others
+        """
+        self.responder.unresponsive.add('10.0.0.1:18765')
+        manager=self.makeManager(
+            identityQuery=self.responder.queryIdentityAsync,
+            queryTimeout=0.5)
+        start=time.time()
+        manager.refresh()
+        self.assertLess(time.time()-start,1.0)
+        self.assertEqual(len(self.added),19)
+        self.assertNotIn('10.0.0.1:18765',manager.machines)
+
+    def test_removed(self):
+        """
+        Test machines leaving the network
+        """
+        manager=self.makeManager()
+        manager.refresh()
+        machine=manager.machines['10.0.0.5:18765']
+        self.responder.removeMachine('10.0.0.5:18765')
+        manager.refresh()
+        self.assertEqual(self.removed,[machine])
+        self.assertEqual(len(manager.machines),19)
+
+    def test_default_identity_query(self):
+        """
+        Test that the default query asks a real machine over the api
+        """
+        identity=MachineIdentity('someone','box','linux','desktop')
+        functionCallManager=FunctionCallManager(num_threads=1,num_processes=0)
+        dispatcher=EndpointDispatcher(functionCallManager)
+        dispatcher.addLocalEndpoint(
+            machineIdentityEndpoint(identity),MACHINE_IDENTITY_ENDPOINT)
+        server=ApiServer(dispatcher,'127.0.0.1',0,useSecureConnection=False)
+        server.start()
+        try:
+            self.responder=FakeDiscoveryResponder()
+            self.responder.addMachine(f'127.0.0.1:{server.port}')
+            manager=self.makeManager(identityQuery=functools.partial(
+                defaultIdentityQuery,useSecureConnection=False))
+            manager.refresh()
+            self.assertEqual(
+                [m.fingerprint for m in manager.machines.values()],
+                [identity.fingerprint])
+        finally:
+            server.stop()
+            functionCallManager.stop()
+
+
+# pylint: disable=no-member
+class TestMachineDiscoveryService(unittest.TestCase):
+    """
+    Unit tests for the MachineDiscoveryService
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.added=[]
+        self.removed=[]
+        # pylint: disable-next=consider-using-with
+        self.tempDir=tempfile.TemporaryDirectory()
+        self.cacheFile=Path(self.tempDir.name)/'identityCache.json'
+        self.responder=FakeSubscribableDiscoveryResponder(
+            5,roundTripTime=0.01)
+        self.services=[]
+
+    def tearDown(self)->None:
+        """
+        Clean up after the tests
+        """
+        for service in self.services:
+            service.stop()
+        self.tempDir.cleanup()
+
+    def startService(self,**kwargs)->MachineDiscoveryService:
+        """
+        Start a service that listens to the fake responder
+        """
+        service=MachineDiscoveryService('test',
+            NetworkLocation('localhost',18765),
+            [self.added.append],[self.removed.append],
+            discoverySources=[self.responder],
+            identityQuery=self.responder.queryIdentity,
+            identityCache=MachineIdentityCache(self.cacheFile),
+            **kwargs)
+        self.services.append(service)
+        service.start()
+        return service
+
+    def test_warm_start(self):
+        """
+        Test that a second startup uses the cached identities
+        """
+        service=self.startService()
+        self.assertTrue(waitFor(lambda:len(self.added)==5))
+        self.assertEqual(self.responder.queryCount,5)
+        service.stop()
+        self.assertTrue(self.cacheFile.exists())
+        self.added.clear()
+        self.startService()
+        self.assertTrue(waitFor(lambda:len(self.added)==5))
+        self.assertEqual(self.responder.queryCount,5)
+
+    def test_fingerprint_change(self):
+        """
+        Test that a new fingerprint means a new query
+        """
+        service=self.startService()
+        self.assertTrue(waitFor(lambda:len(self.added)==5))
+        self.responder.addMachine('10.0.0.1:18765','2')
+        self.assertTrue(waitFor(lambda:self.responder.queryCount==6))
+        self.assertTrue(waitFor(lambda:len(self.removed)==1))
+        self.assertEqual(
+            service.machines['10.0.0.1:18765'].operatingSystem,'Fake OS 2')
+
+    def test_debounce(self):
+        """
+        Test that a machine that flaps does not trigger callbacks
+        """
+        service=self.startService(debounceTime=0.3)
+        self.assertTrue(waitFor(lambda:len(self.added)==5))
+        self.responder.removeMachine('10.0.0.2:18765')
+        self.responder.addMachine('10.0.0.2:18765')
+        time.sleep(0.5)
+        self.assertEqual(self.removed,[])
+        self.assertEqual(len(self.added),5)
+        self.responder.removeMachine('10.0.0.2:18765')
+        self.assertTrue(waitFor(lambda:len(self.removed)==1))
+        self.assertNotIn('10.0.0.2:18765',service.machines)
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
@@ -0,0 +1,65 @@
+"""
+Unit tests for MachineIdentity
+"""
+import unittest
+from ConfederatedApp.machineIdentity import MachineIdentity,NetworkLocation
+
+
+class TestMachineIdentity(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for MachineIdentity
+    """
+
+    def test_equality(self):
+        """
+        Test that identities compare by value, ignoring network location
+        """
+        a=MachineIdentity('user','machine1','Test OS','computer')
+        b=MachineIdentity('user','machine1','Test OS','computer',
+            NetworkLocation('10.0.0.1',18765))
+        c=MachineIdentity('user','machine2','Test OS','computer')
+        self.assertEqual(a,b)
+        self.assertEqual(hash(a),hash(b))
+        self.assertNotEqual(a,c)
+        self.assertEqual({a:1}[b],1)
+
+    def test_read_only(self):
+        """
+        Test that the identifying fields cannot change (which would
+        lose the identity in any dict or set it is in), but the
+        network location can
+        """
+        a=MachineIdentity('user','machine1','Test OS','computer')
+        before=a.fingerprint
+        with self.assertRaises(AttributeError):
+            a.machineName='machine2'
+        with self.assertRaises(AttributeError):
+            a.jsonObj={'userName':'someone else'}
+        a.networkLocation=NetworkLocation('10.0.0.1',18765)
+        self.assertEqual(a.fingerprint,before)
+        self.assertEqual(a.machineName,'machine1')
+
+    def test_intern(self):
+        """
+        Test that interning gives back one shared instance
+        """
+        a=MachineIdentity.intern(
+            MachineIdentity('user','internTest','Test OS','computer'))
+        b=MachineIdentity.fromJson({'userName':'user',
+            'machineName':'internTest','operatingSystem':'Test OS',
+            'machineType':'computer',
+            'networkLocation':{'host':'10.0.0.2','port':18765}})
+        self.assertIs(a,b)
+        self.assertEqual(str(a.networkLocation),'10.0.0.2:18765')
+        self.assertIs(MachineIdentity.byFingerprint(a.fingerprint),a)
+
+    def test_slots(self):
+        """
+        Test that identities do not carry a per-instance dict
+        """
+        a=MachineIdentity('user','machine1','Test OS','computer')
+        self.assertFalse(hasattr(a,'__dict__'))
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
@@ -2,7 +2,11 @@
 Unit tests for the TestNodePaths
 """
 import unittest
-from ConfederatedApp import NodePath
+import sys
+from ConfederatedApp import NodePath,FunctionCallManager
+from ConfederatedApp.nodePath import (
+    compileNodePath,NodePathIndex,NodePathSet,NodePathSubscriptions,
+    InvalidNodePath)
 
 
 class TreeNode:
@@ -67,6 +71,220 @@ class TestNodePaths(unittest.TestCase): # pylint: disable=no-member
         np=NodePath('/user1/data/thing/file1.exe')
         results3=list(np.search(results2))
         self.assertEqual(results3[0],self.file1)
+    def test_compiled_path_is_cached(self):
+        """
+        Test that building the same path twice reuses the compiled program
+        """
+        np1=NodePath('user1/**/*.exe')
+        np2=NodePath('user1/**/*.exe')
+        self.assertIs(np1.compiled,np2.compiled)
+        self.assertIsNot(
+            np1.compiled,NodePath('user1/**/*.exe',ignoreCase=True).compiled)
+        self.assertGreater(compileNodePath.cache_info().hits,0)
+
+    def test_double_star(self):
+        """
+        Test recursive wildcards
+        """
+        np=NodePath('**/*.dll')
+        self.assertEqual(list(np.search(self.root)),[self.file2])
+        np=NodePath('**/thing/**/file1.exe')
+        self.assertEqual(list(np.search(self.root)),[self.file1])
+
+    def test_deep_tree(self):
+        """
+        Test searching a tree deeper than the recursion limit
+        """
+        node=self.file1
+        for i in range(sys.getrecursionlimit()+100):
+            child=TreeNode(f'deep{i}')
+            node.add_child(child)
+            node=child
+        np=NodePath('**/user1/**/thing/**/deep*/**/'+node.name)
+        self.assertEqual(list(np.search(self.root)),[node])
+        self.assertEqual(len(list(NodePath('**/deep*').search(self.root))),
+            sys.getrecursionlimit()+100)
+
+    def test_index(self):
+        """
+        Test that an attached NodePathIndex gives the same answers
+        and follows changes to the tree
+        """
+        index=NodePathIndex(self.root)
+        self.assertIs(self.root.nodePathIndex,index)
+        np=NodePath('**/file1.exe')
+        self.assertIsNotNone(index.lookup(np.compiled,self.root))
+        self.assertEqual(list(np.search(self.root)),[self.file1])
+        np=NodePath('/user1/data/thing/file2.dll')
+        self.assertEqual(list(np.search(self.file1)),[self.file2])
+        self.assertEqual(list(NodePath('**/thing/file2.dll').search(
+            self.data)),[self.file2])
+        self.assertEqual(list(NodePath('**/user1').search(self.data)),[])
+        # add
+        file3=TreeNode("file3.exe")
+        self.thing.add_child(file3)
+        index.nodeAdded(file3)
+        self.assertEqual(list(NodePath('**/file3.exe').search(self.root)),
+            [file3])
+        # rename
+        file3.name='file4.exe'
+        index.nodeRenamed(file3)
+        self.assertEqual(list(NodePath('**/file3.exe').search(self.root)),[])
+        self.assertEqual(
+            list(NodePath('user1/data/thing/file4.exe').search(self.root)),
+            [file3])
+        # remove a whole subtree
+        self.user1.children.remove(self.data)
+        index.nodeRemoved(self.data)
+        self.assertEqual(list(NodePath('**/file1.exe').search(self.root)),[])
+        self.assertNotIn(self.thing,index)
+        index.detach()
+        self.assertIsNone(self.root.nodePathIndex)
+
+    def test_parallel_search(self):
+        """
+        Test splitting a search across a FunctionCallManager
+        """
+        for i in range(20):
+            user=TreeNode(f"user{i+2}")
+            self.root.add_child(user)
+            for j in range(5):
+                user.add_child(TreeNode(f"file{j}.exe"))
+        manager=FunctionCallManager(num_threads=2,num_processes=0)
+        try:
+            np=NodePath('**/*.exe')
+            serial=list(np.search(self.root))
+            parallel=list(np.getNodesParallel(self.root,manager))
+            self.assertEqual(len(serial),101)
+            self.assertEqual(set(parallel),set(serial))
+            self.assertEqual(len(parallel),len(serial))
+            limited=list(np.getNodesParallel(self.root,manager,limit=7))
+            self.assertEqual(len(limited),7)
+            self.assertTrue(set(limited)<=set(serial))
+        finally:
+            manager.stop()
+
+    def test_path_set(self):
+        """
+        Test matching many paths in one traversal
+        """
+        paths=[
+            '**/*.exe',
+            '**/thing/*',
+            'user1/data',
+            'user1/*/thing/file2.dll',
+            '/user1/**/data',
+            'USER1/DATA/THING',
+            '**']
+        pathSet=NodePathSet()
+        for path in paths:
+            pathSet.add(NodePath(path,ignoreCase=path.isupper()),path)
+        results=pathSet.matchingKeys(self.root)
+        for path in paths:
+            expected=NodePath(path,ignoreCase=path.isupper()).search(self.root)
+            self.assertEqual(set(results[path]),set(expected),path)
+        # absolute paths still match from the root
+        results=pathSet.matchingKeys(self.data)
+        self.assertEqual(results['/user1/**/data'],[self.data])
+        self.assertEqual(set(results['**/*.exe']),{self.file1})
+        self.assertEqual(results['user1/data'],[])
+        pathSet.remove('**')
+        self.assertNotIn('**',pathSet)
+        self.assertEqual(len(pathSet),len(paths)-1)
+        with self.assertRaises(InvalidNodePath):
+            pathSet.add('../thing')
+        # matching names without a tree
+        self.assertEqual(set(pathSet.matchNames('user1/data/thing/file1.exe')),
+            {'**/*.exe','**/thing/*'})
+        self.assertEqual(set(pathSet.matchNames(['user1','data'])),
+            {'user1/data','/user1/**/data'})
+
+    def test_subscriptions(self):
+        """
+        Test being told when matching nodes appear and disappear
+        """
+        events=[]
+        subscriptions=NodePathSubscriptions(self.root)
+        exes=subscriptions.subscribe('**/*.exe',
+            lambda n:events.append(('+',n.name)),
+            lambda n:events.append(('-',n.name)))
+        self.assertEqual(events,[('+','file1.exe')])
+        events.clear()
+        # add a subtree
+        other=TreeNode("other")
+        other.add_child(TreeNode("file3.exe"))
+        other.add_child(TreeNode("file4.txt"))
+        self.user1.add_child(other)
+        subscriptions.nodeAdded(other)
+        self.assertEqual(events,[('+','file3.exe')])
+        events.clear()
+        # rename
+        self.file1.name='file1.txt'
+        subscriptions.nodeRenamed(self.file1)
+        self.assertEqual(events,[('-','file1.txt')])
+        events.clear()
+        # remove a subtree
+        self.root.children.remove(self.user1)
+        subscriptions.nodeRemoved(self.user1)
+        self.assertEqual(events,[('-','file3.exe')])
+        self.assertEqual(list(exes.matches),[])
+        subscriptions.unsubscribe(exes)
+        self.assertEqual(len(subscriptions),0)
+
+    def test_ignore_case(self):
+        """
+        Test case-insensitive matching
+        """
+        np=NodePath('USER1/Data/THING/File1.EXE',ignoreCase=True)
+        self.assertEqual(list(np.search(self.root)),[self.file1])
+        np=NodePath('USER1/Data',ignoreCase=False)
+        self.assertEqual(list(np.search(self.root)),[])
+
+    def test_regex_path(self):
+        """
+        Test regex-style paths
+        """
+        np=NodePath(r'user\d/data/thing/file[0-9]\.(exe|dll)',
+            matchStyle='regex')
+        self.assertEqual(
+            list(np.search(self.root)),[self.file1,self.file2])
+
+    def test_regex_dots(self):
+        """
+        Test that "." and ".." are plain regexes in regex style
+        """
+        dots=TreeNode('ab')
+        self.root.add_child(dots)
+        np=NodePath('user1/..',matchStyle='regex')
+        self.assertEqual(list(np.search(self.root)),[])
+        np=NodePath('..',matchStyle='regex')
+        self.assertEqual(list(np.search(self.root)),[dots])
+        np=NodePath('user1/..',matchStyle='glob')
+        self.assertEqual(list(np.search(self.root)),[self.root])
+
+    def test_repeated_names(self):
+        """
+        Test that a literal step matches every child with that name,
+        the same as a wildcard does, with or without an index
+        """
+        data2=TreeNode('data')
+        thing2=TreeNode('thing')
+        self.user1.add_child(data2)
+        data2.add_child(thing2)
+        for index in (None,NodePathIndex(self.root)):
+            for path in ('user1/data/thing','user1/*/thing',
+                '**/data/thing','/user1/data/thing'):
+                self.assertEqual(
+                    list(NodePath(path).search(self.root)),
+                    [self.thing,thing2],path)
+            self.assertEqual(list(NodePath('thing').search(data2)),[thing2])
+            self.assertEqual(
+                list(NodePath('**/thing').search(data2)),[thing2])
+            if index is not None:
+                self.assertEqual(
+                    index.nodesAt(('user1','data')),[self.data,data2])
+                index.detach()
+
 
 if __name__=="__main__":
     unittest.main() # pylint: disable=no-member
@@ -0,0 +1,99 @@
+"""
+Unit tests for bounding queued work
+"""
+import unittest
+import threading
+import time
+from ConfederatedApp.overload import (
+    AdmissionControl,Overloaded,OVERLOAD_REJECT,OVERLOAD_SHED)
+from ConfederatedApp.functionCallManager import FunctionCallManager
+
+
+class TestOverload(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for bounding queued work
+    """
+
+    def test_reject(self):
+        """
+        Test that work beyond the limit is rejected until there is room
+        """
+        admission=AdmissionControl(2,OVERLOAD_REJECT)
+        admission.admit('a')
+        admission.admit('b')
+        with self.assertRaises(Overloaded):
+            admission.admit('c')
+        admission.release('a')
+        admission.release('a')
+        admission.admit('c')
+        self.assertEqual(admission.metrics['pending'],2)
+        self.assertEqual(admission.metrics['highWater'],2)
+        self.assertEqual(admission.metrics['rejected'],1)
+        self.assertEqual(admission.metrics['admitted'],3)
+
+    def test_block(self):
+        """
+        Test that blocking waits for room, and can time out
+        """
+        admission=AdmissionControl(1,blockTimeout=0.05)
+        admission.admit('a')
+        with self.assertRaises(Overloaded):
+            admission.admit('b')
+        timer=threading.Timer(0.05,admission.release,args=('a',))
+        timer.start()
+        admission.blockTimeout=None
+        admission.admit('b')
+        timer.join()
+        self.assertEqual(admission.pending,1)
+        self.assertGreater(admission.blockedSeconds,0.05)
+
+    def test_shed(self):
+        """
+        Test that the newest lower priority work is shed first,
+        and that running work is never shed
+        """
+        cancelled=[]
+        def cancelFn(key,cancellable=True):
+            def cancel():
+                if cancellable:
+                    cancelled.append(key)
+                return cancellable
+            return cancel
+        admission=AdmissionControl(3,OVERLOAD_SHED)
+        admission.admit('old',0,cancelFn('old'))
+        admission.admit('new',0,cancelFn('new'))
+        admission.admit('running',-1,cancelFn('running',False))
+        admission.admit('urgent',5,cancelFn('urgent'))
+        self.assertEqual(cancelled,['new'])
+        with self.assertRaises(Overloaded):
+            admission.admit('routine',0,cancelFn('routine'))
+        self.assertEqual(admission.metrics['shed'],1)
+        self.assertEqual(admission.metrics['rejected'],1)
+
+    def test_function_call_manager(self):
+        """
+        Test that a FunctionCallManager rejects calls beyond its limit,
+        and frees up room as calls finish
+        """
+        release=threading.Event()
+        fcm=FunctionCallManager(num_threads=1,num_processes=0,
+            max_pending=2,overload_policy=OVERLOAD_REJECT)
+        try:
+            fcm.addFunction(release.wait,'wait',threadsafe=True)
+            futures=[fcm.submit('wait') for _ in range(2)]
+            with self.assertRaises(RuntimeError): # Overloaded
+                fcm.submit('wait')
+            release.set()
+            for future in futures:
+                future.result(timeout=5)
+            while fcm.overloadMetrics['pending']:
+                time.sleep(0.001)
+            fcm.submit('wait').result(timeout=5)
+            self.assertEqual(fcm.overloadMetrics['rejected'],1)
+        finally:
+            release.set()
+            fcm.stop()
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
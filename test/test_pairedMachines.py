@@ -0,0 +1,97 @@
+"""
+Unit tests for PairedMachines
+"""
+import unittest
+import tempfile
+import multiprocessing
+from pathlib import Path
+from ConfederatedApp.machineIdentity import MachineIdentity
+from ConfederatedApp.pairedMachines import PairedMachines
+
+
+def makeMachine(i:int)->MachineIdentity:
+    """
+    Create a test machine
+    """
+    return MachineIdentity('user',f'machine{i}','Test OS','computer')
+
+
+def pairMany(filename:str,start:int,count:int)->None:
+    """
+    Pair a range of machines from another process
+    """
+    paired=PairedMachines('test',filename)
+    for i in range(start,start+count):
+        paired.pair(makeMachine(i),f'key{i}')
+
+
+class TestPairedMachines(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for PairedMachines
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.tempDir=tempfile.TemporaryDirectory()
+        self.filename=Path(self.tempDir.name)/'pairedMachines.jsonl'
+
+    def tearDown(self)->None:
+        self.tempDir.cleanup()
+
+    def test_lookup_by_value(self):
+        """
+        Test that an equal identity finds the paired machine
+        """
+        paired=PairedMachines('test',self.filename)
+        paired.pair(makeMachine(1),'key1')
+        self.assertTrue(paired.isPairedAndAuthenticated(makeMachine(1)))
+        self.assertFalse(paired.isPairedAndAuthenticated(makeMachine(2)))
+        self.assertEqual(paired.authenticationKey(makeMachine(1)),'key1')
+
+    def test_persist_and_compact(self):
+        """
+        Test that re-pairing and unpairing survive a reload,
+        and that the journal gets compacted
+        """
+        paired=PairedMachines('test',self.filename)
+        for i in range(50):
+            paired.pair(makeMachine(i%5),f'key{i}')
+        paired.unpair(makeMachine(0))
+        lines=self.filename.read_text('utf-8').splitlines()
+        self.assertLess(len(lines),50)
+        reloaded=PairedMachines('test',self.filename)
+        self.assertEqual(len(reloaded),4)
+        self.assertNotIn(makeMachine(0),reloaded)
+        self.assertEqual(reloaded.authenticationKey(makeMachine(4)),'key49')
+
+    def test_changes_from_other_instance(self):
+        """
+        Test that changes from another instance are picked up
+        """
+        first=PairedMachines('test',self.filename,checkInterval=0.0)
+        second=PairedMachines('test',self.filename,checkInterval=0.0)
+        second.pair(makeMachine(1),'key1')
+        self.assertIn(makeMachine(1),first)
+        second.save()
+        second.pair(makeMachine(2),'key2')
+        self.assertEqual(len(first),2)
+
+    def test_multiprocess(self):
+        """
+        Test that several processes can pair at once without losing any
+        """
+        processes=[multiprocessing.Process(
+            target=pairMany,args=(str(self.filename),i*20,20))
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        paired=PairedMachines('test',self.filename)
+        self.assertEqual(len(paired),80)
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
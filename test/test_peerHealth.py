@@ -0,0 +1,116 @@
+"""
+Unit tests for peer health checking
+"""
+import unittest
+import time
+from ConfederatedApp.machineIdentity import NetworkLocation
+from ConfederatedApp.machineDiscovery import MachineDisoveryManager
+from ConfederatedApp.peerHealth import (
+    PeerHealthMonitor,PhiAccrualFailureDetector)
+from fakeDiscovery import FakeDiscoveryResponder
+
+
+class FakeHeartbeatConnection:
+    """
+    Answers heartbeats after a fixed delay, or never if it is dead
+    """
+    def __init__(self,roundTripTime:float,capabilities=()):
+        self.roundTripTime=roundTripTime
+        self.capabilities=list(capabilities)
+        self.dead=False
+
+    def callRemoteEndpoint(self,endpointName,*args,**kwargs):
+        """
+        Pretend to call the remote heartbeat endpoint
+        """
+        if self.dead:
+            time.sleep(1.0)
+            raise TimeoutError()
+        time.sleep(self.roundTripTime)
+        return {'load':0.0,'availableWorkers':4,
+            'capabilities':self.capabilities}
+
+    def callRemoteEndpointOnce(self,timeout,endpointName,*args,**kwargs):
+        """
+        Pretend to call the remote heartbeat endpoint, only once
+        """
+        del timeout
+        return self.callRemoteEndpoint(endpointName,*args,**kwargs)
+
+
+class TestPeerHealth(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for peer health checking
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.removed=[]
+        responder=FakeDiscoveryResponder(3,roundTripTime=0.0)
+        self.manager=MachineDisoveryManager('test',
+            NetworkLocation('localhost',18765),
+            [],[self.removed.append],
+            discoverySources=[responder],
+            identityQuery=responder.queryIdentity)
+        self.manager.refresh()
+        self.machines=sorted(self.manager.machines.values(),key=str)
+        self.connections={
+            machine:FakeHeartbeatConnection(0.01*(i+1),['gpu'] if i==2 else [])
+            for i,machine in enumerate(self.machines)}
+        self.monitor=PeerHealthMonitor(self.manager,
+            self.connections.__getitem__,heartbeatInterval=0.1)
+
+    def tearDown(self)->None:
+        self.monitor.stop()
+
+    def test_phi(self):
+        """
+        Test that suspicion grows the later a heartbeat is
+        """
+        detector=PhiAccrualFailureDetector(minStdDeviation=0.1)
+        for i in range(10):
+            detector.heartbeat(float(i))
+        self.assertLess(detector.phi(9.5),1.0)
+        self.assertLess(detector.phi(10.0),detector.phi(10.5))
+        self.assertGreater(detector.phi(1000.0),8.0)
+
+    def test_late_heartbeat(self):
+        """
+        Test that with the default settings, a heartbeat that is a
+        little late (eg, a gc pause) does not look like a failure
+        """
+        monitor=PeerHealthMonitor(self.manager,self.connections.__getitem__)
+        detector=monitor.peers[0].failureDetector
+        # steady heartbeats, a second apart since it was found
+        start=time.monotonic()
+        for i in range(1,21):
+            detector.heartbeat(start+i)
+        self.assertLess(detector.phi(start+21.3),1.0)
+        self.assertLess(detector.phi(start+22.5),monitor.phiThreshold)
+        self.assertGreater(detector.phi(start+26.0),monitor.phiThreshold)
+
+    def test_ranking(self):
+        """
+        Test that the fastest peers are ranked first
+        """
+        self.monitor.start()
+        time.sleep(0.5)
+        self.assertEqual(self.monitor.bestPeers(2),self.machines[:2])
+        self.assertEqual(self.monitor.bestPeers(3,capability='gpu'),
+            [self.machines[2]])
+
+    def test_failure(self):
+        """
+        Test that a peer that stops answering is removed quickly
+        """
+        self.monitor.start()
+        time.sleep(0.5)
+        self.connections[self.machines[0]].dead=True
+        end=time.time()+2.0
+        while not self.removed and time.time()<end:
+            time.sleep(0.01)
+        self.assertEqual(self.removed,[self.machines[0]])
+        self.assertNotIn(self.machines[0],self.manager.machines.values())
+        self.assertNotIn(self.machines[0],self.monitor.bestPeers(3))
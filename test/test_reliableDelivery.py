@@ -0,0 +1,162 @@
+"""
+Unit tests for at-least-once delivery of remote calls
+"""
+import unittest
+import threading
+import time
+from ConfederatedApp.reliableDelivery import (
+    ReliableCaller,ResponseCache,DeliveryFailed,OutboxFull)
+
+
+class FlakyLink:
+    """
+    A link to a remote endpoint that loses requests and responses
+    """
+    def __init__(self,lostRequests:int=0,lostResponses:int=0):
+        self.lostRequests=lostRequests
+        self.lostResponses=lostResponses
+        self.cache=ResponseCache()
+        self.executed=0
+        self.attempts=0
+
+    def endpoint(self)->dict:
+        """
+        The remote endpoint, which must only run once per request
+        """
+        self.executed+=1
+        return {'status':200,'count':self.executed}
+
+    def send(self,message:dict,timeout:float)->dict:
+        """
+        Send a request over the link
+        """
+        del timeout
+        self.attempts+=1
+        if self.lostRequests:
+            self.lostRequests-=1
+            raise ConnectionError('request lost')
+        response=self.cache.execute(message['requestId'],self.endpoint)
+        if self.lostResponses:
+            self.lostResponses-=1
+            raise TimeoutError('response lost')
+        return response
+
+
+class TestReliableDelivery(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for at-least-once delivery of remote calls
+    """
+
+    def test_retry_runs_once(self):
+        """
+        Test that retries get the original response instead
+        of running the endpoint again
+        """
+        link=FlakyLink(lostRequests=1,lostResponses=2)
+        caller=ReliableCaller(link.send,baseDelay=0.001)
+        self.assertEqual(caller.call({'endpoint':'count'}),
+            {'status':200,'count':1})
+        self.assertEqual(link.attempts,4)
+        self.assertEqual(link.executed,1)
+        self.assertEqual(caller.retries,3)
+        self.assertEqual(link.cache.hits,2)
+
+    def test_give_up(self):
+        """
+        Test that a peer that never answers fails after maxAttempts
+        """
+        link=FlakyLink(lostRequests=100)
+        caller=ReliableCaller(link.send,maxAttempts=4,baseDelay=0.001)
+        with self.assertRaises(DeliveryFailed):
+            caller.call({'endpoint':'count'})
+        self.assertEqual(link.attempts,4)
+        self.assertEqual(caller.outstanding,0)
+
+    def test_busy_peer(self):
+        """
+        Test that an overloaded peer's 503 is retried with backoff
+        """
+        answers=[{'status':503},{'status':503},{'status':200}]
+        caller=ReliableCaller(lambda message,timeout:answers.pop(0),
+            baseDelay=0.001)
+        self.assertEqual(caller.call({}),{'status':200})
+        self.assertEqual(caller.retries,2)
+        caller=ReliableCaller(lambda message,timeout:{'status':503},
+            maxAttempts=2,baseDelay=0.001)
+        self.assertEqual(caller.call({}),{'status':503})
+        self.assertEqual(caller.failures,1)
+
+    def test_outbox_bound(self):
+        """
+        Test that callers are held back when too much is in flight
+        """
+        release=threading.Event()
+        def slowSend(message,timeout): # pylint: disable=unused-argument
+            release.wait()
+            return {}
+        caller=ReliableCaller(slowSend,maxOutstanding=2,outboxTimeout=0.05)
+        threads=[threading.Thread(target=caller.call,args=({},))
+            for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while caller.outstanding<2:
+            time.sleep(0.001)
+        with self.assertRaises(OutboxFull):
+            caller.call({})
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(caller.call({}),{})
+
+    def test_outstanding_count(self):
+        """
+        Test that the count of requests in flight stays right
+        when many threads call at once
+        """
+        caller=ReliableCaller(lambda message,timeout:{'status':200})
+        def callMany():
+            for _ in range(500):
+                caller.call({})
+        threads=[threading.Thread(target=callMany) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(caller.outstanding,0)
+
+    def test_response_cache(self):
+        """
+        Test that the response cache is bounded, and that concurrent
+        duplicates wait for the first rather than running again
+        """
+        cache=ResponseCache(maxEntries=3)
+        for i in range(10):
+            cache.execute(str(i),lambda:i)
+        self.assertEqual(len(cache),3)
+        self.assertEqual(cache.execute('9',lambda:'again'),9)
+        self.assertEqual(cache.execute('0',lambda:'again'),'again')
+        started=threading.Event()
+        finish=threading.Event()
+        calls=[]
+        def slow():
+            calls.append(1)
+            started.set()
+            finish.wait()
+            return 'slow'
+        results=[]
+        first=threading.Thread(
+            target=lambda:results.append(cache.execute('slow',slow)))
+        first.start()
+        started.wait()
+        second=threading.Thread(
+            target=lambda:results.append(cache.execute('slow',slow)))
+        second.start()
+        finish.set()
+        first.join()
+        second.join()
+        self.assertEqual(results,['slow','slow'])
+        self.assertEqual(calls,[1])
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
@@ -0,0 +1,157 @@
+"""
+Unit tests for sending FunctionCallManager calls to other machines
+"""
+import unittest
+import os
+import time
+from ConfederatedApp.machineIdentity import NetworkLocation
+from ConfederatedApp.machineDiscovery import MachineDisoveryManager
+from ConfederatedApp.functionCallManager import FunctionCallManager
+from ConfederatedApp.peerHealth import PeerHealthMonitor
+from ConfederatedApp.remoteWorkers import RemoteWorkerPool,RemoteCallError
+from localhostCluster import LocalhostCluster
+
+
+def whereAmI(delay:float=0.0)->int:
+    """
+    Target test function that reports which process ran it
+    """
+    time.sleep(delay)
+    return os.getpid()
+
+
+def remote_raise()->None:
+    """
+    Target test function to test exceptions.
+    """
+    raise ValueError("Intentional remote exception")
+
+
+FUNCTIONS={'whereAmI':(whereAmI,True),'raise':(remote_raise,True)}
+
+
+class TestRemoteWorkers(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for sending FunctionCallManager calls to other machines
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.cluster=LocalhostCluster(3,FUNCTIONS,workersPerMachine=2)
+        self.discovery=MachineDisoveryManager('test',
+            NetworkLocation('localhost',18765),
+            discoverySources=[self.cluster],
+            identityQuery=self.cluster.queryIdentity)
+        self.discovery.refresh()
+        self.health=PeerHealthMonitor(self.discovery,
+            self.cluster.getConnection,heartbeatInterval=0.1)
+        self.health.start()
+        self.pool=RemoteWorkerPool(self.health,self.cluster.getConnection)
+        self.manager=FunctionCallManager(num_threads=2,num_processes=0,
+            remoteWorkers=self.pool)
+        for name,(func,threadsafe) in FUNCTIONS.items():
+            self.manager.addFunction(func,name,threadsafe,remote=True)
+        self.manager.addFunction(whereAmI,'localOnly',True)
+        end=time.time()+5.0
+        while len(self.health.bestPeers(3))<3 and time.time()<end:
+            time.sleep(0.01)
+
+    def tearDown(self)->None:
+        self.manager.stop()
+        self.pool.stop()
+        self.health.stop()
+        self.cluster.stop()
+
+    def test_remote_call(self)->None:
+        """
+        Test that remote functions run on other machines
+        """
+        workerPids={p.pid for p in self.cluster.processes.values()}
+        self.assertIn(self.manager.call('whereAmI'),workerPids)
+        self.assertEqual(self.manager.call('localOnly'),os.getpid())
+
+    def test_remote_exception(self)->None:
+        """
+        Test that exceptions on the other machine come back
+        """
+        with self.assertRaises(RemoteCallError) as context:
+            self.manager.call('raise')
+        self.assertIn("Intentional remote exception",str(context.exception))
+
+    def test_load_balancing(self)->None:
+        """
+        Test that calls are spread across machines by capacity,
+        overflowing to local execution when they are all busy
+        """
+        futures=[self.manager.submit('whereAmI',0.3) for _ in range(8)]
+        pids=[f.result(timeout=5.0) for f in futures]
+        for process in self.cluster.processes.values():
+            self.assertEqual(pids.count(process.pid),2)
+        self.assertEqual(pids.count(os.getpid()),2)
+
+    def test_peer_lost(self)->None:
+        """
+        Test that a call is retried elsewhere when its machine dies
+        """
+        victim=self.health.bestPeers(1)[0]
+        future=self.manager.submit('whereAmI',0.5)
+        time.sleep(0.1)
+        self.cluster.killWorker(victim)
+        pid=future.result(timeout=5.0)
+        survivors={p.pid for p in self.cluster.processes.values()
+            if p.is_alive()}
+        self.assertIn(pid,survivors)
+
+    def submitWith(self,getConnection)->int:
+        """
+        Send a call through a pool that uses getConnection,
+        and wait for it to finish
+        """
+        pool=RemoteWorkerPool(self.health,getConnection)
+        try:
+            future=pool.submit('whereAmI',[],{},
+                lambda:self.manager.submitLocal('whereAmI'))
+            return future.result(timeout=5.0)
+        finally:
+            pool.stop()
+
+    def test_peer_gone(self)->None:
+        """
+        Test that a peer with no connection any more is skipped
+        """
+        def getConnection(machine):
+            raise KeyError(machine)
+        self.assertEqual(self.submitWith(getConnection),os.getpid())
+
+    def test_peer_busy(self)->None:
+        """
+        Test that a peer that is too busy is skipped
+        """
+        class BusyConnection:
+            """
+            A peer that is always overloaded
+            """
+            def callRemoteEndpoint(self,*args):
+                """
+                Answer that there is no room
+                """
+                del args
+                return {'status':503}
+        self.assertEqual(
+            self.submitWith(lambda machine:BusyConnection()),os.getpid())
+
+    def test_unexpected_error(self)->None:
+        """
+        Test that any other error fails the call rather than
+        leaving it waiting forever
+        """
+        def getConnection(machine):
+            raise TypeError(f'Can not send to {machine}')
+        with self.assertRaises(TypeError):
+            self.submitWith(getConnection)
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
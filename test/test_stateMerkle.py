@@ -0,0 +1,108 @@
+"""
+Unit tests for finding state that is out of synch between machines
+"""
+import unittest
+import json
+from ConfederatedApp.documentReference import DocumentReference
+from ConfederatedApp.windowLayout import ConfederatedAppLayout
+from ConfederatedApp.stateMerkle import MerkleTree,StateTree
+
+
+class InProcessConnection:
+    """
+    Stands in for an ApiCommunication link to another machine
+    """
+    def __init__(self,target:StateTree):
+        self.target=target
+
+    def callRemoteEndpoint(self,commandName:str,*args):
+        """
+        Call an endpoint on the other machine
+        """
+        response=self.target.endpoints()[commandName](
+            *json.loads(json.dumps(args)))
+        return json.loads(json.dumps(response))
+
+
+LAYOUT={'machines':{'m1':{'name':'m1','desktops':{'main':{'name':'main',
+    'displays':{'left':{'name':'left','windows':{
+        'editor':{'name':'editor','size':[800,600],'location':[0,0],
+            'minimized':'f','maximized':'f','document':'doc1'},
+        'preview':{'name':'preview','size':[400,600],'location':[800,0],
+            'minimized':'f','maximized':'f'}}}}}}}}}
+
+
+class TestStateMerkle(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for finding state that is out of synch between machines
+    """
+
+    def test_tree(self):
+        """
+        Test that the root hash only depends on the contents
+        """
+        a=MerkleTree()
+        b=MerkleTree()
+        for i in range(100):
+            a.set(f'key{i}',str(i))
+        for i in reversed(range(100)):
+            b.set(f'key{i}',str(i))
+        b.set('extra','x')
+        self.assertNotEqual(a.rootHash,b.rootHash)
+        b.remove('extra')
+        self.assertEqual(a.rootHash,b.rootHash)
+        for i in range(100):
+            b.remove(f'key{i}')
+        self.assertEqual(b.rootHash,'')
+        self.assertEqual(len(b),0)
+
+    def test_documents(self):
+        """
+        Test that only the documents that differ are found,
+        in only a few messages
+        """
+        local=StateTree(None)
+        remote=StateTree(None)
+        local.getConnection=lambda machine:InProcessConnection(remote)
+        for i in range(2000):
+            localDoc=DocumentReference(f'doc{i}','a')
+            remoteDoc=DocumentReference(f'doc{i}','a')
+            localDoc.edit({'i':i})
+            remoteDoc.merge(localDoc.log.operations())
+            local.trackDocument(localDoc)
+            remote.trackDocument(remoteDoc)
+        self.assertEqual(local.diverged('remote'),[])
+        self.assertEqual(local.messagesSent,1)
+        remote.documents['doc7'].edit({'more':True})
+        local.documents['doc1234'].edit({'more':True})
+        remote.untrackDocument('doc99')
+        local.messagesSent=0
+        self.assertEqual(local.diverged('remote'),
+            ['document/doc1234','document/doc7','document/doc99'])
+        self.assertLessEqual(local.messagesSent,local.tree.depth+2)
+
+    def test_layout(self):
+        """
+        Test that moved, added and removed windows are found
+        """
+        local=StateTree(None)
+        remote=StateTree(None)
+        local.getConnection=lambda machine:InProcessConnection(remote)
+        localLayout=ConfederatedAppLayout(LAYOUT)
+        remoteLayout=ConfederatedAppLayout(LAYOUT)
+        local.trackLayout(localLayout)
+        remote.trackLayout(remoteLayout)
+        self.assertEqual(local.diverged('remote'),[])
+        display=remoteLayout.machines['m1'].desktops['main'].displays['left']
+        display.windows['editor'].location=(10,10)
+        self.assertEqual(local.diverged('remote'),
+            ['window/m1/main/left/editor'])
+        display.windows['editor'].location=(0,0)
+        display.removeWindow('preview')
+        remote.refreshLayout()
+        self.assertEqual(local.diverged('remote'),
+            ['window/m1/main/left/preview'])
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
@@ -0,0 +1,115 @@
+"""
+Unit tests for the WindowSpatialIndex
+"""
+import unittest
+from ConfederatedApp.windowSpatialIndex import WindowSpatialIndex
+from ConfederatedApp.windowLayout import DisplayLayout,WindowLayout
+
+
+class TestWindowSpatialIndex(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for the WindowSpatialIndex
+    """
+
+    def setUp(self)->None:
+        """
+        Configure the tests
+        """
+        self.index=WindowSpatialIndex(cellSize=100)
+        self.index.insert('editor',(0,0,400,300))
+        self.index.insert('terminal',(350,250,200,200))
+        self.index.insert('background',(0,0,10000,10000))
+
+    def test_windowsAt(self):
+        """
+        Test hit-testing a point
+        """
+        self.assertEqual(
+            set(self.index.windowsAt(375,275)),
+            {'editor','terminal','background'})
+        self.assertEqual(
+            set(self.index.windowsAt(500,400)),{'terminal','background'})
+        self.assertEqual(self.index.windowsAt(-5,-5),[])
+
+    def test_windowsIntersecting(self):
+        """
+        Test overlap queries
+        """
+        self.index.remove('background')
+        self.assertEqual(
+            set(self.index.windowsIntersecting((390,0,20,20))),{'editor'})
+        self.assertEqual(self.index.windowsIntersecting((600,600,5,5)),[])
+
+    def test_update(self):
+        """
+        Test that moving an item keeps the index correct
+        """
+        self.index.update('terminal',(2000,2000,200,200))
+        self.assertNotIn('terminal',self.index.windowsAt(375,275))
+        self.assertIn('terminal',self.index.windowsAt(2100,2100))
+
+    def test_findFreeSpace(self):
+        """
+        Test finding a spot for a new window
+        """
+        self.index.remove('background')
+        location=self.index.findFreeSpace((100,100),(0,0,1000,1000))
+        self.assertEqual(location,(400,0))
+        self.assertTrue(self.index.isFree(location+(100,100)))
+        self.assertIsNone(
+            self.index.findFreeSpace((100,100),(0,0,400,300)))
+
+    def test_findFreeSpace_bounds(self):
+        """
+        Test that items outside the bounds do not get in the way
+        """
+        self.index.remove('background')
+        self.index.insert('elsewhere',(5000,5000,300,300))
+        self.assertEqual(
+            self.index.findFreeSpace((100,100),(5000,0,1000,1000)),
+            (5000,0))
+        self.assertEqual(
+            self.index.findFreeSpace((100,100),(5000,5000,1000,1000)),
+            (5300,5000))
+
+    def test_findFreeSpace_edges(self):
+        """
+        Test a spot that only fits where the edges of two
+        different windows meet
+        """
+        index=WindowSpatialIndex()
+        index.insert('a',(0,0,50,100))
+        index.insert('b',(60,0,140,30))
+        self.assertEqual(
+            index.findFreeSpace((150,170),(0,0,200,200)),(50,30))
+
+
+class TestDisplayLayout(unittest.TestCase): # pylint: disable=no-member
+    """
+    Unit tests for the spatial index kept by a DisplayLayout
+    """
+
+    def test_follows_windows(self):
+        """
+        Test that moving or resizing a window keeps windowsAt()
+        correct, and that a removed window is no longer followed
+        """
+        display=DisplayLayout()
+        window=WindowLayout({'name':'editor','size':(400,300)})
+        display.addWindow(window)
+        self.assertEqual(display.windowsAt(100,100),[window])
+        window.location=(1000,1000)
+        self.assertEqual(display.windowsAt(100,100),[])
+        self.assertEqual(display.windowsAt(1100,1100),[window])
+        window.size=(50,50)
+        self.assertEqual(display.windowsAt(1100,1100),[])
+        self.assertEqual(display.windowsAt(1025,1025),[window])
+        display.removeWindow('editor')
+        self.assertEqual(window.onGeometryChangedCallbacks,[])
+        window.location=(0,0)
+        self.assertEqual(display.windowsAt(25,25),[])
+        self.assertNotIn('editor',display.spatialIndex)
+
+
+if __name__=="__main__":
+    unittest.main() # pylint: disable=no-member
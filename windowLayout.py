@@ -5,6 +5,10 @@ import typing
 from stringTools import yntf
 from machineIdentity import MachineIdentity,localMachineIdentity
 from jsonHelper import JsonBase,JsonCompatible,asJson,JsonLike
+from windowSpatialIndex import WindowSpatialIndex,Rect,Point,Size
+
+
+GeometryChangedCallback=typing.Callable[["WindowLayout"],None]
 
 
 class WindowLayout(JsonBase):
@@ -15,35 +19,85 @@ class WindowLayout(JsonBase):
         jsonObj:typing.Optional[JsonCompatible]=None):
         """ """
         self.name:str=''
-        self.size:typing.Tuple[int,int]
-        self.location:typing.Tuple[int,int]
+        self.document:typing.Optional[str]=None # what document is shown
+        self._size:typing.Tuple[int,int]=(640,480)
+        self._location:typing.Tuple[int,int]=(0,0)
         self.minimized:bool
         self.maximized:bool
+        self.onGeometryChangedCallbacks:typing.List[
+            GeometryChangedCallback]=[]
         if jsonObj is not None:
             self.jsonObj=asJson(jsonObj)
 
+    @property
+    def size(self)->typing.Tuple[int,int]:
+        """
+        get/set the window size
+        """
+        return self._size
+    @size.setter
+    def size(self,size:typing.Tuple[int,int]):
+        self._size=tuple(size)
+        self._geometryChanged()
+
+    @property
+    def location(self)->typing.Tuple[int,int]:
+        """
+        get/set the window location
+        """
+        return self._location
+    @location.setter
+    def location(self,location:typing.Tuple[int,int]):
+        self._location=tuple(location)
+        self._geometryChanged()
+
+    @property
+    def rect(self)->Rect:
+        """
+        get/set the window geometry as (x,y,w,h)
+        """
+        return (self._location[0],self._location[1],
+            self._size[0],self._size[1])
+    @rect.setter
+    def rect(self,rect:Rect):
+        self._location=(rect[0],rect[1])
+        self._size=(rect[2],rect[3])
+        self._geometryChanged()
+
+    def _geometryChanged(self)->None:
+        """
+        Let everyone know the window has moved or been resized
+        """
+        for fn in self.onGeometryChangedCallbacks:
+            fn(self)
+
     @property
     def jsonObj(self)->JsonLike:
         """
         get/set this as a json object
         """
-        return {
+        ret={
             'name':self.name,
             'size':asJson(self.size),
             'location':asJson(self.location),
             'minimized':str(self.minimized),
             'maximized':str(self.maximized)
         }
+        if self.document is not None:
+            ret['document']=self.document
+        return ret
     @jsonObj.setter
     def jsonObj(self,jsonObj:JsonLike):
         """
         get/set this as a json object
         """
         self.name=jsonObj.get('name','')
-        self.size=tuple(jsonObj.get('size',(640,480)))
-        self.location=tuple(jsonObj.get('location',(0,0)))
+        self.document=jsonObj.get('document')
+        self._size=tuple(jsonObj.get('size',(640,480)))
+        self._location=tuple(jsonObj.get('location',(0,0)))
         self.minimized=yntf(jsonObj.get('minimized','t'))
         self.maximized=yntf(jsonObj.get('maximized','t'))
+        self._geometryChanged()
 
 
 class DisplayLayout(JsonBase):
@@ -54,7 +108,10 @@ class DisplayLayout(JsonBase):
         jsonObj:typing.Optional[JsonCompatible]=None):
         """ """
         self.name:str=''
-        self.windows:typing.Dict[str,WindowLayout]
+        self.windows:typing.Dict[str,WindowLayout]={}
+        self.spatialIndex=WindowSpatialIndex()
+        # callbacks attached to each window, so they can be detached again
+        self._geometryCallbacks:typing.Dict[str,GeometryChangedCallback]={}
         if jsonObj is not None:
             self.jsonObj=asJson(jsonObj)
 
@@ -73,9 +130,65 @@ class DisplayLayout(JsonBase):
         get/set this as a json object
         """
         self.name=jsonObj.get('name','')
-        self.windows={}
+        for k in list(self.windows.keys()):
+            self.removeWindow(k)
         for k,v in jsonObj.get('windows',{}).items():
-            self.windows[k]=MachineLayout(v)
+            self.addWindow(WindowLayout(v),k)
+
+    def addWindow(self,
+        window:WindowLayout,
+        name:typing.Optional[str]=None
+        )->None:
+        """
+        Add a window to this display
+
+        The spatial index will follow the window as it moves.
+        """
+        if name is None:
+            name=window.name
+        if name in self.windows:
+            self.removeWindow(name)
+        self.windows[name]=window
+        def onGeometryChanged(w:WindowLayout)->None:
+            self.spatialIndex.update(name,w.rect)
+        window.onGeometryChangedCallbacks.append(onGeometryChanged)
+        self._geometryCallbacks[name]=onGeometryChanged
+        self.spatialIndex.insert(name,window.rect)
+
+    def removeWindow(self,name:str)->typing.Optional[WindowLayout]:
+        """
+        Remove a window from this display
+
+        :return: the window that was removed (if any)
+        """
+        window=self.windows.pop(name,None)
+        if window is None:
+            return None
+        callback=self._geometryCallbacks.pop(name,None)
+        if callback in window.onGeometryChangedCallbacks:
+            window.onGeometryChangedCallbacks.remove(callback)
+        self.spatialIndex.remove(name)
+        return window
+
+    def windowsAt(self,x:int,y:int)->typing.List[WindowLayout]:
+        """
+        Get all windows on this display that contain the given point
+        """
+        return [self.windows[k] for k in self.spatialIndex.windowsAt(x,y)]
+
+    def windowsIntersecting(self,rect:Rect)->typing.List[WindowLayout]:
+        """
+        Get all windows on this display that overlap a rectangle
+        """
+        return [self.windows[k]
+            for k in self.spatialIndex.windowsIntersecting(rect)]
+
+    def findFreeSpace(self,size:Size,bounds:Rect)->typing.Optional[Point]:
+        """
+        Find a location within bounds where a window of the given size
+        will not overlap any other window on this display.
+        """
+        return self.spatialIndex.findFreeSpace(size,bounds)
 
 
 class DesktopLayout(JsonBase):
@@ -86,7 +199,7 @@ class DesktopLayout(JsonBase):
         jsonObj:typing.Optional[JsonCompatible]=None):
         """ """
         self.name:str=''
-        self.displays:typing.Dict[str,DisplayLayout]
+        self.displays:typing.Dict[str,DisplayLayout]={}
         if jsonObj is not None:
             self.jsonObj=asJson(jsonObj)
 
@@ -107,7 +220,47 @@ class DesktopLayout(JsonBase):
         self.name=jsonObj.get('name','')
         self.displays={}
         for k,v in jsonObj.get('displays',{}).items():
-            self.displays[k]=MachineLayout(v)
+            self.displays[k]=DisplayLayout(v)
+
+    def windowsAt(self,
+        x:int,y:int
+        )->typing.List[typing.Tuple[DisplayLayout,WindowLayout]]:
+        """
+        Get all (display,window) pairs that contain the given point
+        """
+        ret=[]
+        for display in self.displays.values():
+            ret.extend((display,w) for w in display.windowsAt(x,y))
+        return ret
+
+    def windowsIntersecting(self,
+        rect:Rect
+        )->typing.List[typing.Tuple[DisplayLayout,WindowLayout]]:
+        """
+        Get all (display,window) pairs that overlap a rectangle
+        """
+        ret=[]
+        for display in self.displays.values():
+            ret.extend((display,w) for w in display.windowsIntersecting(rect))
+        return ret
+
+    def findFreeSpace(self,
+        size:Size,
+        bounds:typing.Dict[str,Rect]
+        )->typing.Optional[typing.Tuple[DisplayLayout,Point]]:
+        """
+        Find the first display with room for a window of the given size
+
+        :bounds: the usable area of each display, by display name
+        """
+        for name,display in self.displays.items():
+            rect=bounds.get(name)
+            if rect is None:
+                continue
+            location=display.findFreeSpace(size,rect)
+            if location is not None:
+                return (display,location)
+        return None
 
 
 class MachineLayout(JsonBase):
@@ -134,19 +287,26 @@ class MachineLayout(JsonBase):
         """
         get/set this as a json object
         """
-        return {
+        ret={
             'name':self.name,
             'desktops':asJson(self.desktops)
         }
+        if isinstance(self.identity,MachineIdentity):
+            ret['identity']=self.identity.jsonObj
+        return ret
     @jsonObj.setter
     def jsonObj(self,jsonObj:JsonLike):
         """
         get/set this as a json object
         """
-        self.identity=jsonObj.get('name','')
+        identity=jsonObj.get('identity')
+        if identity is not None:
+            self.identity=MachineIdentity.fromJson(identity)
+        else:
+            self.identity=jsonObj.get('name','')
         self.desktops={}
         for k,v in jsonObj.get('desktops',{}).items():
-            self.desktops[k]=MachineLayout(v)
+            self.desktops[k]=DesktopLayout(v)
 
     def __repr__(self):
         return str(self.identity)
@@ -159,7 +319,7 @@ class ConfederatedAppLayout(JsonBase):
     def __init__(self,
         jsonObj:typing.Optional[JsonCompatible]=None):
         """ """
-        self.machines:typing.Dict[MachineIdentity,MachineLayout]
+        self.machines:typing.Dict[MachineIdentity,MachineLayout]={}
         if jsonObj is not None:
             self.jsonObj=asJson(jsonObj)
 
@@ -185,7 +345,9 @@ class ConfederatedAppLayout(JsonBase):
         get/set this as a json object
         """
         return {
-            'machines':asJson(self.machines)
+            'machines':{
+                getattr(identity,'fingerprint',identity):machine.jsonObj
+                for identity,machine in self.machines.items()}
         }
     @jsonObj.setter
     def jsonObj(self,jsonObj:JsonLike):
@@ -194,4 +356,8 @@ class ConfederatedAppLayout(JsonBase):
         """
         self.machines={}
         for k,v in jsonObj.get('machines',{}).items():
-            self.machines[k]=MachineLayout(v)
+            machine=MachineLayout(v)
+            identity=machine.identity
+            if not isinstance(identity,MachineIdentity):
+                identity=MachineIdentity.byFingerprint(k) or k
+            self.machines[identity]=machine
@@ -0,0 +1,244 @@
+"""
+A spatial index of window rectangles, so that hit-testing
+and overlap queries do not need to scan every window.
+
+Rectangles are bucketed into a uniform grid of cells.
+Windows that would cover too many cells (eg, maximized windows)
+are kept in a small "oversized" set that is always checked.
+"""
+import typing
+
+
+Rect=typing.Tuple[int,int,int,int] # x,y,w,h
+Point=typing.Tuple[int,int]
+Size=typing.Tuple[int,int]
+CellKey=typing.Tuple[int,int]
+
+
+def rectsIntersect(a:Rect,b:Rect)->bool:
+    """
+    Determine if two rectangles overlap
+    (touching edges do not count as overlapping)
+    """
+    return a[0]<b[0]+b[2] and b[0]<a[0]+a[2] \
+        and a[1]<b[1]+b[3] and b[1]<a[1]+a[3]
+
+
+def rectContains(rect:Rect,x:int,y:int)->bool:
+    """
+    Determine if a point is within a rectangle
+    """
+    return rect[0]<=x<rect[0]+rect[2] and rect[1]<=y<rect[1]+rect[3]
+
+
+class WindowSpatialIndex:
+    """
+    A spatial index of window rectangles, so that hit-testing
+    and overlap queries do not need to scan every window.
+
+    Items are referred to by name (the same key as
+    DisplayLayout.windows uses).
+    """
+    def __init__(self,cellSize:int=256,maxCellsPerItem:int=64):
+        """
+        :cellSize: size of a grid cell, in pixels
+        :maxCellsPerItem: items that would cover more cells than
+            this are kept in a list that is checked on every query
+        """
+        self.cellSize=cellSize
+        self.maxCellsPerItem=maxCellsPerItem
+        self._cells:typing.Dict[CellKey,typing.Set[str]]={}
+        self._rects:typing.Dict[str,Rect]={}
+        self._oversized:typing.Set[str]=set()
+
+    def __len__(self)->int:
+        return len(self._rects)
+
+    def __contains__(self,name:str)->bool:
+        return name in self._rects
+
+    def rect(self,name:str)->typing.Optional[Rect]:
+        """
+        Get the rectangle currently indexed for a name
+        """
+        return self._rects.get(name)
+
+    def _cellRange(self,rect:Rect
+        )->typing.Tuple[int,int,int,int]:
+        """
+        Get the inclusive (x0,y0,x1,y1) range of cells a rect covers
+        """
+        cs=self.cellSize
+        return (
+            rect[0]//cs,rect[1]//cs,
+            (rect[0]+max(rect[2],1)-1)//cs,
+            (rect[1]+max(rect[3],1)-1)//cs)
+
+    def _cellsFor(self,rect:Rect)->typing.Iterable[CellKey]:
+        x0,y0,x1,y1=self._cellRange(rect)
+        for cy in range(y0,y1+1):
+            for cx in range(x0,x1+1):
+                yield (cx,cy)
+
+    def _isOversized(self,rect:Rect)->bool:
+        x0,y0,x1,y1=self._cellRange(rect)
+        return (x1-x0+1)*(y1-y0+1)>self.maxCellsPerItem
+
+    def insert(self,name:str,rect:Rect)->None:
+        """
+        Add an item to the index
+        (if it is already there, it will be moved)
+        """
+        if name in self._rects:
+            self.remove(name)
+        rect=tuple(int(v) for v in rect)
+        self._rects[name]=rect
+        if self._isOversized(rect):
+            self._oversized.add(name)
+            return
+        for key in self._cellsFor(rect):
+            bucket=self._cells.get(key)
+            if bucket is None:
+                bucket=set()
+                self._cells[key]=bucket
+            bucket.add(name)
+    add=insert
+
+    def remove(self,name:str)->None:
+        """
+        Remove an item from the index
+        """
+        rect=self._rects.pop(name,None)
+        if rect is None:
+            return
+        if name in self._oversized:
+            self._oversized.discard(name)
+            return
+        for key in self._cellsFor(rect):
+            bucket=self._cells.get(key)
+            if bucket is not None:
+                bucket.discard(name)
+                if not bucket:
+                    del self._cells[key]
+
+    def update(self,name:str,rect:Rect)->None:
+        """
+        Call when an item has moved or been resized.
+
+        Only touches the cells that actually changed.
+        """
+        old=self._rects.get(name)
+        rect=tuple(int(v) for v in rect)
+        if old is None or name in self._oversized \
+            or self._isOversized(rect):
+            self.insert(name,rect)
+            return
+        oldCells=set(self._cellsFor(old))
+        newCells=set(self._cellsFor(rect))
+        for key in oldCells-newCells:
+            bucket=self._cells[key]
+            bucket.discard(name)
+            if not bucket:
+                del self._cells[key]
+        for key in newCells-oldCells:
+            bucket=self._cells.get(key)
+            if bucket is None:
+                bucket=set()
+                self._cells[key]=bucket
+            bucket.add(name)
+        self._rects[name]=rect
+    move=update
+
+    def clear(self)->None:
+        """
+        Remove everything from the index
+        """
+        self._cells.clear()
+        self._rects.clear()
+        self._oversized.clear()
+
+    def windowsAt(self,x:int,y:int)->typing.List[str]:
+        """
+        Get the names of all items that contain the given point
+        """
+        cs=self.cellSize
+        ret=[]
+        for name in self._cells.get((x//cs,y//cs),()):
+            if rectContains(self._rects[name],x,y):
+                ret.append(name)
+        for name in self._oversized:
+            if rectContains(self._rects[name],x,y):
+                ret.append(name)
+        return ret
+
+    def windowsIntersecting(self,rect:Rect)->typing.List[str]:
+        """
+        Get the names of all items that overlap the given rectangle
+        """
+        found:typing.Set[str]=set()
+        if self._isOversized(rect):
+            # cheaper to just check everything than walk all the cells
+            candidates:typing.Iterable[str]=self._rects.keys()
+        else:
+            candidates=set()
+            for key in self._cellsFor(rect):
+                bucket=self._cells.get(key)
+                if bucket:
+                    candidates.update(bucket)
+            candidates.update(self._oversized)
+        for name in candidates:
+            if rectsIntersect(self._rects[name],rect):
+                found.add(name)
+        return list(found)
+
+    def isFree(self,rect:Rect)->bool:
+        """
+        Determine if nothing in the index overlaps the given rectangle
+        """
+        if self._isOversized(rect):
+            return not self.windowsIntersecting(rect)
+        for key in self._cellsFor(rect):
+            for name in self._cells.get(key,()):
+                if rectsIntersect(self._rects[name],rect):
+                    return False
+        for name in self._oversized:
+            if rectsIntersect(self._rects[name],rect):
+                return False
+        return True
+
+    def findFreeSpace(self,
+        size:Size,
+        bounds:Rect
+        )->typing.Optional[Point]:
+        """
+        Find a location where a rectangle of the given size
+        can be placed within bounds without overlapping anything.
+
+        Any free spot can be slid up and left until it rests against
+        the bounds or an item, so the only locations that need trying
+        are where an x edge (the left of the bounds or the right of
+        an item) meets a y edge (the top of the bounds or the bottom
+        of an item).  These are tried top-to-bottom, left-to-right.
+        Items outside bounds are never looked at, but this tries
+        up to n*n locations for n items within bounds.
+
+        :return: the (x,y) location or None if there is no room
+        """
+        w,h=int(size[0]),int(size[1])
+        bx,by,bw,bh=bounds
+        if w>bw or h>bh:
+            return None
+        xs:typing.Set[int]={bx}
+        ys:typing.Set[int]={by}
+        for name in self.windowsIntersecting(bounds):
+            rx,ry,rw,rh=self._rects[name]
+            xs.add(rx+rw)
+            ys.add(ry+rh)
+        xs=sorted(x for x in xs if bx<=x and x+w<=bx+bw)
+        for y in sorted(ys):
+            if y<by or y+h>by+bh:
+                continue
+            for x in xs:
+                if self.isFree((x,y,w,h)):
+                    return (x,y)
+        return None